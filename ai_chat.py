@@ -1,8 +1,8 @@
 # ai_chat.py
 import json
 import logging
+import threading
 from typing import List, Dict, Any
-import google.generativeai as genai
 from config import GEMINI_API_KEY
 
 logger = logging.getLogger(__name__)
@@ -103,19 +103,33 @@ tools_config = {
 }
 
 class AIChatAssistant:
+    """Клиент Gemini создаётся при первом сообщении, а не при импорте модуля:
+    google.generativeai тяжёлый и не нужен для старта API."""
+
     def __init__(self, api_key: str = None):
         self.api_key = api_key or GEMINI_API_KEY
-        if not self.api_key:
-            logger.warning("GEMINI_API_KEY не найден. AI-чат не будет работать.")
-            self.model = None
+        self.model = None
+        self.chat = None
+        self._initialized = False
+        self._init_lock = threading.Lock()
+
+    def _ensure_model(self):
+        if self._initialized:
             return
-        
-        try:
-            genai.configure(api_key=self.api_key)
-            self.model = genai.GenerativeModel(
-                'gemini-3-flash-preview',
-                tools=[tools_config],
-                system_instruction="""
+        with self._init_lock:
+            if self._initialized:
+                return
+            self._initialized = True
+            if not self.api_key:
+                logger.warning("GEMINI_API_KEY не найден. AI-чат не будет работать.")
+                return
+            try:
+                import google.generativeai as genai
+                genai.configure(api_key=self.api_key)
+                self.model = genai.GenerativeModel(
+                    'gemini-3-flash-preview',
+                    tools=[tools_config],
+                    system_instruction="""
 Ты - AI-ассистент системы управления складом "Склад v4". 
 Твоя задача - помогать пользователям управлять складом, сметами и договорами через естественный язык.
 
@@ -131,14 +145,15 @@ class AIChatAssistant:
 Когда пользователь просит что-то сделать, используй соответствующую функцию.
 Если для создания договора или сметы не хватает данных (например, имени клиента), обязательно спроси об этом.
                 """
-            )
-            self.chat = self.model.start_chat()
-            logger.info("AI Chat initialized successfully")
-        except Exception as e:
-            logger.error(f"Failed to initialize AI Chat: {e}")
-            self.model = None
-    
+                )
+                self.chat = self.model.start_chat()
+                logger.info("AI Chat initialized successfully")
+            except Exception as e:
+                logger.error(f"Failed to initialize AI Chat: {e}")
+                self.model = None
+
     def process_message(self, message: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
+        self._ensure_model()
         if not self.model:
             return {"response": "AI-чат не настроен. Добавьте GEMINI_API_KEY в .env файл.", "function_calls": []}
         
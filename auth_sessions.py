@@ -0,0 +1,80 @@
+# auth_sessions.py
+"""Вход через внешний провайдер (Supabase) и локальные сессии с refresh-токенами.
+
+Supabase нужен только при входе по паролю. Дальше клиент продлевает короткий
+access-токен по refresh-токену, который хранится у нас (таблица AuthSession,
+только sha256 токена) — без обращения к Supabase.
+"""
+import hashlib
+import logging
+import secrets
+import threading
+from typing import Optional, Protocol
+
+logger = logging.getLogger(__name__)
+
+
+class AuthProviderError(Exception):
+    """Провайдер отклонил логин/пароль или вернул неожиданный ответ."""
+
+
+class AuthProvider(Protocol):
+    def sign_in(self, username: str, password: str) -> str:
+        """Проверяет логин и пароль, возвращает идентификатор пользователя (sub).
+        Вызов блокирующий — выполняется в пуле потоков."""
+        ...
+
+
+class SupabaseAuthProvider:
+    """Клиент Supabase создаётся при первом входе: SDK тяжёлый и для старта API не нужен."""
+
+    def __init__(self, url: str, key: str):
+        self.url = url
+        self.key = key
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from supabase import create_client
+                    try:
+                        self._client = create_client(self.url, self.key)
+                    except Exception as e:
+                        raise AuthProviderError(f"Клиент Supabase не инициализирован: {e}")
+        return self._client
+
+    def sign_in(self, username: str, password: str) -> str:
+        res = self.client.auth.sign_in_with_password({
+            "email": username,
+            "password": password
+        })
+        # Успешный ответ содержит объект session с access_token
+        if not (res and res.session and res.session.access_token):
+            logger.error(
+                f"Неожиданный ответ от Supabase при аутентификации: {res}")
+            raise AuthProviderError("Не удалось получить токен из ответа Supabase")
+
+        # Попробуем получить идентификатор пользователя из ответа Supabase
+        user_id = None
+        try:
+            # Некоторый SDK возвращает res.user или res.session.user
+            if getattr(res, 'user', None) and getattr(res.user, 'id', None):
+                user_id = res.user.id
+            elif getattr(res.session, 'user', None) and getattr(res.session.user, 'id', None):
+                user_id = res.session.user.id
+        except Exception:
+            user_id = None
+        # fallback: используем email как суб-идентификатор
+        return str(user_id) if user_id else username
+
+
+def new_refresh_token() -> str:
+    return secrets.token_urlsafe(48)
+
+
+def hash_refresh_token(token: Optional[str]) -> str:
+    # В БД храним только хэш: утечка таблицы не даёт действующих токенов
+    return hashlib.sha256((token or "").encode("utf-8")).hexdigest()
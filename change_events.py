@@ -0,0 +1,240 @@
+# change_events.py
+"""События изменений для потока /events (Server-Sent Events).
+
+События пишутся в таблицу ChangeEvent в той же транзакции, что и изменение
+(после flush любой ORM-сессии, см. _record_events), поэтому клиент получает только
+закоммиченные изменения и ничего не теряет при переподключении: id события —
+Last-Event-ID для возобновления. Типы событий:
+- product.stock — изменился остаток товара;
+- movement.created — создано движение товара;
+- movement.cancelled — движение отменено (публикуется эндпоинтом отмены, см. publish);
+- estimate.status / contract.status — новый документ или смена статуса.
+
+Таблица общая для всех экземпляров приложения: поток опрашивает её раз в
+EVENTS_POLL_SECONDS, а коммиты этого же процесса будят его сразу (change_notifier).
+События старше EVENTS_RETENTION_HOURS удаляются; клиенту с более старым
+Last-Event-ID отправляется событие reset — перечитать данные целиком.
+
+id события выдаётся при вставке, а видно оно после коммита, поэтому пропуск в id —
+ещё не закоммиченная (или откаченная) транзакция. Поток ждёт пропуск _GAP_WAIT_SECONDS,
+затем идёт дальше, но запоминает пропущенные диапазоны id и перечитывает их
+(id BETWEEN lo AND hi, не списком id) при каждом опросе: появившееся событие
+отправляется позже, а диапазон считается откаченным через _GAP_GIVE_UP_SECONDS.
+Диапазонов хранится не больше _MAX_GAP_RANGES — сверх того самый ранний считается
+откаченным. Пока есть незакрытые пропуски, в поле id сообщений уходит
+id перед самым ранним из них: после переподключения клиент получит пропущенное
+событие, а уже полученные события за ним — повторно, в прежнем порядке.
+"""
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import orjson
+from sqlalchemy import delete, event, func, insert, inspect, or_, select
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.orm import Session as OrmSession
+
+import config
+from main_models import ChangeEvent, Contract, Estimate, Product, StockMovement
+
+# Сколько ждать заполнения пропуска в id: событие с меньшим id может принадлежать
+# транзакции, которая ещё не закоммичена
+_GAP_WAIT_SECONDS = 5.0
+# Сколько перечитывать пропущенный id, прежде чем считать его транзакцию откаченной
+_GAP_GIVE_UP_SECONDS = 600.0
+# Сколько диапазонов пропусков перечитывает один поток
+_MAX_GAP_RANGES = 50
+# Не чаще одного удаления старых событий в минуту на процесс
+_PURGE_INTERVAL_SECONDS = 60.0
+_BATCH_SIZE = 500
+# Пауза перед переподключением клиента после обрыва, мс
+_RETRY_MS = 3000
+
+
+def _value(value: Any) -> Any:
+    return getattr(value, "value", value)
+
+
+def publish(session: OrmSession, event_type: str, payload: Dict[str, Any]):
+    """Событие, которое нельзя вывести из изменённых объектов; пишется при следующем flush."""
+    session.info.setdefault("change_events", []).append((event_type, payload))
+
+
+def _changed(obj, attribute: str) -> bool:
+    return inspect(obj).attrs[attribute].history.has_changes()
+
+
+def _collect(session: OrmSession) -> List[Tuple[str, Dict[str, Any]]]:
+    events = session.info.pop("change_events", [])
+    for obj in session.new:
+        if isinstance(obj, StockMovement):
+            events.append(("movement.created", {
+                "id": obj.id, "product_id": obj.product_id, "worker_id": obj.worker_id,
+                "type": _value(obj.type), "quantity": obj.quantity, "stock_after": obj.stock_after}))
+    for obj in (*session.new, *session.dirty):
+        if isinstance(obj, Product) and (obj in session.new or _changed(obj, "stock_quantity")):
+            events.append(("product.stock", {"id": obj.id, "stock_quantity": obj.stock_quantity}))
+        elif isinstance(obj, Estimate) and (obj in session.new or _changed(obj, "status")):
+            events.append(("estimate.status", {"id": obj.id, "status": _value(obj.status), "worker_id": obj.worker_id}))
+        elif isinstance(obj, Contract) and (obj in session.new or _changed(obj, "status")):
+            events.append(("contract.status", {"id": obj.id, "status": _value(obj.status)}))
+    return events
+
+
+_last_purge = 0.0
+
+
+@event.listens_for(OrmSession, "after_flush")
+def _record_events(session: OrmSession, flush_context):
+    global _last_purge
+    events = _collect(session)
+    if not events:
+        return
+    now = datetime.utcnow()
+    conn = session.connection()
+    conn.execute(insert(ChangeEvent), [
+        {"type": event_type, "payload": orjson.dumps(payload).decode("utf-8"), "created_at": now}
+        for event_type, payload in events])
+    if time.monotonic() - _last_purge > _PURGE_INTERVAL_SECONDS:
+        _last_purge = time.monotonic()
+        conn.execute(delete(ChangeEvent).where(
+            ChangeEvent.created_at < now - timedelta(hours=config.EVENTS_RETENTION_HOURS)))
+    session.info["change_events_written"] = True
+
+
+@event.listens_for(OrmSession, "after_commit")
+def _notify_on_commit(session: OrmSession):
+    if session.info.pop("change_events_written", False):
+        change_notifier.notify()
+
+
+@event.listens_for(OrmSession, "after_soft_rollback")
+def _forget_on_rollback(session: OrmSession, previous_transaction):
+    session.info.pop("change_events_written", None)
+    session.info.pop("change_events", None)
+
+
+class ChangeNotifier:
+    """Будит потоки /events этого процесса после коммита с событиями.
+    Коммиты выполняются в пуле потоков, потоки /events — в event loop."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+
+    def subscribe(self) -> Tuple[asyncio.AbstractEventLoop, asyncio.Event]:
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            self._waiters.add(waiter)
+        return waiter
+
+    def unsubscribe(self, waiter: Tuple[asyncio.AbstractEventLoop, asyncio.Event]):
+        with self._lock:
+            self._waiters.discard(waiter)
+
+    def notify(self):
+        with self._lock:
+            waiters = list(self._waiters)
+        for loop, wake in waiters:
+            try:
+                loop.call_soon_threadsafe(wake.set)
+            except RuntimeError:
+                # Event loop уже закрыт
+                self.unsubscribe((loop, wake))
+
+
+def format_sse(event_id: Optional[int], event_type: str, data: str) -> str:
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event_type}")
+    lines.append(f"data: {data}")
+    return "\n".join(lines) + "\n\n"
+
+
+async def _read_after(async_engine: AsyncEngine, after_id: int):
+    async with async_engine.connect() as conn:
+        return (await conn.execute(
+            select(ChangeEvent.id, ChangeEvent.type, ChangeEvent.payload, ChangeEvent.created_at)
+            .where(ChangeEvent.id > after_id).order_by(ChangeEvent.id).limit(_BATCH_SIZE))).all()
+
+
+async def _read_ranges(async_engine: AsyncEngine, ranges: Dict[int, Tuple[int, float]]):
+    async with async_engine.connect() as conn:
+        return (await conn.execute(
+            select(ChangeEvent.id, ChangeEvent.type, ChangeEvent.payload)
+            .where(or_(*(ChangeEvent.id.between(lo, hi) for lo, (hi, _) in sorted(ranges.items()))))
+            .order_by(ChangeEvent.id).limit(_BATCH_SIZE))).all()
+
+
+async def _id_bounds(async_engine: AsyncEngine) -> Tuple[Optional[int], Optional[int]]:
+    async with async_engine.connect() as conn:
+        row = (await conn.execute(select(func.min(ChangeEvent.id), func.max(ChangeEvent.id)))).one()
+    return row[0], row[1]
+
+
+async def event_stream(async_engine: AsyncEngine, last_event_id: Optional[int],
+                       is_disconnected: Callable[[], Awaitable[bool]]) -> AsyncIterator[str]:
+    """Сообщения SSE начиная с события после last_event_id (без него — только новые события)."""
+    oldest, newest = await _id_bounds(async_engine)
+    if last_event_id is None:
+        last_id = newest or 0
+    else:
+        last_id = last_event_id
+        if oldest is not None and last_event_id < oldest - 1:
+            # Нужные события уже удалены: клиент перечитывает данные и продолжает с текущего места
+            last_id = newest or 0
+            yield format_sse(last_id, "reset", "{}")
+    yield f"retry: {_RETRY_MS}\n\n"
+
+    # Пропущенные диапазоны: первый id -> (последний id, когда перестать ждать по time.monotonic)
+    gaps: Dict[int, Tuple[int, float]] = {}
+
+    def resume_id() -> int:
+        return min(gaps) - 1 if gaps else last_id
+
+    waiter = change_notifier.subscribe()
+    wake = waiter[1]
+    last_sent = time.monotonic()
+    try:
+        while not await is_disconnected():
+            wake.clear()
+            if gaps:
+                for lo in [lo for lo, (_, deadline) in gaps.items() if deadline < time.monotonic()]:
+                    del gaps[lo]
+                for event_id, event_type, payload in await _read_ranges(async_engine, gaps) if gaps else ():
+                    # Транзакция с меньшим id закоммитилась позже соседних: диапазон делится на две части
+                    lo = next(lo for lo, (hi, _) in gaps.items() if lo <= event_id <= hi)
+                    hi, deadline = gaps.pop(lo)
+                    if lo < event_id:
+                        gaps[lo] = (event_id - 1, deadline)
+                    if event_id < hi:
+                        gaps[event_id + 1] = (hi, deadline)
+                    last_sent = time.monotonic()
+                    yield format_sse(resume_id(), event_type, payload)
+            for event_id, event_type, payload, created_at in await _read_after(async_engine, last_id):
+                if event_id != last_id + 1:
+                    if created_at > datetime.utcnow() - timedelta(seconds=_GAP_WAIT_SECONDS):
+                        # Пропуск в id: ждём, пока закоммитится более ранняя транзакция
+                        break
+                    gaps[last_id + 1] = (event_id - 1, time.monotonic() + _GAP_GIVE_UP_SECONDS)
+                    if len(gaps) > _MAX_GAP_RANGES:
+                        del gaps[min(gaps)]
+                last_id = event_id
+                last_sent = time.monotonic()
+                yield format_sse(resume_id(), event_type, payload)
+            if time.monotonic() - last_sent >= config.EVENTS_HEARTBEAT_SECONDS:
+                last_sent = time.monotonic()
+                yield ": ping\n\n"
+            try:
+                await asyncio.wait_for(wake.wait(), timeout=config.EVENTS_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        change_notifier.unsubscribe(waiter)
+
+
+# Глобальный notifier потоков /events этого процесса
+change_notifier = ChangeNotifier()
@@ -1,5 +1,6 @@
 # config.py
 import os
+import tempfile
 from dotenv import load_dotenv
 
 # Загружаем переменные из .env файла
@@ -17,12 +18,73 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("Необходимо установить переменную окружения DATABASE_URL")
 
+# URL для асинхронного движка (asyncpg / aiosqlite). Если не задан — выводится из DATABASE_URL
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL")
+
+# Применять миграции схемы при старте приложения. По умолчанию старт только проверяет версию,
+# а миграции запускаются отдельно: python migrations.py upgrade
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "false").lower() in ("1", "true", "yes")
+
+# Пул соединений с БД (для PostgreSQL; у SQLite свой пул).
+# Размер пула и переполнение подбираются по /admin/db-pool под нагрузочным тестом.
+try:
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+except ValueError:
+    DB_POOL_SIZE = 5
+try:
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+except ValueError:
+    DB_MAX_OVERFLOW = 10
+# Сколько секунд запрос ждёт свободное соединение, прежде чем получить ошибку
+try:
+    DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+except ValueError:
+    DB_POOL_TIMEOUT = 30.0
+# Соединения старше этого числа секунд переоткрываются (сервер/пулер закрывает простаивающие)
+try:
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+except ValueError:
+    DB_POOL_RECYCLE = 1800
+# Проверять соединение перед выдачей из пула (защита от разорванных после простоя соединений)
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# Подключение через pgbouncer в режиме транзакций (Supabase pooler, порт 6543):
+# отключает кэш подготовленных выражений asyncpg
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "false").lower() in ("1", "true", "yes")
+# Не держать собственный пул вовсе — соединения открываются на запрос и пулятся внешним пулером
+DB_NULL_POOL = os.getenv("DB_NULL_POOL", "false").lower() in ("1", "true", "yes")
+
+# Прогрев после старта (пулы, шаблоны, каталог, ленивые импорты). Пока он идёт, /health/ready отвечает 503.
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+# Сколько соединений открыть в каждом пуле БД при прогреве
+try:
+    DB_POOL_WARM_CONNECTIONS = int(os.getenv("DB_POOL_WARM_CONNECTIONS", "2"))
+except ValueError:
+    DB_POOL_WARM_CONNECTIONS = 2
+
 SECRET_KEY = os.getenv("SECRET_KEY")
 if not SECRET_KEY or SECRET_KEY == "e8a3a9a8d2b9f0c1a2b3c4d5e6f7a8b9c0d1e2f3a4b5c6d7e8f9a0b1c2d3e4f5":
     raise ValueError("Критическая ошибка: SECRET_KEY не установлен или используется значение по умолчанию.")
 
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 дней
+# Access-токен короткий, продлевается по refresh-токену (POST /token/refresh)
+try:
+    ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60"))
+except ValueError:
+    ACCESS_TOKEN_EXPIRE_MINUTES = 60
+try:
+    REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
+except ValueError:
+    REFRESH_TOKEN_EXPIRE_DAYS = 30
+# Сколько секунд ждать ответа Supabase при входе по паролю
+try:
+    AUTH_PROVIDER_TIMEOUT = float(os.getenv("AUTH_PROVIDER_TIMEOUT", "10"))
+except ValueError:
+    AUTH_PROVIDER_TIMEOUT = 10.0
+# Сколько проверенных токенов держать в памяти (0 — не кэшировать)
+try:
+    TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "1024"))
+except ValueError:
+    TOKEN_CACHE_SIZE = 1024
 
 # Загружаем CORS origins и преобразуем в список
 cors_origins_str = os.getenv("CORS_ORIGINS", "http://localhost:3000,http://127.0.0.1:3000,https://sklad-v4.vercel.app")
@@ -36,4 +98,125 @@ except ValueError:
     MIN_WELL_COST = 75000.0
 
 # Gemini API key для AI-чата (опционально)
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
\ No newline at end of file
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+
+# Каталог с шаблонами .docx (КП, договоры)
+TEMPLATES_DIR = os.getenv("TEMPLATES_DIR", "templates")
+
+# Дисковый LRU-кэш отрендеренных документов (.docx). 0 — кэш отключён.
+DOCUMENT_CACHE_DIR = os.getenv("DOCUMENT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "sklad_documents"))
+try:
+    DOCUMENT_CACHE_MAX_MB = float(os.getenv("DOCUMENT_CACHE_MAX_MB", "200"))
+except ValueError:
+    DOCUMENT_CACHE_MAX_MB = 200.0
+
+# Пулы для работы вне event loop: потоки — блокирующий ввод-вывод и синхронная сессия БД,
+# процессы — CPU-тяжёлые задачи (разбор Excel, нечёткий поиск, рендер .docx).
+# CPU_POOL_PROCESSES = 0 — CPU-задачи выполняются в пуле потоков.
+try:
+    IO_POOL_THREADS = int(os.getenv("IO_POOL_THREADS", "8"))
+except ValueError:
+    IO_POOL_THREADS = 8
+try:
+    CPU_POOL_PROCESSES = int(os.getenv("CPU_POOL_PROCESSES", "2"))
+except ValueError:
+    CPU_POOL_PROCESSES = 2
+
+# Пакетная генерация документов: сколько документов всех архивов процесса рендерится
+# одновременно и лимит документов в одном архиве. Лимит меньше пула: пакеты оставляют
+# хотя бы один процесс (поток при CPU_POOL_PROCESSES = 0) импорту, прогнозу и одиночным
+# документам, поэтому пулу нужно не меньше двух исполнителей.
+_CPU_POOL_WORKERS = CPU_POOL_PROCESSES if CPU_POOL_PROCESSES > 0 else IO_POOL_THREADS
+if _CPU_POOL_WORKERS < 2:
+    raise ValueError(
+        "CPU_POOL_PROCESSES должно быть не меньше 2 (или 0 при IO_POOL_THREADS не меньше 2): "
+        "пакетам документов нужен пул хотя бы из двух исполнителей")
+DOCX_RENDER_PROCESSES_MAX = _CPU_POOL_WORKERS - 1
+try:
+    DOCX_RENDER_PROCESSES = int(os.getenv("DOCX_RENDER_PROCESSES", str(DOCX_RENDER_PROCESSES_MAX)))
+except ValueError:
+    DOCX_RENDER_PROCESSES = DOCX_RENDER_PROCESSES_MAX
+if not 1 <= DOCX_RENDER_PROCESSES <= DOCX_RENDER_PROCESSES_MAX:
+    raise ValueError(
+        f"DOCX_RENDER_PROCESSES должно быть от 1 до {DOCX_RENDER_PROCESSES_MAX} (размер пула - 1)")
+try:
+    DOCX_BATCH_MAX_DOCUMENTS = int(os.getenv("DOCX_BATCH_MAX_DOCUMENTS", "500"))
+except ValueError:
+    DOCX_BATCH_MAX_DOCUMENTS = 500
+
+# Сжатие ответов (gzip/Brotli по Accept-Encoding). Ответы меньше порога не сжимаются.
+try:
+    COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+except ValueError:
+    COMPRESSION_MIN_SIZE = 1024
+try:
+    GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+except ValueError:
+    GZIP_LEVEL = 6
+try:
+    BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+except ValueError:
+    BROTLI_QUALITY = 5
+
+# Ключи идемпотентности (заголовок Idempotency-Key): сколько часов хранится ответ,
+# сколько секунд повтор ждёт завершения исходного запроса и через сколько секунд
+# незавершённый запрос (упавший экземпляр) считается брошенным и ключ перехватывает повтор
+try:
+    IDEMPOTENCY_TTL_HOURS = float(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+except ValueError:
+    IDEMPOTENCY_TTL_HOURS = 24.0
+try:
+    IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "30"))
+except ValueError:
+    IDEMPOTENCY_WAIT_SECONDS = 30.0
+try:
+    IDEMPOTENCY_LOCK_SECONDS = float(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "120"))
+except ValueError:
+    IDEMPOTENCY_LOCK_SECONDS = 120.0
+
+# Поток событий /events (SSE): как часто проверять новые события, интервал пустых
+# keep-alive сообщений и сколько часов события хранятся для возобновления по Last-Event-ID
+try:
+    EVENTS_POLL_SECONDS = float(os.getenv("EVENTS_POLL_SECONDS", "1"))
+except ValueError:
+    EVENTS_POLL_SECONDS = 1.0
+try:
+    EVENTS_HEARTBEAT_SECONDS = float(os.getenv("EVENTS_HEARTBEAT_SECONDS", "15"))
+except ValueError:
+    EVENTS_HEARTBEAT_SECONDS = 15.0
+try:
+    EVENTS_RETENTION_HOURS = float(os.getenv("EVENTS_RETENTION_HOURS", "24"))
+except ValueError:
+    EVENTS_RETENTION_HOURS = 24.0
+
+# Прогноз расхода товаров (forecasting.py): период пересчёта в минутах (0 — не пересчитывать
+# в приложении, только командой), срок поставки и на сколько дней расхода рассчитан закуп
+try:
+    FORECAST_INTERVAL_MINUTES = float(os.getenv("FORECAST_INTERVAL_MINUTES", "60"))
+except ValueError:
+    FORECAST_INTERVAL_MINUTES = 60.0
+try:
+    FORECAST_LEAD_TIME_DAYS = float(os.getenv("FORECAST_LEAD_TIME_DAYS", "7"))
+except ValueError:
+    FORECAST_LEAD_TIME_DAYS = 7.0
+try:
+    FORECAST_COVER_DAYS = float(os.getenv("FORECAST_COVER_DAYS", "30"))
+except ValueError:
+    FORECAST_COVER_DAYS = 30.0
+# Движение за разрывом в id учитывается, только когда оно старше FORECAST_SETTLE_MINUTES:
+# id выдаётся при вставке, и пропущенный id может принадлежать ещё не закоммиченной транзакции
+try:
+    FORECAST_SETTLE_MINUTES = float(os.getenv("FORECAST_SETTLE_MINUTES", "15"))
+except ValueError:
+    FORECAST_SETTLE_MINUTES = 15.0
+try:
+    FORECAST_CHUNK_ROWS = int(os.getenv("FORECAST_CHUNK_ROWS", "50000"))
+except ValueError:
+    FORECAST_CHUNK_ROWS = 50000
+
+# Сверка остатков с журналом движений (stock_reconciliation.py): сколько движений
+# читается и обрабатывается за один проход
+try:
+    RECONCILE_CHUNK_ROWS = int(os.getenv("RECONCILE_CHUNK_ROWS", "50000"))
+except ValueError:
+    RECONCILE_CHUNK_ROWS = 50000
@@ -0,0 +1,197 @@
+# db_pool.py
+"""Создание движков БД с настраиваемым пулом соединений и метриками пула.
+
+Параметры пула берутся из config (DB_POOL_*). Режим DB_PGBOUNCER рассчитан на пулер
+в режиме транзакций (pgbouncer у Supabase): отключает кэш подготовленных выражений
+asyncpg, которые не переживают смену серверного соединения между транзакциями.
+
+Пул каждого движка считает время ожидания соединения (гистограмма), таймауты,
+пик занятых соединений и соединения, отброшенные pre-ping. Статистика — pool_stats().
+"""
+import bisect
+import threading
+import time
+import uuid
+from typing import Any, Dict
+
+from sqlalchemy import event, exc as sa_exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+from sqlmodel import create_engine
+
+import config
+
+# Верхние границы корзин гистограммы ожидания соединения, мс
+WAIT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class PoolMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.wait_counts = [0] * (len(WAIT_BUCKETS_MS) + 1)
+        self.wait_total_ms = 0.0
+        self.wait_max_ms = 0.0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.connects = 0
+        self.invalidated = 0
+        self.peak_checked_out = 0
+
+    def observe_wait(self, seconds: float):
+        ms = seconds * 1000
+        with self._lock:
+            self.wait_counts[bisect.bisect_left(WAIT_BUCKETS_MS, ms)] += 1
+            self.wait_total_ms += ms
+            self.wait_max_ms = max(self.wait_max_ms, ms)
+            self.checkouts += 1
+
+    def increment(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def observe_checked_out(self, checked_out: int):
+        with self._lock:
+            self.peak_checked_out = max(self.peak_checked_out, checked_out)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            histogram = [{"le_ms": le, "count": n}
+                         for le, n in zip(WAIT_BUCKETS_MS, self.wait_counts)]
+            histogram.append({"le_ms": None, "count": self.wait_counts[-1]})
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "connects": self.connects,
+                "invalidated": self.invalidated,
+                "peak_checked_out": self.peak_checked_out,
+                "wait_avg_ms": round(self.wait_total_ms / self.checkouts, 3) if self.checkouts else 0.0,
+                "wait_max_ms": round(self.wait_max_ms, 3),
+                "wait_histogram": histogram,
+            }
+
+
+class _TimedPoolMixin:
+    """Замеряет, сколько запрос ждал соединение из пула (включая открытие нового)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def recreate(self):
+        # engine.dispose() пересоздаёт пул — метрики сохраняем
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except sa_exc.TimeoutError:
+            self.metrics.increment("timeouts")
+            raise
+        self.metrics.observe_wait(time.perf_counter() - started)
+        return conn
+
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def async_database_url(url: str) -> str:
+    """Подбирает асинхронный драйвер для URL синхронного движка."""
+    for prefix in ("postgresql+psycopg2://", "postgresql://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix):]
+    if url.startswith("sqlite://"):
+        return "sqlite+aiosqlite://" + url[len("sqlite://"):]
+    return url
+
+
+def _pool_kwargs(url: str, is_async: bool) -> Dict[str, Any]:
+    if url.startswith("sqlite"):
+        # У SQLite свой пул (одно соединение на поток/файл), настройки пула к нему не относятся
+        return {}
+    if config.DB_NULL_POOL:
+        # Пулингом целиком занимается внешний пулер (pgbouncer)
+        return {"poolclass": NullPool}
+    return {
+        "poolclass": TimedAsyncAdaptedQueuePool if is_async else TimedQueuePool,
+        "pool_size": config.DB_POOL_SIZE,
+        "max_overflow": config.DB_MAX_OVERFLOW,
+        "pool_timeout": config.DB_POOL_TIMEOUT,
+        "pool_recycle": config.DB_POOL_RECYCLE,
+        "pool_pre_ping": config.DB_POOL_PRE_PING,
+    }
+
+
+def _connect_args(url: str, is_async: bool) -> Dict[str, Any]:
+    if config.DB_PGBOUNCER and is_async and url.startswith("postgresql+asyncpg"):
+        # Подготовленные выражения живут в серверном соединении, а pgbouncer в режиме
+        # транзакций отдаёт каждой транзакции любое из них — кэши отключаем, имена делаем уникальными
+        return {
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid.uuid4()}__",
+        }
+    return {}
+
+
+def _instrument(engine: Engine):
+    # Пул берём в момент события: после dispose() у движка уже другой объект пула
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        metrics = getattr(engine.pool, "metrics", None)
+        if metrics is not None:
+            metrics.increment("connects")
+
+    @event.listens_for(engine, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics = getattr(engine.pool, "metrics", None)
+        if metrics is not None and hasattr(engine.pool, "checkedout"):
+            metrics.observe_checked_out(engine.pool.checkedout())
+
+    @event.listens_for(engine, "invalidate")
+    def _on_invalidate(dbapi_connection, connection_record, exception):
+        # В том числе соединения, отброшенные pre-ping после простоя
+        metrics = getattr(engine.pool, "metrics", None)
+        if metrics is not None:
+            metrics.increment("invalidated")
+
+
+def create_pooled_engine(url: str) -> Engine:
+    engine = create_engine(url, connect_args=_connect_args(url, False), **_pool_kwargs(url, False))
+    _instrument(engine)
+    return engine
+
+
+def create_pooled_async_engine(url: str) -> AsyncEngine:
+    engine = create_async_engine(url, connect_args=_connect_args(url, True), **_pool_kwargs(url, True))
+    _instrument(engine.sync_engine)
+    return engine
+
+
+def pool_stats(engine) -> Dict[str, Any]:
+    """Текущее состояние пула движка (синхронного или асинхронного) и накопленные метрики."""
+    if isinstance(engine, AsyncEngine):
+        engine = engine.sync_engine
+    pool = engine.pool
+    stats: Dict[str, Any] = {"pool": type(pool).__name__, "status": pool.status()}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "max_overflow": pool._max_overflow,
+            "timeout": pool.timeout(),
+        })
+    metrics = getattr(pool, "metrics", None)
+    if metrics is not None:
+        stats.update(metrics.snapshot())
+    return stats
@@ -0,0 +1,145 @@
+# document_cache.py
+"""Дисковый LRU-кэш отрендеренных документов (.docx).
+
+Ключ — хэш от версии шаблона и контекста рендера, поэтому любое изменение договора,
+позиций сметы или самого шаблона автоматически даёт новый ключ. Старые записи
+вытесняются по давности использования, когда суммарный размер превышает лимит.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from config import DOCUMENT_CACHE_DIR, DOCUMENT_CACHE_MAX_MB
+
+logger = logging.getLogger(__name__)
+
+
+def make_document_key(template_version: str, context: Dict[str, Any]) -> str:
+    """Стабильный ключ документа: sha256(версия шаблона + контекст в каноническом JSON)."""
+    payload = json.dumps(context, sort_keys=True, ensure_ascii=False, default=str)
+    digest = hashlib.sha256()
+    digest.update(template_version.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(payload.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class DocumentCache:
+    """LRU-кэш файлов в каталоге с ограничением по суммарному размеру."""
+
+    SUFFIX = ".docx"
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._index: "OrderedDict[str, int]" = OrderedDict()  # key -> размер, от старых к новым
+        self._size = 0
+        self._lock = threading.Lock()
+        self._load_index()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def _load_index(self):
+        # Восстанавливаем индекс после рестарта: порядок — по времени последнего доступа
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(self.SUFFIX):
+                    continue
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, name[:-len(self.SUFFIX)], st.st_size))
+        except OSError as e:
+            logger.error(f"Кэш документов недоступен ({self.directory}): {e}")
+            return
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._size += size
+        self._evict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+        try:
+            with open(self._path(key), 'rb') as f:
+                content = f.read()
+            os.utime(self._path(key))
+        except OSError:
+            # Файл удалили снаружи — забываем запись
+            with self._lock:
+                self._size -= self._index.pop(key, 0)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return content
+
+    def put(self, key: str, content: bytes):
+        if len(content) > self.max_bytes:
+            return
+        tmp_path = os.path.join(self.directory, f".{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить документ в кэш: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            self._size -= self._index.pop(key, 0)
+            self._index[key] = len(content)
+            self._size += len(content)
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._index):
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            self._index.clear()
+            self._size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._index),
+                "size_bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+# Глобальный кэш для использования в эндпоинтах
+document_cache = DocumentCache(DOCUMENT_CACHE_DIR, int(DOCUMENT_CACHE_MAX_MB * 1024 * 1024))
@@ -0,0 +1,62 @@
+# docx_render.py
+"""Рендер .docx через docxtpl с заранее скомпилированными Jinja-шаблонами.
+
+Вынесено из docx_templates, чтобы docxtpl (и lxml/python-docx) загружались
+только в процессах, которые рендерят документы.
+"""
+import io
+import re
+
+from docxtpl import DocxTemplate
+from jinja2 import Template
+
+
+def prepare_part_xml(src_xml: str) -> str:
+    # То же преобразование, что делает DocxTemplate.render_xml_part перед компиляцией
+    return re.sub(r"<w:p([ >])", r"\n<w:p\1", src_xml)
+
+
+class CompiledDocxTemplate(DocxTemplate):
+    """DocxTemplate, который берёт документ из памяти и использует заранее
+    скомпилированные Jinja-шаблоны частей документа (тело, колонтитулы)."""
+
+    def __init__(self, entry):
+        # entry — docx_templates._TemplateEntry: байты шаблона и скомпилированные части
+        super().__init__(io.BytesIO(entry.blob))
+        self._entry = entry
+
+    def build_xml(self, context, jinja_env=None):
+        if jinja_env is not None:
+            return super().build_xml(context, jinja_env)
+        self.current_rendering_part = self.docx._part
+        return self._render_compiled(self._entry.body_template, context)
+
+    def render_xml_part(self, src_xml, part, context, jinja_env=None):
+        if jinja_env is not None:
+            return super().render_xml_part(src_xml, part, context, jinja_env)
+        self.current_rendering_part = part
+        return self._render_compiled(self._entry.compile_part(src_xml), context)
+
+    def _render_compiled(self, template: Template, context) -> str:
+        dst_xml = template.render(context)
+        dst_xml = re.sub(r"\n<w:p([ >])", r"<w:p\1", dst_xml)
+        dst_xml = (
+            dst_xml.replace("{_{", "{{")
+            .replace("}_}", "}}")
+            .replace("{_%", "{%")
+            .replace("%_}", "%}")
+        )
+        return self.resolve_listing(dst_xml)
+
+
+def compile_part_xml(src_xml: str) -> Template:
+    """Компилирует уже подготовленный (prepare_part_xml) XML части документа."""
+    return Template(src_xml)
+
+
+def compile_body(blob: bytes) -> Template:
+    """Разбирает тело документа из байтов .docx и компилирует его в Jinja-шаблон."""
+    probe = DocxTemplate(io.BytesIO(blob))
+    probe.init_docx()
+    body_xml = probe.patch_xml(probe.get_xml())
+    return Template(prepare_part_xml(body_xml))
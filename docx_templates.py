@@ -0,0 +1,130 @@
+# docx_templates.py
+"""Реестр шаблонов .docx (КП, договоры).
+
+Каждый шаблон читается с диска один раз: байты файла держим в памяти, а XML тела
+документа заранее "чистим" (patch_xml) и компилируем в Jinja-шаблон. При изменении
+mtime файла шаблон перечитывается. Рендер выполняется целиком в памяти (BytesIO),
+без временных файлов.
+
+Версия шаблона (ключ кэша документов) считается по байтам файла, а docxtpl
+загружается (docx_render) только там, где шаблон действительно рендерится, —
+обычно это процессы пула, а не основной процесс API.
+"""
+import hashlib
+import io
+import logging
+import os
+import threading
+from typing import Any, Dict, List
+
+from config import TEMPLATES_DIR
+
+logger = logging.getLogger(__name__)
+
+DOCX_MEDIA_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+
+class _TemplateEntry:
+    """Загруженный шаблон: байты файла, mtime и скомпилированные части."""
+
+    def __init__(self, path: str, blob: bytes, mtime: float):
+        self.path = path
+        self.blob = blob
+        self.mtime = mtime
+        self.version = hashlib.sha1(blob).hexdigest()
+        self._body_template = None
+        self._parts: Dict[str, Any] = {}
+        self._parts_lock = threading.Lock()
+
+    @property
+    def body_template(self):
+        # Тело документа разбирается и компилируется один раз, при первом рендере
+        if self._body_template is None:
+            with self._parts_lock:
+                if self._body_template is None:
+                    from docx_render import compile_body
+                    self._body_template = compile_body(self.blob)
+        return self._body_template
+
+    def compile_part(self, src_xml: str):
+        from docx_render import compile_part_xml, prepare_part_xml
+        src_xml = prepare_part_xml(src_xml)
+        key = hashlib.sha1(src_xml.encode('utf-8')).hexdigest()
+        template = self._parts.get(key)
+        if template is None:
+            with self._parts_lock:
+                template = self._parts.get(key)
+                if template is None:
+                    template = compile_part_xml(src_xml)
+                    self._parts[key] = template
+        return template
+
+    def render(self, context: Dict[str, Any]) -> bytes:
+        from docx_render import CompiledDocxTemplate
+        doc = CompiledDocxTemplate(self)
+        doc.render(context)
+        buf = io.BytesIO()
+        doc.save(buf)
+        return buf.getvalue()
+
+
+class TemplateRegistry:
+    """Кэш шаблонов из каталога templates/ с перезагрузкой по mtime."""
+
+    def __init__(self, directory: str = "templates"):
+        self.directory = directory
+        self._entries: Dict[str, _TemplateEntry] = {}
+        self._lock = threading.Lock()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self.path(name))
+
+    def get(self, name: str) -> _TemplateEntry:
+        """Возвращает загруженный шаблон, перечитывая его, если файл изменился.
+        Бросает FileNotFoundError, если шаблона нет."""
+        path = self.path(name)
+        mtime = os.stat(path).st_mtime
+        entry = self._entries.get(name)
+        if entry is not None and entry.mtime == mtime:
+            return entry
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry.mtime != mtime:
+                with open(path, 'rb') as f:
+                    blob = f.read()
+                entry = _TemplateEntry(path, blob, mtime)
+                self._entries[name] = entry
+                logger.info(f"Шаблон '{name}' загружен (версия {entry.version[:8]})")
+        return entry
+
+    def render(self, name: str, context: Dict[str, Any]) -> bytes:
+        """Рендерит шаблон в память и возвращает содержимое .docx."""
+        return self.get(name).render(context)
+
+    def preload(self) -> List[str]:
+        """Загружает все .docx из каталога шаблонов. Возвращает имена загруженных."""
+        loaded = []
+        if not os.path.isdir(self.directory):
+            return loaded
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.docx'):
+                continue
+            try:
+                self.get(name)
+                loaded.append(name)
+            except Exception as e:
+                logger.error(f"Не удалось загрузить шаблон '{name}': {e}")
+        return loaded
+
+
+# Глобальный реестр для использования в эндпоинтах
+template_registry = TemplateRegistry(TEMPLATES_DIR)
+
+
+def render_template_job(name: str, context: Dict[str, Any]) -> bytes:
+    """Задача для пула процессов: у каждого процесса свой реестр шаблонов."""
+    return template_registry.render(name, context)
+
@@ -0,0 +1,95 @@
+# estimate_totals.py
+"""Денормализованные итоги смет: total_retail, total_purchase, item_count.
+
+Итоги пересчитываются одним UPDATE с коррелированными подзапросами после flush
+любой ORM-сессии, в которой менялись строки смет (EstimateItem) или закупочная
+цена товара, — в той же транзакции. Поэтому их поддерживают все пути записи:
+эндпоинты смет, довыдача, импорт.
+
+Полный пересчёт (после ручных правок в БД или восстановления бэкапа):
+
+    python estimate_totals.py rebuild
+"""
+import logging
+import sys
+from typing import Iterable, Optional
+
+from sqlalchemy import and_, event, func, inspect, select, update
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session as OrmSession
+
+from main_models import Estimate, EstimateItem, Product
+
+logger = logging.getLogger(__name__)
+
+TOTAL_FIELDS = ("total_retail", "total_purchase", "item_count")
+
+
+def _totals_update(estimate_ids: Optional[Iterable[int]] = None):
+    retail = select(func.coalesce(func.sum(EstimateItem.quantity * EstimateItem.unit_price), 0.0)).where(
+        EstimateItem.estimate_id == Estimate.id).scalar_subquery()
+    purchase = select(func.coalesce(func.sum(EstimateItem.quantity * Product.purchase_price), 0.0)).where(
+        and_(EstimateItem.estimate_id == Estimate.id, EstimateItem.product_id == Product.id)).scalar_subquery()
+    count = select(func.count(EstimateItem.id)).where(
+        EstimateItem.estimate_id == Estimate.id).scalar_subquery()
+    stmt = update(Estimate).values(total_retail=retail, total_purchase=purchase, item_count=count)
+    if estimate_ids is not None:
+        stmt = stmt.where(Estimate.id.in_(sorted(estimate_ids)))
+    return stmt.execution_options(synchronize_session=False)
+
+
+def refresh_totals(conn: Connection, estimate_ids: Optional[Iterable[int]] = None) -> int:
+    """Пересчитывает итоги указанных смет (None — всех). Возвращает число обновлённых смет."""
+    return conn.execute(_totals_update(estimate_ids)).rowcount
+
+
+def _estimates_with_products(conn: Connection, product_ids: Iterable[int]) -> set:
+    return set(conn.execute(select(EstimateItem.estimate_id).where(
+        EstimateItem.product_id.in_(list(product_ids))).distinct()).scalars())
+
+
+@event.listens_for(OrmSession, "after_flush")
+def _refresh_after_flush(session: OrmSession, flush_context):
+    estimate_ids, product_ids = set(), set()
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, EstimateItem):
+            estimate_ids.add(obj.estimate_id)
+            # Строку перенесли в другую смету — пересчитать и старую
+            history = inspect(obj).attrs.estimate_id.history
+            estimate_ids.update(history.deleted or ())
+        elif isinstance(obj, Product) and obj not in session.new:
+            if inspect(obj).attrs.purchase_price.history.has_changes():
+                product_ids.add(obj.id)
+    estimate_ids.discard(None)
+    if not estimate_ids and not product_ids:
+        return
+    conn = session.connection()
+    if product_ids:
+        estimate_ids |= _estimates_with_products(conn, product_ids)
+    if estimate_ids:
+        refresh_totals(conn, estimate_ids)
+        session.info.setdefault("stale_estimate_totals", set()).update(estimate_ids)
+
+
+@event.listens_for(OrmSession, "after_flush_postexec")
+def _expire_refreshed(session: OrmSession, flush_context):
+    stale = session.info.pop("stale_estimate_totals", None)
+    if not stale:
+        return
+    # Загруженные в сессию сметы перечитают итоги при следующем обращении
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Estimate) and obj.id in stale:
+            session.expire(obj, list(TOTAL_FIELDS))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    import config
+    from db_pool import create_pooled_engine
+
+    if len(sys.argv) < 2 or sys.argv[1] != "rebuild":
+        print("Использование: python estimate_totals.py rebuild")
+        sys.exit(2)
+    with create_pooled_engine(config.DATABASE_URL).begin() as rebuild_conn:
+        print(f"Пересчитаны итоги смет: {refresh_totals(rebuild_conn)}")
@@ -0,0 +1,132 @@
+# etags.py
+"""Условные GET-запросы (ETag / If-None-Match) для списков и карточек.
+
+Для каждой таблицы в TableVersion хранится счётчик изменений. Таблицы, затронутые
+flush любой ORM-сессии, запоминаются в сессии (см. _collect_tables), а счётчики
+увеличиваются после commit отдельной короткой транзакцией, поэтому отдельные
+write-эндпоинты ничего не делают. Строка версии не блокируется на время записи:
+иначе все писатели одной таблицы выстраивались бы в очередь за ней. Пока версия
+не поднята, клиент может получить новые данные со старым ETag — это лишь лишний
+запрос при следующей проверке; поднять версию до commit нельзя — тогда под новым
+ETag закэшировались бы старые данные.
+
+ETag ответа — хэш версий нужных таблиц, пути и параметров запроса. Если клиент
+прислал совпадающий If-None-Match, эндпоинт отвечает 304 после одного запроса
+версий, не выполняя основной запрос и не сериализуя ответ.
+"""
+import hashlib
+import logging
+from typing import Dict, Iterable, Optional
+
+from fastapi import Request, Response
+from sqlalchemy import event, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session as OrmSession
+
+from main_models import TableVersion
+
+# Ответ зависит от данных, которые меняются в любой момент: браузер хранит его,
+# но каждый раз проверяет ETag; private — ответы на запросы с токеном
+CACHE_CONTROL_REVALIDATE = "private, no-cache"
+
+logger = logging.getLogger(__name__)
+
+# Таблицы, изменения которых не влияют на кэшируемые ответы
+_UNTRACKED_TABLES = {TableVersion.__tablename__, "authsession", "idempotencykey"}
+
+_BUMP_SQL = text(
+    "INSERT INTO tableversion (table_name, version) VALUES (:table_name, 1) "
+    "ON CONFLICT (table_name) DO UPDATE SET version = tableversion.version + 1"
+)
+
+
+_PENDING_KEY = "etag_tables"
+
+
+def defer_bump(session: OrmSession, tables: Iterable[str]):
+    """Поднять версии таблиц после commit сессии; для записей в её транзакции в обход ORM."""
+    session.info.setdefault(_PENDING_KEY, set()).update(tables)
+
+
+@event.listens_for(OrmSession, "after_flush")
+def _collect_tables(session: OrmSession, flush_context):
+    tables = set()
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        table = getattr(obj, "__tablename__", None)
+        if table and table not in _UNTRACKED_TABLES:
+            tables.add(table)
+    if tables:
+        defer_bump(session, tables)
+
+
+@event.listens_for(OrmSession, "after_commit")
+def _bump_after_commit(session: OrmSession):
+    # После отката таблицы не сбрасываются: лишний подъём версии безвреден,
+    # а пропущенный после отката savepoint оставил бы устаревший ETag
+    tables = session.info.pop(_PENDING_KEY, None)
+    if tables:
+        try:
+            bump_versions(session.get_bind(), tables)
+        except Exception:
+            # Изменения уже закоммичены — запрос не должен падать из-за версии ETag
+            logger.exception(f"Не удалось поднять версии таблиц {sorted(tables)}")
+
+
+def bump_versions(bind, tables: Iterable[str]):
+    """Увеличивает версии таблиц отдельной короткой транзакцией.
+
+    Вызывается после commit изменений (для записей в обход ORM-сессии — после блока
+    engine.begin()); bind — движок или соединение, от которого берётся движок.
+    """
+    engine = bind.engine if isinstance(bind, Connection) else bind
+    with engine.begin() as conn:
+        # Сортировка — одинаковый порядок блокировок строк версий
+        conn.execute(_BUMP_SQL, [{"table_name": t} for t in sorted(tables)])
+
+
+def _versions_query(tables: Iterable[str]):
+    return select(TableVersion.table_name, TableVersion.version).where(
+        TableVersion.table_name.in_(list(tables)))
+
+
+def make_etag(versions: Dict[str, int], request: Request) -> str:
+    parts = [f"{table}={versions.get(table, 0)}" for table in sorted(versions)]
+    parts.append(request.url.path)
+    parts.extend(f"{key}={value}" for key, value in sorted(request.query_params.multi_items()))
+    return '"' + hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Для GET сравнение слабое: префикс W/ не мешает совпадению
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag in candidates
+
+
+def _conditional(versions: Dict[str, int], tables: Iterable[str], request: Request,
+                 response: Response, cache_control: str) -> Optional[Response]:
+    etag = make_etag({table: versions.get(table, 0) for table in tables}, request)
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+
+def check_not_modified(session, tables: Iterable[str], request: Request, response: Response,
+                       cache_control: str = CACHE_CONTROL_REVALIDATE) -> Optional[Response]:
+    """Синхронная сессия. Возвращает ответ 304 или None, выставив ETag и Cache-Control."""
+    tables = tuple(tables)
+    versions = dict(session.exec(_versions_query(tables)).all())
+    return _conditional(versions, tables, request, response, cache_control)
+
+
+async def check_not_modified_async(session, tables: Iterable[str], request: Request, response: Response,
+                                   cache_control: str = CACHE_CONTROL_REVALIDATE) -> Optional[Response]:
+    """То же для AsyncSession."""
+    tables = tuple(tables)
+    versions = dict((await session.exec(_versions_query(tables))).all())
+    return _conditional(versions, tables, request, response, cache_control)
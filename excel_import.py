@@ -0,0 +1,246 @@
+# excel_import.py
+"""Разбор Excel-файлов для импорта (смета из 1С, универсальный импорт).
+
+Функции модуля не обращаются к БД и выполняются в пуле процессов (см. executors.py),
+поэтому модуль держим лёгким: без FastAPI, моделей и настроек подключения.
+pandas и fuzzywuzzy импортируются внутри функций — основной процесс API их не грузит.
+"""
+import io
+import logging
+import re
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ImportFileError(ValueError):
+    """Файл не удалось прочитать или в нём не найдена ожидаемая структура."""
+
+
+def parse_number_robust(val) -> Optional[float]:
+    if val is None:
+        return None
+    if isinstance(val, (int, float)):
+        return float(val)
+    s = str(val).strip().replace('\u00A0', '').replace(
+        ' ', '').replace(',', '.')
+    s = re.sub(r'[^0-9.\-]', '', s)
+    try:
+        return float(s)
+    except (ValueError, TypeError):
+        return None
+
+
+def match_product_names(names: List[str], choices: List[str], min_score: int = 80) -> List[Optional[str]]:
+    """Нечёткое сопоставление названий из файла с названиями товаров.
+    Для каждого названия возвращает лучшее совпадение или None."""
+    if not choices:
+        return [None] * len(names)
+    from fuzzywuzzy import process as fuzzy_process
+    matches = []
+    for name in names:
+        if not name:
+            matches.append(None)
+            continue
+        best_match, score = fuzzy_process.extractOne(name, choices)
+        matches.append(best_match if score > min_score else None)
+    return matches
+
+
+def _log_preview(df, title: str):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"{title}: первые 15 строк, как их видит Pandas:\n{df.head(15).to_string()}")
+
+
+def _normalize_header_text(s: Any) -> str:
+    # Flexible header matching: normalize both Excel cell text and alias tokens
+    if s is None:
+        return ""
+    s = str(s).strip().lower()
+    # keep letters, digits and spaces; remove punctuation like hyphens and non-breaking spaces
+    s = re.sub(r'[^а-яa-z0-9\s]', '', s)
+    s = re.sub(r'\s+', ' ', s)
+    return s
+
+
+ALIASES_1C = {
+    'name': ['товары', 'товар', 'наименование', 'наименование товара'],
+    'quantity': ['кол-во', 'количество', 'кол'],
+    'unit_price': ['цена', 'стоимость']
+}
+
+
+def parse_1c_estimate(content: bytes) -> Dict[str, Any]:
+    """Разбирает смету из 1С: номер, клиент, объект и строки (название, количество, цена)."""
+    import pandas as pd
+    try:
+        df = pd.read_excel(io.BytesIO(content), header=None, engine='calamine')
+    except Exception as e:
+        raise ImportFileError(f"Не удалось прочитать файл Excel. Ошибка: {e}")
+    _log_preview(df, "Диагностика Excel файла (1C)")
+
+    estimate_number, client_name, location = "б/н", "Не определен", "Не определен"
+    # Build a cleaned text representation for extracting metadata.
+    # Remove repeated 'nan' tokens that come from empty Excel cells.
+    text_rows = []
+    for i, row in df.head(20).iterrows():
+        # join cells with a single space, filter out NaNs
+        cells = [str(x).strip() for x in row.values if pd.notna(x)
+                 and str(x).strip().lower() != 'nan']
+        if cells:
+            text_rows.append(' '.join(cells))
+    full_text = '\n'.join(text_rows)
+
+    # Try to extract estimate number, client name and location from the cleaned rows
+    if match := re.search(r'Коммерческое предложение №\s*(\S+)', full_text, re.IGNORECASE):
+        estimate_number = match.group(1)
+    # Prefer explicit 'Кому:' lines
+    if match := re.search(r'Кому:\s*([^\n,]+)', full_text, re.IGNORECASE):
+        client_name = match.group(1).strip()
+    else:
+        # fallback: first non-empty line that looks like a person/name (contains Cyrillic letters)
+        for line in text_rows:
+            if re.search(r'[А-Яа-яЁё]', line):
+                client_name = line.strip()
+                break
+    if match := re.search(r'Тема:\s*[^\n_]+_(.*)', full_text, re.IGNORECASE):
+        location = match.group(1).strip()
+
+    # Pre-normalize aliases so we compare like-with-like (handles hyphens etc.)
+    normalized_aliases = {k: [_normalize_header_text(
+        a) for a in v] for k, v in ALIASES_1C.items()}
+
+    column_map, header_row_idx = {}, -1
+    for idx, row in df.iterrows():
+        for col_idx, cell_val in row.items():
+            cell_norm = _normalize_header_text(cell_val)
+            for map_key, alias_list in normalized_aliases.items():
+                if map_key in column_map:
+                    continue
+                for alias_norm in alias_list:
+                    if alias_norm and alias_norm in cell_norm:
+                        column_map[map_key] = col_idx
+                        break
+        if len(column_map) == len(ALIASES_1C):
+            header_row_idx = idx
+            break
+    if header_row_idx == -1:
+        # Build a small preview of the first rows to help debug header mismatches
+        preview_rows = []
+        max_preview = 5
+        for i, row in df.head(max_preview).iterrows():
+            cells = [(_normalize_header_text(c)[:40] +
+                      ("..." if len(str(c)) > 40 else "")) for c in row.values]
+            preview_rows.append(f"Row {i}: " + " | ".join(cells))
+        preview_text = "\\n".join(preview_rows)
+        raise ImportFileError(
+            "Не найдены заголовки ('Товары', 'Кол-во', 'Цена'). "
+            "Проверьте структуру файла. Превью первых строк:\n" + preview_text)
+
+    rows = []
+    for _, row in df.iloc[header_row_idx + 1:].iterrows():
+        if row.astype(str).str.contains("Итого:|Всего наименований", na=False).any():
+            break
+        product_name = str(row.get(column_map['name']))
+        quantity = parse_number_robust(row.get(column_map['quantity']))
+        unit_price = parse_number_robust(row.get(column_map['unit_price']))
+        if not product_name or quantity is None or unit_price is None or product_name.lower() == 'nan':
+            continue
+        rows.append({"name": product_name, "quantity": quantity, "unit_price": unit_price})
+
+    return {"estimate_number": estimate_number, "client_name": client_name,
+            "location": location, "rows": rows}
+
+
+HEADER_SETS = {
+    "petrovich": {"КОД", "ТОВАР", "КОЛИЧЕСТВО"},
+    "my_sklad": {"INTERNAL_SKU", "NAME", "STOCK_QUANTITY"}
+}
+
+
+def parse_universal_import(content: bytes, with_order_number: bool = False) -> Dict[str, Any]:
+    """Разбирает файл поставщика ("Петрович") или выгрузку склада.
+    Возвращает строки данных в виде словарей по найденным колонкам
+    (name, qty, price, sku, internal_sku) и, по запросу, номер заказа."""
+    import pandas as pd
+    try:
+        df = pd.read_excel(io.BytesIO(content), header=None, engine='calamine')
+    except Exception as e:
+        raise ImportFileError(f"Ошибка чтения Excel: {e}")
+    _log_preview(df, "Диагностика Excel файла (универсальный импорт)")
+
+    start_row, header_map = -1, {}
+    for i, row in df.iterrows():
+        row_values = {str(v).strip().upper() for v in row.dropna().values}
+        header_map_raw = {str(v).strip().upper(
+        ): col_idx for col_idx, v in enumerate(row.values)}
+        if HEADER_SETS["petrovich"].issubset(row_values):
+            start_row, header_map = i, {
+                'sku': 'КОД', 'name': 'ТОВАР', 'qty': 'КОЛИЧЕСТВО', 'price': 'ЦЕНА'}
+            break
+        elif HEADER_SETS["my_sklad"].issubset(row_values):
+            start_row, header_map = i, {'internal_sku': 'INTERNAL_SKU',
+                                        'name': 'NAME', 'qty': 'STOCK_QUANTITY', 'sku': 'SUPPLIER_SKU'}
+            break
+    if start_row == -1:
+        raise ImportFileError("Не найдены обязательные заголовки в файле.")
+
+    col_map = {k: header_map_raw.get(
+        v) for k, v in header_map.items() if header_map_raw.get(v) is not None}
+    data_df = df.iloc[start_row + 1:].where(pd.notna(df), None)
+    rows = [{"index": i, **{key: row.get(col) for key, col in col_map.items()}}
+            for i, row in data_df.iterrows()]
+
+    order_number = "б/н"
+    if with_order_number:
+        if match := re.search(r'Заказ №\s*(\S+)', ' '.join(df.astype(str).to_string().split())):
+            order_number = match.group(1)
+
+    return {"start_row": start_row, "rows": rows, "order_number": order_number}
+
+
+# Лист инвентаризации: артикул и фактическое количество. Подходит и выгрузка склада
+# (INTERNAL_SKU, STOCK_QUANTITY) с проставленными вместо остатков фактическими количествами.
+ALIASES_STOCKTAKE = {
+    'internal_sku': ['internal_sku', 'внутренний артикул', 'артикул'],
+    'counted_quantity': ['факт', 'посчитано', 'stock_quantity', 'количество'],
+}
+
+
+def parse_stocktake_sheet(content: bytes) -> Dict[str, Any]:
+    """Разбирает лист инвентаризации: строки (internal_sku, counted_quantity).
+    Строки без артикула или количества пропускаются."""
+    import pandas as pd
+    try:
+        df = pd.read_excel(io.BytesIO(content), header=None, engine='calamine')
+    except Exception as e:
+        raise ImportFileError(f"Ошибка чтения Excel: {e}")
+    _log_preview(df, "Диагностика Excel файла (инвентаризация)")
+
+    normalized_aliases = {k: [_normalize_header_text(a) for a in v] for k, v in ALIASES_STOCKTAKE.items()}
+    column_map, header_row_idx = {}, -1
+    for idx, row in df.iterrows():
+        cells = {col_idx: _normalize_header_text(v) for col_idx, v in row.items()}
+        # Псевдонимы по порядку приоритета: точное «внутренний артикул» раньше общего «артикул»
+        column_map = {}
+        for map_key, alias_list in normalized_aliases.items():
+            for alias_norm in alias_list:
+                col = next((c for c, text in cells.items()
+                            if alias_norm in text and c not in column_map.values()), None)
+                if col is not None:
+                    column_map[map_key] = col
+                    break
+        if len(column_map) == len(ALIASES_STOCKTAKE):
+            header_row_idx = idx
+            break
+    if header_row_idx == -1:
+        raise ImportFileError("Не найдены заголовки ('Артикул', 'Факт').")
+
+    rows = []
+    for _, row in df.iloc[header_row_idx + 1:].iterrows():
+        sku = row.get(column_map['internal_sku'])
+        quantity = parse_number_robust(row.get(column_map['counted_quantity']))
+        if pd.isna(sku) or not str(sku).strip() or quantity is None or pd.isna(quantity):
+            continue
+        rows.append({"internal_sku": str(sku).strip(), "counted_quantity": quantity})
+    return {"rows": rows}
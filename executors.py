@@ -0,0 +1,134 @@
+# executors.py
+"""Общие пулы для работы, которую нельзя выполнять в event loop.
+
+- пул потоков — для блокирующих вызовов (синхронная сессия БД, файловый ввод-вывод);
+- пул процессов — для CPU-тяжёлых задач (разбор Excel, нечёткое сопоставление, рендер .docx).
+
+Размеры пулов задаются в config. Каждый пул считает задачи в работе и глубину очереди,
+статистика доступна через stats().
+"""
+import asyncio
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict
+
+from config import IO_POOL_THREADS, CPU_POOL_PROCESSES
+
+logger = logging.getLogger(__name__)
+
+
+class InstrumentedExecutor:
+    """Лениво создаваемый пул с метриками: задачи в работе, очередь, время выполнения."""
+
+    def __init__(self, name: str, factory: Callable[[int], Executor], max_workers: int):
+        self.name = name
+        self.max_workers = max_workers
+        self._factory = factory
+        self._executor = None
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.max_queue_depth = 0
+        self.total_seconds = 0.0
+
+    def _get(self) -> Executor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = self._factory(self.max_workers)
+        return self._executor
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        try:
+            future = self._get().submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            # Дочерний процесс упал — пересоздаём пул и пробуем ещё раз
+            logger.error(f"Пул '{self.name}' сломан, пересоздаю")
+            with self._lock:
+                self._executor = None
+            future = self._get().submit(fn, *args, **kwargs)
+        started = time.monotonic()
+        with self._lock:
+            self.submitted += 1
+            self.in_flight += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        future.add_done_callback(lambda f: self._on_done(f, started))
+        return future
+
+    def _on_done(self, future: Future, started: float):
+        with self._lock:
+            self.in_flight -= 1
+            self.total_seconds += time.monotonic() - started
+            if future.cancelled() or future.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    @property
+    def queue_depth(self) -> int:
+        # Задачи сверх числа воркеров ждут в очереди
+        return max(0, self.in_flight - self.max_workers)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            finished = self.completed + self.failed
+            return {
+                "max_workers": self.max_workers,
+                "started": self._executor is not None,
+                "in_flight": self.in_flight,
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "avg_seconds": round(self.total_seconds / finished, 4) if finished else 0.0,
+            }
+
+    def shutdown(self, wait: bool = False):
+        """wait=True дожидается воркеров, а с ними и done-callback'ов со статистикой."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+
+def _thread_pool(max_workers: int) -> Executor:
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sklad-io")
+
+
+def _process_pool(max_workers: int) -> Executor:
+    # spawn вместо fork: родитель — многопоточный сервер
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+io_executor = InstrumentedExecutor("io", _thread_pool, max(1, IO_POOL_THREADS))
+cpu_executor = InstrumentedExecutor("cpu", _process_pool, max(1, CPU_POOL_PROCESSES))
+
+
+def cpu_pool() -> InstrumentedExecutor:
+    """Пул для CPU-тяжёлых задач. При CPU_POOL_PROCESSES = 0 задачи идут в пул потоков."""
+    return cpu_executor if CPU_POOL_PROCESSES > 0 else io_executor
+
+
+async def run_in_thread(fn: Callable, *args, **kwargs) -> Any:
+    return await asyncio.wrap_future(io_executor.submit(fn, *args, **kwargs))
+
+
+async def run_in_process(fn: Callable, *args, **kwargs) -> Any:
+    """Функция и аргументы должны сериализоваться pickle (функция — уровня модуля)."""
+    return await asyncio.wrap_future(cpu_pool().submit(fn, *args, **kwargs))
+
+
+def stats() -> Dict[str, Any]:
+    return {"io": io_executor.stats(), "cpu": cpu_executor.stats()}
+
+
+def shutdown():
+    io_executor.shutdown()
+    cpu_executor.shutdown()
@@ -0,0 +1,236 @@
+# forecasting.py
+"""Прогноз расхода товаров: расход в день, дни до окончания остатка, рекомендуемый закуп.
+
+Расход — уход товара со склада: выдача работнику и списание по договору за вычетом
+возвратов от работника и отмен этих операций. Прогноз считается по скользящим окнам
+WINDOWS дней; расход в день — взвешенное среднее окон (последняя неделя весит больше).
+
+Журнал движений не перечитывается целиком: в ConsumptionDaily копится расход по дням,
+а каждый запуск читает только движения с id больше ForecastState.last_movement_id —
+частями по FORECAST_CHUNK_ROWS строк, так что и первый запуск не держит журнал в памяти.
+id выдаётся при вставке, а видна строка после коммита, поэтому за разрывом в id может
+стоять ещё не закоммиченная транзакция. Отметка сдвигается только по непрерывным id;
+движение за разрывом учитывается, когда оно старше FORECAST_SETTLE_MINUTES (разрыв
+от отката или кэша последовательности к тому времени уже не заполнится), а до того
+оно и всё после него ждут следующего запуска. Дни старше самого длинного окна удаляются. Результат пишется в колонки товара:
+consumption_rate, days_until_stockout, suggested_reorder_qty, forecast_at.
+
+Перезаписываются только товары, у которых прогноз изменился (forecast_at — время
+последнего изменения), по возрастанию id, как блокируют товары запросы; версия ETag
+товаров поднимается, только если что-то изменилось.
+
+Расчёт векторный (pandas/NumPy) и выполняется в пуле процессов; pandas
+импортируется лениво — при старте API он не нужен. Запуск вручную:
+
+    python forecasting.py run
+"""
+import logging
+import sys
+from datetime import date, datetime, timedelta
+from typing import Dict
+
+from sqlalchemy import String, bindparam, cast, delete, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Connection, Engine
+
+import config
+from etags import bump_versions
+from main_models import ConsumptionDaily, ForecastState, MovementTypeEnum, Product, StockMovement
+
+logger = logging.getLogger(__name__)
+
+# Окна в днях и их веса в расходе в день
+WINDOWS = (7, 30, 90)
+WEIGHTS = (0.5, 0.3, 0.2)
+
+# Движения, меняющие остаток склада из-за расхода. В БД тип хранится именем члена enum,
+# у отмен — строкой «Отмена (MovementTypeEnum.<имя>)», поэтому ищем имя внутри строки.
+# Расход = -quantity: выдача и списание отрицательны, возврат и отмена выдачи положительны.
+CONSUMPTION_TYPES = (
+    MovementTypeEnum.ISSUE_TO_WORKER.name,
+    MovementTypeEnum.WRITE_OFF_CONTRACT.name,
+    MovementTypeEnum.RETURN_FROM_WORKER.name,
+)
+
+
+def consumption_by_day(movements):
+    """Движения (product_id, timestamp, type, quantity) -> расход по товарам и дням."""
+    import pandas as pd
+
+    pattern = "|".join(CONSUMPTION_TYPES)
+    relevant = movements[movements["type"].astype(str).str.contains(pattern, regex=True)]
+    daily = pd.DataFrame({
+        "product_id": relevant["product_id"].astype("int64"),
+        "day": pd.to_datetime(relevant["timestamp"]).dt.date,
+        "quantity": -relevant["quantity"].astype("float64"),
+    })
+    return daily.groupby(["product_id", "day"], as_index=False)["quantity"].sum()
+
+
+def compute_forecast(daily, products, today: date, lead_time_days: float, cover_days: float):
+    """Расход по дням и товары (id, stock_quantity, min_stock_level) -> прогноз по товарам."""
+    import numpy as np
+    import pandas as pd
+
+    age = (pd.Timestamp(today) - pd.to_datetime(daily["day"])).dt.days.to_numpy()
+    quantity = daily["quantity"].to_numpy(dtype="float64")
+    windows = pd.DataFrame(
+        {f"rate_{w}": np.where((age >= 0) & (age < w), quantity, 0.0) / w for w in WINDOWS})
+    windows["product_id"] = daily["product_id"].to_numpy()
+    rates = windows.groupby("product_id").sum()
+
+    frame = products.set_index("id").join(rates, how="left").fillna(0.0)
+    rate = sum(weight * frame[f"rate_{w}"].to_numpy() for w, weight in zip(WINDOWS, WEIGHTS))
+    rate = np.maximum(rate, 0.0)
+    stock = frame["stock_quantity"].to_numpy(dtype="float64")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        days_left = np.where(rate > 0, np.maximum(stock, 0.0) / rate, np.nan)
+    target = rate * (lead_time_days + cover_days) + frame["min_stock_level"].to_numpy(dtype="float64")
+    return pd.DataFrame({
+        "id": frame.index.to_numpy(),
+        "consumption_rate": np.round(rate, 4),
+        "days_until_stockout": np.round(days_left, 1),
+        "suggested_reorder_qty": np.ceil(np.maximum(target - stock, 0.0)),
+    })
+
+
+_FORECAST_COLUMNS = (Product.consumption_rate, Product.days_until_stockout, Product.suggested_reorder_qty)
+_FORECAST_NAMES = [column.key for column in _FORECAST_COLUMNS]
+
+
+def _changed_forecasts(forecast, products):
+    """Строки прогноза, отличающиеся от сохранённых в товарах (NULL и NaN равны)."""
+    import numpy as np
+
+    stored = products.set_index("id")[_FORECAST_NAMES].reindex(forecast["id"])
+    differs = np.zeros(len(forecast), dtype=bool)
+    for name in _FORECAST_NAMES:
+        new = forecast[name].to_numpy(dtype="float64")
+        old = stored[name].to_numpy(dtype="float64")
+        same = np.isclose(new, old, rtol=0.0, atol=1e-9) | (np.isnan(new) & np.isnan(old))
+        differs |= ~same
+    return forecast[differs]
+
+
+_FORECAST_UPDATE = update(Product).where(Product.id == bindparam("b_id")).values(
+    consumption_rate=bindparam("b_rate"), days_until_stockout=bindparam("b_days"),
+    suggested_reorder_qty=bindparam("b_reorder"), forecast_at=bindparam("b_at"),
+).execution_options(synchronize_session=False)
+
+
+def _lock_state(conn: Connection) -> int:
+    """Строка состояния под блокировкой: два экземпляра не учтут одни движения дважды."""
+    dialect_insert = pg_insert if conn.dialect.name == "postgresql" else sqlite_insert
+    conn.execute(dialect_insert(ForecastState).values(id=1, last_movement_id=0).on_conflict_do_nothing())
+    return conn.execute(select(ForecastState.last_movement_id).where(
+        ForecastState.id == 1).with_for_update()).scalar_one()
+
+
+def _accumulate(conn: Connection, daily):
+    if daily.empty:
+        return
+    dialect_insert = pg_insert if conn.dialect.name == "postgresql" else sqlite_insert
+    stmt = dialect_insert(ConsumptionDaily)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["product_id", "day"],
+        set_={"quantity": ConsumptionDaily.quantity + stmt.excluded.quantity})
+    conn.execute(stmt, daily.to_dict("records"))
+
+
+def _settled_prefix(chunk, last_id: int, cutoff: datetime):
+    """Начало части, которое можно учесть: до первого движения за разрывом id моложе cutoff."""
+    import pandas as pd
+
+    ids = chunk["id"].reset_index(drop=True)
+    after_gap = ids - ids.shift(1, fill_value=last_id) > 1
+    recent = pd.to_datetime(chunk["timestamp"]).reset_index(drop=True) >= pd.Timestamp(cutoff)
+    waiting = (after_gap & recent).to_numpy()
+    return chunk.iloc[:waiting.argmax()] if waiting.any() else chunk
+
+
+def _read_new_movements(conn: Connection, last_id: int, chunk_rows: int):
+    """Части новых движений (id, product_id, timestamp, type, quantity) по возрастанию id."""
+    import pandas as pd
+
+    columns = ["id", "product_id", "timestamp", "type", "quantity"]
+    while True:
+        rows = conn.execute(select(
+            StockMovement.id, StockMovement.product_id, StockMovement.timestamp,
+            cast(StockMovement.type, String).label("type"), StockMovement.quantity,
+        ).where(StockMovement.id > last_id).order_by(StockMovement.id).limit(chunk_rows)).all()
+        if not rows:
+            return
+        yield pd.DataFrame(rows, columns=columns)
+        last_id = rows[-1][0]
+
+
+def run_forecast(engine: Engine, today: date = None, chunk_rows: int = None) -> Dict[str, int]:
+    """Учитывает новые движения и пересчитывает прогноз всех товаров в одной транзакции."""
+    import pandas as pd
+
+    today = today or datetime.utcnow().date()
+    cutoff = datetime.utcnow() - timedelta(minutes=config.FORECAST_SETTLE_MINUTES)
+    counted = 0
+    with engine.begin() as conn:
+        last_id = _lock_state(conn)
+        for chunk in _read_new_movements(conn, last_id, chunk_rows or config.FORECAST_CHUNK_ROWS):
+            settled = _settled_prefix(chunk, last_id, cutoff)
+            if not settled.empty:
+                _accumulate(conn, consumption_by_day(settled))
+                counted += len(settled)
+                last_id = int(settled["id"].iloc[-1])
+            if len(settled) < len(chunk):
+                break
+        conn.execute(delete(ConsumptionDaily).where(
+            ConsumptionDaily.day <= today - timedelta(days=max(WINDOWS))))
+
+        daily = pd.DataFrame(conn.execute(select(
+            ConsumptionDaily.product_id, ConsumptionDaily.day, ConsumptionDaily.quantity)).all(),
+            columns=["product_id", "day", "quantity"])
+        products = pd.DataFrame(conn.execute(select(
+            Product.id, Product.stock_quantity, Product.min_stock_level,
+            *_FORECAST_COLUMNS,
+        ).where(Product.is_deleted == False).order_by(Product.id)).all(),  # noqa: E712
+            columns=["id", "stock_quantity", "min_stock_level", *_FORECAST_NAMES])
+        forecast = compute_forecast(daily, products, today,
+                                    config.FORECAST_LEAD_TIME_DAYS, config.FORECAST_COVER_DAYS)
+        changed = _changed_forecasts(forecast, products)
+
+        now = datetime.utcnow()
+        if not changed.empty:
+            # NaN (расхода нет) -> NULL
+            changed = changed.astype(object).where(changed.notna(), None)
+            # По возрастанию id — в том же порядке, в каком товары блокируют запросы (lock_products)
+            conn.execute(_FORECAST_UPDATE, [
+                {"b_id": row["id"], "b_rate": row["consumption_rate"], "b_days": row["days_until_stockout"],
+                 "b_reorder": row["suggested_reorder_qty"], "b_at": now}
+                for row in changed.sort_values("id").to_dict("records")])
+        conn.execute(update(ForecastState).where(ForecastState.id == 1).values(
+            last_movement_id=last_id, computed_at=now))
+    if not changed.empty:
+        # Массовый UPDATE идёт мимо ORM-сессии — версию для ETag списка товаров поднимаем сами, после commit
+        bump_versions(engine, ["product"])
+    logger.info(f"Прогноз расхода: новых движений {counted}, товаров {len(forecast)}, изменено {len(changed)}")
+    return {"movements": counted, "products": len(forecast), "updated": len(changed), "last_movement_id": last_id}
+
+
+_process_engine = None
+
+
+def run_forecast_job() -> Dict[str, int]:
+    """Точка входа для пула процессов: движок БД создаётся один раз на процесс."""
+    global _process_engine
+    if _process_engine is None:
+        from db_pool import create_pooled_engine
+        _process_engine = create_pooled_engine(config.DATABASE_URL)
+    return run_forecast(_process_engine)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) < 2 or sys.argv[1] != "run":
+        print("Использование: python forecasting.py run")
+        sys.exit(2)
+    print(f"Прогноз пересчитан: {run_forecast_job()}")
@@ -36,7 +36,7 @@ export default function ContractsPage() {
     const fetchContracts = async () => {
       setIsLoading(true);
       try {
-        const q = new URLSearchParams();
+        const q = new URLSearchParams({ view: 'summary' });
         if (debouncedSearch) q.set('search', debouncedSearch);
         if (sortBy) q.set('sort_by', sortBy);
         if (order) q.set('order', order);
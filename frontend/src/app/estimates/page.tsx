@@ -15,6 +15,8 @@ interface Estimate {
     created_at: string;
     worker_id?: number | null;
     shipped_at?: string | null;
+    total_retail: number;
+    item_count: number;
 }
 
 export default function EstimatesPage() {
@@ -37,7 +39,7 @@ export default function EstimatesPage() {
     const fetchEstimates = async (page: number, search: string) => {
         setIsLoading(true);
         try {
-            const params = new URLSearchParams({ page: String(page), size: String(PAGE_SIZE) });
+            const params = new URLSearchParams({ page: String(page), size: String(PAGE_SIZE), view: 'summary' });
             if (search) params.append('search', search);
 
             const data = await fetchApi(`/estimates/?${params.toString()}`);
@@ -238,15 +240,16 @@ export default function EstimatesPage() {
                                 <th className="py-3 px-4 text-left font-semibold text-gray-600 uppercase tracking-wider">Клиент</th>
                                 <th className="py-3 px-4 text-left font-semibold text-gray-600 uppercase tracking-wider">Объект</th>
                                 <th className="py-3 px-4 text-left font-semibold text-gray-600 uppercase tracking-wider">Статус</th>
+                                <th className="py-3 px-4 text-right font-semibold text-gray-600 uppercase tracking-wider">Сумма</th>
                                 <th className="py-3 px-4 text-left font-semibold text-gray-600 uppercase tracking-wider">Отгружено</th>
                                 <th className="py-3 px-4 text-center font-semibold text-gray-600 uppercase tracking-wider">Действия</th>
                             </tr>
                         </thead>
                         <tbody className="divide-y divide-gray-200">
                             {isLoading ? (
-                                <tr><td colSpan={7} className="text-center py-10 text-gray-500">Загрузка...</td></tr>
+                                <tr><td colSpan={9} className="text-center py-10 text-gray-500">Загрузка...</td></tr>
                             ) : estimates.length === 0 ? (
-                                <tr><td colSpan={7} className="text-center py-10 text-gray-500">Сметы не найдены.</td></tr>
+                                <tr><td colSpan={9} className="text-center py-10 text-gray-500">Сметы не найдены.</td></tr>
                             ) : (
                                 estimates.map(estimate => (
                                     <tr key={estimate.id} className="hover:bg-gray-50">
@@ -260,6 +263,7 @@ export default function EstimatesPage() {
                                                 {estimate.status}
                                             </span>
                                         </td>
+                                        <td className="py-3 px-4 text-right whitespace-nowrap">{estimate.total_retail.toFixed(2)} ₽</td>
                                         <td className="py-3 px-4 text-gray-600">
                                             <div>
                                                 <div>{estimate.shipped_at ? formatDate(estimate.shipped_at) : <span className="text-gray-400">—</span>}</div>
@@ -38,6 +38,7 @@ export default function HistoryPage() {
             if (movementType) params.append('movement_type', movementType);
             params.append('page', String(page));
             params.append('size', String(size));
+            params.append('view', 'summary');
             const url = `/actions/history/?${params.toString()}`;
             const data = await fetchApi(url);
             setHistory(data.items || []);
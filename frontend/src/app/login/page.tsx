@@ -39,6 +39,7 @@ export default function LoginPage() {
             const data = await response.json();
 
             Cookies.set('accessToken', data.access_token, { expires: 7, path: '/', secure: true, sameSite: 'strict' });
+            Cookies.set('refreshToken', data.refresh_token, { expires: 30, path: '/', secure: true, sameSite: 'strict' });
 
             toast.success('Вход выполнен успешно!', { id: toastId });
 
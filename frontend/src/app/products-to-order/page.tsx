@@ -11,6 +11,9 @@ interface ProductToOrder {
     stock_quantity: number;
     min_stock_level: number;
     unit: string;
+    shortfall: number;
+    days_until_stockout: number | null;
+    suggested_reorder_qty: number;
 }
 
 export default function ProductsToOrderPage() {
@@ -21,9 +24,10 @@ export default function ProductsToOrderPage() {
         const load = async () => {
             setLoading(true);
             try {
-                const data = await fetchApi('/products/?stock_status=low_stock');
+                const data = await fetchApi('/reorder-queue/');
                 const list: ProductToOrder[] = Array.isArray(data.items) ? data.items : [];
-                list.sort((a, b) => b.stock_quantity - a.stock_quantity);
+                // Сначала то, что закончится раньше всего; без прогноза расхода — в конце
+                list.sort((a, b) => (a.days_until_stockout ?? Infinity) - (b.days_until_stockout ?? Infinity));
                 setItems(list);
             } catch (e: any) {
                 toast.error(e?.message || 'Не удалось загрузить товары');
@@ -91,7 +91,7 @@ export default function ReportsPage() {
         const fetchProductsToOrder = async () => {
             setIsLoadingStock(true);
             try {
-                const data = await fetchApi('/products/?stock_status=low_stock');
+                const data = await fetchApi('/reorder-queue/');
                 // Ensure we have an array, sort from largest stock_quantity -> smallest (0 last)
                 const items: ProductToOrder[] = Array.isArray(data.items) ? data.items : [];
                 items.sort((a, b) => b.stock_quantity - a.stock_quantity);
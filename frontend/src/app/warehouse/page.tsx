@@ -6,7 +6,8 @@ import { useState, useEffect, FormEvent, useRef } from 'react';
 import toast from 'react-hot-toast';
 import Modal from '@/components/Modal';
 import { Plus, RefreshCw, Edit, Trash2, Upload, FileUp, Send, Search, ChevronLeft, ChevronRight, Star } from 'lucide-react';
-import { fetchApi } from '@/lib/api';
+import { fetchApi, fetchApiIdempotent } from '@/lib/api';
+import { subscribeEvents } from '@/lib/events';
 
 interface Worker {
   id: number;
@@ -82,6 +83,19 @@ export default function WarehousePage() {
     return () => clearTimeout(debounceTimer);
   }, [searchTerm, currentPage]);
 
+  // Остатки, изменённые другими пользователями, приходят из потока /events
+  useEffect(() => {
+    return subscribeEvents(event => {
+      if (event.type === 'product.stock') {
+        setProducts(current => current.map(p =>
+          p.id === event.data.id ? { ...p, stock_quantity: event.data.stock_quantity } : p
+        ));
+      } else if (event.type === 'reset') {
+        forceRefresh();
+      }
+    });
+  }, []);
+
   // Слушаем событие от AI-чата для автообновления
   useEffect(() => {
     const handleAiUpdate = () => {
@@ -269,7 +283,7 @@ export default function WarehousePage() {
     try {
       const payload = { product_id: issueProduct.id, worker_id: Number(issueWorkerId), quantity: Number(issueQuantity) };
       console.log('Issuing payload:', payload);
-      const movement = await fetchApi('/actions/issue-item/', {
+      const movement = await fetchApiIdempotent('/actions/issue-item/', {
         method: 'POST',
         body: JSON.stringify(payload)
       });
@@ -16,11 +16,47 @@ interface StockItem {
   unit: string;
 }
 
+// /actions/worker-stock-matrix: оси и ненулевые ячейки (индексы в workers/products)
+interface StockMatrix {
+  workers: { id: number[]; name: string[]; total: number[] };
+  products: { id: number[]; name: string[]; unit: string[]; total: number[] };
+  cells: { worker: number[]; product: number[]; quantity: number[] };
+}
+
+function StockMatrixTable({ matrix }: { matrix: StockMatrix }) {
+  const grid = new Map<string, number>();
+  matrix.cells.quantity.forEach((q, i) => grid.set(`${matrix.cells.product[i]}:${matrix.cells.worker[i]}`, q));
+  if (matrix.products.id.length === 0) {
+    return <div className="text-center py-10 text-gray-500">Ни у кого из работников нет товаров.</div>;
+  }
+  return (
+    <table className="min-w-full text-sm">
+      <thead className="bg-gray-100 border-b-2 border-gray-200">
+        <tr>
+          <th className="py-3 px-4 text-left font-semibold text-gray-600">Наименование</th>
+          {matrix.workers.name.map((name, w) => <th key={matrix.workers.id[w]} className="py-3 px-4 text-right font-semibold text-gray-600">{name}</th>)}
+          <th className="py-3 px-4 text-right font-semibold text-gray-600">Всего</th>
+        </tr>
+      </thead>
+      <tbody className="divide-y divide-gray-200">
+        {matrix.products.name.map((name, p) => (
+          <tr key={matrix.products.id[p]} className="hover:bg-gray-50">
+            <td className="py-2 px-4 font-medium text-gray-900">{name}</td>
+            {matrix.workers.id.map((id, w) => <td key={id} className="py-2 px-4 text-right">{grid.get(`${p}:${w}`) ?? ''}</td>)}
+            <td className="py-2 px-4 text-right font-bold">{matrix.products.total[p]} {matrix.products.unit[p]}</td>
+          </tr>
+        ))}
+      </tbody>
+    </table>
+  );
+}
+
 export default function WorkerStockPage() {
   const [workers, setWorkers] = useState<Worker[]>([]);
   const [selectedWorkerId, setSelectedWorkerId] = useState<string>('');
   const [stockItems, setStockItems] = useState<StockItem[]>([]);
   const [isLoading, setIsLoading] = useState(false);
+  const [matrix, setMatrix] = useState<StockMatrix | null>(null);
 
   // API_URL больше не нужен, используем fetchApi
 
@@ -56,6 +92,14 @@ export default function WorkerStockPage() {
   };
 
   useEffect(() => {
+    if (selectedWorkerId === 'all') {
+      setIsLoading(true);
+      fetchApi('/actions/worker-stock-matrix')
+        .then(setMatrix)
+        .catch(() => toast.error('Не удалось загрузить товары работников'))
+        .finally(() => setIsLoading(false));
+      return;
+    }
     fetchStockForWorker(selectedWorkerId);
   }, [selectedWorkerId]);
 
@@ -137,12 +181,16 @@ export default function WorkerStockPage() {
           onChange={e => setSelectedWorkerId(e.target.value)}
           className="block w-full md:w-1/3 p-2 border bg-white rounded-md shadow-sm focus:outline-none focus:ring-2 focus:ring-blue-500"
         >
+          <option value="all">Все работники</option>
           {workers.map(w => <option key={w.id} value={w.id}>{w.name}</option>)}
         </select>
       </div>
 
       <div className="bg-white rounded-lg shadow-md overflow-hidden">
         <div className="overflow-x-auto">
+            {selectedWorkerId === 'all' ? (
+              isLoading || !matrix ? <div className="text-center py-10 text-gray-500">Загрузка...</div> : <StockMatrixTable matrix={matrix} />
+            ) : (
             <table className="min-w-full text-sm">
                 <thead className="bg-gray-100 border-b-2 border-gray-200">
                     <tr>
@@ -179,6 +227,7 @@ export default function WorkerStockPage() {
                     )}
                 </tbody>
             </table>
+            )}
         </div>
       </div>
     </main>
@@ -2,7 +2,7 @@
 'use client';
 
 import { useState, useEffect, FormEvent } from 'react';
-import { fetchApi } from '@/lib/api';
+import { fetchApi, fetchApiIdempotent } from '@/lib/api';
 import { useRouter } from 'next/navigation';
 import toast from 'react-hot-toast';
 // --- 1. ДОБАВЛЯЕМ ИКОНКИ FileText и Star ---
@@ -58,7 +58,7 @@ export default function EstimateForm({ estimateId }: EstimateFormProps) {
 
   useEffect(() => {
     const fetchProducts = async () => {
-      const data = await fetchApi(`/products/?search=${searchTerm}&size=20`);
+      const data = await fetchApi(`/products/?search=${searchTerm}&size=20&view=summary`);
       setSearchResults(data.items || []);
     };
     if (isSearchFocused || searchTerm.length > 0) {
@@ -168,7 +168,7 @@ export default function EstimateForm({ estimateId }: EstimateFormProps) {
     if (!idToUse) { toast.error('Смета не сохранена. Сначала сохраните смету.'); return; }
     const toastId = toast.loading('Выполняется отгрузка...');
     try {
-      await fetchApi(`/estimates/${idToUse}/ship?worker_id=${selectedWorkerId}`, { method: 'POST' });
+      await fetchApiIdempotent(`/estimates/${idToUse}/ship?worker_id=${selectedWorkerId}`, { method: 'POST' });
       toast.success('Смета успешно отгружена!', { id: toastId });
       setIsShipModalOpen(false);
       // refresh from server
@@ -252,7 +252,7 @@ export default function EstimateForm({ estimateId }: EstimateFormProps) {
     const payload = { items: itemsToAdd.map(({ product_id, quantity, unit_price }) => ({ product_id, quantity, unit_price })) };
     try {
   const idToUse = currentEstimateId || estimateId;
-  await fetchApi(`/estimates/${idToUse}/issue-additional`, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(payload) });
+  await fetchApiIdempotent(`/estimates/${idToUse}/issue-additional`, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(payload) });
       toast.success('Товары успешно довыданы!', { id: toastId });
       setIsAddItemsModalOpen(false);
       fetchEstimate();
@@ -9,6 +9,11 @@ interface ProductToOrder {
     stock_quantity: number;
     min_stock_level: number;
     unit: string;
+    // Сколько не хватает до минимального остатка (очередь закупки)
+    shortfall?: number;
+    // Прогноз расхода: дней до окончания остатка и рекомендуемый закуп
+    days_until_stockout?: number | null;
+    suggested_reorder_qty?: number;
 }
 
 export default function ProductsToOrderPanel({ items, title = 'Товары к закупке' }: { items: ProductToOrder[]; title?: string }) {
@@ -23,7 +28,12 @@ export default function ProductsToOrderPanel({ items, title = 'Товары к 
                         {items.map(p => (
                             <li key={p.id} className="p-2 bg-yellow-50 rounded-md flex justify-between items-center">
                                 <div className="text-sm font-medium text-gray-900">{p.name}</div>
-                                <div className="text-right text-sm text-gray-700">{p.stock_quantity} {p.unit} / min {p.min_stock_level}</div>
+                                <div className="text-right text-sm text-gray-700">
+                                    {p.stock_quantity} {p.unit} / min {p.min_stock_level}
+                                    {p.shortfall ? <div className="text-xs text-red-600">не хватает {p.shortfall} {p.unit}</div> : null}
+                                    {p.days_until_stockout != null ? <div className="text-xs text-gray-500">закончится через ≈{p.days_until_stockout} дн.</div> : null}
+                                    {p.suggested_reorder_qty ? <div className="text-xs text-blue-700">заказать {p.suggested_reorder_qty} {p.unit}</div> : null}
+                                </div>
                             </li>
                         ))}
                     </ul>
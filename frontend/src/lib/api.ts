@@ -3,7 +3,32 @@ import Cookies from 'js-cookie';
 
 export const API_URL = process.env.NEXT_PUBLIC_API_URL || 'https://sklad-petrovich-api.onrender.com';
 
-export const fetchApi = async (url: string, options: RequestInit = {}) => {
+// Продлевает access-токен по refresh-токену. Параллельные запросы ждут одно продление.
+let refreshPromise: Promise<boolean> | null = null;
+
+export const refreshAccessToken = (): Promise<boolean> => {
+    const refreshToken = Cookies.get('refreshToken');
+    if (!refreshToken) return Promise.resolve(false);
+    if (!refreshPromise) {
+        refreshPromise = fetch(`${API_URL}/token/refresh`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ refresh_token: refreshToken }),
+        })
+            .then(async (response) => {
+                if (!response.ok) return false;
+                const data = await response.json();
+                Cookies.set('accessToken', data.access_token, { expires: 7, path: '/', secure: true, sameSite: 'strict' });
+                Cookies.set('refreshToken', data.refresh_token, { expires: 30, path: '/', secure: true, sameSite: 'strict' });
+                return true;
+            })
+            .catch(() => false)
+            .finally(() => { refreshPromise = null; });
+    }
+    return refreshPromise;
+};
+
+export const fetchApi = async (url: string, options: RequestInit = {}, retried = false): Promise<any> => {
     const token = Cookies.get('accessToken');
 
     const headers: Record<string, string> = { ...(options.headers as Record<string, string> ?? {}) };
@@ -20,8 +45,13 @@ export const fetchApi = async (url: string, options: RequestInit = {}) => {
     if (!response.ok) {
             // --- УМНАЯ ОБРАБОТКА ОШИБКИ 401 ---
             if (response.status === 401) {
-                // Если мы не авторизованы, удаляем "протухший" cookie
+                // Access-токен истёк — пробуем продлить сессию и повторить запрос один раз
+                if (!retried && await refreshAccessToken()) {
+                    return fetchApi(url, options, true);
+                }
+                // Если мы не авторизованы, удаляем "протухшие" cookie
                 Cookies.remove('accessToken');
+                Cookies.remove('refreshToken');
                 // И если мы в браузере, перенаправляем на логин
                 if (typeof window !== 'undefined') {
                     window.location.href = '/login';
@@ -62,4 +92,17 @@ export const fetchApi = async (url: string, options: RequestInit = {}) => {
         console.error("API Error in fetchApi:", error);
         throw error;
     }
-};
\ No newline at end of file
+};
+// Операции, меняющие остатки: один Idempotency-Key на действие пользователя. При сетевой
+// ошибке (ответ не получен) запрос повторяется с тем же ключом — сервер не выполнит его дважды.
+export const fetchApiIdempotent = async (url: string, options: RequestInit = {}, attempts = 3): Promise<any> => {
+    const headers = { ...(options.headers as Record<string, string> ?? {}), 'Idempotency-Key': crypto.randomUUID() };
+    for (let attempt = 1; ; attempt++) {
+        try {
+            return await fetchApi(url, { ...options, headers });
+        } catch (error) {
+            // fetch бросает TypeError только при сетевой ошибке
+            if (!(error instanceof TypeError) || attempt >= attempts) throw error;
+        }
+    }
+};
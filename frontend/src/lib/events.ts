@@ -0,0 +1,76 @@
+// frontend/src/lib/events.ts
+import Cookies from 'js-cookie';
+import { API_URL, refreshAccessToken } from './api';
+
+// События потока /events: data — JSON с изменёнными полями
+export type ChangeEvent =
+    | { type: 'product.stock'; data: { id: number; stock_quantity: number } }
+    | { type: 'movement.created'; data: { id: number; product_id: number; worker_id: number | null; type: string; quantity: number; stock_after: number | null } }
+    | { type: 'movement.cancelled'; data: { id: number; product_id: number } }
+    | { type: 'estimate.status'; data: { id: number; status: string; worker_id: number | null } }
+    | { type: 'contract.status'; data: { id: number; status: string } }
+    // Пропущенные события уже удалены на сервере — данные нужно перечитать целиком
+    | { type: 'reset'; data: Record<string, never> };
+
+// Подписка на /events. EventSource не умеет передавать заголовок Authorization, поэтому
+// поток читается через fetch; после обрыва переподключаемся с Last-Event-ID и получаем
+// пропущенные события. На 401 продлеваем access-токен тем же общим продлением, что
+// и fetchApi, и сразу переподключаемся; без сессии поток останавливается.
+// Возвращает функцию отписки.
+export const subscribeEvents = (onEvent: (event: ChangeEvent) => void): (() => void) => {
+    let lastEventId: string | null = null;
+    let retryMs = 3000;
+    let stopped = false;
+    let controller: AbortController | null = null;
+
+    const dispatch = (block: string) => {
+        let type = 'message';
+        let data = '';
+        for (const line of block.split('\n')) {
+            if (line.startsWith('id: ')) lastEventId = line.slice(4);
+            else if (line.startsWith('event: ')) type = line.slice(7);
+            else if (line.startsWith('data: ')) data += line.slice(6);
+            else if (line.startsWith('retry: ')) retryMs = Number(line.slice(7)) || retryMs;
+        }
+        if (data) onEvent({ type, data: JSON.parse(data) } as ChangeEvent);
+    };
+
+    const connect = async () => {
+        while (!stopped) {
+            controller = new AbortController();
+            try {
+                const headers: Record<string, string> = { Authorization: `Bearer ${Cookies.get('accessToken') ?? ''}` };
+                if (lastEventId) headers['Last-Event-ID'] = lastEventId;
+                const response = await fetch(`${API_URL}/events`, { headers, signal: controller.signal });
+                if (response.status === 401) {
+                    if (await refreshAccessToken()) continue;
+                    stopped = true;
+                    return;
+                }
+                if (!response.ok || !response.body) throw new Error(`Ошибка ${response.status}`);
+                const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+                let buffer = '';
+                for (;;) {
+                    const { value, done } = await reader.read();
+                    if (done) break;
+                    buffer += value;
+                    let end;
+                    while ((end = buffer.indexOf('\n\n')) !== -1) {
+                        dispatch(buffer.slice(0, end));
+                        buffer = buffer.slice(end + 2);
+                    }
+                }
+            } catch (error) {
+                if (stopped) return;
+                console.warn('Поток событий прерван, переподключение:', error);
+            }
+            await new Promise(resolve => setTimeout(resolve, retryMs));
+        }
+    };
+
+    connect();
+    return () => {
+        stopped = true;
+        controller?.abort();
+    };
+};
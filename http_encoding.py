@@ -0,0 +1,129 @@
+# http_encoding.py
+"""Кодирование ответов: JSON через orjson и сжатие gzip/Brotli.
+
+OrjsonResponse подключается как класс ответа по умолчанию через Default(...):
+эндпоинты с response_model по-прежнему сериализуются быстрым путём FastAPI
+(Pydantic dump_json), а orjson используется там, где возвращается dict/list
+без модели. Сравнение — serialization_benchmark.py.
+
+CompressionMiddleware выбирает кодировку по Accept-Encoding: br (если установлен
+пакет Brotli), затем gzip. Ответы меньше порога и уже сжатые форматы (.docx, .zip,
+изображения) отдаются как есть.
+"""
+import zlib
+from typing import Any, Optional
+
+import anyio
+import orjson
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import DEFAULT_EXCLUDED_CONTENT_TYPES, GZipResponder, IdentityResponder
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # Brotli не обязателен: без него отдаём gzip
+    brotli = None
+
+# .docx — тот же zip: повторное сжатие только тратит CPU
+EXCLUDED_CONTENT_TYPES = DEFAULT_EXCLUDED_CONTENT_TYPES + (
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+)
+
+# Тела больше этого сжимаются в потоке, чтобы не блокировать event loop
+THREAD_MIN_SIZE = 128 * 1024
+
+
+class OrjsonResponse(JSONResponse):
+    """JSON через orjson: UTF-8 без экранирования, datetime/UUID/enum без jsonable_encoder."""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+def _accepted_encodings(header: str) -> dict:
+    """'gzip;q=0.8, br' -> {'gzip': 0.8, 'br': 1.0}"""
+    encodings = {}
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        if not name:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        encodings[name.strip().lower()] = quality
+    return encodings
+
+
+def choose_encoding(header: Optional[str]) -> Optional[str]:
+    encodings = _accepted_encodings(header or "")
+    wildcard = encodings.get("*", 0.0)
+    candidates = ["br", "gzip"] if brotli is not None else ["gzip"]
+    best, best_quality = None, 0.0
+    for name in candidates:
+        quality = encodings.get(name, wildcard)
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+
+class BrotliResponder(IdentityResponder):
+    content_encoding = "br"
+
+    def __init__(self, app: ASGIApp, minimum_size: int, quality: int, *, exclude_content_types):
+        super().__init__(app, minimum_size, exclude_content_types=exclude_content_types)
+        self.quality = quality
+        self._compressor = None
+
+    @property
+    def compressor(self):
+        if self._compressor is None:
+            self._compressor = brotli.Compressor(quality=self.quality)
+        return self._compressor
+
+    async def apply_compression(self, body: bytes, *, more_body: bool) -> bytes:
+        if len(body) >= THREAD_MIN_SIZE:
+            return await anyio.to_thread.run_sync(self._compress_body, body, more_body)
+        return self._compress_body(body, more_body)
+
+    def _compress_body(self, body: bytes, more_body: bool) -> bytes:
+        if more_body:
+            return self.compressor.process(body) + self.compressor.flush()
+        return self.compressor.process(body) + self.compressor.finish()
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 5):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding"))
+        if encoding == "br":
+            responder = BrotliResponder(self.app, self.minimum_size, self.brotli_quality,
+                                        exclude_content_types=EXCLUDED_CONTENT_TYPES)
+        elif encoding == "gzip":
+            responder = GZipResponder(self.app, self.minimum_size, compresslevel=self.gzip_level,
+                                      thread_minimum_size=THREAD_MIN_SIZE,
+                                      exclude_content_types=EXCLUDED_CONTENT_TYPES)
+        else:
+            responder = IdentityResponder(self.app, self.minimum_size,
+                                          exclude_content_types=EXCLUDED_CONTENT_TYPES)
+        await responder(scope, receive, send)
+
+
+def compress(body: bytes, encoding: str, gzip_level: int = 6, brotli_quality: int = 5) -> bytes:
+    """Однократное сжатие (для бенчмарка)."""
+    if encoding == "br":
+        return brotli.compress(body, quality=brotli_quality)
+    compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
@@ -0,0 +1,173 @@
+# idempotency.py
+"""Идемпотентные повторы запросов, меняющих остатки (заголовок Idempotency-Key).
+
+Клиент на нестабильной связи повторяет запрос после таймаута. С одинаковым ключом
+эндпоинт выполняется один раз:
+- первый запрос занимает ключ (строка IdempotencyKey без ответа, отдельный commit),
+  выполняется и записывает ответ в строку ключа в той же транзакции, что и свои
+  изменения: handler только делает flush, commit один — в run_idempotent;
+- повтор после завершения получает сохранённый ответ без повторного выполнения;
+- повтор, пришедший, пока первый запрос ещё выполняется, ждёт его результата
+  (IDEMPOTENCY_WAIT_SECONDS), затем отвечает 409.
+
+Ответы с ошибкой не сохраняются: ключ освобождается, и повтор выполнится заново
+(например, после прихода товара). Так как изменения и ответ коммитятся вместе,
+у ключа без ответа изменений в БД нет. Ключ, занятый дольше IDEMPOTENCY_LOCK_SECONDS
+(экземпляр упал посреди запроса), повтор перехватывает, сменив created_at; исходный
+запрос, если он всё же жив, записывает ответ только при своём created_at — иначе
+его транзакция откатывается (409), и изменения не применяются дважды. Ответы хранятся
+IDEMPOTENCY_TTL_HOURS; просроченные строки удаляются при занятии новых ключей.
+"""
+import hashlib
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional
+
+import orjson
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+
+import config
+from main_models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+# Интервал опроса строки ключа, пока исходный запрос выполняется
+_POLL_SECONDS = 0.1
+
+
+def _sha256(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+def _replay(row) -> Response:
+    return Response(content=row.response_body, status_code=row.status_code,
+                    media_type="application/json", headers={REPLAYED_HEADER: "true"})
+
+
+def _claim(session: Session, key_hash: str, request_hash: str) -> Optional[datetime]:
+    """Занимает ключ и возвращает время занятия. None — ключ уже занят другим запросом."""
+    now = datetime.utcnow()
+    session.exec(delete(IdempotencyKey).where(IdempotencyKey.expires_at < now))
+    session.add(IdempotencyKey(
+        key_hash=key_hash, request_hash=request_hash, created_at=now,
+        expires_at=now + timedelta(hours=config.IDEMPOTENCY_TTL_HOURS)))
+    try:
+        session.commit()
+        return now
+    except IntegrityError:
+        session.rollback()
+        return None
+
+
+def _wait_for_result(session: Session, key_hash: str, request_hash: str):
+    """Ждёт ответа исходного запроса.
+
+    Возвращает строку с ответом, строку без ответа, если запрос брошен (занят дольше
+    IDEMPOTENCY_LOCK_SECONDS), или None — ключ свободен (освобождён или просрочен).
+    """
+    deadline = time.monotonic() + config.IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        row = session.exec(select(
+            IdempotencyKey.request_hash, IdempotencyKey.status_code, IdempotencyKey.response_body,
+            IdempotencyKey.created_at, IdempotencyKey.expires_at,
+        ).where(IdempotencyKey.key_hash == key_hash)).first()
+        # Завершаем транзакцию чтения, чтобы следующий опрос увидел свежие данные
+        session.rollback()
+        if row is None:
+            return None
+        if row.request_hash != request_hash:
+            raise HTTPException(
+                status_code=422, detail=f"{IDEMPOTENCY_HEADER} уже использован с другим запросом")
+        if row.status_code is not None:
+            if row.expires_at > datetime.utcnow():
+                return row
+            return None
+        if row.created_at + timedelta(seconds=config.IDEMPOTENCY_LOCK_SECONDS) < datetime.utcnow():
+            return row
+        if time.monotonic() >= deadline:
+            raise HTTPException(
+                status_code=409, detail=f"Запрос с этим {IDEMPOTENCY_HEADER} ещё выполняется, повторите позже")
+        time.sleep(_POLL_SECONDS)
+
+
+def _take_over(session: Session, key_hash: str, claimed_at: datetime) -> Optional[datetime]:
+    """Перехватывает брошенный ключ. None — его успели завершить или перехватить."""
+    now = datetime.utcnow()
+    taken = session.exec(update(IdempotencyKey).where(
+        IdempotencyKey.key_hash == key_hash, IdempotencyKey.created_at == claimed_at,
+        IdempotencyKey.status_code.is_(None),
+    ).values(created_at=now)).rowcount
+    session.commit()
+    if not taken:
+        return None
+    logger.warning("Ключ идемпотентности брошен незавершённым запросом, запрос выполняется заново")
+    return now
+
+
+def _release(session: Session, key_hash: str, claimed_at: datetime):
+    session.rollback()
+    session.exec(delete(IdempotencyKey).where(
+        IdempotencyKey.key_hash == key_hash, IdempotencyKey.created_at == claimed_at))
+    session.commit()
+
+
+def _store(session: Session, key_hash: str, claimed_at: datetime, status_code: int, body: bytes) -> bool:
+    """Записывает ответ в транзакцию запроса. False — ключ перехвачен другим запросом."""
+    return session.exec(update(IdempotencyKey).where(
+        IdempotencyKey.key_hash == key_hash, IdempotencyKey.created_at == claimed_at,
+    ).values(status_code=status_code, response_body=body.decode("utf-8"))).rowcount == 1
+
+
+def run_idempotent(session: Session, current_user: Dict[str, Any], key: Optional[str],
+                   scope: str, handler: Callable[[], Any]) -> Any:
+    """Выполняет handler не более одного раза для ключа key и возвращает его ответ.
+
+    handler не делает commit (только flush): его изменения и ответ коммитятся вместе.
+
+    scope — эндпоинт и тело запроса: повтор с тем же ключом, но другим запросом отклоняется (422).
+    Без ключа handler просто выполняется; ответ в обоих случаях сериализуется до commit.
+    """
+    if not key:
+        body = orjson.dumps(jsonable_encoder(handler()))
+        session.commit()
+        return Response(content=body, media_type="application/json")
+    if len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(
+            status_code=400, detail=f"{IDEMPOTENCY_HEADER} длиннее {MAX_KEY_LENGTH} символов")
+    key_hash = _sha256(f"{current_user.get('sub', '')}\n{key}")
+    request_hash = _sha256(scope)
+
+    claimed_at = _claim(session, key_hash, request_hash)
+    while claimed_at is None:
+        row = _wait_for_result(session, key_hash, request_hash)
+        if row is None:
+            claimed_at = _claim(session, key_hash, request_hash)
+        elif row.status_code is not None:
+            return _replay(row)
+        else:
+            claimed_at = _take_over(session, key_hash, row.created_at)
+
+    try:
+        result = handler()
+        # Ответ сериализуется до commit (commit сбрасывает загруженные объекты сессии);
+        # исходный запрос и повтор получают одно и то же тело
+        body = orjson.dumps(jsonable_encoder(result))
+        if not _store(session, key_hash, claimed_at, 200, body):
+            raise HTTPException(
+                status_code=409, detail=f"Запрос с этим {IDEMPOTENCY_HEADER} перехвачен повтором, изменения не применены")
+        session.commit()
+    except BaseException:
+        # Изменения откатываются вместе с ответом; ключ удаляется, только если он ещё наш
+        _release(session, key_hash, claimed_at)
+        raise
+    return Response(content=body, media_type="application/json")
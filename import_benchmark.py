@@ -0,0 +1,102 @@
+# import_benchmark.py
+"""Бенчмарк холодного старта: время импорта main_api (python -X importtime).
+
+Запуск:
+    python import_benchmark.py            # отчёт и проверка бюджета
+    python import_benchmark.py --top 30   # больше строк в отчёте
+
+Импорт выполняется в отдельных процессах несколько раз, берётся медиана.
+Скрипт завершается с кодом 1, если медиана превышает бюджет IMPORT_TIME_BUDGET_MS
+или при старте загрузился модуль из LAZY_MODULES — они должны импортироваться
+только в эндпоинтах, которым нужны (импорт Excel, .docx, AI, вход через Supabase).
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+# Бюджет на импорт приложения, мс (замер без этих модулей — около 1.1 с на dev-машине)
+try:
+    IMPORT_TIME_BUDGET_MS = float(os.getenv("IMPORT_TIME_BUDGET_MS", "2000"))
+except ValueError:
+    IMPORT_TIME_BUDGET_MS = 2000.0
+
+LAZY_MODULES = (
+    "pandas", "docxtpl", "docx", "num2words", "fuzzywuzzy",
+    "supabase", "passlib", "google.generativeai",
+)
+
+_PROBE = (
+    "import sys, {module}; "
+    "print('LOADED=' + ','.join(m for m in {modules!r} if m in sys.modules))"
+)
+
+
+def measure_import(module: str = "main_api") -> Tuple[float, Dict[str, int], List[str]]:
+    """Импортирует модуль в чистом процессе. Возвращает общее время (мс),
+    накопленное время по его прямым импортам (мкс) и загруженные ленивые модули."""
+    code = _PROBE.format(module=module, modules=LAZY_MODULES)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"Импорт {module} завершился с ошибкой:\n{proc.stderr[-2000:]}")
+
+    cumulative: Dict[str, int] = {}
+    total_us = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        try:
+            cumulative_us = int(parts[1])
+        except ValueError:
+            continue  # строка заголовка
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        if depth == 1:
+            cumulative[name] = cumulative_us
+        if name == module:
+            total_us = cumulative_us
+
+    loaded = []
+    for line in proc.stdout.splitlines():
+        if line.startswith("LOADED="):
+            loaded = [m for m in line[len("LOADED="):].split(",") if m]
+    return total_us / 1000, cumulative, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время импорта main_api")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--budget-ms", type=float, default=IMPORT_TIME_BUDGET_MS)
+    args = parser.parse_args()
+
+    results = [measure_import() for _ in range(max(1, args.runs))]
+    totals = [total for total, _, _ in results]
+    median_ms = statistics.median(totals)
+    _, cumulative, loaded = results[totals.index(min(totals, key=lambda t: abs(t - median_ms)))]
+
+    print(f"Импорт main_api: медиана {median_ms:.0f} мс "
+          f"(замеры: {', '.join(f'{t:.0f}' for t in totals)}), бюджет {args.budget_ms:.0f} мс")
+    print("\nСамые тяжёлые прямые импорты main_api (накопительно):")
+    for name, us in sorted(cumulative.items(), key=lambda kv: kv[1], reverse=True)[:args.top]:
+        print(f"  {us / 1000:8.1f} мс  {name}")
+
+    failed = False
+    if loaded:
+        print(f"\nОШИБКА: при старте загружены ленивые модули: {', '.join(loaded)}")
+        failed = True
+    if median_ms > args.budget_ms:
+        print(f"\nОШИБКА: время импорта {median_ms:.0f} мс превышает бюджет {args.budget_ms:.0f} мс")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# locations.py
+"""Остатки по местам хранения (склады, площадки, машина).
+
+LocationStock хранит остаток товара на каждом месте. Product.stock_quantity остаётся
+общим остатком — его читают списки, очередь закупки, прогноз и сверка, — а остатки
+по местам ведутся после flush любой ORM-сессии в той же транзакции:
+
+- движение, меняющее склад, или перемещение (TRANSFER) прибавляет quantity к остатку
+  своего места, в том числе места по умолчанию; движению без места перед flush
+  проставляется место по умолчанию;
+- изменение stock_quantity без движения (товар создан с остатком, списание без истории,
+  импорт) прибавляется к месту по умолчанию (absorb_unallocated), поэтому сумма
+  по местам остаётся равной общему остатку.
+
+Остаток каждого места хранится, а не выводится как разность: операции, списывающие
+товар, проверяют остаток своего места под блокировкой (сначала строки товаров, затем
+остатки по местам — см. lock_products и require_location_stock в main_api), а пути,
+не знающие о местах (отгрузка и довыдача по смете, списание по договору, AI-чат),
+списывают с места по умолчанию. Запросы по месту — поиск по первичному ключу
+(location_id, product_id) или по индексу product_id, без чтения журнала.
+
+Пересчёт места по умолчанию для всех товаров как разности общего остатка и остальных
+мест (после правок в БД в обход ORM):
+
+    python locations.py rebuild
+"""
+import logging
+import sys
+from collections import defaultdict
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import event, func, inspect, literal, select, true
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session as OrmSession
+
+from etags import defer_bump
+from main_models import Location, LocationStock, MovementTypeEnum, Product, StockMovement
+from stock_reconciliation import affects_stock
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOCATION_NAME = "Основной склад"
+
+
+def _dialect_insert(conn: Connection):
+    return pg_insert if conn.dialect.name == "postgresql" else sqlite_insert
+
+
+def stored_type(movement_type) -> str:
+    """Тип движения в том виде, в котором он хранится в БД (имя члена enum или строка отмены)."""
+    return movement_type.name if isinstance(movement_type, MovementTypeEnum) else str(movement_type)
+
+
+def moves_location_stock(movement_type) -> bool:
+    """Меняет ли движение остаток своего места хранения."""
+    stored = stored_type(movement_type)
+    return stored == MovementTypeEnum.TRANSFER.name or affects_stock(stored)
+
+
+def default_location_id(conn: Connection) -> int:
+    """Место по умолчанию; создаётся при первом обращении, если его ещё нет."""
+    query = select(Location.id).where(Location.is_default == True).order_by(Location.id).limit(1)  # noqa: E712
+    location_id = conn.execute(query).scalar()
+    if location_id is None:
+        conn.execute(_dialect_insert(conn)(Location).values(
+            name=DEFAULT_LOCATION_NAME, is_default=True).on_conflict_do_nothing())
+        location_id = conn.execute(query).scalar_one()
+    return location_id
+
+
+def apply_deltas(conn: Connection, deltas: Dict[Tuple[int, int], float]):
+    """Прибавляет изменения к остаткам (location_id, product_id) одним upsert."""
+    if not deltas:
+        return
+    stmt = _dialect_insert(conn)(LocationStock)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["location_id", "product_id"],
+        set_={"quantity": LocationStock.quantity + stmt.excluded.quantity})
+    conn.execute(stmt, [{"location_id": location_id, "product_id": product_id, "quantity": quantity}
+                        for (location_id, product_id), quantity in sorted(deltas.items())])
+
+
+def absorb_unallocated(conn: Connection, product_ids: Iterable[int], location_id: int) -> int:
+    """Прибавляет к месту по умолчанию часть общего остатка, не разнесённую по местам
+    (stock_quantity минус сумма всех мест), у товаров, где она не нулевая."""
+    allocated = select(func.coalesce(func.sum(LocationStock.quantity), 0.0)).where(
+        LocationStock.product_id == Product.id).scalar_subquery()
+    unallocated = Product.stock_quantity - allocated
+    rows = select(Product.id, literal(location_id), unallocated).where(
+        Product.id.in_(sorted(product_ids)), func.abs(unallocated) > 1e-9)
+    stmt = _dialect_insert(conn)(LocationStock).from_select(["product_id", "location_id", "quantity"], rows)
+    stmt = stmt.on_conflict_do_update(index_elements=["location_id", "product_id"],
+                                      set_={"quantity": LocationStock.quantity + stmt.excluded.quantity})
+    return conn.execute(stmt).rowcount
+
+
+def refresh_default(conn: Connection, product_ids: Optional[Iterable[int]] = None,
+                    location_id: Optional[int] = None) -> int:
+    """Остаток места по умолчанию = общий остаток минус остальные места (None — все товары)."""
+    location_id = location_id or default_location_id(conn)
+    elsewhere = select(func.coalesce(func.sum(LocationStock.quantity), 0.0)).where(
+        LocationStock.product_id == Product.id, LocationStock.location_id != location_id
+    ).scalar_subquery()
+    # WHERE обязателен: без него SQLite не разбирает INSERT ... SELECT ... ON CONFLICT
+    rows = select(Product.id, literal(location_id), Product.stock_quantity - elsewhere).where(
+        true() if product_ids is None else Product.id.in_(sorted(product_ids)))
+    stmt = _dialect_insert(conn)(LocationStock).from_select(["product_id", "location_id", "quantity"], rows)
+    stmt = stmt.on_conflict_do_update(index_elements=["location_id", "product_id"],
+                                      set_={"quantity": stmt.excluded.quantity})
+    return conn.execute(stmt).rowcount
+
+
+@event.listens_for(OrmSession, "before_flush")
+def _assign_default_location(session: OrmSession, flush_context, instances):
+    movements = [obj for obj in session.new if isinstance(obj, StockMovement)
+                 and obj.location_id is None and moves_location_stock(obj.type)]
+    if movements:
+        location_id = default_location_id(session.connection())
+        for movement in movements:
+            movement.location_id = location_id
+
+
+@event.listens_for(OrmSession, "after_flush")
+def _refresh_after_flush(session: OrmSession, flush_context):
+    product_ids = set()
+    deltas = defaultdict(float)
+    for obj in session.new:
+        if isinstance(obj, StockMovement) and moves_location_stock(obj.type):
+            product_ids.add(obj.product_id)
+            deltas[(obj.location_id, obj.product_id)] += obj.quantity
+    for obj in (*session.new, *session.dirty):
+        if isinstance(obj, Product) and (
+                obj in session.new or inspect(obj).attrs.stock_quantity.history.has_changes()):
+            product_ids.add(obj.id)
+    product_ids.discard(None)
+    if not product_ids:
+        return
+
+    conn = session.connection()
+    apply_deltas(conn, deltas)
+    absorb_unallocated(conn, product_ids, default_location_id(conn))
+    # Запись идёт мимо ORM-объектов — версию для ETag остатков по местам поднимет commit
+    defer_bump(session, ["locationstock"])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    import config
+    from db_pool import create_pooled_engine
+
+    if len(sys.argv) < 2 or sys.argv[1] != "rebuild":
+        print("Использование: python locations.py rebuild")
+        sys.exit(2)
+    with create_pooled_engine(config.DATABASE_URL).begin() as rebuild_conn:
+        print(f"Пересчитан остаток места по умолчанию у товаров: {refresh_default(rebuild_conn)}")
@@ -3,46 +3,68 @@
 # --- 1. Стандартная библиотека ---
 from fastapi.responses import JSONResponse
 from fastapi.exceptions import RequestValidationError
+import asyncio
 import io
 import os
 import re
 import logging
+import threading
 import hashlib
-import tempfile
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, wait
 from datetime import date, datetime, timedelta, timezone
 from enum import Enum
-from typing import List, Optional, Annotated, Type, Any
+from typing import Dict, List, Optional, Annotated, Tuple, Type, Any, Union
+from urllib.parse import quote
 
 # --- 2. Сторонние библиотеки ---
-import pandas as pd
-from docxtpl import DocxTemplate
 from fastapi import (
-    FastAPI, Depends, Form, HTTPException, UploadFile,
-    File, Query, BackgroundTasks
+    FastAPI, Depends, Form, Header, HTTPException, UploadFile,
+    File, Query, Request
 )
-import math
+from fastapi.datastructures import Default
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, Response
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from fuzzywuzzy import process as fuzzy_process
 from jose import JWTError, jwt
-from num2words import num2words
-from passlib.context import CryptContext
+import orjson
 from pydantic import BaseModel
-from sqlalchemy import func, or_, text
+from sqlalchemy import String, and_, cast, func, or_, text, update
 from sqlalchemy.orm import selectinload
-from sqlmodel import SQLModel, create_engine, Session, select
-import supabase
+from sqlmodel import SQLModel, Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 # --- 3. Локальные импорты ---
 # Убедитесь, что у вас есть файлы config.py и main_models.py
 import config
+from migrations import check_schema, HEAD_VERSION
+from db_pool import create_pooled_engine, create_pooled_async_engine, async_database_url, pool_stats
+import excel_import
+import executors
+from docx_templates import template_registry, render_template_job, DOCX_MEDIA_TYPE
+from document_cache import document_cache, make_document_key
+from excel_import import ImportFileError
+from executors import cpu_pool, run_in_process, run_in_thread
+import forecasting
+import stock_reconciliation
+from auth_sessions import AuthProvider, SupabaseAuthProvider, new_refresh_token, hash_refresh_token
+from token_cache import token_verifier, TOKEN_ISSUER
+from warmup import warm_up, warmup_state
+from etags import check_not_modified, check_not_modified_async
+from idempotency import IDEMPOTENCY_HEADER, run_idempotent
+import estimate_totals  # noqa: F401 — пересчёт итогов смет после flush
+import change_events
+import reorder_queue  # noqa: F401 — очередь закупки обновляется после flush
+import locations
+from http_encoding import CompressionMiddleware, OrjsonResponse
 from main_models import (
     Estimate, EstimateItem, EstimateStatusEnum,
     Contract, ContractStatusEnum, ContractTypeEnum,
-    UnitEnum, Product, Worker, StockMovement, MovementTypeEnum
+    UnitEnum, Product, Worker, StockMovement, MovementTypeEnum, AuthSession, ReorderQueue,
+    Stocktake, StocktakeLine, StocktakeStatusEnum, Location, LocationStock,
+    FiniteFloat, NonNegativeFiniteFloat
 )
-from supabase import create_client, Client, PostgrestAPIError
 
 # --- Настройка логирования ---
 logging.basicConfig(level=logging.INFO,
@@ -50,87 +72,36 @@ logging.basicConfig(level=logging.INFO,
 logger = logging.getLogger(__name__)
 
 # --- Настройка подключения к базе данных ---
-engine = create_engine(config.DATABASE_URL)
+engine = create_pooled_engine(config.DATABASE_URL)
 
-# Инициализация клиента Supabase (глобально)
-try:
-    supabase_client = create_client(config.SUPABASE_URL, config.SUPABASE_KEY)
-except Exception:
-    supabase_client = None
+# Асинхронный движок для читающих эндпоинтов (списки, история, отчёты, дашборд).
+# Остальные эндпоинты пока работают через синхронный engine.
+async_engine = create_pooled_async_engine(
+    config.ASYNC_DATABASE_URL or async_database_url(config.DATABASE_URL))
 
 
-def create_db_and_tables():
-    logger.info("Создание таблиц в базе данных...")
-    try:
-        SQLModel.metadata.create_all(engine)
-        logger.info("Таблицы успешно созданы (или уже существовали).")
-    except Exception as e:
-        logger.error(f"КРИТИЧЕСКАЯ ОШИБКА при создании таблиц: {e}")
-        # Мы не выбрасываем исключение дальше, чтобы приложение могло запуститься
-        # и мы могли получить хотя бы ответ 500 от эндпоинтов, а не падение процесса.
-        return
-    # Небольшая runtime-миграция: если мы добавили поле shipped_at в модель, но
-    # таблица уже существует без этой колонки, автоматически добавим колонку.
-    try:
-        with engine.begin() as conn:
-            res = conn.execute(text(
-                "SELECT column_name FROM information_schema.columns WHERE table_name='estimate' AND column_name='shipped_at'"))
-            if res.first() is None:
-                logger.info(
-                    "Колонка 'shipped_at' не найдена в таблице estimate — добавляю...")
-                conn.execute(
-                    text("ALTER TABLE estimate ADD COLUMN shipped_at TIMESTAMP WITH TIME ZONE"))
-                logger.info("Колонка 'shipped_at' успешно добавлена.")
-            # Runtime-миграция: убедимся, что enum movementtypeenum содержит необходимые значения
-            try:
-                enum_vals = conn.execute(
-                    text("SELECT enum_range(NULL::movementtypeenum)")).scalar()
-                if enum_vals and 'WRITE_OFF_WORKER' not in enum_vals:
-                    logger.info(
-                        "Значение 'WRITE_OFF_WORKER' не найдено в movementtypeenum — добавляю...")
-                    conn.execute(
-                        text("ALTER TYPE movementtypeenum ADD VALUE 'WRITE_OFF_WORKER'"))
-                    logger.info(
-                        "Значение 'WRITE_OFF_WORKER' успешно добавлено в movementtypeenum.")
-            except Exception as enum_exc:
-                # Если enum не существует или привязка иная — логируем и пропускаем
-                logger.debug(
-                    f"Не удалось проверить/обновить movementtypeenum: {enum_exc}")
-            # Runtime-миграция: добавить колонку min_price в таблицу contract, если её нет
-            try:
-                res_min = conn.execute(text(
-                    "SELECT column_name FROM information_schema.columns WHERE table_name='contract' AND column_name='min_price'"))
-                if res_min.first() is None:
-                    logger.info(
-                        "Колонка 'min_price' не найдена в таблице contract — добавляю...")
-                    # Используем тип DOUBLE PRECISION, допускающий NULL
-                    conn.execute(
-                        text("ALTER TABLE contract ADD COLUMN min_price DOUBLE PRECISION"))
-                    logger.info(
-                        "Колонка 'min_price' успешно добавлена в таблицу contract.")
-            except Exception as min_exc:
-                logger.exception(
-                    f"Не удалось добавить колонку 'min_price' в таблицу contract: {min_exc}")
-    except Exception as e:
-        logger.exception(f"Не удалось выполнить миграцию shipped_at: {e}")
-
 
 # --- КОНФИГУРАЦИЯ БЕЗОПАСНОСТИ ---
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+_pwd_context = None
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # --- Вспомогательные функции для аутентификации ---
 
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    # passlib/bcrypt загружаем только при первой проверке пароля
+    global _pwd_context
+    if _pwd_context is None:
+        from passlib.context import CryptContext
+        _pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    return _pwd_context.verify(plain_password, hashed_password)
 
 
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + \
         timedelta(minutes=config.ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "iss": TOKEN_ISSUER})
     encoded_jwt = jwt.encode(
         to_encode, config.SECRET_KEY, algorithm=config.ALGORITHM)
     return encoded_jwt
@@ -143,30 +114,22 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
         headers={"WWW-Authenticate": "Bearer"},
     )
 
-    # Попытка 1: это наш собственный JWT, подписанный SECRET_KEY
+    # Наш JWT (SECRET_KEY) или Supabase JWT (backwards compatibility) — секрет выбирается
+    # по issuer токена, повторные запросы с тем же токеном берутся из кэша
     try:
-        payload = jwt.decode(token, config.SECRET_KEY,
-                             algorithms=[config.ALGORITHM])
-        return payload
-    except JWTError:
-        # Если не наш токен — пробуем декодировать как Supabase JWT (backwards compatibility)
-        try:
-            payload = jwt.decode(
-                token,
-                config.SUPABASE_JWT_SECRET,
-                algorithms=["HS256"],
-                audience="authenticated"
-            )
-            return payload
-        except JWTError as e:
-            logger.error(f"Ошибка JWT при проверке токена: {e}")
-            raise credentials_exception
+        return token_verifier.verify(token)
+    except JWTError as e:
+        logger.error(f"Ошибка JWT при проверке токена: {e}")
+        raise credentials_exception
 
 
 # --- Основное приложение FastAPI ---
+# Default(...) сохраняет быстрый путь FastAPI (Pydantic dump_json) для эндпоинтов
+# с response_model; OrjsonResponse — для ответов без модели (см. http_encoding.py)
 app = FastAPI(
     title="Sklad V4 API",
-    description="API для управления складской системой."
+    description="API для управления складской системой.",
+    default_response_class=Default(OrjsonResponse)
 )
 
 
@@ -195,6 +158,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- Сжатие ответов (gzip/Brotli) ---
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=config.COMPRESSION_MIN_SIZE,
+    gzip_level=config.GZIP_LEVEL,
+    brotli_quality=config.BROTLI_QUALITY,
+)
+
 
 # --- Зависимость для сессии БД и вспомогательные функции ---
 def get_session():
@@ -202,6 +173,11 @@ def get_session():
         yield session
 
 
+async def get_async_session():
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
+
+
 def get_db_object_or_404(model: Type[SQLModel], obj_id: int, session: Session) -> SQLModel:
     obj = session.get(model, obj_id)
     if not obj:
@@ -210,49 +186,153 @@ def get_db_object_or_404(model: Type[SQLModel], obj_id: int, session: Session) -
     return obj
 
 
+async def aget_db_object_or_404(model: Type[SQLModel], obj_id: int, session: AsyncSession) -> SQLModel:
+    obj = await session.get(model, obj_id)
+    if not obj:
+        raise HTTPException(
+            status_code=404, detail=f"{model.__name__} с ID {obj_id} не найден")
+    return obj
+
+
 # --- Событие при старте приложения ---
 @app.on_event("startup")
-def on_startup():
-    create_db_and_tables()
+async def on_startup():
+    # Только проверка версии схемы; миграции — отдельной командой (python migrations.py upgrade)
+    version = await run_in_thread(check_schema, engine)
+    if version >= HEAD_VERSION:
+        warmup_state.set("schema", "ok", version=version)
+    else:
+        warmup_state.set("schema", "error", version=version, required=HEAD_VERSION)
+    if config.WARMUP_ON_STARTUP:
+        # Прогрев в фоне: приложение стартует сразу, /health/ready ждёт его окончания
+        app.state.warmup_task = asyncio.create_task(
+            warm_up(engine, async_engine, config.DB_POOL_WARM_CONNECTIONS))
+    if config.FORECAST_INTERVAL_MINUTES > 0:
+        app.state.forecast_task = asyncio.create_task(_forecast_loop())
+
+
+async def _forecast_loop():
+    """Периодический пересчёт прогноза расхода в пуле процессов."""
+    while True:
+        try:
+            await run_in_process(forecasting.run_forecast_job)
+        except Exception as e:
+            logger.error(f"Не удалось пересчитать прогноз расхода: {e}")
+        await asyncio.sleep(config.FORECAST_INTERVAL_MINUTES * 60)
 
 
-# --- Эндпоинт для получения токена ---
-@app.post("/token", summary="Получить токен доступа", tags=["Аутентификация"])
-async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
+@app.on_event("shutdown")
+async def on_shutdown():
+    forecast_task = getattr(app.state, "forecast_task", None)
+    if forecast_task:
+        forecast_task.cancel()
+    executors.shutdown()
+    await async_engine.dispose()
+
+
+# --- Проверки живости и готовности (для платформы) ---
+@app.get("/health/live", summary="Процесс жив", tags=["Служебные"])
+def health_live():
+    return {"status": "ok"}
+
+
+@app.get("/health/ready", summary="Экземпляр готов принимать трафик", tags=["Служебные"])
+async def health_ready():
+    components = warmup_state.snapshot()
+    started = time.perf_counter()
     try:
-        # Используем переименованный клиент и вызываем метод входа
-        res = supabase_client.auth.sign_in_with_password({
-            "email": form_data.username,
-            "password": form_data.password
-        })
+        async with async_engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+        components["database"] = {"status": "ok",
+                                  "latency_ms": round((time.perf_counter() - started) * 1000, 2)}
+    except Exception as e:
+        components["database"] = {"status": "error", "error": str(e)}
+    if "schema" not in components:
+        components["schema"] = {"status": "pending"}
+    # БД и схема обязательны; неудачный шаг прогрева только замедлит первые запросы,
+    # поэтому трафик не держим — ждём лишь, пока прогрев идёт
+    ready = (components["database"]["status"] == "ok" and components["schema"]["status"] == "ok"
+             and not any(c["status"] == "pending" for c in components.values()))
+    return JSONResponse(status_code=200 if ready else 503,
+                        content={"status": "ready" if ready else "not_ready", "components": components})
+
+
+# --- Эндпоинт для получения токена ---
+class TokenResponse(BaseModel):
+    access_token: str
+    token_type: str = "bearer"
+    refresh_token: str
+    expires_in: int
+
+
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
+
+
+auth_provider = SupabaseAuthProvider(config.SUPABASE_URL, config.SUPABASE_KEY)
+
+
+def get_auth_provider() -> AuthProvider:
+    return auth_provider
+
+
+def _session_invalid() -> HTTPException:
+    return HTTPException(
+        status_code=401,
+        detail="Сессия истекла или недействительна",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
 
-        # Надежная проверка ответа, как вы и предложили.
-        # Успешный ответ содержит объект session с access_token.
-        if res and res.session and res.session.access_token:
-            # Попробуем получить идентификатор пользователя из ответа Supabase
-            user_id = None
-            try:
-                # Некоторый SDK возвращает res.user или res.session.user
-                if hasattr(res, 'user') and getattr(res, 'user') and getattr(res.user, 'id', None):
-                    user_id = res.user.id
-                elif getattr(res.session, 'user', None) and getattr(res.session.user, 'id', None):
-                    user_id = res.session.user.id
-            except Exception:
-                user_id = None
-
-            # fallback: используем email как суб-идентификатор
-            if not user_id:
-                user_id = form_data.username
-
-            our_token = create_access_token({"sub": user_id})
-            return {"access_token": our_token, "token_type": "bearer"}
-        else:
-            # Если ответ пришел, но он пустой или в неожиданном формате
-            logger.error(
-                f"Неожиданный ответ от Supabase при аутентификации: {res}")
-            raise HTTPException(
-                status_code=401, detail="Не удалось получить токен из ответа Supabase")
 
+async def _open_auth_session(user_id: str, session: AsyncSession, auth_session: Optional[AuthSession] = None) -> TokenResponse:
+    """Выдаёт пару токенов. Для существующей сессии refresh-токен заменяется новым (ротация).
+
+    Ротация — условный UPDATE по прежнему хэшу: из двух одновременных продлений одним
+    токеном проходит одно, второе получает 401, и украденный токен не даёт второй сессии.
+    """
+    refresh_token = new_refresh_token()
+    now = datetime.utcnow()
+    if auth_session is None:
+        session.add(AuthSession(user_id=user_id, refresh_token_hash=hash_refresh_token(refresh_token),
+                                expires_at=now + timedelta(days=config.REFRESH_TOKEN_EXPIRE_DAYS)))
+    else:
+        rotated = await session.execute(update(AuthSession).where(
+            AuthSession.id == auth_session.id,
+            AuthSession.refresh_token_hash == auth_session.refresh_token_hash,
+            AuthSession.revoked_at.is_(None),
+        ).values(refresh_token_hash=hash_refresh_token(refresh_token), last_used_at=now
+                 ).execution_options(synchronize_session=False))
+        if rotated.rowcount != 1:
+            await session.rollback()
+            raise _session_invalid()
+    await session.commit()
+    return TokenResponse(access_token=create_access_token({"sub": user_id}), refresh_token=refresh_token,
+                         expires_in=config.ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+
+
+async def _get_active_auth_session(refresh_token: str, session: AsyncSession) -> AuthSession:
+    auth_session = (await session.exec(select(AuthSession).where(
+        AuthSession.refresh_token_hash == hash_refresh_token(refresh_token)))).first()
+    if not auth_session or auth_session.revoked_at is not None or auth_session.expires_at <= datetime.utcnow():
+        raise _session_invalid()
+    return auth_session
+
+
+@app.post("/token", response_model=TokenResponse, summary="Получить токен доступа", tags=["Аутентификация"])
+async def login_for_access_token(
+    form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
+    provider: AuthProvider = Depends(get_auth_provider),
+    session: AsyncSession = Depends(get_async_session)
+):
+    # Вызов Supabase блокирующий — выполняем его в пуле потоков и не ждём дольше таймаута
+    try:
+        user_id = await asyncio.wait_for(
+            run_in_thread(provider.sign_in, form_data.username, form_data.password),
+            timeout=config.AUTH_PROVIDER_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error("Supabase не ответил при аутентификации за отведённое время")
+        raise HTTPException(
+            status_code=504, detail="Сервис авторизации не отвечает, попробуйте позже")
     except Exception as e:
         # Если Supabase вернул ошибку (неверный пароль, пользователь не найден и т.д.)
         logger.error(f"Ошибка аутентификации Supabase: {e}")
@@ -261,6 +341,29 @@ async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    return await _open_auth_session(user_id, session)
+
+
+@app.post("/token/refresh", response_model=TokenResponse, summary="Продлить токен доступа", tags=["Аутентификация"])
+async def refresh_access_token(request: RefreshTokenRequest, session: AsyncSession = Depends(get_async_session)):
+    auth_session = await _get_active_auth_session(request.refresh_token, session)
+    return await _open_auth_session(auth_session.user_id, session, auth_session)
+
+
+@app.post("/token/revoke", summary="Завершить сессию (выход)", tags=["Аутентификация"])
+async def revoke_refresh_token(request: RefreshTokenRequest, session: AsyncSession = Depends(get_async_session)):
+    auth_session = await _get_active_auth_session(request.refresh_token, session)
+    # Условный UPDATE: токен, уже заменённый одновременным продлением, сессию не завершает
+    revoked = await session.execute(update(AuthSession).where(
+        AuthSession.id == auth_session.id,
+        AuthSession.refresh_token_hash == auth_session.refresh_token_hash,
+        AuthSession.revoked_at.is_(None),
+    ).values(revoked_at=datetime.utcnow()).execution_options(synchronize_session=False))
+    if revoked.rowcount != 1:
+        await session.rollback()
+        raise _session_invalid()
+    await session.commit()
+    return {"message": "Сессия завершена."}
 
 # --- Модели для API (вспомогательные) ---
 
@@ -271,25 +374,143 @@ class StockStatusFilter(str, Enum):
     OUT_OF_STOCK = "out_of_stock"
 
 
+class ListView(str, Enum):
+    """Набор полей в списках: summary — только то, что показывают страницы списков"""
+    SUMMARY = "summary"
+    FULL = "full"
+
+
+class ProductSummary(BaseModel):
+    id: int
+    internal_sku: str
+    name: str
+    supplier_sku: Optional[str] = None
+    unit: UnitEnum
+    stock_quantity: float
+    retail_price: float
+    is_favorite: bool
+    days_until_stockout: Optional[float] = None
+    suggested_reorder_qty: float
+
+
+class ProductSort(str, Enum):
+    NAME = "name"
+    DAYS_UNTIL_STOCKOUT = "days_until_stockout"
+    SUGGESTED_REORDER = "suggested_reorder_qty"
+
+
+class EstimateSummary(BaseModel):
+    id: int
+    estimate_number: str
+    client_name: str
+    location: Optional[str] = None
+    status: EstimateStatusEnum
+    created_at: datetime
+    worker_id: Optional[int] = None
+    shipped_at: Optional[datetime] = None
+    total_retail: float
+    item_count: int
+
+
+class EstimateSort(str, Enum):
+    CREATED = "created"
+    TOTAL = "total"
+
+
+class ContractSummary(BaseModel):
+    id: int
+    contract_type: ContractTypeEnum
+    contract_number: str
+    contract_date: datetime
+    client_name: str
+    location: str
+    status: ContractStatusEnum
+
+
+def select_view(model: Type[SQLModel], view_model: Type[BaseModel]):
+    """SELECT только колонок, объявленных в модели представления (без загрузки ORM-объектов)."""
+    return select(*[getattr(model, name) for name in view_model.model_fields])
+
+
+def rows_to_view(view_model: Type[BaseModel], rows) -> list:
+    # Через конструктор, а не model_validate: у табличных моделей SQLModel
+    # model_validate(dict) принимает dict.items за связь Estimate.items
+    return [view_model(**row._mapping) for row in rows]
+
+
+class ReorderQueueEntry(BaseModel):
+    """Товар в очереди закупки; id — id товара"""
+    id: int
+    name: str
+    internal_sku: str
+    unit: UnitEnum
+    stock_quantity: float
+    min_stock_level: float
+    shortfall: float
+    went_low_at: datetime
+    consumption_rate: float
+    days_until_stockout: Optional[float] = None
+    suggested_reorder_qty: float
+
+
+class ReorderQueuePage(BaseModel):
+    total: int
+    items: List[ReorderQueueEntry]
+
+
 class ProductPage(BaseModel):
     total: int
     items: List[Product]
 
 
+class ProductSummaryPage(BaseModel):
+    total: int
+    items: List[ProductSummary]
+
+
 class IssueItemRequest(BaseModel):
     product_id: int
     worker_id: int
-    quantity: float
+    quantity: FiniteFloat
+    # None — место хранения по умолчанию
+    location_id: Optional[int] = None
 
 
 class ReceiveItemRequest(BaseModel):
     product_id: int
-    quantity: float
+    quantity: FiniteFloat
+    location_id: Optional[int] = None
 
 
 class ReturnItemRequest(BaseModel):
     product_id: int
     worker_id: int
+    quantity: FiniteFloat
+    location_id: Optional[int] = None
+
+
+class TransferItemRequest(BaseModel):
+    product_id: int
+    from_location_id: int
+    to_location_id: int
+    quantity: FiniteFloat
+
+
+class LocationCreate(BaseModel):
+    name: str
+
+
+class LocationStockItem(BaseModel):
+    product_id: int
+    product_name: str
+    internal_sku: str
+    unit: UnitEnum
+    quantity: float
+
+
+class ProductLocationBalance(BaseModel):
+    location_id: int
+    location_name: str
     quantity: float
 
 
@@ -300,10 +521,81 @@ class WorkerStockItem(BaseModel):
     unit: str
 
 
+class WorkerStockMatrixWorkers(BaseModel):
+    id: List[int]
+    name: List[str]
+    total: List[float]
+
+
+class WorkerStockMatrixProducts(BaseModel):
+    id: List[int]
+    name: List[str]
+    unit: List[str]
+    total: List[float]
+
+
+class WorkerStockMatrixCells(BaseModel):
+    # Разреженная матрица в координатном формате: индексы в workers и products
+    worker: List[int]
+    product: List[int]
+    quantity: List[float]
+
+
+class WorkerStockMatrix(BaseModel):
+    """Остатки на руках всех работников по колонкам: оси и ненулевые ячейки"""
+    workers: WorkerStockMatrixWorkers
+    products: WorkerStockMatrixProducts
+    cells: WorkerStockMatrixCells
+
+
+class StocktakeCreate(BaseModel):
+    note: Optional[str] = None
+    # None — все неудалённые товары
+    product_ids: Optional[List[int]] = None
+
+
+class StocktakeCount(BaseModel):
+    product_id: int
+    counted_quantity: NonNegativeFiniteFloat
+
+
+class StocktakeSummary(BaseModel):
+    id: int
+    note: Optional[str]
+    status: StocktakeStatusEnum
+    created_at: datetime
+    posted_at: Optional[datetime]
+    line_count: int
+    counted_count: int
+
+
+class StocktakeLineResponse(BaseModel):
+    product_id: int
+    product_name: str
+    internal_sku: str
+    unit: UnitEnum
+    expected_quantity: float
+    # Изменение склада движениями от начала инвентаризации до подсчёта товара
+    movements_during_count: float
+    counted_quantity: Optional[float]
+    # До проведения — предварительное расхождение, после — проведённое
+    variance: Optional[float]
+
+
+class StocktakeResponse(StocktakeSummary):
+    lines: List[StocktakeLineResponse]
+
+
+class StocktakePostResult(BaseModel):
+    posted: int
+    adjustments: int
+    uncounted: int
+
+
 class EstimateItemCreate(BaseModel):
     product_id: int
-    quantity: float
-    unit_price: Optional[float] = None
+    quantity: NonNegativeFiniteFloat
+    unit_price: Optional[NonNegativeFiniteFloat] = None
 
 
 class EstimateCreate(BaseModel):
@@ -339,6 +631,11 @@ class EstimatePage(BaseModel):
     items: List[Estimate]
 
 
+class EstimateSummaryPage(BaseModel):
+    total: int
+    items: List[EstimateSummary]
+
+
 class ContractUpdate(BaseModel):
     client_name: Optional[str] = None
     location: Optional[str] = None
@@ -349,25 +646,25 @@ class ContractUpdate(BaseModel):
     passport_issue_date: Optional[str] = None
     passport_dep_code: Optional[str] = None
     passport_address: Optional[str] = None
-    estimated_depth: Optional[float] = None
-    price_per_meter_soil: Optional[float] = None
-    price_per_meter_rock: Optional[float] = None
-    actual_depth_soil: Optional[float] = None
-    actual_depth_rock: Optional[float] = None
-    pipe_steel_used: Optional[float] = None
-    pipe_plastic_used: Optional[float] = None
+    estimated_depth: Optional[FiniteFloat] = None
+    price_per_meter_soil: Optional[FiniteFloat] = None
+    price_per_meter_rock: Optional[FiniteFloat] = None
+    actual_depth_soil: Optional[FiniteFloat] = None
+    actual_depth_rock: Optional[FiniteFloat] = None
+    pipe_steel_used: Optional[FiniteFloat] = None
+    pipe_plastic_used: Optional[FiniteFloat] = None
     status: Optional[ContractStatusEnum] = None
     contract_type: Optional[ContractTypeEnum] = None
 
 
 class RevenueCalcRequest(BaseModel):
-    meters_soil: float
-    meters_rock: float
-    steel_pipe_meters: Optional[float] = None
-    steel_pipe_price_per_meter: Optional[float] = None
-    plastic_pipe_meters: Optional[float] = None
-    plastic_pipe_price_per_meter: Optional[float] = None
-    min_price: Optional[float] = None
+    meters_soil: FiniteFloat
+    meters_rock: FiniteFloat
+    steel_pipe_meters: Optional[FiniteFloat] = None
+    steel_pipe_price_per_meter: Optional[FiniteFloat] = None
+    plastic_pipe_meters: Optional[FiniteFloat] = None
+    plastic_pipe_price_per_meter: Optional[FiniteFloat] = None
+    min_price: Optional[FiniteFloat] = None
     # optional lookup keys — если не переданы, используются константы по умолчанию
     steel_internal_sku: Optional[str] = None
     plastic_internal_sku: Optional[str] = None
@@ -413,10 +710,10 @@ class ProductUpdate(BaseModel):
     name: Optional[str] = None
     supplier_sku: Optional[str] = None
     unit: Optional[UnitEnum] = None
-    purchase_price: Optional[float] = None
-    retail_price: Optional[float] = None
-    stock_quantity: Optional[float] = None
-    min_stock_level: Optional[float] = None
+    purchase_price: Optional[NonNegativeFiniteFloat] = None
+    retail_price: Optional[NonNegativeFiniteFloat] = None
+    stock_quantity: Optional[FiniteFloat] = None
+    min_stock_level: Optional[NonNegativeFiniteFloat] = None
     internal_sku: Optional[str] = None
     is_favorite: Optional[bool] = None
 
@@ -445,7 +742,7 @@ class AddItemsRequest(BaseModel):
 class WriteOffItemRequest(BaseModel):
     product_id: int
     worker_id: int
-    quantity: float
+    quantity: FiniteFloat
 
 
 class ProfitReportItem(BaseModel):
@@ -475,6 +772,21 @@ class DashboardSummary(BaseModel):
     drilling_profit_last_30_days: float
 
 
+class EstimateDocumentBatchRequest(BaseModel):
+    ids: Optional[List[int]] = None
+    start_date: Optional[date] = None
+    end_date: Optional[date] = None
+    status: Optional[EstimateStatusEnum] = None
+
+
+class ContractDocumentBatchRequest(BaseModel):
+    ids: Optional[List[int]] = None
+    start_date: Optional[date] = None
+    end_date: Optional[date] = None
+    status: Optional[ContractStatusEnum] = None
+    contract_type: Optional[ContractTypeEnum] = None
+
+
 # --- Эндпоинты для Товаров (Products) ---
 @app.post("/products/", response_model=Product, summary="Добавить новый товар", tags=["Товары"])
 def create_product(current_user: Annotated[dict, Depends(get_current_user)], product: Product, session: Session = Depends(get_session)):
@@ -493,17 +805,28 @@ def create_product(current_user: Annotated[dict, Depends(get_current_user)], pro
     return product
 
 
-@app.get("/products/", response_model=ProductPage, summary="Получить список товаров", tags=["Товары"])
-def read_products(
+@app.get("/products/", response_model=Union[ProductPage, ProductSummaryPage], summary="Получить список товаров", tags=["Товары"])
+async def read_products(
     current_user: Annotated[dict, Depends(get_current_user)],
+    request: Request,
+    response: Response,
     search: Optional[str] = None,
     stock_status: StockStatusFilter = StockStatusFilter.ALL,
     page: int = Query(1, gt=0),
     size: int = Query(50, gt=0, le=200),
-    session: Session = Depends(get_session)
+    view: ListView = ListView.FULL,
+    sort_by: ProductSort = ProductSort.NAME,
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    location_id: Optional[int] = Query(None, description="Только товары с остатком на этом месте хранения"),
+    session: AsyncSession = Depends(get_async_session)
 ):
+    tables = ("product",) if location_id is None else ("product", "locationstock")
+    not_modified = await check_not_modified_async(session, tables, request, response)
+    if not_modified:
+        return not_modified
     offset = (page - 1) * size
-    query = select(Product).where(Product.is_deleted == False)
+    view_model = ProductSummary if view == ListView.SUMMARY else Product
+    query = select_view(Product, view_model).where(Product.is_deleted == False)
     if search:
         search_term = f"%{search}%"
         query = query.where(
@@ -514,40 +837,54 @@ def read_products(
             )
         )
     if stock_status == StockStatusFilter.LOW_STOCK:
-        # Only consider products that have a configured minimum stock (> 0).
-        # Show products where current stock is less or equal to the configured minimum.
-        query = query.where((Product.min_stock_level > 0) & (
-            Product.stock_quantity <= Product.min_stock_level))
+        # Товары с остатком не выше минимального — очередь закупки (см. reorder_queue.py)
+        query = query.join(ReorderQueue, ReorderQueue.product_id == Product.id)
     elif stock_status == StockStatusFilter.OUT_OF_STOCK:
         query = query.where(Product.stock_quantity <= 0)
+    if location_id is not None:
+        query = query.join(LocationStock, and_(LocationStock.product_id == Product.id,
+                                               LocationStock.location_id == location_id,
+                                               LocationStock.quantity > 0))
 
     count_query = select(func.count()).select_from(query.subquery())
-    total_count = session.exec(count_query).one()
-    paginated_query = query.offset(offset).limit(
-        size).order_by(Product.is_favorite.desc(), Product.name)
+    total_count = (await session.exec(count_query)).one()
+    if sort_by == ProductSort.NAME:
+        ordering = (Product.is_favorite.desc(), Product.name.desc() if order == "desc" else Product.name)
+    else:
+        # Прогноз (см. forecasting.py); товары без расхода (NULL) — в конце
+        column = getattr(Product, sort_by.value)
+        ordering = (column.is_(None), column.desc() if order == "desc" else column.asc(), Product.name)
+    paginated_query = query.offset(offset).limit(size).order_by(*ordering)
 
-    items = session.exec(paginated_query).all()
+    # NaN/Infinity в числовых полях исключены CHECK-ограничениями таблицы
+    items = rows_to_view(view_model, (await session.exec(paginated_query)).all())
+    if view == ListView.SUMMARY:
+        return ProductSummaryPage(total=total_count, items=items)
+    return ProductPage(total=total_count, items=items)
 
-    # --- ИСПРАВЛЕНИЕ ОШИБКИ NaN ---
-    # Пробегаемся по всем найденным товарам и чиним "сломанные" числа перед отправкой
-    cleaned_items = []
-    for item in items:
-        # Преобразуем в словарь, чтобы гарантированно очистить данные
-        item_dict = item.model_dump()
-        
-        # Список полей типа float в модели Product, которые могут быть NaN
-        float_fields = ['stock_quantity', 'purchase_price', 'retail_price', 'min_stock_level']
-        
-        for field in float_fields:
-            val = item_dict.get(field)
-            if val is not None and isinstance(val, float) and (math.isnan(val) or math.isinf(val)):
-                logger.warning(f"Product ID={item_dict.get('id')}: Field '{field}' is {val}. Resetting to 0.0")
-                item_dict[field] = 0.0
-        
-        cleaned_items.append(item_dict)
-    # ------------------------------
 
-    return ProductPage(total=total_count, items=cleaned_items)
+@app.get("/reorder-queue/", response_model=ReorderQueuePage, summary="Очередь закупки: товары ниже минимального остатка", tags=["Товары"])
+async def read_reorder_queue(
+    current_user: Annotated[dict, Depends(get_current_user)],
+    request: Request,
+    response: Response,
+    since: Optional[datetime] = Query(
+        None, description="Только товары, попавшие в очередь после этого момента"),
+    session: AsyncSession = Depends(get_async_session)
+):
+    # Очередь меняется только вместе с товаром, поэтому ETag — по версии таблицы product
+    not_modified = await check_not_modified_async(session, ("product",), request, response)
+    if not_modified:
+        return not_modified
+    query = select(
+        Product.id, Product.name, Product.internal_sku, Product.unit, Product.stock_quantity,
+        Product.min_stock_level, ReorderQueue.shortfall, ReorderQueue.went_low_at,
+        Product.consumption_rate, Product.days_until_stockout, Product.suggested_reorder_qty
+    ).join(ReorderQueue, ReorderQueue.product_id == Product.id)
+    if since:
+        query = query.where(ReorderQueue.went_low_at > since)
+    rows = (await session.exec(query.order_by(ReorderQueue.went_low_at.desc(), Product.name))).all()
+    return ReorderQueuePage(total=len(rows), items=rows_to_view(ReorderQueueEntry, rows))
 
 
 @app.patch("/products/{product_id}", response_model=Product, summary="Обновить товар", tags=["Товары"])
@@ -615,7 +952,10 @@ def create_worker(current_user: Annotated[dict, Depends(get_current_user)], work
 
 
 @app.get("/workers/", response_model=List[Worker], summary="Получить список всех работников", tags=["Работники"])
-def read_workers(current_user: Annotated[dict, Depends(get_current_user)], session: Session = Depends(get_session)):
+def read_workers(current_user: Annotated[dict, Depends(get_current_user)], request: Request, response: Response, session: Session = Depends(get_session)):
+    not_modified = check_not_modified(session, ("worker",), request, response)
+    if not_modified:
+        return not_modified
     return session.exec(select(Worker).order_by(Worker.name)).all()
 
 
@@ -642,39 +982,143 @@ def delete_worker(current_user: Annotated[dict, Depends(get_current_user)], work
     return None
 
 
+# --- Эндпоинты для Мест хранения (Locations) ---
+# Остатки по местам ведутся в транзакции записи (см. locations.py); запросы ниже —
+# поиск по первичному ключу (location_id, product_id) или индексу product_id.
+@app.post("/locations/", response_model=Location, summary="Добавить место хранения", tags=["Места хранения"])
+def create_location(current_user: Annotated[dict, Depends(get_current_user)], request: LocationCreate, session: Session = Depends(get_session)):
+    if session.exec(select(Location).where(Location.name == request.name)).first():
+        raise HTTPException(status_code=400, detail=f"Место хранения '{request.name}' уже существует.")
+    # Место по умолчанию создаётся раньше остальных: на него приходится нераспределённый остаток
+    locations.default_location_id(session.connection())
+    location = Location(name=request.name)
+    session.add(location)
+    session.commit()
+    session.refresh(location)
+    return location
+
+
+@app.get("/locations/", response_model=List[Location], summary="Получить список мест хранения", tags=["Места хранения"])
+def read_locations(current_user: Annotated[dict, Depends(get_current_user)], session: Session = Depends(get_session)):
+    return session.exec(select(Location).order_by(Location.is_default.desc(), Location.name)).all()
+
+
+@app.get("/locations/{location_id}/stock", response_model=List[LocationStockItem], summary="Остатки на месте хранения", tags=["Места хранения"])
+async def read_location_stock(current_user: Annotated[dict, Depends(get_current_user)], location_id: int, request: Request,
+                              response: Response, session: AsyncSession = Depends(get_async_session)):
+    not_modified = await check_not_modified_async(session, ("locationstock", "product"), request, response)
+    if not_modified:
+        return not_modified
+    if not await session.get(Location, location_id):
+        raise HTTPException(status_code=404, detail=f"Location с ID {location_id} не найден")
+    rows = (await session.exec(select(
+        LocationStock.product_id, Product.name.label("product_name"), Product.internal_sku, Product.unit,
+        LocationStock.quantity,
+    ).join(Product, Product.id == LocationStock.product_id).where(
+        LocationStock.location_id == location_id, LocationStock.quantity != 0, Product.is_deleted == False
+    ).order_by(Product.name))).all()
+    return rows_to_view(LocationStockItem, rows)
+
+
+@app.get("/products/{product_id}/locations", response_model=List[ProductLocationBalance], summary="Остатки товара по местам хранения", tags=["Места хранения"])
+def read_product_locations(current_user: Annotated[dict, Depends(get_current_user)], product_id: int, session: Session = Depends(get_session)):
+    get_db_object_or_404(Product, product_id, session)
+    rows = session.exec(select(
+        LocationStock.location_id, Location.name.label("location_name"), LocationStock.quantity,
+    ).join(Location, Location.id == LocationStock.location_id).where(
+        LocationStock.product_id == product_id, LocationStock.quantity != 0
+    ).order_by(Location.is_default.desc(), Location.name)).all()
+    return rows_to_view(ProductLocationBalance, rows)
+
+
 # --- Вспомогательные функции ---
 def validate_quantity(qty: float) -> float:
-    if math.isnan(qty) or math.isinf(qty):
-        raise HTTPException(status_code=400, detail="Количество не может быть NaN или бесконечностью.")
+    # NaN и бесконечность отклоняются ещё при валидации запроса (FiniteFloat)
     if qty <= 0:
         raise HTTPException(status_code=400, detail="Количество должно быть > 0")
     return qty
 
+
+def resolve_location_id(location_id: Optional[int], session: Session) -> int:
+    """Место хранения операции: указанное (404, если его нет) или место по умолчанию."""
+    if location_id is None:
+        return locations.default_location_id(session.connection())
+    return get_db_object_or_404(Location, location_id, session).id
+
+
+def lock_products(session: Session, product_ids) -> Dict[int, Product]:
+    """Товары под блокировкой (SELECT ... FOR UPDATE) по возрастанию id; 404, если товара нет.
+
+    Во всех операциях строки товаров блокируются раньше остатков по местам
+    (lock_location_balances): одинаковый порядок исключает взаимоблокировки.
+    """
+    product_ids = sorted(set(product_ids))
+    # populate_existing: уже загруженный в сессию товар перечитывается под блокировкой
+    products = {p.id: p for p in session.exec(select(Product).where(
+        Product.id.in_(product_ids)).order_by(Product.id).with_for_update().execution_options(
+        populate_existing=True)).all()} if product_ids else {}
+    missing = [pid for pid in product_ids if pid not in products]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Product с ID {missing[0]} не найден")
+    return products
+
+
+def lock_location_balances(session: Session, product_id: int, location_ids: List[int]) -> Dict[int, float]:
+    """Остатки товара на местах под блокировкой (в порядке location_id); нет строки — 0."""
+    rows = session.exec(select(LocationStock.location_id, LocationStock.quantity).where(
+        LocationStock.product_id == product_id, LocationStock.location_id.in_(location_ids)
+    ).order_by(LocationStock.location_id).with_for_update()).all()
+    return {**dict.fromkeys(location_ids, 0.0), **dict(rows)}
+
+
+def require_location_stock(session: Session, location_id: int, required: Dict[int, float], products: Dict[int, Product]):
+    """Проверяет под блокировкой, что товаров хватает на месте хранения; иначе 400.
+    Товары products уже заблокированы (lock_products)."""
+    for product_id in sorted(required):
+        available = lock_location_balances(session, product_id, [location_id])[location_id]
+        if available + 1e-9 < required[product_id]:
+            raise HTTPException(
+                status_code=400, detail=f"Недостаточно товара '{products[product_id].name}' на месте хранения. В наличии: {available}, требуется: {required[product_id]}")
+
+
+def lock_default_location_debits(session: Session, debits: Dict[int, float]) -> Tuple[Dict[int, Product], int]:
+    """Для списаний без места хранения: блокирует товары, затем их остатки на месте
+    по умолчанию и проверяет, что списания {product_id: количество} хватает (иначе 400).
+    Возвращает заблокированные товары и место по умолчанию."""
+    products = lock_products(session, debits)
+    location_id = resolve_location_id(None, session)
+    require_location_stock(session, location_id, debits, products)
+    return products, location_id
+
 # --- Эндпоинты для Операций (Actions) ---
 @app.post("/actions/issue-item/", response_model=StockMovement, summary="Выдать товар работнику", tags=["Операции"])
-def issue_item_to_worker(current_user: Annotated[dict, Depends(get_current_user)], request: IssueItemRequest, session: Session = Depends(get_session)):
+def issue_item_to_worker(current_user: Annotated[dict, Depends(get_current_user)], request: IssueItemRequest, session: Session = Depends(get_session),
+                         idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER)):
+    return run_idempotent(session, current_user, idempotency_key, f"issue-item:{request.model_dump_json()}",
+                          lambda: _issue_item_to_worker(request, session))
+
+
+def _issue_item_to_worker(request: IssueItemRequest, session: Session) -> StockMovement:
     validate_quantity(request.quantity)
-    product = get_db_object_or_404(Product, request.product_id, session)
+    product = lock_products(session, [request.product_id])[request.product_id]
     worker = get_db_object_or_404(Worker, request.worker_id, session)
-    
-    # Ensure product stock is valid
-    if math.isnan(product.stock_quantity):
-        product.stock_quantity = 0.0
+    location_id = resolve_location_id(request.location_id, session)
 
     if product.stock_quantity < request.quantity:
         raise HTTPException(
             status_code=400, detail=f"Недостаточно товара. В наличии: {product.stock_quantity}")
+    require_location_stock(session, location_id, {product.id: request.quantity}, {product.id: product})
 
     product.stock_quantity -= request.quantity
     movement = StockMovement(
         product_id=request.product_id, worker_id=request.worker_id,
         quantity=-request.quantity, type=MovementTypeEnum.ISSUE_TO_WORKER,
-        stock_after=product.stock_quantity
+        stock_after=product.stock_quantity, location_id=location_id
     )
     session.add(product)
     session.add(movement)
-    session.commit()
-    session.refresh(movement)
+    # commit делает run_idempotent — вместе с записью ответа ключа
+    session.flush()
     return movement
 
 
@@ -683,16 +1127,17 @@ def receive_item_on_stock(current_user: Annotated[dict, Depends(get_current_user
     """Увеличивает остаток товара и создаёт движение типа INCOME."""
     validate_quantity(request.quantity)
     product = get_db_object_or_404(Product, request.product_id, session)
+    location_id = resolve_location_id(request.location_id, session)
 
     # Обновляем остаток
-    current_stock = product.stock_quantity if not math.isnan(product.stock_quantity) else 0.0
-    product.stock_quantity = current_stock + request.quantity
-    
+    product.stock_quantity += request.quantity
+
     movement = StockMovement(
         product_id=request.product_id,
         quantity=request.quantity,
         type=MovementTypeEnum.INCOME,
-        stock_after=product.stock_quantity
+        stock_after=product.stock_quantity,
+        location_id=location_id
     )
     session.add(product)
     session.add(movement)
@@ -706,14 +1151,14 @@ def return_item_from_worker(current_user: Annotated[dict, Depends(get_current_us
     validate_quantity(request.quantity)
     product = get_db_object_or_404(Product, request.product_id, session)
     worker = get_db_object_or_404(Worker, request.worker_id, session)
+    location_id = resolve_location_id(request.location_id, session)
+
+    product.stock_quantity += request.quantity
 
-    current_stock = product.stock_quantity if not math.isnan(product.stock_quantity) else 0.0
-    product.stock_quantity = current_stock + request.quantity
-    
     movement = StockMovement(
         product_id=request.product_id, worker_id=request.worker_id,
         quantity=request.quantity, type=MovementTypeEnum.RETURN_FROM_WORKER,
-        stock_after=product.stock_quantity
+        stock_after=product.stock_quantity, location_id=location_id
     )
     session.add(product)
     session.add(movement)
@@ -722,6 +1167,35 @@ def return_item_from_worker(current_user: Annotated[dict, Depends(get_current_us
     return movement
 
 
+@app.post("/actions/transfer-item/", response_model=List[StockMovement], summary="Переместить товар между местами хранения", tags=["Операции"])
+def transfer_item(current_user: Annotated[dict, Depends(get_current_user)], request: TransferItemRequest, session: Session = Depends(get_session)):
+    """Создаёт пару движений TRANSFER (-q на месте-источнике, +q на месте-получателе).
+    Общий остаток товара не меняется."""
+    validate_quantity(request.quantity)
+    if request.from_location_id == request.to_location_id:
+        raise HTTPException(status_code=400, detail="Место-источник и место-получатель совпадают.")
+    product = lock_products(session, [request.product_id])[request.product_id]
+    source = get_db_object_or_404(Location, request.from_location_id, session)
+    target = get_db_object_or_404(Location, request.to_location_id, session)
+
+    available = lock_location_balances(session, product.id, [source.id, target.id])[source.id]
+    if available < request.quantity:
+        raise HTTPException(
+            status_code=400, detail=f"Недостаточно товара на месте '{source.name}'. В наличии: {available}")
+
+    movements = [
+        StockMovement(product_id=product.id, quantity=-request.quantity, type=MovementTypeEnum.TRANSFER,
+                      stock_after=product.stock_quantity, location_id=source.id),
+        StockMovement(product_id=product.id, quantity=request.quantity, type=MovementTypeEnum.TRANSFER,
+                      stock_after=product.stock_quantity, location_id=target.id),
+    ]
+    session.add_all(movements)
+    session.commit()
+    for movement in movements:
+        session.refresh(movement)
+    return movements
+
+
 @app.get("/actions/worker-stock/{worker_id}", response_model=List[WorkerStockItem], summary="Получить товары на руках у работника", tags=["Операции"])
 def get_worker_stock(current_user: Annotated[dict, Depends(get_current_user)], worker_id: int, session: Session = Depends(get_session)):
     get_db_object_or_404(Worker, worker_id, session)
@@ -733,11 +1207,7 @@ def get_worker_stock(current_user: Annotated[dict, Depends(get_current_user)], w
     )).all()
     worker_stock = []
     for product_id, product_name, unit, total_quantity in results:
-        # Check for None or NaN in total_quantity
-        if total_quantity is None or math.isnan(total_quantity):
-            total_quantity = 0.0
-            
-        quantity_on_hand = -total_quantity
+        quantity_on_hand = -(total_quantity or 0.0)
         if quantity_on_hand > 0.001:  # Порог для чисел с плавающей точкой
             worker_stock.append(WorkerStockItem(
                 product_id=product_id, product_name=product_name,
@@ -746,6 +1216,53 @@ def get_worker_stock(current_user: Annotated[dict, Depends(get_current_user)], w
     return worker_stock
 
 
+@app.get("/actions/worker-stock-matrix", response_model=WorkerStockMatrix, summary="Товары на руках у всех работников (матрица)", tags=["Операции"])
+async def get_worker_stock_matrix(
+    current_user: Annotated[dict, Depends(get_current_user)],
+    product_id: Optional[List[int]] = Query(None, description="Только эти товары"),
+    session: AsyncSession = Depends(get_async_session)
+):
+    """Один сгруппированный запрос по (работник, товар); в ответ попадают только
+    ненулевые остатки, итоги по работникам и товарам считаются по ним же."""
+    on_hand = -func.sum(StockMovement.quantity)
+    query = select(
+        Worker.id, Worker.name, Product.id, Product.name, Product.unit, on_hand
+    ).join(Worker, Worker.id == StockMovement.worker_id).join(Product, Product.id == StockMovement.product_id)
+    if product_id:
+        query = query.where(StockMovement.product_id.in_(product_id))
+    query = query.group_by(
+        Worker.id, Worker.name, Product.id, Product.name, Product.unit
+    ).having(on_hand > 0.001).order_by(Worker.name, Product.name)
+
+    workers = {"id": [], "name": [], "total": []}
+    products = {"id": [], "name": [], "unit": [], "total": []}
+    cells = {"worker": [], "product": [], "quantity": []}
+    worker_index, product_index = {}, {}
+    for w_id, w_name, p_id, p_name, unit, quantity in (await session.exec(query)).all():
+        if w_id not in worker_index:
+            worker_index[w_id] = len(workers["id"])
+            workers["id"].append(w_id)
+            workers["name"].append(w_name)
+            workers["total"].append(0.0)
+        if p_id not in product_index:
+            product_index[p_id] = len(products["id"])
+            products["id"].append(p_id)
+            products["name"].append(p_name)
+            products["unit"].append(unit.value)
+            products["total"].append(0.0)
+        quantity = round(quantity, 3)
+        cells["worker"].append(worker_index[w_id])
+        cells["product"].append(product_index[p_id])
+        cells["quantity"].append(quantity)
+        workers["total"][worker_index[w_id]] += quantity
+        products["total"][product_index[p_id]] += quantity
+    workers["total"] = [round(t, 3) for t in workers["total"]]
+    products["total"] = [round(t, 3) for t in products["total"]]
+    return WorkerStockMatrix(workers=WorkerStockMatrixWorkers(**workers),
+                             products=WorkerStockMatrixProducts(**products),
+                             cells=WorkerStockMatrixCells(**cells))
+
+
 @app.post("/actions/write-off-item/", response_model=StockMovement, summary="Списать товар, числящийся за работником", tags=["Операции"])
 def write_off_item_from_worker(current_user: Annotated[dict, Depends(get_current_user)], request: WriteOffItemRequest, session: Session = Depends(get_session)):
     validate_quantity(request.quantity)
@@ -757,10 +1274,6 @@ def write_off_item_from_worker(current_user: Annotated[dict, Depends(get_current
         StockMovement.worker_id == request.worker_id,
         StockMovement.product_id == request.product_id
     )).one()
-    
-    if current_on_hand_sum is None or math.isnan(current_on_hand_sum):
-        current_on_hand_sum = 0.0
-        
     quantity_on_hand = -float(current_on_hand_sum)
 
     # Проверяем, достаточно ли товара для списания
@@ -776,7 +1289,7 @@ def write_off_item_from_worker(current_user: Annotated[dict, Depends(get_current
         worker_id=request.worker_id,
         quantity=write_off_quantity,  # Используем гарантированно положительное значение
         type=MovementTypeEnum.WRITE_OFF_WORKER,
-        stock_after=product.stock_quantity if not math.isnan(product.stock_quantity) else 0.0 # Остаток на общем складе не меняется, но сохраняем актуальный
+        stock_after=product.stock_quantity  # Остаток на общем складе не меняется, но сохраняем актуальный
     )
 
     # Добавляем лог для отладки, чтобы видеть, что именно сохраняется в БД
@@ -795,12 +1308,14 @@ class HistoryPage(BaseModel):
 
 
 @app.get("/actions/history/", response_model=HistoryPage, summary="Получить историю всех движений", tags=["Операции"])
-def get_history(
+async def get_history(
     current_user: Annotated[dict, Depends(get_current_user)],
     search: Optional[str] = Query(
         None, description="Поиск по названию товара или имени работника"),
     worker_id: Optional[int] = Query(
         None, description="Фильтр по ID работника"),
+    location_id: Optional[int] = Query(
+        None, description="Фильтр по ID места хранения"),
     movement_type: Optional[str] = Query(
         None, description="Фильтр по типу движения (например: INCOME, ISSUE_TO_WORKER)"),
     start_date: Optional[date] = Query(
@@ -809,45 +1324,45 @@ def get_history(
         None, description="Конечная дата (включительно)"),
     page: int = Query(1, gt=0),
     size: int = Query(50, gt=0, le=500),
-    session: Session = Depends(get_session)
+    view: ListView = ListView.FULL,
+    session: AsyncSession = Depends(get_async_session)
 ):
-    # PERFORMANCE: N+1 FIX + server-side filtering
-    query = select(StockMovement).options(
-        selectinload(StockMovement.product),
-        selectinload(StockMovement.worker)
-    ).order_by(StockMovement.id.desc())
+    # Фильтры только по StockMovement: count считается без JOIN
+    filters = []
 
     # If explicit worker_id filter provided, apply it
     if worker_id is not None:
-        query = query.where(StockMovement.worker_id == worker_id)
+        filters.append(StockMovement.worker_id == worker_id)
+    if location_id is not None:
+        filters.append(StockMovement.location_id == location_id)
 
     # Filter by movement type if provided
     if movement_type:
-        query = query.where(StockMovement.type == movement_type)
+        filters.append(StockMovement.type == movement_type)
 
     # Filter by date range (timestamp assumed datetime)
     if start_date and end_date:
-        query = query.where(StockMovement.timestamp >= datetime.combine(start_date, datetime.min.time()),
-                            StockMovement.timestamp < datetime.combine(end_date + timedelta(days=1), datetime.min.time()))
+        filters.append(StockMovement.timestamp >= datetime.combine(start_date, datetime.min.time()))
+        filters.append(StockMovement.timestamp < datetime.combine(end_date + timedelta(days=1), datetime.min.time()))
 
     # If search provided, try to match product by name/sku or worker by name
     if search:
         term = f"%{search}%"
         # find matching products
-        prod_ids = session.exec(select(Product.id).where(
+        prod_ids = (await session.exec(select(Product.id).where(
             or_(
                 Product.name.ilike(term),
                 Product.internal_sku.ilike(term),
                 Product.supplier_sku.ilike(term)
             )
-        )).all()
+        ))).all()
         # find matching workers
-        worker_ids = session.exec(
-            select(Worker.id).where(Worker.name.ilike(term))).all()
+        worker_ids = (await session.exec(
+            select(Worker.id).where(Worker.name.ilike(term)))).all()
 
-        # If nothing matches, return empty list early
+        # If nothing matches, return empty page early
         if not prod_ids and not worker_ids:
-            return []
+            return HistoryPage(total=0, items=[])
 
         # Apply appropriate filtering depending on which matches exist
         conds = []
@@ -855,24 +1370,43 @@ def get_history(
             conds.append(StockMovement.product_id.in_(prod_ids))
         if worker_ids:
             conds.append(StockMovement.worker_id.in_(worker_ids))
-
-        if conds:
-            query = query.where(or_(*conds))
-
-    # Pagination
-    count_query = select(func.count()).select_from(query.subquery())
-    total_count = session.exec(count_query).one()
+        filters.append(or_(*conds))
+
+    total_count = (await session.exec(
+        select(func.count(StockMovement.id)).where(*filters))).one()
+
+    # Колонки движения и имена товара/работника одним запросом, без загрузки ORM-объектов
+    columns = [
+        StockMovement.id, StockMovement.timestamp, StockMovement.type,
+        StockMovement.quantity, StockMovement.stock_after,
+        Product.name.label("product_name"), Product.is_deleted.label("product_is_deleted"),
+        Worker.name.label("worker_name"),
+    ]
+    if view == ListView.FULL:
+        columns += [StockMovement.product_id, StockMovement.worker_id, StockMovement.location_id]
     offset = (page - 1) * size
-    paginated = query.offset(offset).limit(size)
-    history_records = session.exec(paginated).all()
+    query = (
+        select(*columns).select_from(StockMovement)
+        .outerjoin(Product, StockMovement.product_id == Product.id)
+        .outerjoin(Worker, StockMovement.worker_id == Worker.id)
+        .where(*filters)
+        .order_by(StockMovement.id.desc())
+        .offset(offset).limit(size)
+    )
+    history_records = (await session.exec(query)).all()
 
     response_items = []
     for m in history_records:
-        response_items.append({
+        item = {
             "id": m.id, "timestamp": m.timestamp, "type": m.type, "quantity": m.quantity, "stock_after": m.stock_after,
-            "product": {"name": m.product.name if m.product and not m.product.is_deleted else "Товар удален"},
-            "worker": {"name": m.worker.name} if m.worker else None
-        })
+            "product": {"name": m.product_name if m.product_name is not None and not m.product_is_deleted else "Товар удален"},
+            "worker": {"name": m.worker_name} if m.worker_name is not None else None
+        }
+        if view == ListView.FULL:
+            item["product_id"] = m.product_id
+            item["worker_id"] = m.worker_id
+            item["location_id"] = m.location_id
+        response_items.append(item)
     return HistoryPage(total=total_count, items=response_items)
 
 
@@ -883,12 +1417,17 @@ def cancel_movement(current_user: Annotated[dict, Depends(get_current_user)], mo
     if "Отмена" in original_movement.type:
         raise HTTPException(
             status_code=400, detail="Нельзя отменить операцию отмены.")
+    if original_movement.type == MovementTypeEnum.TRANSFER:
+        raise HTTPException(
+            status_code=400, detail="Перемещение отменяется обратным перемещением.")
 
     product = session.get(Product, original_movement.product_id)
     if not product or product.is_deleted:
         raise HTTPException(
             status_code=404, detail="Связанный товар был удален.")
 
+    lock_products(session, [product.id])
+
     correction_quantity = -original_movement.quantity
     # BUG FIX: Проверка на отрицательный остаток
     if (product.stock_quantity + correction_quantity) < 0 and original_movement.type in [
@@ -896,6 +1435,11 @@ def cancel_movement(current_user: Annotated[dict, Depends(get_current_user)], mo
     ]:
         raise HTTPException(
             status_code=400, detail=f"Отмена операции приведет к отрицательному остатку товара '{product.name}'.")
+    # Отмена прихода или возврата списывает товар с того места, куда он поступил
+    if correction_quantity < 0 and original_movement.location_id is not None and original_movement.type in [
+        MovementTypeEnum.INCOME, MovementTypeEnum.RETURN_FROM_WORKER, MovementTypeEnum.ADJUSTMENT
+    ]:
+        require_location_stock(session, original_movement.location_id, {product.id: -correction_quantity}, {product.id: product})
 
     # Корректируем остаток на складе только если операция влияла на него
     if original_movement.type in [MovementTypeEnum.INCOME, MovementTypeEnum.RETURN_FROM_WORKER, MovementTypeEnum.ISSUE_TO_WORKER, MovementTypeEnum.ADJUSTMENT]:
@@ -905,150 +1449,78 @@ def cancel_movement(current_user: Annotated[dict, Depends(get_current_user)], mo
     correction_movement = StockMovement(
         product_id=original_movement.product_id, worker_id=original_movement.worker_id,
         quantity=correction_quantity, type=f"Отмена ({original_movement.type})",
-        stock_after=product.stock_quantity
+        stock_after=product.stock_quantity, location_id=original_movement.location_id
     )
     session.add(correction_movement)
+    change_events.publish(session, "movement.cancelled", {"id": movement_id, "product_id": original_movement.product_id})
     session.commit()
     return {"message": f"Операция ID {movement_id} успешно отменена."}
 
 
-# --- REFACTOR: Логика импорта ---
-def _parse_number_robust(val) -> Optional[float]:
-    if val is None:
-        return None
-    if isinstance(val, (int, float)):
-        return float(val)
-    s = str(val).strip().replace('\u00A0', '').replace(
-        ' ', '').replace(',', '.')
-    s = re.sub(r'[^0-9.\-]', '', s)
-    try:
-        return float(s)
-    except (ValueError, TypeError):
-        return None
-
-
-def find_best_product_match_fuzzy(excel_name: str, product_name_map: dict) -> Optional[Product]:
-    if not excel_name or not product_name_map:
-        return None
-    best_match, score = fuzzy_process.extractOne(
-        excel_name, product_name_map.keys())
-    return product_name_map[best_match] if score > 80 else None
+# --- Поток событий изменений (SSE) ---
+@app.get("/events", summary="Поток событий изменений остатков и документов (SSE)", tags=["Операции"])
+async def stream_events(
+    current_user: Annotated[dict, Depends(get_current_user)],
+    request: Request,
+    last_event_id: Optional[int] = Header(None, alias="Last-Event-ID"),
+):
+    """text/event-stream: product.stock, movement.created, movement.cancelled, estimate.status,
+    contract.status. Data — JSON с изменёнными полями; при переподключении клиент
+    передаёт Last-Event-ID и получает пропущенные события."""
+    return StreamingResponse(
+        change_events.event_stream(async_engine, last_event_id, request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
+# --- REFACTOR: Логика импорта ---
+# Разбор Excel и нечёткое сопоставление выполняются в пуле процессов (excel_import),
+# запросы к БД через синхронную сессию — в пуле потоков.
 def generate_unique_internal_sku(name: str, sku: Optional[str]) -> str:
     base = sku or re.sub('[^0-9a-zA-Zа-яА-Я]+', '', name)[:10].upper()
     unique_hash = hashlib.sha1(name.encode()).hexdigest()[:6]
     return f"AUTO-{base}-{unique_hash}"
 
 
-@app.post("/actions/import-1c-estimate/", summary="Импорт сметы из 1С (.xls)", tags=["Операции"])
-async def import_1c_estimate(current_user: Annotated[dict, Depends(get_current_user)], file: UploadFile = File(...), session: Session = Depends(get_session)):
+async def _parse_import_file(parser, *args) -> dict:
     try:
-        df = pd.read_excel(io.BytesIO(await file.read()), header=None, engine='calamine')
-    except Exception as e:
-        raise HTTPException(
-            status_code=400, detail=f"Не удалось прочитать файл Excel. Ошибка: {e}")
-    # +++ ДИАГНОСТИЧЕСКИЙ БЛОК (ВСТАВЬТЕ ЕГО СЮДА) +++
-    print("\n--- ДИАГНОСТИКА EXCEL ФАЙЛА (1C) ---")
-    print("Содержимое первых 15 строк, как их видит Pandas:")
-    print(df.head(15).to_string())
-    print("--- КОНЕЦ ДИАГНОСТИКИ ---\n")
-    # +++ КОНЕЦ БЛОКА +++
-    estimate_number, client_name, location = "б/н", "Не определен", "Не определен"
-    # Build a cleaned text representation for extracting metadata.
-    # Remove repeated 'nan' tokens that come from empty Excel cells.
-    text_rows = []
-    for i, row in df.head(20).iterrows():
-        # join cells with a single space, filter out NaNs
-        cells = [str(x).strip() for x in row.values if pd.notna(x)
-                 and str(x).strip().lower() != 'nan']
-        if cells:
-            text_rows.append(' '.join(cells))
-    full_text = '\n'.join(text_rows)
-
-    # Try to extract estimate number, client name and location from the cleaned rows
-    if match := re.search(r'Коммерческое предложение №\s*(\S+)', full_text, re.IGNORECASE):
-        estimate_number = match.group(1)
-    # Prefer explicit 'Кому:' lines
-    if match := re.search(r'Кому:\s*([^\n,]+)', full_text, re.IGNORECASE):
-        client_name = match.group(1).strip()
-    else:
-        # fallback: first non-empty line that looks like a person/name (contains Cyrillic letters)
-        for line in text_rows:
-            if re.search(r'[А-Яа-яЁё]', line):
-                client_name = line.strip()
-                break
-    if match := re.search(r'Тема:\s*[^\n_]+_(.*)', full_text, re.IGNORECASE):
-        location = match.group(1).strip()
-
-    # Flexible header matching: normalize both Excel cell text and alias tokens
-    def _normalize_header_text(s: Any) -> str:
-        if s is None:
-            return ""
-        s = str(s).strip().lower()
-        # keep letters, digits and spaces; remove punctuation like hyphens and non-breaking spaces
-        s = re.sub(r'[^а-яa-z0-9\s]', '', s)
-        s = re.sub(r'\s+', ' ', s)
-        return s
-
-    ALIASES = {
-        'name': ['товары', 'товар', 'наименование', 'наименование товара'],
-        'quantity': ['кол-во', 'количество', 'кол'],
-        'unit_price': ['цена', 'стоимость']
-    }
+        return await run_in_process(parser, *args)
+    except ImportFileError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    # Pre-normalize aliases so we compare like-with-like (handles hyphens etc.)
-    normalized_aliases = {k: [_normalize_header_text(
-        a) for a in v] for k, v in ALIASES.items()}
-
-    column_map, header_row_idx = {}, -1
-    for idx, row in df.iterrows():
-        for col_idx, cell_val in row.items():
-            cell_norm = _normalize_header_text(cell_val)
-            for map_key, alias_list in normalized_aliases.items():
-                if map_key in column_map:
-                    continue
-                for alias_norm in alias_list:
-                    if alias_norm and alias_norm in cell_norm:
-                        column_map[map_key] = col_idx
-                        break
-        if len(column_map) == len(ALIASES):
-            header_row_idx = idx
-            break
-    if header_row_idx == -1:
-        # Build a small preview of the first rows to help debug header mismatches
-        preview_rows = []
-        max_preview = 5
-        for i, row in df.head(max_preview).iterrows():
-            cells = [(_normalize_header_text(c)[:40] +
-                      ("..." if len(str(c)) > 40 else "")) for c in row.values]
-            preview_rows.append(f"Row {i}: " + " | ".join(cells))
-        preview_text = "\\n".join(preview_rows)
-        raise HTTPException(
-            status_code=400,
-            detail=("Не найдены заголовки ('Товары', 'Кол-во', 'Цена'). "
-                    "Проверьте структуру файла. Превью первых строк:\n" + preview_text)
-        )
 
-    all_products = session.exec(select(Product).where(
+def _active_product_ids_by_name(session: Session) -> dict:
+    rows = session.exec(select(Product.name, Product.id).where(
         Product.is_deleted == False)).all()
-    product_map = {p.name: p for p in all_products}
-    items_to_create, unmatched_items = [], []
+    return {name: product_id for name, product_id in rows}
 
-    for _, row in df.iloc[header_row_idx + 1:].iterrows():
-        if row.astype(str).str.contains("Итого:|Всего наименований", na=False).any():
-            break
-        product_name = str(row.get(column_map['name']))
-        quantity = _parse_number_robust(row.get(column_map['quantity']))
-        unit_price = _parse_number_robust(row.get(column_map['unit_price']))
-        if not product_name or quantity is None or unit_price is None or product_name.lower() == 'nan':
-            continue
 
-        if matched := find_best_product_match_fuzzy(product_name, product_map):
+def _create_imported_estimate(session: Session, estimate: Estimate, items: List[dict]) -> Estimate:
+    session.add(estimate)
+    session.flush()
+    for item_data in items:
+        session.add(EstimateItem(estimate_id=estimate.id, **item_data))
+    session.commit()
+    session.refresh(estimate)
+    return estimate
+
+
+@app.post("/actions/import-1c-estimate/", summary="Импорт сметы из 1С (.xls)", tags=["Операции"])
+async def import_1c_estimate(current_user: Annotated[dict, Depends(get_current_user)], file: UploadFile = File(...), session: Session = Depends(get_session)):
+    content = await file.read()
+    parsed = await _parse_import_file(excel_import.parse_1c_estimate, content)
+
+    product_ids = await run_in_thread(_active_product_ids_by_name, session)
+    matches = await run_in_process(
+        excel_import.match_product_names, [r["name"] for r in parsed["rows"]], list(product_ids))
+    items_to_create, unmatched_items = [], []
+    for row, matched in zip(parsed["rows"], matches):
+        if matched is not None:
             items_to_create.append(
-                {"product_id": matched.id, "quantity": quantity, "unit_price": unit_price})
+                {"product_id": product_ids[matched], "quantity": row["quantity"], "unit_price": row["unit_price"]})
         else:
-            unmatched_items.append(product_name)
+            unmatched_items.append(row["name"])
 
     if unmatched_items:
         raise HTTPException(
@@ -1058,14 +1530,8 @@ async def import_1c_estimate(current_user: Annotated[dict, Depends(get_current_u
             status_code=400, detail="Не найдено товаров для импорта.")
 
     new_estimate = Estimate(
-        estimate_number=f"1C-{estimate_number}", client_name=client_name, location=location)
-    session.add(new_estimate)
-    session.flush()
-    for item_data in items_to_create:
-        session.add(EstimateItem(estimate_id=new_estimate.id, **item_data))
-    session.commit()
-    session.refresh(new_estimate)
-    return new_estimate
+        estimate_number=f"1C-{parsed['estimate_number']}", client_name=parsed['client_name'], location=parsed['location'])
+    return await run_in_thread(_create_imported_estimate, session, new_estimate, items_to_create)
 
 
 @app.post("/actions/universal-import/", summary="Универсальный импорт", tags=["Операции"])
@@ -1074,129 +1540,95 @@ async def universal_import(
     mode: ImportMode = Form(...), is_initial_load: bool = Form(False), auto_create_new: bool = Form(True),
     file: UploadFile = File(...), session: Session = Depends(get_session)
 ):
-    try:
-        df = pd.read_excel(io.BytesIO(await file.read()), header=None, engine='calamine')
-    except Exception as e:
-        raise HTTPException(
-            status_code=400, detail=f"Ошибка чтения Excel: {e}")
+    content = await file.read()
+    parsed = await _parse_import_file(
+        excel_import.parse_universal_import, content, mode == ImportMode.AS_ESTIMATE)
+    if mode == ImportMode.TO_STOCK:
+        return await run_in_thread(_import_to_stock, parsed, is_initial_load, auto_create_new, session)
+    elif mode == ImportMode.AS_ESTIMATE:
+        return await run_in_thread(_import_as_estimate, parsed, session)
 
-    start_row, header_map = -1, {}
-    HEADER_SETS = {
-        "petrovich": {"КОД", "ТОВАР", "КОЛИЧЕСТВО"},
-        "my_sklad": {"INTERNAL_SKU", "NAME", "STOCK_QUANTITY"}
-    }
 
-    for i, row in df.iterrows():
-        row_values = {str(v).strip().upper() for v in row.dropna().values}
-        header_map_raw = {str(v).strip().upper(
-        ): col_idx for col_idx, v in enumerate(row.values)}
-        if HEADER_SETS["petrovich"].issubset(row_values):
-            start_row, header_map = i, {
-                'sku': 'КОД', 'name': 'ТОВАР', 'qty': 'КОЛИЧЕСТВО', 'price': 'ЦЕНА'}
-            break
-        elif HEADER_SETS["my_sklad"].issubset(row_values):
-            start_row, header_map = i, {'internal_sku': 'INTERNAL_SKU',
-                                        'name': 'NAME', 'qty': 'STOCK_QUANTITY', 'sku': 'SUPPLIER_SKU'}
-            break
-    if start_row == -1:
-        raise HTTPException(
-            status_code=400, detail="Не найдены обязательные заголовки в файле.")
+def _import_to_stock(parsed: dict, is_initial_load: bool, auto_create_new: bool, session: Session):
+    report = {"created": [], "updated": [], "skipped": [], "errors": []}
+    for row in parsed["rows"]:
+        try:
+            name_val = row.get('name')
+            qty_val = row.get('qty')
+            if not name_val or qty_val is None:
+                continue
+            qty = float(qty_val)
+            price = float(row.get('price', 0.0) or 0.0)
+            sku = str(row.get('sku')).strip() if row.get('sku') else None
+            internal_sku = str(row.get('internal_sku')).strip(
+            ) if row.get('internal_sku') else None
+
+            product_q = select(Product)
+            if sku:
+                product_q = product_q.where(Product.supplier_sku == sku)
+            elif internal_sku:
+                product_q = product_q.where(
+                    Product.internal_sku == internal_sku)
+            else:
+                product_q = None
+
+            product = session.exec(product_q).first(
+            ) if product_q is not None else None
 
-    col_map = {k: header_map_raw.get(
-        v) for k, v in header_map.items() if header_map_raw.get(v) is not None}
-    data_df = df.iloc[start_row + 1:].where(pd.notna(df), None)
+            if product:
+                product.stock_quantity = qty if is_initial_load else product.stock_quantity + qty
+                product.purchase_price = price
+                session.add(product)
+                session.add(StockMovement(product_id=product.id, quantity=qty,
+                            type=MovementTypeEnum.INCOME, stock_after=product.stock_quantity))
+                report["updated"].append(f"{product.name}")
+            elif auto_create_new:
+                final_sku = internal_sku if internal_sku else generate_unique_internal_sku(
+                    str(name_val), sku)
+                new_product = Product(name=str(name_val), supplier_sku=sku, internal_sku=final_sku,
+                                      stock_quantity=qty, purchase_price=price, retail_price=price * 1.2)
+                session.add(new_product)
+                session.flush()
+                session.add(StockMovement(product_id=new_product.id, quantity=qty,
+                            type=MovementTypeEnum.INCOME, stock_after=new_product.stock_quantity))
+                report["created"].append(f"{name_val}")
+            else:
+                report["skipped"].append(
+                    f"{name_val} (SKU: {sku or internal_sku})")
+        except Exception as e:
+            report["errors"].append(f"Строка {row['index'] + parsed['start_row'] + 2}: {e}")
+    session.commit()
+    return report
 
-    if mode == ImportMode.TO_STOCK:
-        report = {"created": [], "updated": [], "skipped": [], "errors": []}
-        for i, row in data_df.iterrows():
-            try:
-                name_val = row.get(col_map.get('name'))
-                qty_val = row.get(col_map.get('qty'))
-                if not name_val or qty_val is None:
-                    continue
-                qty = float(qty_val)
-                price = float(row.get(col_map.get('price'), 0.0) or 0.0)
-                sku = str(row.get(col_map.get('sku'))).strip(
-                ) if row.get(col_map.get('sku')) else None
-                internal_sku = str(row.get(col_map.get('internal_sku'))).strip(
-                ) if row.get(col_map.get('internal_sku')) else None
-
-                product_q = select(Product)
-                if sku:
-                    product_q = product_q.where(Product.supplier_sku == sku)
-                elif internal_sku:
-                    product_q = product_q.where(
-                        Product.internal_sku == internal_sku)
-                else:
-                    product_q = None
-
-                product = session.exec(product_q).first(
-                ) if product_q is not None else None
-
-                if product:
-                    product.stock_quantity = qty if is_initial_load else product.stock_quantity + qty
-                    product.purchase_price = price
-                    session.add(product)
-                    session.add(StockMovement(product_id=product.id, quantity=qty,
-                                type=MovementTypeEnum.INCOME, stock_after=product.stock_quantity))
-                    report["updated"].append(f"{product.name}")
-                elif auto_create_new:
-                    final_sku = internal_sku if internal_sku else generate_unique_internal_sku(
-                        str(name_val), sku)
-                    new_product = Product(name=str(name_val), supplier_sku=sku, internal_sku=final_sku,
-                                          stock_quantity=qty, purchase_price=price, retail_price=price * 1.2)
-                    session.add(new_product)
-                    session.flush()
-                    session.add(StockMovement(product_id=new_product.id, quantity=qty,
-                                type=MovementTypeEnum.INCOME, stock_after=new_product.stock_quantity))
-                    report["created"].append(f"{name_val}")
-                else:
-                    report["skipped"].append(
-                        f"{name_val} (SKU: {sku or internal_sku})")
-            except Exception as e:
-                report["errors"].append(f"Строка {i + start_row + 2}: {e}")
-        session.commit()
-        return report
 
-    elif mode == ImportMode.AS_ESTIMATE:
-        items_to_create, not_found_skus = [], []
-        for _, row in data_df.iterrows():
-            try:
-                sku = str(row.get(col_map['sku'])).strip(
-                ) if 'sku' in col_map else None
-                qty = float(row.get(col_map['qty']))
-                price = float(row.get(col_map.get('price'), 0.0) or 0.0)
-                if not sku or qty is None:
-                    continue
-                product = session.exec(select(Product).where(
-                    Product.supplier_sku == sku)).first()
-                if product:
-                    items_to_create.append(
-                        {"product_id": product.id, "quantity": qty, "unit_price": price})
-                else:
-                    not_found_skus.append(sku)
-            except (ValueError, TypeError, KeyError):
+def _import_as_estimate(parsed: dict, session: Session):
+    items_to_create, not_found_skus = [], []
+    for row in parsed["rows"]:
+        try:
+            sku = str(row['sku']).strip() if 'sku' in row else None
+            qty = float(row.get('qty'))
+            price = float(row.get('price', 0.0) or 0.0)
+            if not sku or qty is None:
                 continue
-        if not_found_skus:
-            raise HTTPException(
-                status_code=404, detail=f"Товары с артикулами не найдены: {', '.join(not_found_skus)}")
-        if not items_to_create:
-            raise HTTPException(
-                status_code=400, detail="Не найдено корректных товаров для сметы.")
-
-        order_number = "б/н"
-        if match := re.search(r'Заказ №\s*(\S+)', ' '.join(df.astype(str).to_string().split())):
-            order_number = match.group(1)
-
-        new_estimate = Estimate(
-            estimate_number=f"Импорт-{order_number}", client_name="Импорт из файла", location="Петрович")
-        session.add(new_estimate)
-        session.flush()
-        for item in items_to_create:
-            session.add(EstimateItem(estimate_id=new_estimate.id, **item))
-        session.commit()
-        session.refresh(new_estimate)
-        return new_estimate
+            product = session.exec(select(Product).where(
+                Product.supplier_sku == sku)).first()
+            if product:
+                items_to_create.append(
+                    {"product_id": product.id, "quantity": qty, "unit_price": price})
+            else:
+                not_found_skus.append(sku)
+        except (ValueError, TypeError, KeyError):
+            continue
+    if not_found_skus:
+        raise HTTPException(
+            status_code=404, detail=f"Товары с артикулами не найдены: {', '.join(not_found_skus)}")
+    if not items_to_create:
+        raise HTTPException(
+            status_code=400, detail="Не найдено корректных товаров для сметы.")
+
+    new_estimate = Estimate(
+        estimate_number=f"Импорт-{parsed['order_number']}", client_name="Импорт из файла", location="Петрович")
+    return _create_imported_estimate(session, new_estimate, items_to_create)
 
 
 # --- Эндпоинты для Смет (Estimates) ---
@@ -1231,17 +1663,23 @@ def create_estimate(
     return new_estimate
 
 
-@app.get("/estimates/", response_model=EstimatePage, summary="Получить список смет", tags=["Сметы"])
-def read_estimates(
+@app.get("/estimates/", response_model=Union[EstimatePage, EstimateSummaryPage], summary="Получить список смет", tags=["Сметы"])
+async def read_estimates(
     current_user: Annotated[dict, Depends(get_current_user)],
     search: Optional[str] = None,
     page: int = Query(1, gt=0),
     size: int = Query(20, gt=0, le=100),
-    session: Session = Depends(get_session)
+    view: ListView = ListView.FULL,
+    sort_by: EstimateSort = EstimateSort.CREATED,
+    order: str = Query("desc", pattern="^(asc|desc)$"),
+    min_total: Optional[float] = Query(None, description="Сумма сметы от (розница)"),
+    max_total: Optional[float] = Query(None, description="Сумма сметы до (розница)"),
+    session: AsyncSession = Depends(get_async_session)
 ):
     offset = (page - 1) * size
-    query = select(Estimate).options(selectinload(
-        Estimate.items).selectinload(EstimateItem.product))
+    # Строки смет в списке не отдаются, поэтому и не загружаются
+    view_model = EstimateSummary if view == ListView.SUMMARY else Estimate
+    query = select_view(Estimate, view_model)
     if search:
         search_term = f"%{search}%"
         query = query.where(or_(
@@ -1249,44 +1687,44 @@ def read_estimates(
             Estimate.client_name.ilike(search_term),
             Estimate.location.ilike(search_term)
         ))
+    # Итоги хранятся в самой смете: фильтр и сортировка по сумме без чтения строк
+    if min_total is not None:
+        query = query.where(Estimate.total_retail >= min_total)
+    if max_total is not None:
+        query = query.where(Estimate.total_retail <= max_total)
     count_query = select(func.count()).select_from(query.subquery())
-    total_count = session.exec(count_query).one()
-    paginated_query = query.offset(offset).limit(
-        size).order_by(Estimate.id.desc())
-    items = session.exec(paginated_query).all()
+    total_count = (await session.exec(count_query)).one()
+    sort_column = Estimate.total_retail if sort_by == EstimateSort.TOTAL else Estimate.id
+    paginated_query = query.offset(offset).limit(size).order_by(
+        sort_column.asc() if order == "asc" else sort_column.desc(), Estimate.id.desc())
+    items = rows_to_view(view_model, (await session.exec(paginated_query)).all())
+    if view == ListView.SUMMARY:
+        return EstimateSummaryPage(total=total_count, items=items)
     return EstimatePage(total=total_count, items=items)
 
 
 @app.get("/estimates/{estimate_id}", response_model=EstimateResponse, summary="Получить одну смету по ID", tags=["Сметы"])
-def read_estimate(current_user: Annotated[dict, Depends(get_current_user)], estimate_id: int, session: Session = Depends(get_session)):
+async def read_estimate(current_user: Annotated[dict, Depends(get_current_user)], estimate_id: int, request: Request, response: Response, session: AsyncSession = Depends(get_async_session)):
+    # Карточка показывает названия товаров, поэтому зависит и от таблицы product
+    not_modified = await check_not_modified_async(
+        session, ("estimate", "estimateitem", "product"), request, response)
+    if not_modified:
+        return not_modified
     query = select(Estimate).where(Estimate.id == estimate_id).options(
         selectinload(Estimate.items).selectinload(EstimateItem.product))
-    estimate = session.exec(query).first()
+    estimate = (await session.exec(query)).first()
     if not estimate:
         raise HTTPException(status_code=404, detail="Смета не найдена")
     response_items = []
-    # compute total_sum carefully and sanitize NaN/inf
-    raw_total = 0.0
     for item in estimate.items:
-        q = float(item.quantity or 0.0)
-        p = float(item.unit_price or 0.0)
-        # sanitize q and p to valid JSON numbers
-        if math.isnan(q) or math.isinf(q):
-            q = 0.0
-        if math.isnan(p) or math.isinf(p):
-            p = 0.0
-        raw_total += q * p
         response_items.append(EstimateItemResponse(
             id=item.id,
-            quantity=q,
-            unit_price=p,
+            quantity=item.quantity,
+            unit_price=item.unit_price,
             product_id=item.product_id,
             product_name=item.product.name if item.product and not item.product.is_deleted else "Товар удален"
         ))
-
-    total_sum = raw_total if not (math.isnan(
-        raw_total) or math.isinf(raw_total)) else 0.0
-    return EstimateResponse(**estimate.model_dump(), items=response_items, total_sum=total_sum)
+    return EstimateResponse(**estimate.model_dump(), items=response_items, total_sum=estimate.total_retail)
 
 
 @app.patch("/estimates/{estimate_id}", response_model=Estimate, summary="Обновить смету", tags=["Сметы"])
@@ -1335,29 +1773,81 @@ def delete_estimate(current_user: Annotated[dict, Depends(get_current_user)], es
     return None
 
 
+def _lock_estimate_lines(session: Session, estimate_id: int):
+    """Смета, её строки и товары строк тремя запросами.
+
+    Смета и товары блокируются (SELECT ... FOR UPDATE; в SQLite игнорируется):
+    сначала смета, затем товары по возрастанию id. Одинаковый порядок блокировок
+    во всех переходах исключает взаимоблокировку двух одновременных отгрузок.
+    """
+    estimate = session.exec(select(Estimate).where(Estimate.id == estimate_id).with_for_update()).first()
+    if not estimate:
+        raise HTTPException(status_code=404, detail=f"Estimate с ID {estimate_id} не найден")
+    items = session.exec(select(EstimateItem).where(
+        EstimateItem.estimate_id == estimate_id).order_by(EstimateItem.product_id, EstimateItem.id)).all()
+    return estimate, items, lock_products(session, [item.product_id for item in items])
+
+
+def _required_by_product(items: List[EstimateItem]) -> dict:
+    required = {}
+    for item in items:
+        required[item.product_id] = required.get(item.product_id, 0.0) + item.quantity
+    return required
+
+
+def _issue_estimate_items(session: Session, items: List[EstimateItem], products: dict, worker_id: int) -> List[StockMovement]:
+    """Проверяет остатки по всем товарам сметы и списывает их с места по умолчанию на работника."""
+    required = _required_by_product(items)
+    for product_id, quantity in required.items():
+        product = products[product_id]
+        if product.stock_quantity < quantity:
+            raise HTTPException(
+                status_code=400, detail=f"Недостаточно товара '{product.name}'. В наличии: {product.stock_quantity}, требуется: {quantity}")
+    location_id = resolve_location_id(None, session)
+    require_location_stock(session, location_id, required, products)
+    movements = []
+    for item in items:
+        product = products[item.product_id]
+        product.stock_quantity -= item.quantity
+        movements.append(StockMovement(product_id=item.product_id, worker_id=worker_id, quantity=-item.quantity,
+                                       type=MovementTypeEnum.ISSUE_TO_WORKER, stock_after=product.stock_quantity,
+                                       location_id=location_id))
+    return movements
+
+
+def _return_estimate_items(items: List[EstimateItem], products: dict, worker_id: int) -> List[StockMovement]:
+    """Возвращает товары сметы от работника на склад."""
+    movements = []
+    for item in items:
+        product = products[item.product_id]
+        product.stock_quantity += item.quantity
+        # Положительное движение: товар "вернулся" от работника
+        movements.append(StockMovement(product_id=item.product_id, worker_id=worker_id, quantity=item.quantity,
+                                       type=MovementTypeEnum.RETURN_FROM_WORKER, stock_after=product.stock_quantity))
+    return movements
+
+
 @app.post("/estimates/{estimate_id}/ship", summary="Отгрузить товары по смете", tags=["Сметы"])
-def ship_estimate(current_user: Annotated[dict, Depends(get_current_user)], estimate_id: int, worker_id: int = Query(...), session: Session = Depends(get_session)):
-    estimate, worker = get_db_object_or_404(
-        Estimate, estimate_id, session), get_db_object_or_404(Worker, worker_id, session)
+def ship_estimate(current_user: Annotated[dict, Depends(get_current_user)], estimate_id: int, worker_id: int = Query(...), session: Session = Depends(get_session),
+                  idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER)):
+    return run_idempotent(session, current_user, idempotency_key, f"ship:{estimate_id}:{worker_id}",
+                          lambda: _ship_estimate(estimate_id, worker_id, session))
+
+
+def _ship_estimate(estimate_id: int, worker_id: int, session: Session) -> dict:
+    estimate, items, products = _lock_estimate_lines(session, estimate_id)
+    worker = get_db_object_or_404(Worker, worker_id, session)
     if estimate.status not in [EstimateStatusEnum.DRAFT, EstimateStatusEnum.APPROVED]:
         raise HTTPException(
             status_code=400, detail=f"Нельзя отгрузить смету в статусе '{estimate.status.value}'")
-    for item in estimate.items:
-        product = get_db_object_or_404(Product, item.product_id, session)
-        if product.stock_quantity < item.quantity:
-            raise HTTPException(
-                status_code=400, detail=f"Недостаточно товара '{product.name}'. В наличии: {product.stock_quantity}, требуется: {item.quantity}")
-        product.stock_quantity -= item.quantity
-        movement = StockMovement(product_id=item.product_id, worker_id=worker.id, quantity=-
-                                 item.quantity, type=MovementTypeEnum.ISSUE_TO_WORKER, stock_after=product.stock_quantity)
-        session.add(product)
-        session.add(movement)
+    # Движения вставляются одним INSERT ... VALUES (insertmanyvalues SQLAlchemy 2.0)
+    session.add_all(_issue_estimate_items(session, items, products, worker.id))
     estimate.status = EstimateStatusEnum.IN_PROGRESS
     estimate.worker_id = worker.id
     # Записываем время отгрузки
     estimate.shipped_at = datetime.utcnow()
     session.add(estimate)
-    session.commit()
+    session.flush()
     return {"message": f"Смета №{estimate.estimate_number} успешно отгружена на работника {worker.name}."}
 
 
@@ -1366,7 +1856,7 @@ def complete_estimate(current_user: Annotated[dict, Depends(get_current_user)],
     """Окончательное завершение сметы: создаёт движения списания по смете и переводит статус в COMPLETED.
     Требует, чтобы смета была в статусе IN_PROGRESS и была привязана к работнику (worker_id).
     """
-    estimate = get_db_object_or_404(Estimate, estimate_id, session)
+    estimate, items, products = _lock_estimate_lines(session, estimate_id)
 
     if estimate.status != EstimateStatusEnum.IN_PROGRESS:
         raise HTTPException(
@@ -1376,35 +1866,35 @@ def complete_estimate(current_user: Annotated[dict, Depends(get_current_user)],
         raise HTTPException(
             status_code=400, detail="Смета не привязана к работнику. Сначала отгрузите смету или привяжите работника.")
 
-    # Для каждой позиции создаём движение списания по смете. Глобальные остатки не меняем
-    # (они уже уменьшились при отгрузке). Это лишь отмечает окончательное списание у работника.
-    # Проверяем, что работнику действительно были выданы эти товары (ISSUE_TO_WORKER).
-    for item in estimate.items:
-        product = get_db_object_or_404(Product, item.product_id, session)
-        issued_sum = session.exec(select(func.coalesce(func.sum(StockMovement.quantity), 0)).where(
-            StockMovement.worker_id == estimate.worker_id,
-            StockMovement.product_id == item.product_id,
-            StockMovement.type == MovementTypeEnum.ISSUE_TO_WORKER
-        )).one()
-        # issued_sum is negative (ISSUE_TO_WORKER stores negative quantities), so invert sign
-        issued_qty = -issued_sum if issued_sum is not None else 0
-        if issued_qty + 1e-9 < item.quantity:
+    # Проверяем, что работнику действительно были выданы эти товары (ISSUE_TO_WORKER):
+    # один сгруппированный запрос по всем товарам сметы
+    required = _required_by_product(items)
+    issued_sums = dict(session.exec(select(StockMovement.product_id, func.sum(StockMovement.quantity)).where(
+        StockMovement.worker_id == estimate.worker_id,
+        StockMovement.product_id.in_(list(required)),
+        StockMovement.type == MovementTypeEnum.ISSUE_TO_WORKER
+    ).group_by(StockMovement.product_id)).all()) if required else {}
+    for product_id, quantity in required.items():
+        # ISSUE_TO_WORKER хранит отрицательные количества, поэтому меняем знак
+        issued_qty = -(issued_sums.get(product_id) or 0)
+        if issued_qty + 1e-9 < quantity:
             # Недостаточно выдано работнику — запрещаем завершение
             raise HTTPException(
                 status_code=400,
-                detail=f"Нельзя завершить смету: работнику не выдано достаточное количество товара '{product.name}'. Выдано: {issued_qty}, требуется: {item.quantity}. Пожалуйста, сначала отгрузите со склада или сделайте довыдачу."
+                detail=f"Нельзя завершить смету: работнику не выдано достаточное количество товара '{products[product_id].name}'. Выдано: {issued_qty}, требуется: {quantity}. Пожалуйста, сначала отгрузите со склада или сделайте довыдачу."
             )
 
-        movement = StockMovement(
-            product_id=item.product_id,
-            worker_id=estimate.worker_id,
-            # WRITE_OFF_ESTIMATE should be positive to reflect final removal
-            # from the worker's balance (ISSUE_TO_WORKER stored negative).
-            quantity=item.quantity,
-            type=MovementTypeEnum.WRITE_OFF_ESTIMATE,
-            stock_after=product.stock_quantity
-        )
-        session.add(movement)
+    # Для каждой позиции создаём движение списания по смете. Глобальные остатки не меняем
+    # (они уже уменьшились при отгрузке). Это лишь отмечает окончательное списание у работника.
+    session.add_all([StockMovement(
+        product_id=item.product_id,
+        worker_id=estimate.worker_id,
+        # WRITE_OFF_ESTIMATE should be positive to reflect final removal
+        # from the worker's balance (ISSUE_TO_WORKER stored negative).
+        quantity=item.quantity,
+        type=MovementTypeEnum.WRITE_OFF_ESTIMATE,
+        stock_after=products[item.product_id].stock_quantity
+    ) for item in items])
 
     estimate.status = EstimateStatusEnum.COMPLETED
     session.add(estimate)
@@ -1451,26 +1941,40 @@ def delete_estimate_item(current_user: Annotated[dict, Depends(get_current_user)
 
 
 @app.post("/estimates/{estimate_id}/issue-additional", summary="Довыдача товаров по смете", tags=["Сметы"])
-def issue_additional_items(current_user: Annotated[dict, Depends(get_current_user)], estimate_id: int, request: AddItemsRequest, session: Session = Depends(get_session)):
+def issue_additional_items(current_user: Annotated[dict, Depends(get_current_user)], estimate_id: int, request: AddItemsRequest, session: Session = Depends(get_session),
+                           idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER)):
+    return run_idempotent(session, current_user, idempotency_key, f"issue-additional:{estimate_id}:{request.model_dump_json()}",
+                          lambda: _issue_additional_items(estimate_id, request, session))
+
+
+def _issue_additional_items(estimate_id: int, request: AddItemsRequest, session: Session) -> dict:
     estimate = get_db_object_or_404(Estimate, estimate_id, session)
     if not estimate.worker_id:
         raise HTTPException(
             status_code=400, detail="Смета еще не отгружена, нельзя сделать довыдачу.")
     worker = get_db_object_or_404(Worker, estimate.worker_id, session)
+    products = lock_products(session, [item_data.product_id for item_data in request.items])
+    required = {}
     for item_data in request.items:
-        product = get_db_object_or_404(Product, item_data.product_id, session)
+        required[item_data.product_id] = required.get(item_data.product_id, 0.0) + item_data.quantity
+    location_id = resolve_location_id(None, session)
+    require_location_stock(session, location_id, required, products)
+    for item_data in request.items:
+        product = products[item_data.product_id]
         if product.stock_quantity < item_data.quantity:
             raise HTTPException(
                 status_code=400, detail=f"Недостаточно товара '{product.name}'.")
         product.stock_quantity -= item_data.quantity
+        unit_price = item_data.unit_price if item_data.unit_price is not None else product.retail_price
         new_item = EstimateItem(estimate_id=estimate_id, product_id=product.id,
-                                quantity=item_data.quantity, unit_price=item_data.unit_price)
+                                quantity=item_data.quantity, unit_price=unit_price)
         movement = StockMovement(product_id=product.id, worker_id=worker.id, quantity=-item_data.quantity,
-                                 type=MovementTypeEnum.ISSUE_TO_WORKER, stock_after=product.stock_quantity)
+                                 type=MovementTypeEnum.ISSUE_TO_WORKER, stock_after=product.stock_quantity,
+                                 location_id=location_id)
         session.add(product)
         session.add(new_item)
         session.add(movement)
-    session.commit()
+    session.flush()
     return {"message": "Товары успешно довыданы."}
 
 
@@ -1492,17 +1996,141 @@ def assign_worker_to_estimate(current_user: Annotated[dict, Depends(get_current_
     return {"message": f"Смета №{estimate.estimate_number} привязана к работнику {worker.name}."}
 
 
-@app.get("/estimates/{estimate_id}/generate-commercial-proposal", summary="Сгенерировать КП .docx", tags=["Сметы"])
-def generate_commercial_proposal_docx(
-    current_user: Annotated[dict, Depends(get_current_user)], estimate_id: int,
-    background_tasks: BackgroundTasks, session: Session = Depends(get_session)
-):
-    # Этот код у вас уже был и, вероятно, работал, оставляем его
-    estimate = get_db_object_or_404(Estimate, estimate_id, session)
-    template_path = os.path.join(
-        "templates", "commercial_proposal_template.docx")
-    if not os.path.exists(template_path):
-        raise HTTPException(status_code=500, detail="Шаблон КП не найден")
+MONTHS_GENITIVE = ['', 'января', 'февраля', 'марта', 'апреля', 'мая', 'июня',
+                   'июля', 'августа', 'сентября', 'октября', 'ноября', 'декабря']
+
+COMMERCIAL_PROPOSAL_TEMPLATE = "commercial_proposal_template.docx"
+
+
+def _docx_response(content: bytes, filename: str) -> StreamingResponse:
+    """Отдаёт отрендеренный .docx из памяти (без временных файлов)."""
+    quoted = quote(filename)
+    if quoted != filename:
+        disposition = f"attachment; filename*=utf-8''{quoted}"
+    else:
+        disposition = f'attachment; filename="{filename}"'
+    return StreamingResponse(
+        io.BytesIO(content),
+        media_type=DOCX_MEDIA_TYPE,
+        headers={"Content-Disposition": disposition,
+                 "Content-Length": str(len(content))}
+    )
+
+
+def _render_document(template_name: str, context: dict) -> bytes:
+    """Рендерит документ через кэш: ключ зависит от версии шаблона и контекста,
+    поэтому любое изменение данных или шаблона даёт новый документ."""
+    entry = template_registry.get(template_name)
+    key = make_document_key(entry.version, context)
+    content = document_cache.get(key)
+    if content is None:
+        content = cpu_pool().submit(render_template_job, template_name, context).result()
+        document_cache.put(key, content)
+    return content
+
+
+class _ZipStreamBuffer(io.RawIOBase):
+    """Неперематываемый поток для zipfile: копит записанные байты до отправки клиенту."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _zip_entry_name(prefix: str, number: str, obj_id: int) -> str:
+    safe_number = re.sub(r'[\\/\s]+', '_', number or '').strip('_') or 'bn'
+    return f"{prefix}_{safe_number}_{obj_id}.docx"
+
+
+# Места для рендера пакетных документов, общие для всех запросов процесса
+_docx_render_slots = threading.BoundedSemaphore(config.DOCX_RENDER_PROCESSES)
+
+
+def _render_documents(jobs: List[tuple]):
+    """Рендерит документы (имя файла, шаблон, контекст) и отдаёт их по мере готовности.
+    Промахи кэша уходят в пул процессов. Каждая задача занимает место _docx_render_slots
+    до своего завершения, поэтому все пакеты процесса вместе держат в полёте не больше
+    DOCX_RENDER_PROCESSES задач — это меньше размера пула (проверяется в config), и
+    одновременные архивы не занимают весь пул."""
+    pool = cpu_pool()
+    pending = {}
+
+    def collect():
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            filename, key = pending.pop(future)
+            try:
+                content = future.result()
+            except Exception as e:
+                logger.error(f"Ошибка рендера документа {filename}: {e}")
+                yield filename, None, str(e)
+                continue
+            document_cache.put(key, content)
+            yield filename, content, None
+
+    for filename, template_name, context in jobs:
+        try:
+            key = make_document_key(template_registry.get(template_name).version, context)
+        except Exception as e:
+            logger.error(f"Ошибка рендера документа {filename}: {e}")
+            yield filename, None, str(e)
+            continue
+        cached = document_cache.get(key)
+        if cached is not None:
+            yield filename, cached, None
+            continue
+        # Пока мест нет, забираем готовые документы своего пакета; без своих задач — ждём
+        while not _docx_render_slots.acquire(blocking=not pending):
+            yield from collect()
+        try:
+            future = pool.submit(render_template_job, template_name, context)
+        except BaseException:
+            _docx_render_slots.release()
+            raise
+        # Место освобождается по завершении задачи, даже если клиент уже отключился
+        future.add_done_callback(lambda _: _docx_render_slots.release())
+        pending[future] = (filename, key)
+    while pending:
+        yield from collect()
+
+
+def _iter_documents_zip(jobs: List[tuple]):
+    buf = _ZipStreamBuffer()
+    errors = []
+    # .docx уже сжат, поэтому складываем без повторного сжатия
+    with zipfile.ZipFile(buf, mode='w', compression=zipfile.ZIP_STORED) as zf:
+        for filename, content, error in _render_documents(jobs):
+            if error is not None:
+                errors.append(f"{filename}: {error}")
+            else:
+                zf.writestr(filename, content)
+            yield buf.drain()
+        if errors:
+            zf.writestr("errors.txt", "\n".join(errors))
+    yield buf.drain()
+
+
+def _documents_zip_response(jobs: List[tuple], filename: str) -> StreamingResponse:
+    return StreamingResponse(
+        _iter_documents_zip(jobs),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+def _build_commercial_proposal_context(estimate: Estimate, session: Session) -> dict:
+    from num2words import num2words
     items, total_sum = [], 0
     for item in estimate.items:
         product = get_db_object_or_404(Product, item.product_id, session)
@@ -1514,21 +2142,64 @@ def generate_commercial_proposal_docx(
         })
     today = date.today()
     rub, kop = int(total_sum), int((total_sum - int(total_sum)) * 100)
-    context = {
-        'estimate_number': estimate.estimate_number, 'current_date_formatted': f"{today.day:02d} {['', 'января', 'февраля', 'марта', 'апреля', 'мая', 'июня', 'июля', 'августа', 'сентября', 'октября', 'ноября', 'декабря'][today.month]} {today.year} г.",
+    return {
+        'estimate_number': estimate.estimate_number, 'current_date_formatted': f"{today.day:02d} {MONTHS_GENITIVE[today.month]} {today.year} г.",
         'client_name': estimate.client_name, 'theme': f"Работы по смете на объекте: {estimate.location or 'не указан'}", 'items': items,
         'total_sum_formatted': f"{total_sum:,.2f}".replace(",", " "), 'total_items_count': len(items),
         'total_sum_in_words': f"{num2words(rub, lang='ru', to='currency', currency='RUB')} {kop:02d} копеек".capitalize(),
         'valid_until_date_formatted': (today + timedelta(days=7)).strftime('%d.%m.%Y'),
     }
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".docx") as tmp:
-        doc = DocxTemplate(template_path)
-        doc.render(context)
-        doc.save(tmp.name)
-        tmp_path = tmp.name
-    background_tasks.add_task(os.remove, tmp_path)
+
+
+@app.get("/estimates/{estimate_id}/generate-commercial-proposal", summary="Сгенерировать КП .docx", tags=["Сметы"])
+def generate_commercial_proposal_docx(
+    current_user: Annotated[dict, Depends(get_current_user)], estimate_id: int,
+    session: Session = Depends(get_session)
+):
+    estimate = get_db_object_or_404(Estimate, estimate_id, session)
+    if not template_registry.exists(COMMERCIAL_PROPOSAL_TEMPLATE):
+        raise HTTPException(status_code=500, detail="Шаблон КП не найден")
+    context = _build_commercial_proposal_context(estimate, session)
+    content = _render_document(COMMERCIAL_PROPOSAL_TEMPLATE, context)
     filename = f"KP_{estimate.estimate_number.replace(' ', '_')}.docx"
-    return FileResponse(path=tmp_path, filename=filename, media_type='application/vnd.openxmlformats-officedocument.wordprocessingml.document')
+    return _docx_response(content, filename)
+
+
+@app.post("/estimates/generate-commercial-proposal-batch", summary="Архив КП .docx по списку или фильтру", tags=["Сметы"])
+def generate_commercial_proposal_batch(
+    current_user: Annotated[dict, Depends(get_current_user)], request: EstimateDocumentBatchRequest,
+    session: Session = Depends(get_session)
+):
+    """Собирает ZIP с КП по списку ID смет или по фильтру (период создания, статус).
+    Документы рендерятся параллельно и отдаются потоком по мере готовности."""
+    if not request.ids and not (request.start_date or request.end_date or request.status):
+        raise HTTPException(
+            status_code=400, detail="Укажите список ID или фильтр (период, статус).")
+    if not template_registry.exists(COMMERCIAL_PROPOSAL_TEMPLATE):
+        raise HTTPException(status_code=500, detail="Шаблон КП не найден")
+
+    query = select(Estimate).options(selectinload(
+        Estimate.items).selectinload(EstimateItem.product))
+    if request.ids:
+        query = query.where(Estimate.id.in_(request.ids))
+    if request.start_date:
+        query = query.where(Estimate.created_at >= request.start_date)
+    if request.end_date:
+        query = query.where(Estimate.created_at < (request.end_date + timedelta(days=1)))
+    if request.status:
+        query = query.where(Estimate.status == request.status)
+    estimates = session.exec(query.order_by(Estimate.id).limit(
+        config.DOCX_BATCH_MAX_DOCUMENTS + 1)).all()
+    if not estimates:
+        raise HTTPException(status_code=404, detail="Сметы не найдены")
+    if len(estimates) > config.DOCX_BATCH_MAX_DOCUMENTS:
+        raise HTTPException(
+            status_code=400, detail=f"Слишком много документов. Максимум в одном архиве: {config.DOCX_BATCH_MAX_DOCUMENTS}")
+
+    # Контексты собираем сразу: сессия БД закроется до начала отдачи архива
+    jobs = [(_zip_entry_name("KP", est.estimate_number, est.id), COMMERCIAL_PROPOSAL_TEMPLATE,
+             _build_commercial_proposal_context(est, session)) for est in estimates]
+    return _documents_zip_response(jobs, f"KP_{date.today().strftime('%Y%m%d')}.zip")
 
 
 @app.post("/estimates/{estimate_id}/cancel-completion", summary="Отменить выполнение сметы и вернуть товары", tags=["Сметы"])
@@ -1537,7 +2208,7 @@ def cancel_estimate_completion(
     estimate_id: int,
     session: Session = Depends(get_session)
 ):
-    estimate = get_db_object_or_404(Estimate, estimate_id, session)
+    estimate, items, products = _lock_estimate_lines(session, estimate_id)
 
     if estimate.status != EstimateStatusEnum.COMPLETED:
         raise HTTPException(
@@ -1547,24 +2218,8 @@ def cancel_estimate_completion(
         raise HTTPException(
             status_code=400, detail="Не найден работник, на которого была отгружена смета. Возврат невозможен.")
 
-    # Возвращаем товары со сметы обратно на основной склад
-    for item in estimate.items:
-        product = get_db_object_or_404(Product, item.product_id, session)
-
-        # Возвращаем товар на основной склад
-        product.stock_quantity += item.quantity
-
-        # Создаем движение, которое "отменяет" списание на работника
-        # Это положительное движение, так как товар "вернулся" от работника
-        movement = StockMovement(
-            product_id=item.product_id,
-            worker_id=estimate.worker_id,
-            quantity=item.quantity,
-            type=MovementTypeEnum.RETURN_FROM_WORKER,
-            stock_after=product.stock_quantity
-        )
-        session.add(product)
-        session.add(movement)
+    # Возвращаем товары со сметы обратно на основной склад движениями, которые "отменяют" списание
+    session.add_all(_return_estimate_items(items, products, estimate.worker_id))
 
     # Меняем статус сметы обратно на "В работе"
     estimate.status = EstimateStatusEnum.IN_PROGRESS
@@ -1583,7 +2238,7 @@ def cancel_in_progress_estimate(
     """Отменяет смету, которая находится в статусе IN_PROGRESS: возвращает товары на основной склад
     и переводит статус сметы в CANCELLED. Записывает соответствующие движения в историю.
     """
-    estimate = get_db_object_or_404(Estimate, estimate_id, session)
+    estimate, items, products = _lock_estimate_lines(session, estimate_id)
 
     if estimate.status != EstimateStatusEnum.IN_PROGRESS:
         raise HTTPException(
@@ -1594,18 +2249,7 @@ def cancel_in_progress_estimate(
             status_code=400, detail="Не найден работник, на которого была отгружена смета. Отмена невозможна.")
 
     # Возвращаем товары со сметы обратно на основной склад и создаём движения возврата
-    for item in estimate.items:
-        product = get_db_object_or_404(Product, item.product_id, session)
-        product.stock_quantity += item.quantity
-        movement = StockMovement(
-            product_id=item.product_id,
-            worker_id=estimate.worker_id,
-            quantity=item.quantity,
-            type=MovementTypeEnum.RETURN_FROM_WORKER,
-            stock_after=product.stock_quantity
-        )
-        session.add(product)
-        session.add(movement)
+    session.add_all(_return_estimate_items(items, products, estimate.worker_id))
 
     estimate.status = EstimateStatusEnum.CANCELLED
     session.add(estimate)
@@ -1623,7 +2267,7 @@ def reopen_cancelled_estimate(
 ):
     """Восстанавливает отменённую смету: переводит статус в IN_PROGRESS и повторно выдает
     товары работнику (списание со склада). Требует указания worker_id."""
-    estimate = get_db_object_or_404(Estimate, estimate_id, session)
+    estimate, items, products = _lock_estimate_lines(session, estimate_id)
 
     if estimate.status != EstimateStatusEnum.CANCELLED:
         raise HTTPException(
@@ -1632,16 +2276,7 @@ def reopen_cancelled_estimate(
     worker = get_db_object_or_404(Worker, worker_id, session)
 
     # Попробуем списать товары со склада заново
-    for item in estimate.items:
-        product = get_db_object_or_404(Product, item.product_id, session)
-        if product.stock_quantity < item.quantity:
-            raise HTTPException(
-                status_code=400, detail=f"Недостаточно товара на складе: {product.name}")
-        product.stock_quantity -= item.quantity
-        movement = StockMovement(product_id=item.product_id, worker_id=worker.id, quantity=-item.quantity,
-                                 type=MovementTypeEnum.ISSUE_TO_WORKER, stock_after=product.stock_quantity)
-        session.add(product)
-        session.add(movement)
+    session.add_all(_issue_estimate_items(session, items, products, worker.id))
 
     estimate.status = EstimateStatusEnum.IN_PROGRESS
     estimate.worker_id = worker.id
@@ -1664,18 +2299,25 @@ def create_contract(current_user: Annotated[dict, Depends(get_current_user)], co
     return contract
 
 
-@app.get("/contracts/", response_model=List[Contract], summary="Получить список договоров", tags=["Договоры"])
+@app.get("/contracts/", response_model=Union[List[Contract], List[ContractSummary]], summary="Получить список договоров", tags=["Договоры"])
 def read_contracts(
     current_user: Annotated[dict, Depends(get_current_user)],
+    request: Request,
+    response: Response,
     session: Session = Depends(get_session),
     search: Optional[str] = Query(
         None, description="Поиск по номеру договора или имени клиента"),
     sort_by: Optional[str] = Query(
         'contract_date', description="Поле сортировки: contract_number|contract_date"),
     order: Optional[str] = Query(
-        'desc', description="Порядок сортировки: asc|desc")
+        'desc', description="Порядок сортировки: asc|desc"),
+    view: ListView = ListView.FULL
 ):
-    q = select(Contract)
+    not_modified = check_not_modified(session, ("contract",), request, response)
+    if not_modified:
+        return not_modified
+    view_model = ContractSummary if view == ListView.SUMMARY else Contract
+    q = select_view(Contract, view_model)
     if search:
         term = f"%{search}%"
         q = q.where(or_(Contract.contract_number.ilike(
@@ -1694,7 +2336,7 @@ def read_contracts(
         else:
             q = q.order_by(Contract.contract_date.desc())
 
-    return session.exec(q).all()
+    return rows_to_view(view_model, session.exec(q).all())
 
 
 @app.get("/contracts/{contract_id}", response_model=Contract, summary="Получить договор по ID", tags=["Договоры"])
@@ -1743,16 +2385,25 @@ def write_off_pipes(current_user: Annotated[dict, Depends(get_current_user)], co
             return None
 
     movements_created = []
+    steel_prod = find_product_by_type(
+        'PIPE_STEEL_133_ST20', '%STEEL%', '%сталь%') if steel_m and steel_m > 0 else None
+    plastic_prod = find_product_by_type(
+        'PIPE_PLASTIC_110_6_1', '%PLASTIC%', '%пластик%') if plastic_m and plastic_m > 0 else None
+    # Трубы списываются с места по умолчанию: сначала блокируются оба товара, затем их остатки
+    debits = {}
+    for prod, meters in ((steel_prod, steel_m), (plastic_prod, plastic_m)):
+        if prod:
+            debits[prod.id] = debits.get(prod.id, 0.0) + meters
+    _, location_id = lock_default_location_debits(session, debits)
 
     # Steel
     if steel_m and steel_m > 0:
-        steel_prod = find_product_by_type(
-            'PIPE_STEEL_133_ST20', '%STEEL%', '%сталь%')
         if steel_prod:
             old_qty = float(steel_prod.stock_quantity or 0.0)
             steel_prod.stock_quantity = old_qty - steel_m
             movement = StockMovement(product_id=steel_prod.id, quantity=-steel_m,
-                                     type=MovementTypeEnum.WRITE_OFF_CONTRACT, stock_after=steel_prod.stock_quantity)
+                                     type=MovementTypeEnum.WRITE_OFF_CONTRACT, stock_after=steel_prod.stock_quantity,
+                                     location_id=location_id)
             session.add(steel_prod)
             session.add(movement)
             movements_created.append(
@@ -1763,13 +2414,12 @@ def write_off_pipes(current_user: Annotated[dict, Depends(get_current_user)], co
 
     # Plastic
     if plastic_m and plastic_m > 0:
-        plastic_prod = find_product_by_type(
-            'PIPE_PLASTIC_110_6_1', '%PLASTIC%', '%пластик%')
         if plastic_prod:
             old_qty = float(plastic_prod.stock_quantity or 0.0)
             plastic_prod.stock_quantity = old_qty - plastic_m
             movement = StockMovement(product_id=plastic_prod.id, quantity=-plastic_m,
-                                     type=MovementTypeEnum.WRITE_OFF_CONTRACT, stock_after=plastic_prod.stock_quantity)
+                                     type=MovementTypeEnum.WRITE_OFF_CONTRACT, stock_after=plastic_prod.stock_quantity,
+                                     location_id=location_id)
             session.add(plastic_prod)
             session.add(movement)
             movements_created.append(
@@ -1821,30 +2471,39 @@ def write_off_all_pipes(current_user: Annotated[dict, Depends(get_current_user)]
         except Exception:
             return None
 
+    steel_prod = find_product_by_type(
+        'PIPE_STEEL_133_ST20', '%STEEL%', '%сталь%') if total_steel > 0 else None
+    plastic_prod = find_product_by_type(
+        'PIPE_PLASTIC_110_6_1', '%PLASTIC%', '%пластик%') if total_plastic > 0 else None
+    # Трубы списываются с места по умолчанию (и без истории): сначала товары, затем их остатки
+    debits = {}
+    for prod, meters in ((steel_prod, total_steel), (plastic_prod, total_plastic)):
+        if prod:
+            debits[prod.id] = debits.get(prod.id, 0.0) + meters
+    _, location_id = lock_default_location_debits(session, debits)
+
     if total_steel > 0:
-        steel_prod = find_product_by_type(
-            'PIPE_STEEL_133_ST20', '%STEEL%', '%сталь%')
         if steel_prod:
             old_qty = float(steel_prod.stock_quantity or 0.0)
             steel_prod.stock_quantity = old_qty - total_steel
             session.add(steel_prod)
             if not no_history:
                 movement = StockMovement(product_id=steel_prod.id, quantity=-total_steel,
-                                         type=MovementTypeEnum.WRITE_OFF_CONTRACT, stock_after=steel_prod.stock_quantity)
+                                         type=MovementTypeEnum.WRITE_OFF_CONTRACT, stock_after=steel_prod.stock_quantity,
+                                         location_id=location_id)
                 session.add(movement)
             movements_created.append(
                 {'product': steel_prod.name, 'deducted': total_steel, 'after': steel_prod.stock_quantity})
 
     if total_plastic > 0:
-        plastic_prod = find_product_by_type(
-            'PIPE_PLASTIC_110_6_1', '%PLASTIC%', '%пластик%')
         if plastic_prod:
             old_qty = float(plastic_prod.stock_quantity or 0.0)
             plastic_prod.stock_quantity = old_qty - total_plastic
             session.add(plastic_prod)
             if not no_history:
                 movement = StockMovement(product_id=plastic_prod.id, quantity=-total_plastic,
-                                         type=MovementTypeEnum.WRITE_OFF_CONTRACT, stock_after=plastic_prod.stock_quantity)
+                                         type=MovementTypeEnum.WRITE_OFF_CONTRACT, stock_after=plastic_prod.stock_quantity,
+                                         location_id=location_id)
                 session.add(movement)
             movements_created.append(
                 {'product': plastic_prod.name, 'deducted': total_plastic, 'after': plastic_prod.stock_quantity})
@@ -1858,29 +2517,16 @@ def write_off_all_pipes(current_user: Annotated[dict, Depends(get_current_user)]
     return {'contracts_processed': len(contract_ids), 'movements': movements_created}
 
 
-@app.get("/contracts/{contract_id}/generate-docx", summary="Сгенерировать договор .docx", tags=["Договоры"])
-def generate_contract_docx(
-    current_user: Annotated[dict, Depends(get_current_user)], contract_id: int,
-    background_tasks: BackgroundTasks, session: Session = Depends(get_session)
-):
-    """Генерирует .docx для договора по шаблону в папке templates.
-    Если шаблон отсутствует, возвращает 500 с объяснением.
-    """
-    contract = get_db_object_or_404(Contract, contract_id, session)
-
-    # Выбираем шаблон по типу договора, если есть специализированный шаблон для насосов
-    tmpl_name = "contract_template.docx"
+def _contract_template_name(contract: Contract) -> str:
+    """Выбираем шаблон по типу договора, если есть специализированный шаблон для насосов."""
     # if contract_type mentions pumps (насос), prefer pumps template
     if 'насос' in getattr(contract, 'contract_type', '').lower():
-        alt = os.path.join('templates', 'contract_template_pumps.docx')
-        if os.path.exists(alt):
-            tmpl_name = 'contract_template_pumps.docx'
+        if template_registry.exists('contract_template_pumps.docx'):
+            return 'contract_template_pumps.docx'
+    return "contract_template.docx"
 
-    template_path = os.path.join('templates', tmpl_name)
-    if not os.path.exists(template_path):
-        raise HTTPException(
-            status_code=500, detail="Шаблон договора не найден")
 
+def _build_contract_context(contract: Contract) -> dict:
     # Подготавливаем контекст для шаблона. Оставляем наиболее востребованные поля.
     # prefer contract.contract_date if present so historical contracts show their original date in documents
     try:
@@ -1893,18 +2539,9 @@ def generate_contract_docx(
     except Exception:
         contract_date_obj = date.today()
 
-    # prepare min_price formatted
-    raw_min_price = getattr(contract, 'min_price',
-                            None) or float(config.MIN_WELL_COST)
-    try:
-        min_price_formatted = f"{int(round(float(raw_min_price))):,}".replace(
-            ',', ' ') + ' ₽'
-    except Exception:
-        min_price_formatted = str(raw_min_price)
-
-    context = {
+    return {
         'contract_number': contract.contract_number,
-        'current_date_formatted': f"{contract_date_obj.day:02d} {['', 'января', 'февраля', 'марта', 'апреля', 'мая', 'июня', 'июля', 'августа', 'сентября', 'октября', 'ноября', 'декабря'][contract_date_obj.month]} {contract_date_obj.year} г.",
+        'current_date_formatted': f"{contract_date_obj.day:02d} {MONTHS_GENITIVE[contract_date_obj.month]} {contract_date_obj.year} г.",
         'contract_date_iso': contract_date_obj.isoformat(),
         'client_name': contract.client_name,
         'location': contract.location or '',
@@ -1923,15 +2560,66 @@ def generate_contract_docx(
         'min_price': getattr(contract, 'min_price', None) or config.MIN_WELL_COST,
     }
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".docx") as tmp:
-        doc = DocxTemplate(template_path)
-        doc.render(context)
-        doc.save(tmp.name)
-        tmp_path = tmp.name
 
-    background_tasks.add_task(os.remove, tmp_path)
+@app.get("/contracts/{contract_id}/generate-docx", summary="Сгенерировать договор .docx", tags=["Договоры"])
+def generate_contract_docx(
+    current_user: Annotated[dict, Depends(get_current_user)], contract_id: int,
+    session: Session = Depends(get_session)
+):
+    """Генерирует .docx для договора по шаблону в папке templates.
+    Если шаблон отсутствует, возвращает 500 с объяснением.
+    """
+    contract = get_db_object_or_404(Contract, contract_id, session)
+
+    tmpl_name = _contract_template_name(contract)
+    if not template_registry.exists(tmpl_name):
+        raise HTTPException(
+            status_code=500, detail="Шаблон договора не найден")
+
+    content = _render_document(tmpl_name, _build_contract_context(contract))
     filename = f"Contract_{contract.contract_number.replace(' ', '_')}.docx"
-    return FileResponse(path=tmp_path, filename=filename, media_type='application/vnd.openxmlformats-officedocument.wordprocessingml.document')
+    return _docx_response(content, filename)
+
+
+@app.post("/contracts/generate-docx-batch", summary="Архив договоров .docx по списку или фильтру", tags=["Договоры"])
+def generate_contracts_docx_batch(
+    current_user: Annotated[dict, Depends(get_current_user)], request: ContractDocumentBatchRequest,
+    session: Session = Depends(get_session)
+):
+    """Собирает ZIP с договорами по списку ID или по фильтру (период, статус, тип).
+    Документы рендерятся параллельно и отдаются потоком по мере готовности."""
+    if not request.ids and not (request.start_date or request.end_date or request.status or request.contract_type):
+        raise HTTPException(
+            status_code=400, detail="Укажите список ID или фильтр (период, статус, тип).")
+
+    query = select(Contract)
+    if request.ids:
+        query = query.where(Contract.id.in_(request.ids))
+    if request.start_date:
+        query = query.where(Contract.contract_date >= request.start_date)
+    if request.end_date:
+        query = query.where(Contract.contract_date < (request.end_date + timedelta(days=1)))
+    if request.status:
+        query = query.where(Contract.status == request.status)
+    if request.contract_type:
+        query = query.where(Contract.contract_type == request.contract_type)
+    contracts = session.exec(query.order_by(Contract.contract_date, Contract.id).limit(
+        config.DOCX_BATCH_MAX_DOCUMENTS + 1)).all()
+    if not contracts:
+        raise HTTPException(status_code=404, detail="Договоры не найдены")
+    if len(contracts) > config.DOCX_BATCH_MAX_DOCUMENTS:
+        raise HTTPException(
+            status_code=400, detail=f"Слишком много документов. Максимум в одном архиве: {config.DOCX_BATCH_MAX_DOCUMENTS}")
+
+    jobs = []
+    for c in contracts:
+        tmpl_name = _contract_template_name(c)
+        if not template_registry.exists(tmpl_name):
+            raise HTTPException(
+                status_code=500, detail="Шаблон договора не найден")
+        jobs.append((_zip_entry_name("Contract", c.contract_number, c.id),
+                     tmpl_name, _build_contract_context(c)))
+    return _documents_zip_response(jobs, f"Contracts_{date.today().strftime('%Y%m%d')}.zip")
 
 
 @app.post('/contracts/{contract_id}/calculate-revenue', response_model=RevenueDetailResponse, summary='Посчитать выручку по договору (детально)', tags=['Договоры'])
@@ -2107,66 +2795,248 @@ def calculate_contract_revenue(current_user: Annotated[dict, Depends(get_current
         total=round(total, 2),
         net_profit=net_profit
     )
+
+
+# --- Эндпоинты для Инвентаризации (Stocktakes) ---
+# Ожидаемые остатки фиксируются при создании инвентаризации. Расхождение товара —
+# факт минус учётный остаток на момент подсчёта: ожидаемый плюс движения склада между
+# началом инвентаризации и подсчётом. Движения после подсчёта в расхождение не входят,
+# поэтому склад может работать во время пересчёта.
+def _get_open_stocktake(session: Session, stocktake_id: int) -> Stocktake:
+    # Блокировка строки: запись фактов и проведение одной инвентаризации не идут параллельно
+    stocktake = session.exec(select(Stocktake).where(Stocktake.id == stocktake_id).with_for_update()).first()
+    if not stocktake:
+        raise HTTPException(status_code=404, detail=f"Stocktake с ID {stocktake_id} не найден")
+    if stocktake.status != StocktakeStatusEnum.OPEN:
+        raise HTTPException(status_code=400, detail=f"Инвентаризация уже в статусе '{stocktake.status.value}'.")
+    return stocktake
+
+
+def _movements_during_count(session: Session, stocktake: Stocktake) -> Dict[int, float]:
+    """Изменение склада по товарам между началом инвентаризации и подсчётом (одним запросом)."""
+    movement_type = cast(StockMovement.type, String)
+    rows = session.exec(select(StocktakeLine.product_id, movement_type, func.sum(StockMovement.quantity)).join(
+        StockMovement, and_(StockMovement.product_id == StocktakeLine.product_id,
+                            StockMovement.id > stocktake.start_movement_id,
+                            StockMovement.id <= StocktakeLine.counted_movement_id)
+    ).where(StocktakeLine.stocktake_id == stocktake.id).group_by(StocktakeLine.product_id, movement_type)).all()
+    moved = {}
+    for product_id, stored_type, quantity in rows:
+        if stock_reconciliation.affects_stock(stored_type):
+            moved[product_id] = moved.get(product_id, 0.0) + quantity
+    return moved
+
+
+def _stocktake_summaries(session: Session, stocktake_id: Optional[int] = None) -> List[StocktakeSummary]:
+    query = select(
+        Stocktake.id, Stocktake.note, Stocktake.status, Stocktake.created_at, Stocktake.posted_at,
+        func.count(StocktakeLine.product_id).label("line_count"),
+        func.count(StocktakeLine.counted_quantity).label("counted_count"),
+    ).join(StocktakeLine, isouter=True).group_by(Stocktake.id)
+    if stocktake_id is not None:
+        query = query.where(Stocktake.id == stocktake_id)
+    return rows_to_view(StocktakeSummary, session.exec(query.order_by(Stocktake.id.desc())).all())
+
+
+def _record_counts(session: Session, stocktake_id: int, counts: Dict[int, float]) -> StocktakeSummary:
+    """Записывает факты пачкой; повторный подсчёт товара заменяет предыдущий."""
+    _get_open_stocktake(session, stocktake_id)
+    lines = session.exec(select(StocktakeLine).where(
+        StocktakeLine.stocktake_id == stocktake_id, StocktakeLine.product_id.in_(list(counts)))).all()
+    missing = set(counts) - {line.product_id for line in lines}
+    if missing:
+        raise HTTPException(
+            status_code=400, detail=f"Товаров нет в инвентаризации: ID {', '.join(map(str, sorted(missing)))}.")
+    last_movement_id = session.exec(select(func.coalesce(func.max(StockMovement.id), 0))).one()
+    now = datetime.utcnow()
+    for line in lines:
+        line.counted_quantity = counts[line.product_id]
+        line.counted_at = now
+        line.counted_movement_id = last_movement_id
+    session.add_all(lines)
+    session.commit()
+    return _stocktake_summaries(session, stocktake_id)[0]
+
+
+@app.post("/stocktakes/", response_model=StocktakeSummary, summary="Начать инвентаризацию", tags=["Инвентаризация"])
+def create_stocktake(current_user: Annotated[dict, Depends(get_current_user)], request: StocktakeCreate, session: Session = Depends(get_session)):
+    """Фиксирует текущие остатки товаров (всех или перечисленных) как ожидаемые."""
+    query = select(Product).where(Product.is_deleted == False)
+    if request.product_ids is not None:
+        query = query.where(Product.id.in_(request.product_ids))
+    # Пока остатки фиксируются, движений по этим товарам нет: снимок согласован с start_movement_id
+    products = session.exec(query.order_by(Product.id).with_for_update()).all()
+    if not products:
+        raise HTTPException(status_code=400, detail="Нет товаров для инвентаризации.")
+
+    open_product_ids = set(session.exec(select(StocktakeLine.product_id).join(Stocktake).where(
+        Stocktake.status == StocktakeStatusEnum.OPEN)).all())
+    busy = sorted(p.id for p in products if p.id in open_product_ids)
+    if busy:
+        raise HTTPException(
+            status_code=409, detail=f"Товары уже в незавершённой инвентаризации: ID {', '.join(map(str, busy))}.")
+
+    stocktake = Stocktake(note=request.note, start_movement_id=session.exec(
+        select(func.coalesce(func.max(StockMovement.id), 0))).one())
+    session.add(stocktake)
+    session.flush()
+    session.add_all([StocktakeLine(stocktake_id=stocktake.id, product_id=p.id, expected_quantity=p.stock_quantity)
+                     for p in products])
+    session.commit()
+    return _stocktake_summaries(session, stocktake.id)[0]
+
+
+@app.get("/stocktakes/", response_model=List[StocktakeSummary], summary="Список инвентаризаций", tags=["Инвентаризация"])
+def list_stocktakes(current_user: Annotated[dict, Depends(get_current_user)], session: Session = Depends(get_session)):
+    return _stocktake_summaries(session)
+
+
+@app.get("/stocktakes/{stocktake_id}", response_model=StocktakeResponse, summary="Инвентаризация с расхождениями", tags=["Инвентаризация"])
+def get_stocktake(current_user: Annotated[dict, Depends(get_current_user)], stocktake_id: int, session: Session = Depends(get_session)):
+    summaries = _stocktake_summaries(session, stocktake_id)
+    if not summaries:
+        raise HTTPException(status_code=404, detail=f"Stocktake с ID {stocktake_id} не найден")
+    stocktake = session.get(Stocktake, stocktake_id)
+    moved = _movements_during_count(session, stocktake)
+    rows = session.exec(select(
+        StocktakeLine.product_id, Product.name, Product.internal_sku, Product.unit,
+        StocktakeLine.expected_quantity, StocktakeLine.counted_quantity, StocktakeLine.variance,
+    ).join(Product).where(StocktakeLine.stocktake_id == stocktake_id).order_by(Product.name)).all()
+    lines = []
+    for product_id, name, internal_sku, unit, expected, counted, variance in rows:
+        during = moved.get(product_id, 0.0)
+        if variance is None and counted is not None and stocktake.status == StocktakeStatusEnum.OPEN:
+            variance = counted - (expected + during)
+        lines.append(StocktakeLineResponse(
+            product_id=product_id, product_name=name, internal_sku=internal_sku, unit=unit,
+            expected_quantity=expected, movements_during_count=during, counted_quantity=counted, variance=variance))
+    return StocktakeResponse(**summaries[0].model_dump(), lines=lines)
+
+
+@app.put("/stocktakes/{stocktake_id}/counts", response_model=StocktakeSummary, summary="Записать фактические количества", tags=["Инвентаризация"])
+def record_stocktake_counts(current_user: Annotated[dict, Depends(get_current_user)], stocktake_id: int,
+                            counts: List[StocktakeCount], session: Session = Depends(get_session)):
+    if not counts:
+        raise HTTPException(status_code=400, detail="Нет фактических количеств.")
+    return _record_counts(session, stocktake_id, {c.product_id: c.counted_quantity for c in counts})
+
+
+def _record_sheet_counts(session: Session, stocktake_id: int, rows: List[dict]) -> StocktakeSummary:
+    skus = {row["internal_sku"] for row in rows}
+    product_ids = dict(session.exec(select(Product.internal_sku, Product.id).where(
+        Product.internal_sku.in_(list(skus)))).all())
+    unmatched = sorted(skus - set(product_ids))
+    if unmatched:
+        raise HTTPException(status_code=404, detail=f"Товары не найдены: {'; '.join(unmatched)}.")
+    return _record_counts(session, stocktake_id,
+                          {product_ids[row["internal_sku"]]: row["counted_quantity"] for row in rows})
+
+
+@app.post("/stocktakes/{stocktake_id}/counts/upload", response_model=StocktakeSummary, summary="Загрузить лист инвентаризации (.xlsx)", tags=["Инвентаризация"])
+async def upload_stocktake_counts(current_user: Annotated[dict, Depends(get_current_user)], stocktake_id: int,
+                                  file: UploadFile = File(...), session: Session = Depends(get_session)):
+    """Лист с колонками «Артикул» и «Факт» (или выгрузка склада INTERNAL_SKU / STOCK_QUANTITY)."""
+    content = await file.read()
+    parsed = await _parse_import_file(excel_import.parse_stocktake_sheet, content)
+    if not parsed["rows"]:
+        raise HTTPException(status_code=400, detail="В файле нет строк с артикулом и количеством.")
+    return await run_in_thread(_record_sheet_counts, session, stocktake_id, parsed["rows"])
+
+
+@app.post("/stocktakes/{stocktake_id}/post", response_model=StocktakePostResult, summary="Провести инвентаризацию", tags=["Инвентаризация"])
+def post_stocktake(current_user: Annotated[dict, Depends(get_current_user)], stocktake_id: int, session: Session = Depends(get_session)):
+    """Проводит расхождения посчитанных товаров корректировками в одной транзакции.
+    Непосчитанные товары не меняются."""
+    stocktake = _get_open_stocktake(session, stocktake_id)
+    lines = session.exec(select(StocktakeLine).where(
+        StocktakeLine.stocktake_id == stocktake_id, StocktakeLine.counted_quantity != None  # noqa: E711
+    ).order_by(StocktakeLine.product_id)).all()
+    if not lines:
+        raise HTTPException(status_code=400, detail="Нет посчитанных товаров.")
+    uncounted = session.exec(select(func.count()).select_from(StocktakeLine).where(
+        StocktakeLine.stocktake_id == stocktake_id, StocktakeLine.counted_quantity == None)).one()  # noqa: E711
+
+    products = {p.id: p for p in session.exec(select(Product).where(
+        Product.id.in_([line.product_id for line in lines])).order_by(Product.id).with_for_update()).all()}
+    moved = _movements_during_count(session, stocktake)
+    movements = []
+    for line in lines:
+        variance = line.counted_quantity - (line.expected_quantity + moved.get(line.product_id, 0.0))
+        line.variance = variance if abs(variance) > 1e-9 else 0.0
+        if line.variance:
+            product = products[line.product_id]
+            product.stock_quantity += line.variance
+            movements.append(StockMovement(
+                product_id=product.id, quantity=line.variance, type=MovementTypeEnum.ADJUSTMENT,
+                stock_after=product.stock_quantity))
+    # Движения вставляются одной пачкой при flush
+    session.add_all([*lines, *movements])
+    stocktake.status = StocktakeStatusEnum.POSTED
+    stocktake.posted_at = datetime.utcnow()
+    session.add(stocktake)
+    session.commit()
+    return StocktakePostResult(posted=len(lines), adjustments=len(movements), uncounted=uncounted)
+
+
+@app.post("/stocktakes/{stocktake_id}/cancel", response_model=StocktakeSummary, summary="Отменить инвентаризацию", tags=["Инвентаризация"])
+def cancel_stocktake(current_user: Annotated[dict, Depends(get_current_user)], stocktake_id: int, session: Session = Depends(get_session)):
+    stocktake = _get_open_stocktake(session, stocktake_id)
+    stocktake.status = StocktakeStatusEnum.CANCELLED
+    session.add(stocktake)
+    session.commit()
+    return _stocktake_summaries(session, stocktake_id)[0]
+
+
 # --- Эндпоинты для Отчетов (Reports) ---
 
 
+@app.post("/reports/forecast/refresh", summary="Пересчитать прогноз расхода товаров", tags=["Отчеты"])
+async def refresh_forecast(current_user: Annotated[dict, Depends(get_current_user)]):
+    """Учитывает движения с прошлого пересчёта и обновляет прогноз всех товаров
+    (обычно выполняется периодически, см. FORECAST_INTERVAL_MINUTES)."""
+    return await run_in_process(forecasting.run_forecast_job)
+
+
 @app.get("/reports/profit", response_model=ProfitReportResponse, summary="Отчет по прибыли", tags=["Отчеты"])
-def get_profit_report(
+async def get_profit_report(
     current_user: Annotated[dict, Depends(get_current_user)],
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
     # --- НОВЫЙ ПАРАМЕТР ---
     include_in_progress: bool = Query(
         False, description="Включить в отчет сметы 'В работе'"),
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     # --- НОВАЯ ЛОГИКА СТАТУСОВ ---
     statuses_to_include = [EstimateStatusEnum.COMPLETED]
     if include_in_progress:
         statuses_to_include.append(EstimateStatusEnum.IN_PROGRESS)
 
-    query = select(Estimate).options(selectinload(Estimate.items)).where(
-        Estimate.status.in_(statuses_to_include))
+    # Итоги хранятся в смете (estimate_totals.py): строки и товары не загружаются
+    query = select(
+        Estimate.id, Estimate.estimate_number, Estimate.client_name, Estimate.created_at,
+        Estimate.total_retail, Estimate.total_purchase
+    ).where(Estimate.status.in_(statuses_to_include), Estimate.total_retail != 0)
     # ---------------------------
 
     if start_date and end_date:
         query = query.where(Estimate.created_at >= start_date,
                             Estimate.created_at < (end_date + timedelta(days=1)))
 
-    estimates = session.exec(query).all()
+    rows = (await session.exec(query.order_by(Estimate.created_at))).all()
+    logger.debug(f"Отчёт по прибыли: смет {len(rows)}")
 
-    # --- РУЧНАЯ ЗАГРУЗКА ТОВАРОВ (оставляем, это работает) ---
-    product_ids = {item.product_id for est in estimates for item in est.items}
-    products_list = []
-    if product_ids:
-        products_list = session.exec(
-            select(Product).where(Product.id.in_(product_ids))).all()
-    product_map = {p.id: p for p in products_list}
-    print(
-        f"4. Создана карта товаров для поиска. Количество ключей: {len(product_map)}")
-    print("--- КОНЕЦ ДИАГНОСТИКИ ---\n")
-    # --- КОНЕЦ ДИАГНОСТИКИ ---
-
-    # ... (стандартный код)
     report_items, grand_total_retail, grand_total_purchase = [], 0.0, 0.0
-    for est in estimates:
-        total_retail = sum(it.quantity * it.unit_price for it in est.items)
-        total_purchase = 0
-        for item in est.items:
-            product = product_map.get(item.product_id)
-            if product:
-                total_purchase += item.quantity * (product.purchase_price or 0)
-        if total_retail == 0:
-            continue
-        profit = total_retail - total_purchase
-        margin = (profit / total_retail * 100) if total_retail > 0 else 0
+    for row in rows:
+        profit = row.total_retail - row.total_purchase
+        margin = (profit / row.total_retail * 100) if row.total_retail > 0 else 0
         report_items.append(ProfitReportItem(
-            estimate_id=est.id, estimate_number=est.estimate_number, client_name=est.client_name,
-            completed_at=est.created_at.date(), total_retail=total_retail, total_purchase=total_purchase,
-            profit=profit, margin=margin
+            estimate_id=row.id, estimate_number=row.estimate_number, client_name=row.client_name,
+            completed_at=row.created_at.date(), total_retail=row.total_retail,
+            total_purchase=row.total_purchase, profit=profit, margin=margin
         ))
-        grand_total_retail += total_retail
-        grand_total_purchase += total_purchase
+        grand_total_retail += row.total_retail
+        grand_total_purchase += row.total_purchase
 
     grand_total_profit = grand_total_retail - grand_total_purchase
     average_margin = (grand_total_profit / grand_total_retail *
@@ -2198,20 +3068,24 @@ class ProfitDetailResponse(BaseModel):
 
 
 @app.get("/reports/profit/{estimate_id}/details", response_model=ProfitDetailResponse, summary="Детали по смете (позиций)", tags=["Отчеты"])
-def get_profit_report_details(
+async def get_profit_report_details(
     current_user: Annotated[dict, Depends(get_current_user)],
     estimate_id: int,
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     # Return detailed lines for a single estimate: retail/purchase per position and totals.
-    estimate = get_db_object_or_404(Estimate, estimate_id, session)
+    estimate = (await session.exec(select(Estimate).where(Estimate.id == estimate_id).options(
+        selectinload(Estimate.items)))).first()
+    if not estimate:
+        raise HTTPException(
+            status_code=404, detail=f"Estimate с ID {estimate_id} не найден")
 
     # Load products used in the estimate in one query
     product_ids = [it.product_id for it in estimate.items]
     products = []
     if product_ids:
-        products = session.exec(select(Product).where(
-            Product.id.in_(product_ids))).all()
+        products = (await session.exec(select(Product).where(
+            Product.id.in_(product_ids)))).all()
     product_map = {p.id: p for p in products}
 
     items: List[ProfitDetailItem] = []
@@ -2273,11 +3147,11 @@ class DrillingProfitResponse(BaseModel):
 
 
 @app.get("/reports/drilling-profit", response_model=DrillingProfitResponse, summary="Прибыль по бурению (период)", tags=["Отчеты"])
-def get_drilling_profit_report(
+async def get_drilling_profit_report(
     current_user: Annotated[dict, Depends(get_current_user)],
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     # 1. ФИЛЬТРАЦИЯ: Убеждаемся, что тип договора СТРОГО 'DRILLING'
     query = select(Contract).where(
@@ -2292,7 +3166,13 @@ def get_drilling_profit_report(
     # 2. СОРТИРОВКА: Добавляем сортировку по номеру договора по возрастанию
     query = query.order_by(Contract.contract_number.asc())
 
-    contracts = session.exec(query).all()
+    contracts = (await session.exec(query)).all()
+
+    # Цены на трубы загружаем один раз, а не на каждый договор
+    steel_prod = (await session.exec(select(Product).where(
+        Product.internal_sku == 'PIPE_STEEL_133_ST20'))).first()
+    plastic_prod = (await session.exec(select(Product).where(
+        Product.internal_sku == 'PIPE_PLASTIC_110_6_1'))).first()
 
     items: List[DrillingProfitItem] = []
     grand_profit = 0.0
@@ -2306,10 +3186,6 @@ def get_drilling_profit_report(
 
         steel_m = float(c.pipe_steel_used or 0.0)
         plastic_m = float(c.pipe_plastic_used or 0.0)
-        steel_prod = session.exec(select(Product).where(
-            Product.internal_sku == 'PIPE_STEEL_133_ST20')).first()
-        plastic_prod = session.exec(select(Product).where(
-            Product.internal_sku == 'PIPE_PLASTIC_110_6_1')).first()
         steel_purchase = float(
             steel_prod.purchase_price) if steel_prod and steel_prod.purchase_price is not None else 0.0
         steel_retail = float(
@@ -2336,56 +3212,25 @@ def get_drilling_profit_report(
 
 # --- Исправленная функция get_dashboard_summary ---
 @app.get("/dashboard/summary", response_model=DashboardSummary, summary="Сводка для дашборда", tags=["Дашборд"])
-def get_dashboard_summary(current_user: Annotated[dict, Depends(get_current_user)], session: Session = Depends(get_session)):
-    # 1. Считаем количество товаров
-    products_to_order_count = session.exec(
-        select(func.count(Product.id)).where(
-            Product.is_deleted == False,
-            Product.min_stock_level > 0,
-            Product.stock_quantity <= Product.min_stock_level
-        )
-    ).one()
+async def get_dashboard_summary(current_user: Annotated[dict, Depends(get_current_user)], session: AsyncSession = Depends(get_async_session)):
+    # 1. Считаем количество товаров к закупке (очередь закупки)
+    products_to_order_count = (await session.exec(select(func.count(ReorderQueue.product_id)))).one()
 
-    estimates_in_progress_count = session.exec(select(func.count(Estimate.id)).where(
+    estimates_in_progress_count = (await session.exec(select(func.count(Estimate.id)).where(
         Estimate.status == EstimateStatusEnum.IN_PROGRESS
-    )).one()
+    ))).one()
 
-    contracts_in_progress_count = session.exec(select(func.count(Contract.id)).where(
+    contracts_in_progress_count = (await session.exec(select(func.count(Contract.id)).where(
         Contract.status == ContractStatusEnum.IN_PROGRESS
-    )).one()
+    ))).one()
 
     # 2. Считаем прибыль по сметам за 30 дней
     thirty_days_ago = datetime.now(timezone.utc) - timedelta(days=30)
-    profit_estimates = session.exec(select(Estimate).options(selectinload(Estimate.items)).where(
-        Estimate.status == EstimateStatusEnum.COMPLETED,
-        Estimate.created_at >= thirty_days_ago
-    )).all()
-
-    product_ids = {
-        item.product_id for est in profit_estimates for item in est.items}
-    products_list = []
-    if product_ids:
-        products_list = session.exec(
-            select(Product).where(Product.id.in_(product_ids))).all()
-    product_map = {p.id: p for p in products_list}
-
-    total_profit = 0.0
-    for est in profit_estimates:
-        for item in est.items:
-            product = product_map.get(item.product_id)
-            if product:
-                # Защита от None и NaN
-                qty = float(item.quantity or 0)
-                price = float(item.unit_price or 0)
-                cost = float(product.purchase_price or 0)
-
-                item_profit = (qty * price) - (qty * cost)
-
-                # Если вдруг получился NaN (например 0 * inf), заменяем на 0
-                if math.isnan(item_profit) or math.isinf(item_profit):
-                    item_profit = 0.0
-
-                total_profit += item_profit
+    total_profit = (await session.exec(
+        select(func.coalesce(func.sum(Estimate.total_retail - Estimate.total_purchase), 0.0)).where(
+            Estimate.status == EstimateStatusEnum.COMPLETED,
+            Estimate.created_at >= thirty_days_ago
+        ))).one()
 
     # 3. Считаем прибыль по бурению за 30 дней
     drilling_query = select(Contract).where(
@@ -2393,15 +3238,15 @@ def get_dashboard_summary(current_user: Annotated[dict, Depends(get_current_user
         Contract.status == ContractStatusEnum.COMPLETED,
         Contract.contract_date >= thirty_days_ago
     )
-    drilling_contracts = session.exec(drilling_query).all()
+    drilling_contracts = (await session.exec(drilling_query)).all()
 
     drilling_total = 0.0
 
     # Подгружаем цены на трубы один раз (чтобы не дергать базу в цикле)
-    steel_prod = session.exec(select(Product).where(
-        Product.internal_sku == 'PIPE_STEEL_133_ST20')).first()
-    plastic_prod = session.exec(select(Product).where(
-        Product.internal_sku == 'PIPE_PLASTIC_110_6_1')).first()
+    steel_prod = (await session.exec(select(Product).where(
+        Product.internal_sku == 'PIPE_STEEL_133_ST20'))).first()
+    plastic_prod = (await session.exec(select(Product).where(
+        Product.internal_sku == 'PIPE_PLASTIC_110_6_1'))).first()
 
     steel_purchase = float(
         steel_prod.purchase_price) if steel_prod and steel_prod.purchase_price is not None else 0.0
@@ -2427,19 +3272,7 @@ def get_dashboard_summary(current_user: Annotated[dict, Depends(get_current_user
         pipe_purchase = steel_purchase * steel_m + plastic_purchase * plastic_m
         pipe_retail = steel_retail * steel_m + plastic_retail * plastic_m
 
-        profit = (drilling_retail + pipe_retail) - (pipe_purchase)
-
-        # ГЛАВНОЕ ИСПРАВЛЕНИЕ: Проверка на NaN перед добавлением к общей сумме
-        if math.isnan(profit) or math.isinf(profit):
-            profit = 0.0
-
-        drilling_total += profit
-
-    # Финальная проверка перед возвратом (на всякий случай)
-    if math.isnan(total_profit):
-        total_profit = 0.0
-    if math.isnan(drilling_total):
-        drilling_total = 0.0
+        drilling_total += (drilling_retail + pipe_retail) - (pipe_purchase)
 
     return DashboardSummary(
         products_to_order_count=products_to_order_count,
@@ -2453,8 +3286,6 @@ def get_dashboard_summary(current_user: Annotated[dict, Depends(get_current_user
 # --- Эндпоинты для Администрирования (Backup) ---
 @app.get("/admin/backup", summary="Скачать бэкап базы данных", tags=["Администрирование"])
 def download_backup(current_user: Annotated[dict, Depends(get_current_user)], session: Session = Depends(get_session)):
-    import json
-    
     backup_data = {
         "timestamp": datetime.utcnow().isoformat(),
         "products": [p.model_dump(mode='json') for p in session.exec(select(Product)).all()],
@@ -2466,15 +3297,41 @@ def download_backup(current_user: Annotated[dict, Depends(get_current_user)], se
     }
     
     filename = f"backup_sklad_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-    json_str = json.dumps(backup_data, ensure_ascii=False, indent=2)
-    
     return Response(
-        content=json_str,
+        content=orjson.dumps(backup_data, option=orjson.OPT_INDENT_2),
         media_type="application/json",
         headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
 
 
+@app.post("/admin/stock-reconciliation", summary="Сверить остатки с журналом движений", tags=["Администрирование"])
+async def reconcile_stock(current_user: Annotated[dict, Depends(get_current_user)],
+                          repair: bool = Query(False, description='Если true — записать корректировки, приводящие журнал к текущим остаткам')):
+    """Считает остатки товаров и работников по журналу движений частями, возвращает
+    расхождения с stock_quantity, разрывы цепочки stock_after и отрицательные остатки на руках."""
+    return await run_in_process(stock_reconciliation.run_reconcile_job, repair)
+
+
+@app.get("/admin/document-cache", summary="Статистика кэша документов", tags=["Администрирование"])
+def get_document_cache_stats(current_user: Annotated[dict, Depends(get_current_user)]):
+    return document_cache.stats()
+
+
+@app.get("/admin/db-pool", summary="Состояние пулов соединений с БД", tags=["Администрирование"])
+def get_db_pool_stats(current_user: Annotated[dict, Depends(get_current_user)]):
+    return {"sync": pool_stats(engine), "async": pool_stats(async_engine)}
+
+
+@app.get("/admin/token-cache", summary="Статистика кэша проверенных токенов", tags=["Администрирование"])
+def get_token_cache_stats(current_user: Annotated[dict, Depends(get_current_user)]):
+    return token_verifier.stats()
+
+
+@app.get("/admin/executors", summary="Загрузка пулов потоков и процессов", tags=["Администрирование"])
+def get_executors_stats(current_user: Annotated[dict, Depends(get_current_user)]):
+    return executors.stats()
+
+
 # --- AI Chat Endpoint ---
 from ai_chat import ai_assistant
 
@@ -2583,6 +3440,15 @@ def ai_chat(current_user: Annotated[dict, Depends(get_current_user)], request: A
                     continue
                 
                 quantity = float(func_args["quantity"])
+                try:
+                    _, location_id = lock_default_location_debits(session, {product.id: quantity})
+                except HTTPException as error:
+                    function_results.append({
+                        "function": func_name,
+                        "success": False,
+                        "result": error.detail
+                    })
+                    continue
                 
                 if product.stock_quantity < quantity:
                     function_results.append({
@@ -2598,7 +3464,8 @@ def ai_chat(current_user: Annotated[dict, Depends(get_current_user)], request: A
                     worker_id=worker.id,
                     quantity=-quantity,
                     type=MovementTypeEnum.ISSUE_TO_WORKER,
-                    stock_after=product.stock_quantity
+                    stock_after=product.stock_quantity,
+                    location_id=location_id
                 )
                 session.add(product)
                 session.add(movement)
@@ -2612,11 +3479,7 @@ def ai_chat(current_user: Annotated[dict, Depends(get_current_user)], request: A
             
             elif func_name == "get_low_stock_products":
                 products = session.exec(
-                    select(Product).where(
-                        Product.is_deleted == False,
-                        Product.min_stock_level > 0,
-                        Product.stock_quantity <= Product.min_stock_level
-                    )
+                    select(Product).join(ReorderQueue, ReorderQueue.product_id == Product.id)
                 ).all()
                 
                 if products:
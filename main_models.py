@@ -1,14 +1,40 @@
 # main_models.py
 
-from datetime import datetime
-from typing import List, Optional
+from datetime import date, datetime
+from typing import Annotated, List, Optional
 from enum import Enum
 from pydantic import ConfigDict  # <-- ДОБАВЬТЕ ЭТОТ ИМПОРТ
+from pydantic import Field as PydanticField
 
 from sqlmodel import Field, SQLModel, Relationship
 from uuid import UUID as PythonUUID
 from sqlalchemy.dialects.postgresql import UUID as SQLAlchemyUUID
-from sqlalchemy import Column, ForeignKey
+from sqlalchemy import CheckConstraint, Column, ForeignKey, Index
+
+# --- Целостность числовых полей ---
+
+# Наибольшее конечное значение double. NaN и ±Infinity не проходят BETWEEN
+# ни в PostgreSQL (NaN там больше любого числа), ни в SQLite.
+FLOAT_MAX = "1.7976931348623157e308"
+
+# Для входных моделей API: NaN и ±Infinity отклоняются валидацией (422)
+FiniteFloat = Annotated[float, PydanticField(allow_inf_nan=False)]
+NonNegativeFiniteFloat = Annotated[float, PydanticField(ge=0, allow_inf_nan=False)]
+
+
+def finite_check(table: str, column: str, non_negative: bool = False) -> CheckConstraint:
+    """CHECK: значение конечное (и не меньше нуля). NULL проходит проверку."""
+    low = "0" if non_negative else f"-{FLOAT_MAX}"
+    return CheckConstraint(
+        f"{column} BETWEEN {low} AND {FLOAT_MAX}",
+        name=f"ck_{table}_{column}_finite",
+        info={"column": column},
+    )
+
+
+def finite_field(default=..., non_negative: bool = False):
+    """Поле таблицы, которое не принимает NaN и ±Infinity при валидации."""
+    return Field(default, ge=0 if non_negative else None, schema_extra={"allow_inf_nan": False})
 
 # --- Перечисления (Enums) для стандартизации полей ---
 
@@ -33,6 +59,8 @@ class MovementTypeEnum(str, Enum):
     WRITE_OFF_CONTRACT = "Списание по договору"
     ADJUSTMENT = "Корректировка"
     WRITE_OFF_WORKER = "Списание работником"  # <-- НОВЫЙ ТИП
+    # Перемещение между местами хранения: пара движений -q и +q, общий остаток не меняется
+    TRANSFER = "Перемещение"
 # --- Основные модели таблиц ---
 
 
@@ -47,6 +75,13 @@ class Worker(SQLModel, table=True):
 
 class Product(SQLModel, table=True):
     """Таблица товаров на складе"""
+    __table_args__ = (
+        finite_check("product", "purchase_price", non_negative=True),
+        finite_check("product", "retail_price", non_negative=True),
+        # Остаток может уйти в минус при списании труб по договору
+        finite_check("product", "stock_quantity"),
+        finite_check("product", "min_stock_level", non_negative=True),
+    )
     id: Optional[int] = Field(default=None, primary_key=True)
     is_favorite: bool = Field(default=False, index=True)
     is_deleted: bool = Field(default=False, index=True)
@@ -54,23 +89,78 @@ class Product(SQLModel, table=True):
     name: str
     supplier_sku: Optional[str] = Field(default=None, index=True)
     unit: UnitEnum = Field(default=UnitEnum.szt)
-    purchase_price: float = 0.0
-    retail_price: float = 0.0
-    stock_quantity: float = 0.0
-    min_stock_level: float = 0.0
+    purchase_price: float = finite_field(0.0, non_negative=True)
+    retail_price: float = finite_field(0.0, non_negative=True)
+    stock_quantity: float = finite_field(0.0)
+    min_stock_level: float = finite_field(0.0, non_negative=True)
+    # Прогноз расхода на момент forecast_at (см. forecasting.py): расход в день,
+    # через сколько дней закончится остаток (None — расхода нет) и рекомендуемый закуп
+    consumption_rate: float = Field(default=0.0, sa_column_kwargs={"server_default": "0"})
+    days_until_stockout: Optional[float] = Field(default=None, index=True)
+    suggested_reorder_qty: float = Field(default=0.0, sa_column_kwargs={"server_default": "0"})
+    forecast_at: Optional[datetime] = None
     stock_movements: List["StockMovement"] = Relationship(
         back_populates="product")
 
 
+class Location(SQLModel, table=True):
+    """Место хранения: склад, площадка, машина"""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str = Field(index=True, unique=True)
+    # Место по умолчанию: движения без места и остаток, не разнесённый по другим местам
+    is_default: bool = Field(default=False, index=True)
+
+
+class LocationStock(SQLModel, table=True):
+    """Остаток товара на месте хранения; ведётся в транзакции записи (см. locations.py)"""
+    __table_args__ = (
+        finite_check("locationstock", "quantity"),
+    )
+    location_id: int = Field(foreign_key="location.id", primary_key=True)
+    product_id: int = Field(foreign_key="product.id", primary_key=True, index=True)
+    quantity: float = finite_field(0.0)
+
+
+class ReorderQueue(SQLModel, table=True):
+    """Товар с остатком не выше минимального; ведётся в транзакции записи остатка (см. reorder_queue.py)"""
+    product_id: int = Field(foreign_key="product.id", primary_key=True)
+    # Сколько не хватает до минимального остатка: min_stock_level - stock_quantity
+    shortfall: float = 0.0
+    # Когда остаток опустился до минимума; не меняется, пока товар остаётся в очереди
+    went_low_at: datetime = Field(default_factory=datetime.utcnow, index=True)
+
+
+class ConsumptionDaily(SQLModel, table=True):
+    """Расход товара со склада за день; накапливается прогнозом по новым движениям (см. forecasting.py)"""
+    product_id: int = Field(foreign_key="product.id", primary_key=True)
+    day: date = Field(primary_key=True)
+    quantity: float = 0.0
+
+
+class ForecastState(SQLModel, table=True):
+    """Состояние прогноза расхода: последнее учтённое движение (одна строка, id = 1)"""
+    id: int = Field(default=1, primary_key=True)
+    last_movement_id: int = 0
+    computed_at: Optional[datetime] = None
+
+
 class StockMovement(SQLModel, table=True):
     """Таблица истории всех движений товаров"""
+    __table_args__ = (
+        finite_check("stockmovement", "quantity"),
+        finite_check("stockmovement", "stock_after"),
+        # Остатки на руках (SUM по работнику и товару) читаются только из индекса
+        Index("ix_stockmovement_worker_product", "worker_id", "product_id", "quantity"),
+    )
     id: Optional[int] = Field(default=None, primary_key=True)
-    quantity: float
+    quantity: float = finite_field()
     type: MovementTypeEnum
-    stock_after: Optional[float] = Field(default=None)
-    product_id: int = Field(foreign_key="product.id")
-    worker_id: Optional[int] = Field(default=None, foreign_key="worker.id")
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    stock_after: Optional[float] = finite_field(None)
+    product_id: int = Field(foreign_key="product.id", index=True)
+    worker_id: Optional[int] = Field(default=None, foreign_key="worker.id", index=True)
+    # Место хранения, остаток которого изменило движение
+    location_id: Optional[int] = Field(default=None, foreign_key="location.id", index=True)
+    timestamp: datetime = Field(default_factory=datetime.utcnow, index=True)
     product: Product = Relationship(back_populates="stock_movements")
     worker: Optional[Worker] = Relationship(back_populates="stock_movements")
 
@@ -87,10 +177,14 @@ class EstimateStatusEnum(str, Enum):
 
 class EstimateItem(SQLModel, table=True):
     """Строка в смете (один товар/услуга)"""
+    __table_args__ = (
+        finite_check("estimateitem", "quantity", non_negative=True),
+        finite_check("estimateitem", "unit_price", non_negative=True),
+    )
     id: Optional[int] = Field(default=None, primary_key=True)
-    quantity: float
-    unit_price: float
-    estimate_id: int = Field(foreign_key="estimate.id")
+    quantity: float = finite_field(non_negative=True)
+    unit_price: float = finite_field(non_negative=True)
+    estimate_id: int = Field(foreign_key="estimate.id", index=True)
     product_id: int = Field(foreign_key="product.id")
     estimate: "Estimate" = Relationship(back_populates="items")
     product: Product = Relationship()
@@ -102,7 +196,7 @@ class Estimate(SQLModel, table=True):
     estimate_number: str = Field(index=True)
     client_name: str
     location: Optional[str] = None
-    status: EstimateStatusEnum = Field(default=EstimateStatusEnum.DRAFT)
+    status: EstimateStatusEnum = Field(default=EstimateStatusEnum.DRAFT, index=True)
     created_at: datetime = Field(default_factory=datetime.utcnow)
     # user_id previously referenced external auth.users table which may not exist in this DB.
     # Keep a simple UUID field without a foreign key constraint to avoid SQLAlchemy errors when
@@ -112,6 +206,10 @@ class Estimate(SQLModel, table=True):
     worker_id: Optional[int] = Field(default=None, foreign_key="worker.id")
     # Записываем время отгрузки (shipped) — nullable, заполняется при отгрузке сметы
     shipped_at: Optional[datetime] = None
+    # Итоги по строкам; пересчитываются при каждом изменении строк (см. estimate_totals.py)
+    total_retail: float = Field(default=0.0, index=True)
+    total_purchase: float = 0.0
+    item_count: int = 0
     items: List[EstimateItem] = Relationship(back_populates="estimate")
     model_config = ConfigDict(arbitrary_types_allowed=True)
 
@@ -130,8 +228,16 @@ class ContractTypeEnum(str, Enum):
 # --- Таблица для Договоров ---
 
 
+_CONTRACT_FLOAT_COLUMNS = (
+    "estimated_depth", "price_per_meter_soil", "price_per_meter_rock",
+    "actual_depth_soil", "actual_depth_rock", "pipe_steel_used", "pipe_plastic_used",
+    "pipe_steel_price_per_meter", "min_price",
+)
+
+
 class Contract(SQLModel, table=True):
     """Договор на бурение скважины"""
+    __table_args__ = tuple(finite_check("contract", column) for column in _CONTRACT_FLOAT_COLUMNS)
     id: Optional[int] = Field(default=None, primary_key=True)
     contract_type: ContractTypeEnum = Field(default=ContractTypeEnum.DRILLING)
     contract_number: str = Field(index=True)
@@ -146,16 +252,112 @@ class Contract(SQLModel, table=True):
     passport_issue_date: Optional[str] = None
     passport_dep_code: Optional[str] = None
     passport_address: Optional[str] = None
-    estimated_depth: Optional[float] = None
-    price_per_meter_soil: Optional[float] = None
-    price_per_meter_rock: Optional[float] = None
-    actual_depth_soil: Optional[float] = None
-    actual_depth_rock: Optional[float] = None
-    pipe_steel_used: Optional[float] = None
-    pipe_plastic_used: Optional[float] = None
+    estimated_depth: Optional[float] = finite_field(None)
+    price_per_meter_soil: Optional[float] = finite_field(None)
+    price_per_meter_rock: Optional[float] = finite_field(None)
+    actual_depth_soil: Optional[float] = finite_field(None)
+    actual_depth_rock: Optional[float] = finite_field(None)
+    pipe_steel_used: Optional[float] = finite_field(None)
+    pipe_plastic_used: Optional[float] = finite_field(None)
     # Optional explicit price per meter for steel pipe; if not provided, code may fallback to Product.retail_price or default
-    pipe_steel_price_per_meter: Optional[float] = None
+    pipe_steel_price_per_meter: Optional[float] = finite_field(None)
     # Минимальная сумма для бурения (может быть переопределена на уровне договора)
-    min_price: Optional[float] = None
+    min_price: Optional[float] = finite_field(None)
     status: ContractStatusEnum = Field(default=ContractStatusEnum.PLANNED)
     model_config = ConfigDict(arbitrary_types_allowed=True)
+
+
+# --- Инвентаризация ---
+
+
+class StocktakeStatusEnum(str, Enum):
+    OPEN = "Идёт пересчёт"
+    POSTED = "Проведена"
+    CANCELLED = "Отменена"
+
+
+class Stocktake(SQLModel, table=True):
+    """Инвентаризация: учётные остатки фиксируются при создании, расхождения проводятся одной транзакцией"""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    note: Optional[str] = None
+    status: StocktakeStatusEnum = Field(default=StocktakeStatusEnum.OPEN, index=True)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    posted_at: Optional[datetime] = None
+    # Последнее движение на момент создания: ожидаемые остатки сняты после него
+    start_movement_id: int = 0
+    lines: List["StocktakeLine"] = Relationship(back_populates="stocktake")
+
+
+class StocktakeLine(SQLModel, table=True):
+    """Товар в инвентаризации: ожидаемый остаток на начало и фактически посчитанный"""
+    __table_args__ = (
+        finite_check("stocktakeline", "expected_quantity"),
+        finite_check("stocktakeline", "counted_quantity", non_negative=True),
+        finite_check("stocktakeline", "variance"),
+    )
+    stocktake_id: int = Field(foreign_key="stocktake.id", primary_key=True)
+    product_id: int = Field(foreign_key="product.id", primary_key=True, index=True)
+    expected_quantity: float = finite_field(0.0)
+    counted_quantity: Optional[float] = finite_field(None, non_negative=True)
+    counted_at: Optional[datetime] = None
+    # Последнее движение на момент подсчёта: движения после него в расхождение не входят
+    counted_movement_id: Optional[int] = None
+    # Проведённое расхождение: факт минус учётный остаток на момент подсчёта
+    variance: Optional[float] = finite_field(None)
+    stocktake: Stocktake = Relationship(back_populates="lines")
+
+
+# --- Сессии входа ---
+
+
+class AuthSession(SQLModel, table=True):
+    """Сессия входа: по refresh-токену выдаются новые access-токены без обращения к Supabase"""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    # sub из токена: id пользователя Supabase или email
+    user_id: str = Field(index=True)
+    # sha256 текущего refresh-токена; при каждом продлении токен меняется
+    refresh_token_hash: str = Field(unique=True, index=True)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    expires_at: datetime
+    last_used_at: Optional[datetime] = None
+    revoked_at: Optional[datetime] = None
+
+
+# --- Ключи идемпотентности ---
+
+
+class IdempotencyKey(SQLModel, table=True):
+    """Запрос с заголовком Idempotency-Key и его сохранённый ответ (см. idempotency.py)"""
+    # sha256 от пользователя и ключа: одинаковые ключи разных пользователей не пересекаются
+    key_hash: str = Field(primary_key=True)
+    # sha256 от эндпоинта и тела запроса: ключ нельзя переиспользовать для другого запроса
+    request_hash: str
+    # None — исходный запрос ещё выполняется
+    status_code: Optional[int] = None
+    response_body: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    expires_at: datetime = Field(index=True)
+
+
+# --- События изменений для потока /events ---
+
+
+class ChangeEvent(SQLModel, table=True):
+    """Событие изменения данных; пишется в транзакции изменения (см. change_events.py)"""
+    # AUTOINCREMENT: в SQLite id не переиспользуются после удаления старых событий
+    __table_args__ = {"sqlite_autoincrement": True}
+    id: Optional[int] = Field(default=None, primary_key=True)
+    # Например: product.stock, movement.created, estimate.status
+    type: str
+    # Компактный JSON с изменёнными полями
+    payload: str
+    created_at: datetime = Field(default_factory=datetime.utcnow, index=True)
+
+
+# --- Версии таблиц для ETag ---
+
+
+class TableVersion(SQLModel, table=True):
+    """Счётчик изменений таблицы: растёт в той же транзакции, что и запись (см. etags.py)"""
+    table_name: str = Field(primary_key=True)
+    version: int = 0
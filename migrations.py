@@ -0,0 +1,295 @@
+# migrations.py
+"""Версионные миграции схемы БД.
+
+Применённые миграции записываются в таблицу schema_version. Миграции — функции,
+зарегистрированные декоратором @migration с возрастающими номерами; каждая выполняется
+в своей транзакции вместе с записью версии.
+
+Пустая база создаётся по текущим моделям (create_all) и сразу помечается последней
+версией. При старте приложения выполняется одна проверка версии (check_schema);
+сами миграции запускаются отдельной командой:
+
+    python migrations.py upgrade   # применить недостающие миграции
+    python migrations.py status    # текущая и последняя версии
+"""
+import logging
+import sys
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+
+from sqlalchemy import (
+    CheckConstraint, Column, DateTime, Integer, MetaData, String, Table, func, inspect, select, text,
+)
+from sqlalchemy.engine import Connection, Engine
+from sqlmodel import SQLModel
+
+import config
+import main_models  # noqa: F401 — регистрирует таблицы в SQLModel.metadata
+
+logger = logging.getLogger(__name__)
+
+_version_metadata = MetaData()
+schema_version = Table(
+    "schema_version", _version_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+# Ключ pg_advisory_xact_lock: два экземпляра приложения не применят миграцию дважды
+_MIGRATION_LOCK_ID = 7_340_001
+
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = []
+
+
+def migration(version: int, description: str):
+    def register(fn: Callable[[Connection], None]):
+        expected = len(MIGRATIONS) + 1
+        if version != expected:
+            raise RuntimeError(f"Миграция {fn.__name__}: ожидался номер {expected}, указан {version}")
+        MIGRATIONS.append((version, description, fn))
+        return fn
+    return register
+
+
+def _column_exists(conn: Connection, table: str, column: str) -> bool:
+    return any(c["name"] == column for c in inspect(conn).get_columns(table))
+
+
+def _create_index(conn: Connection, name: str, table: str, columns: str):
+    # IF NOT EXISTS поддерживают и PostgreSQL, и SQLite
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+
+
+# --- Миграции ---
+
+@migration(1, "Базовая схема и прежние runtime-миграции (shipped_at, min_price, WRITE_OFF_WORKER)")
+def _baseline(conn: Connection):
+    # Недостающие таблицы (например, authsession) создаются по моделям; существующие не трогаются
+    SQLModel.metadata.create_all(conn)
+    if not _column_exists(conn, "estimate", "shipped_at"):
+        conn.execute(text("ALTER TABLE estimate ADD COLUMN shipped_at TIMESTAMP WITH TIME ZONE"))
+    if not _column_exists(conn, "contract", "min_price"):
+        conn.execute(text("ALTER TABLE contract ADD COLUMN min_price DOUBLE PRECISION"))
+    if conn.dialect.name == "postgresql":
+        enum_vals = conn.execute(text("SELECT enum_range(NULL::movementtypeenum)")).scalar()
+        if enum_vals and 'WRITE_OFF_WORKER' not in enum_vals:
+            conn.execute(text("ALTER TYPE movementtypeenum ADD VALUE 'WRITE_OFF_WORKER'"))
+
+
+@migration(2, "Индексы для истории движений, строк смет и фильтра смет по статусу")
+def _history_and_estimate_indexes(conn: Connection):
+    _create_index(conn, "ix_stockmovement_product_id", "stockmovement", "product_id")
+    _create_index(conn, "ix_stockmovement_worker_id", "stockmovement", "worker_id")
+    _create_index(conn, "ix_stockmovement_timestamp", "stockmovement", "timestamp")
+    _create_index(conn, "ix_estimateitem_estimate_id", "estimateitem", "estimate_id")
+    _create_index(conn, "ix_estimate_status", "estimate", "status")
+
+
+# Таблицы с CHECK на конечность числовых полей (см. finite_check в main_models)
+_FINITE_TABLES = ("product", "stockmovement", "estimateitem", "contract")
+
+
+def _finite_checks(table: str) -> List[CheckConstraint]:
+    return [c for c in SQLModel.metadata.tables[table].constraints
+            if isinstance(c, CheckConstraint) and "column" in c.info]
+
+
+def repair_numeric_columns(conn: Connection) -> Dict[str, int]:
+    """Чинит значения, не проходящие CHECK: один UPDATE на колонку.
+    NOT NULL колонки получают 0, допускающие NULL — NULL. Возвращает число исправленных строк."""
+    fixed = {}
+    for table in _FINITE_TABLES:
+        columns = SQLModel.metadata.tables[table].c
+        for check in _finite_checks(table):
+            column = check.info["column"]
+            value = "NULL" if columns[column].nullable else "0"
+            result = conn.execute(text(
+                f"UPDATE {table} SET {column} = {value} WHERE NOT ({check.sqltext.text})"))
+            if result.rowcount:
+                logger.warning(f"{table}.{column}: исправлено строк с NaN/Infinity/отрицательными: {result.rowcount}")
+            fixed[f"{table}.{column}"] = result.rowcount
+    return fixed
+
+
+@migration(3, "Починка NaN/Infinity в числовых полях и CHECK на их конечность")
+def _finite_numeric_checks(conn: Connection):
+    repair_numeric_columns(conn)
+    if conn.dialect.name != "postgresql":
+        # SQLite не умеет ALTER TABLE ADD CONSTRAINT; CHECK есть в таблицах, созданных по моделям
+        return
+    for table in _FINITE_TABLES:
+        existing = {c["name"] for c in inspect(conn).get_check_constraints(table)}
+        for check in _finite_checks(table):
+            if check.name not in existing:
+                conn.execute(text(
+                    f"ALTER TABLE {table} ADD CONSTRAINT {check.name} CHECK ({check.sqltext.text})"))
+
+
+@migration(4, "Таблица версий таблиц для ETag")
+def _table_versions(conn: Connection):
+    main_models.TableVersion.__table__.create(conn, checkfirst=True)
+
+
+@migration(5, "Итоги смет в таблице estimate (total_retail, total_purchase, item_count)")
+def _estimate_totals(conn: Connection):
+    from estimate_totals import refresh_totals
+
+    for column in ("total_retail", "total_purchase"):
+        if not _column_exists(conn, "estimate", column):
+            conn.execute(text(f"ALTER TABLE estimate ADD COLUMN {column} DOUBLE PRECISION NOT NULL DEFAULT 0"))
+    if not _column_exists(conn, "estimate", "item_count"):
+        conn.execute(text("ALTER TABLE estimate ADD COLUMN item_count INTEGER NOT NULL DEFAULT 0"))
+    _create_index(conn, "ix_estimate_total_retail", "estimate", "total_retail")
+    refresh_totals(conn)
+
+
+@migration(6, "Таблица ключей идемпотентности")
+def _idempotency_keys(conn: Connection):
+    main_models.IdempotencyKey.__table__.create(conn, checkfirst=True)
+
+
+@migration(7, "Таблица событий изменений для /events")
+def _change_events(conn: Connection):
+    main_models.ChangeEvent.__table__.create(conn, checkfirst=True)
+
+
+@migration(8, "Очередь закупки (товары ниже минимального остатка)")
+def _reorder_queue(conn: Connection):
+    from reorder_queue import refresh_queue
+
+    main_models.ReorderQueue.__table__.create(conn, checkfirst=True)
+    refresh_queue(conn)
+
+
+@migration(9, "Прогноз расхода: колонки товара, расход по дням, состояние пересчёта")
+def _consumption_forecast(conn: Connection):
+    if not _column_exists(conn, "product", "consumption_rate"):
+        conn.execute(text("ALTER TABLE product ADD COLUMN consumption_rate DOUBLE PRECISION NOT NULL DEFAULT 0"))
+    if not _column_exists(conn, "product", "days_until_stockout"):
+        conn.execute(text("ALTER TABLE product ADD COLUMN days_until_stockout DOUBLE PRECISION"))
+    if not _column_exists(conn, "product", "suggested_reorder_qty"):
+        conn.execute(text("ALTER TABLE product ADD COLUMN suggested_reorder_qty DOUBLE PRECISION NOT NULL DEFAULT 0"))
+    if not _column_exists(conn, "product", "forecast_at"):
+        conn.execute(text("ALTER TABLE product ADD COLUMN forecast_at TIMESTAMP WITHOUT TIME ZONE"))
+    _create_index(conn, "ix_product_days_until_stockout", "product", "days_until_stockout")
+    main_models.ConsumptionDaily.__table__.create(conn, checkfirst=True)
+    main_models.ForecastState.__table__.create(conn, checkfirst=True)
+
+
+@migration(10, "Составной индекс движений по работнику и товару для остатков на руках")
+def _worker_product_index(conn: Connection):
+    _create_index(conn, "ix_stockmovement_worker_product", "stockmovement", "worker_id, product_id, quantity")
+
+
+@migration(11, "Инвентаризации и их строки")
+def _stocktakes(conn: Connection):
+    main_models.Stocktake.__table__.create(conn, checkfirst=True)
+    main_models.StocktakeLine.__table__.create(conn, checkfirst=True)
+
+
+@migration(12, "Места хранения, остатки по местам и перемещения")
+def _locations(conn: Connection):
+    from locations import default_location_id, refresh_default
+
+    if conn.dialect.name == "postgresql":
+        enum_vals = conn.execute(text("SELECT enum_range(NULL::movementtypeenum)")).scalar()
+        if enum_vals and 'TRANSFER' not in enum_vals:
+            conn.execute(text("ALTER TYPE movementtypeenum ADD VALUE 'TRANSFER'"))
+    main_models.Location.__table__.create(conn, checkfirst=True)
+    main_models.LocationStock.__table__.create(conn, checkfirst=True)
+    if not _column_exists(conn, "stockmovement", "location_id"):
+        conn.execute(text("ALTER TABLE stockmovement ADD COLUMN location_id INTEGER REFERENCES location (id)"))
+    _create_index(conn, "ix_stockmovement_location_id", "stockmovement", "location_id")
+
+    # До этой версии место было одно: весь остаток и история относятся к месту по умолчанию
+    location_id = default_location_id(conn)
+    conn.execute(text(
+        "UPDATE stockmovement SET location_id = :location_id WHERE location_id IS NULL "
+        "AND type NOT IN ('WRITE_OFF_ESTIMATE', 'WRITE_OFF_WORKER')"), {"location_id": location_id})
+    refresh_default(conn, location_id=location_id)
+
+
+HEAD_VERSION = len(MIGRATIONS)
+
+
+# --- Применение ---
+
+def current_version(conn: Connection) -> int:
+    if not inspect(conn).has_table("schema_version"):
+        return 0
+    return conn.execute(select(func.max(schema_version.c.version))).scalar() or 0
+
+
+def _lock(conn: Connection):
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": _MIGRATION_LOCK_ID})
+
+
+def _stamp(conn: Connection, version: int, description: str):
+    conn.execute(schema_version.insert().values(
+        version=version, description=description, applied_at=datetime.utcnow()))
+
+
+def upgrade(engine: Engine) -> List[int]:
+    """Применяет недостающие миграции по порядку. Возвращает номера применённых."""
+    with engine.begin() as conn:
+        _lock(conn)
+        fresh = not inspect(conn).has_table("schema_version") and not inspect(conn).has_table("product")
+        _version_metadata.create_all(conn)
+        if fresh:
+            # Пустая база: схема сразу создаётся по моделям, все миграции считаются применёнными
+            SQLModel.metadata.create_all(conn)
+            for version, description, _ in MIGRATIONS:
+                _stamp(conn, version, description)
+            logger.info(f"Создана новая схема БД, версия {HEAD_VERSION}")
+            return [version for version, _, _ in MIGRATIONS]
+
+    applied = []
+    for version, description, fn in MIGRATIONS:
+        with engine.begin() as conn:
+            _lock(conn)
+            if current_version(conn) >= version:
+                continue
+            logger.info(f"Миграция {version}: {description}")
+            fn(conn)
+            _stamp(conn, version, description)
+            applied.append(version)
+    return applied
+
+
+def check_schema(engine: Engine) -> int:
+    """Проверка при старте: один запрос версии, без изменений схемы, если она актуальна."""
+    try:
+        with engine.connect() as conn:
+            version = conn.execute(select(func.max(schema_version.c.version))).scalar() or 0
+    except Exception:
+        # Таблицы версий ещё нет
+        version = 0
+    if version >= HEAD_VERSION:
+        return version
+    if config.MIGRATE_ON_STARTUP:
+        upgrade(engine)
+        return HEAD_VERSION
+    logger.error(
+        f"Схема БД устарела: версия {version}, требуется {HEAD_VERSION}. "
+        "Выполните: python migrations.py upgrade")
+    return version
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    from db_pool import create_pooled_engine
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "upgrade"
+    migration_engine = create_pooled_engine(config.DATABASE_URL)
+    if command == "upgrade":
+        applied = upgrade(migration_engine)
+        print(f"Применено миграций: {len(applied)}. Версия схемы: {HEAD_VERSION}")
+    elif command == "status":
+        with migration_engine.connect() as status_conn:
+            print(f"Версия схемы: {current_version(status_conn)}, последняя: {HEAD_VERSION}")
+    else:
+        print("Использование: python migrations.py [upgrade|status]")
+        sys.exit(2)
@@ -0,0 +1,89 @@
+# reorder_queue.py
+"""Очередь закупки: товары, остаток которых опустился до минимального.
+
+Строка ReorderQueue появляется, когда остаток товара становится не выше
+min_stock_level (при min_stock_level > 0), и удаляется, когда остаток поднимается
+выше минимума, минимум обнуляется или товар удаляется. Очередь обновляется после
+flush любой ORM-сессии, изменившей остаток, минимум или пометку удаления товара, —
+в той же транзакции. Поэтому её поддерживают все пути записи: выдача, приход,
+сметы, договоры, импорт, AI-чат.
+
+Страница «Товары к закупу», счётчик на дашборде и AI-инструмент читают очередь,
+а не сканируют товары; went_low_at даёт ленту «новое с момента».
+
+Полный пересчёт (после ручных правок в БД или восстановления бэкапа):
+
+    python reorder_queue.py rebuild
+"""
+import logging
+import sys
+from datetime import datetime
+from typing import Iterable, Optional
+
+from sqlalchemy import and_, delete, event, inspect, literal, not_, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session as OrmSession
+
+from main_models import Product, ReorderQueue
+
+logger = logging.getLogger(__name__)
+
+# Поля товара, от которых зависит попадание в очередь
+WATCHED_FIELDS = ("stock_quantity", "min_stock_level", "is_deleted")
+
+
+def _is_low():
+    return and_(Product.is_deleted == False, Product.min_stock_level > 0,  # noqa: E712
+                Product.stock_quantity <= Product.min_stock_level)
+
+
+def refresh_queue(conn: Connection, product_ids: Optional[Iterable[int]] = None) -> int:
+    """Приводит очередь в соответствие с остатками указанных товаров (None — всех).
+    Возвращает число товаров в очереди среди них."""
+    ids = None if product_ids is None else sorted(product_ids)
+    low = select(Product.id).where(_is_low())
+    stale = delete(ReorderQueue).where(not_(ReorderQueue.product_id.in_(low)))
+    if ids is not None:
+        low = low.where(Product.id.in_(ids))
+        stale = stale.where(ReorderQueue.product_id.in_(ids))
+    conn.execute(stale)
+
+    # Новые товары встают в очередь с текущим временем; у уже стоящих обновляется только нехватка
+    dialect_insert = pg_insert if conn.dialect.name == "postgresql" else sqlite_insert
+    rows = select(Product.id, Product.min_stock_level - Product.stock_quantity,
+                  literal(datetime.utcnow())).where(_is_low())
+    if ids is not None:
+        rows = rows.where(Product.id.in_(ids))
+    stmt = dialect_insert(ReorderQueue).from_select(["product_id", "shortfall", "went_low_at"], rows)
+    stmt = stmt.on_conflict_do_update(index_elements=["product_id"],
+                                      set_={"shortfall": stmt.excluded.shortfall})
+    return conn.execute(stmt).rowcount
+
+
+@event.listens_for(OrmSession, "after_flush")
+def _refresh_after_flush(session: OrmSession, flush_context):
+    product_ids = set()
+    for obj in (*session.new, *session.dirty):
+        if not isinstance(obj, Product):
+            continue
+        state = inspect(obj)
+        if obj in session.new or any(state.attrs[f].history.has_changes() for f in WATCHED_FIELDS):
+            product_ids.add(obj.id)
+    product_ids.discard(None)
+    if product_ids:
+        refresh_queue(session.connection(), product_ids)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    import config
+    from db_pool import create_pooled_engine
+
+    if len(sys.argv) < 2 or sys.argv[1] != "rebuild":
+        print("Использование: python reorder_queue.py rebuild")
+        sys.exit(2)
+    with create_pooled_engine(config.DATABASE_URL).begin() as rebuild_conn:
+        print(f"Товаров в очереди закупки: {refresh_queue(rebuild_conn)}")
@@ -0,0 +1,121 @@
+# serialization_benchmark.py
+"""Бенчмарк сериализации и сжатия больших ответов.
+
+Запуск:
+    python serialization_benchmark.py              # все нагрузки
+    python serialization_benchmark.py --rows 1000  # размер списков
+
+Сравниваются три способа получить тело JSON-ответа из тех же данных:
+- stdlib: прежний путь JSONResponse (dump в dict + jsonable_encoder + json.dumps);
+- orjson: OrjsonResponse (dump в dict + orjson.dumps) — ответы без response_model;
+- dump_json: быстрый путь FastAPI для эндпоинтов с response_model (Pydantic, Rust).
+Для результата печатается размер после gzip и Brotli (если установлен) и время сжатия.
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Tuple
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+import http_encoding
+from main_models import Contract, Estimate, EstimateItem, MovementTypeEnum
+
+
+def _history_payload(rows: int) -> Tuple[TypeAdapter, object]:
+    # Страница /actions/history/ — список словарей
+    started = datetime(2024, 1, 1)
+    items = [{
+        "id": i,
+        "timestamp": (started + timedelta(minutes=i)).isoformat(),
+        "type": MovementTypeEnum.ISSUE_TO_WORKER.value,
+        "quantity": -1.5 * (i % 7 + 1),
+        "stock_after": 120.0 - i,
+        "product_id": i % 300,
+        "product_name": f"Труба ПНД 32 мм, бухта {i % 300}",
+        "worker_id": i % 12,
+        "worker_name": "Петров Пётр Петрович",
+    } for i in range(rows)]
+    return TypeAdapter(Dict[str, object]), {"total": rows * 20, "items": items}
+
+
+def _contracts_payload(rows: int) -> Tuple[TypeAdapter, object]:
+    contracts = [Contract(
+        id=i, contract_number=f"Д-{i:05d}", contract_date=datetime(2024, 1, 1) + timedelta(days=i % 365),
+        client_name="Иванов Иван Иванович", location="д. Берёзовка, ул. Лесная, 5",
+        passport_series_number="1234 567890", passport_issued_by="ОВД района",
+        estimated_depth=60.0, price_per_meter_soil=2500.0, price_per_meter_rock=3500.0,
+        actual_depth_soil=40.0, actual_depth_rock=22.5, pipe_steel_used=30.0, pipe_plastic_used=62.5,
+    ) for i in range(rows)]
+    return TypeAdapter(List[Contract]), contracts
+
+
+def _estimates_payload(rows: int) -> Tuple[TypeAdapter, object]:
+    estimates = [Estimate(id=i, estimate_number=f"С-{i:05d}", client_name="ООО «Водоканал»",
+                          location="с. Озёрное", created_at=datetime(2024, 1, 1)) for i in range(rows)]
+    return TypeAdapter(List[Estimate]), estimates
+
+
+def _estimate_items_payload(rows: int) -> Tuple[TypeAdapter, object]:
+    items = [EstimateItem(id=i, estimate_id=1, product_id=i, quantity=2.0, unit_price=1450.5)
+             for i in range(rows)]
+    return TypeAdapter(List[EstimateItem]), items
+
+
+PAYLOADS: Dict[str, Callable[[int], Tuple[TypeAdapter, object]]] = {
+    "history": _history_payload,
+    "contracts": _contracts_payload,
+    "estimates": _estimates_payload,
+    "estimate_items": _estimate_items_payload,
+}
+
+
+def _best_ms(fn: Callable[[], bytes], repeat: int) -> Tuple[float, bytes]:
+    best, result = float("inf"), b""
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000, result
+
+
+def serializers(adapter: TypeAdapter, data) -> Dict[str, Callable[[], bytes]]:
+    def stdlib() -> bytes:
+        content = jsonable_encoder(adapter.dump_python(data, mode="json"))
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+    def orjson_response() -> bytes:
+        return http_encoding.OrjsonResponse(adapter.dump_python(data, mode="json")).body
+
+    def dump_json() -> bytes:
+        return adapter.dump_json(data)
+
+    return {"stdlib": stdlib, "orjson": orjson_response, "dump_json": dump_json}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сериализация и сжатие ответов")
+    parser.add_argument("--rows", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    encodings = ["gzip"] + (["br"] if http_encoding.brotli is not None else [])
+    for name, build in PAYLOADS.items():
+        adapter, data = build(args.rows)
+        print(f"\n{name} ({args.rows} строк)")
+        body = b""
+        for serializer, fn in serializers(adapter, data).items():
+            ms, body = _best_ms(fn, args.repeat)
+            print(f"  {serializer:<10} {ms:8.2f} мс  {len(body) / 1024:8.1f} КБ")
+        for encoding in encodings:
+            ms, compressed = _best_ms(lambda: http_encoding.compress(body, encoding), args.repeat)
+            print(f"  {encoding:<10} {ms:8.2f} мс  {len(compressed) / 1024:8.1f} КБ "
+                  f"({len(compressed) / len(body):.0%} исходного)")
+    if http_encoding.brotli is None:
+        print("\nBrotli не установлен: сравнивается только gzip (pip install Brotli)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+# stock_reconciliation.py
+"""Сверка остатков с журналом движений и исправление расхождений.
+
+Остаток товара на складе по журналу — сумма quantity движений, меняющих склад:
+приход, выдача, возврат, корректировка, списание по договору и отмены тех операций,
+которые меняли склад (см. cancel_movement). Списания по смете и работником склад
+не трогают. Остаток на руках у работника — минус сумма quantity его движений.
+
+Сверка находит:
+- товары, у которых stock_quantity не совпадает с остатком по журналу
+  (ручные правки в обход истории, write-off-all-pipes?no_history=true, старые NaN);
+- разрывы цепочки stock_after: движение, у которого stock_after не равен
+  предыдущему stock_after товара плюс изменение склада этим движением;
+- отрицательные остатки на руках у работников.
+
+Журнал читается частями по RECONCILE_CHUNK_ROWS строк (по возрастанию id), каждая
+часть обрабатывается векторно (pandas); между частями хранятся только итоги по
+товарам и парам работник/товар, поэтому память не растёт с длиной журнала.
+
+Исправление пишет по одной корректировке (ADJUSTMENT) на товар: журнал приводится
+к текущему stock_quantity, сам остаток не меняется. Расхождения пересчитываются
+под блокировкой строк товаров, так что движения, записанные во время сверки,
+не исказят корректировку. Остатки работников только показываются — корректировки
+их не исправляют. Запуск вручную:
+
+    python stock_reconciliation.py check
+    python stock_reconciliation.py repair
+"""
+import logging
+import sys
+from datetime import datetime
+from typing import Any, Dict, Iterable
+
+from sqlalchemy import String, cast, func, insert, select
+from sqlalchemy.engine import Connection, Engine
+
+import config
+from etags import bump_versions
+from main_models import MovementTypeEnum, Product, StockMovement
+
+logger = logging.getLogger(__name__)
+
+# Допуск сравнения остатков (накопленная погрешность float)
+TOLERANCE = 1e-6
+
+# Типы (имена членов enum), движения которых меняют остаток склада
+STOCK_TYPES = frozenset({
+    MovementTypeEnum.INCOME.name,
+    MovementTypeEnum.ISSUE_TO_WORKER.name,
+    MovementTypeEnum.RETURN_FROM_WORKER.name,
+    MovementTypeEnum.ADJUSTMENT.name,
+    MovementTypeEnum.WRITE_OFF_CONTRACT.name,
+})
+# Отмены этих типов возвращают остаток склада
+RESTORING_CANCEL_TYPES = (
+    MovementTypeEnum.INCOME.name,
+    MovementTypeEnum.ISSUE_TO_WORKER.name,
+    MovementTypeEnum.RETURN_FROM_WORKER.name,
+    MovementTypeEnum.ADJUSTMENT.name,
+)
+
+
+def affects_stock(movement_type: str) -> bool:
+    """Меняет ли движение с таким типом (как он хранится в БД) остаток склада."""
+    if "Отмена" in movement_type:
+        return any(f"MovementTypeEnum.{name})" in movement_type for name in RESTORING_CANCEL_TYPES)
+    return movement_type in STOCK_TYPES
+
+
+class LedgerScan:
+    """Накопленные итоги сверки по уже прочитанным частям журнала."""
+
+    def __init__(self):
+        import pandas as pd
+
+        self.movements = 0
+        self.balance = pd.Series(dtype="float64")  # остаток склада по журналу, по товарам
+        self.last_after = pd.Series(dtype="float64")  # последний известный stock_after товара
+        self.on_hand = pd.Series(dtype="float64", index=pd.MultiIndex.from_arrays(
+            [[], []], names=["worker_id", "product_id"]))
+        self.breaks: Dict[int, Dict[str, Any]] = {}
+
+    def add_chunk(self, chunk):
+        """Часть журнала (id, product_id, worker_id, type, quantity, stock_after), по возрастанию id."""
+        import numpy as np
+
+        self.movements += len(chunk)
+        # Разбор типа — по уникальным строкам части, их единицы
+        factors = {t: 1.0 if affects_stock(t) else 0.0 for t in chunk["type"].unique()}
+        chunk = chunk.assign(delta=chunk["quantity"] * chunk["type"].map(factors))
+        chunk = chunk.sort_values(["product_id", "id"], kind="stable").reset_index(drop=True)
+        by_product = chunk.groupby("product_id", sort=False)
+
+        # Остаток по журналу до каждого движения и ожидаемый stock_after
+        carried = chunk["product_id"].map(self.balance).fillna(0.0)
+        balance_before = carried + by_product["delta"].cumsum() - chunk["delta"]
+        previous_after = by_product["stock_after"].ffill().groupby(chunk["product_id"]).shift(1)
+        previous_after = previous_after.fillna(chunk["product_id"].map(self.last_after)).fillna(balance_before)
+        expected_after = previous_after + chunk["delta"]
+        broken = chunk["stock_after"].notna() & (np.abs(chunk["stock_after"] - expected_after) > TOLERANCE)
+        self._add_breaks(chunk.assign(expected_after=expected_after)[broken])
+
+        totals = by_product["delta"].sum()
+        self.balance = self.balance.add(totals, fill_value=0.0)
+        last_after = by_product["stock_after"].last()  # last() пропускает NaN
+        self.last_after = last_after.combine_first(self.last_after)
+
+        issued = chunk[chunk["worker_id"].notna()]
+        if not issued.empty:
+            pairs = (-issued["quantity"]).groupby(
+                [issued["worker_id"].astype("int64"), issued["product_id"]]).sum()
+            self.on_hand = self.on_hand.add(pairs, fill_value=0.0)
+
+    def _add_breaks(self, broken):
+        for product_id, rows in broken.groupby("product_id", sort=False):
+            entry = self.breaks.get(int(product_id))
+            if entry is None:
+                first = rows.iloc[0]
+                self.breaks[int(product_id)] = {
+                    "product_id": int(product_id), "breaks": len(rows),
+                    "first_movement_id": int(first["id"]),
+                    "expected_stock_after": round(float(first["expected_after"]), 4),
+                    "stock_after": round(float(first["stock_after"]), 4),
+                }
+            else:
+                entry["breaks"] += len(rows)
+
+
+def _read_chunks(conn: Connection, chunk_rows: int):
+    import pandas as pd
+
+    columns = ["id", "product_id", "worker_id", "type", "quantity", "stock_after"]
+    last_id = 0
+    while True:
+        rows = conn.execute(select(
+            StockMovement.id, StockMovement.product_id, StockMovement.worker_id,
+            cast(StockMovement.type, String).label("type"), StockMovement.quantity, StockMovement.stock_after,
+        ).where(StockMovement.id > last_id).order_by(StockMovement.id).limit(chunk_rows)).all()
+        if not rows:
+            return
+        chunk = pd.DataFrame(rows, columns=columns)
+        chunk["stock_after"] = chunk["stock_after"].astype("float64")
+        yield chunk
+        last_id = int(chunk["id"].iloc[-1])
+
+
+def reconcile(engine: Engine, repair: bool = False, chunk_rows: int = None) -> Dict[str, Any]:
+    """Сверяет остатки с журналом; при repair=True записывает корректировки расхождений."""
+    import pandas as pd
+
+    scan = LedgerScan()
+    with engine.connect() as conn:
+        for chunk in _read_chunks(conn, chunk_rows or config.RECONCILE_CHUNK_ROWS):
+            scan.add_chunk(chunk)
+        products = pd.DataFrame(conn.execute(select(
+            Product.id, Product.name, Product.stock_quantity)).all(), columns=["id", "name", "stock_quantity"])
+
+    frame = products.set_index("id")
+    frame["ledger_balance"] = scan.balance.reindex(frame.index).fillna(0.0)
+    frame["difference"] = frame["stock_quantity"] - frame["ledger_balance"]
+    mismatched = frame[frame["difference"].abs() > TOLERANCE]
+    discrepancies = [
+        {"product_id": int(product_id), "name": row["name"], "stock_quantity": round(row["stock_quantity"], 4),
+         "ledger_balance": round(row["ledger_balance"], 4), "difference": round(row["difference"], 4)}
+        for product_id, row in mismatched.iterrows()]
+
+    negative = scan.on_hand[scan.on_hand < -TOLERANCE]
+    negative_on_hand = [
+        {"worker_id": int(worker_id), "product_id": int(product_id), "on_hand": round(float(quantity), 4)}
+        for (worker_id, product_id), quantity in negative.items()]
+
+    adjustments = repair_products(engine, mismatched.index) if repair and not mismatched.empty else 0
+    logger.info(f"Сверка остатков: движений {scan.movements}, расхождений {len(discrepancies)}, "
+                f"разрывов stock_after у {len(scan.breaks)} товаров, корректировок {adjustments}")
+    return {
+        "movements": scan.movements,
+        "products": len(frame),
+        "discrepancies": discrepancies,
+        "broken_chains": sorted(scan.breaks.values(), key=lambda b: b["product_id"]),
+        "negative_on_hand": negative_on_hand,
+        "adjustments": adjustments,
+    }
+
+
+def repair_products(engine: Engine, product_ids: Iterable[int]) -> int:
+    """Записывает корректировки, приводящие журнал к stock_quantity указанных товаров."""
+    # locations импортирует этот модуль (affects_stock), поэтому импорт — при вызове
+    from locations import default_location_id
+
+    ids = sorted(int(i) for i in product_ids)
+    adjustments = []
+    with engine.begin() as conn:
+        stock = dict(conn.execute(select(Product.id, Product.stock_quantity).where(
+            Product.id.in_(ids)).order_by(Product.id).with_for_update()).all())
+        # Пересчёт под блокировкой: учитывает движения, записанные после чтения журнала
+        types = cast(StockMovement.type, String)
+        rows = conn.execute(select(StockMovement.product_id, types, func.sum(StockMovement.quantity)).where(
+            StockMovement.product_id.in_(ids)).group_by(StockMovement.product_id, types)).all()
+        ledger = dict.fromkeys(ids, 0.0)
+        for product_id, movement_type, quantity in rows:
+            if affects_stock(movement_type):
+                ledger[product_id] += quantity
+        now = datetime.utcnow()
+        # Расхождение уже учтено в остатке места по умолчанию (запись остатка без движения
+        # попадает туда), корректировка лишь отражает его в журнале этого места
+        location_id = default_location_id(conn)
+        for product_id, quantity in stock.items():
+            difference = quantity - ledger[product_id]
+            if abs(difference) > TOLERANCE:
+                adjustments.append({
+                    "product_id": product_id, "quantity": difference, "type": MovementTypeEnum.ADJUSTMENT,
+                    "stock_after": quantity, "timestamp": now, "location_id": location_id})
+        if adjustments:
+            conn.execute(insert(StockMovement), adjustments)
+    if adjustments:
+        # Вставка идёт мимо ORM-сессии — версию для ETag истории поднимаем сами, после commit
+        bump_versions(engine, ["stockmovement"])
+    return len(adjustments)
+
+
+_process_engine = None
+
+
+def run_reconcile_job(repair: bool = False) -> Dict[str, Any]:
+    """Точка входа для пула процессов: движок БД создаётся один раз на процесс."""
+    global _process_engine
+    if _process_engine is None:
+        from db_pool import create_pooled_engine
+        _process_engine = create_pooled_engine(config.DATABASE_URL)
+    return reconcile(_process_engine, repair=repair)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) < 2 or sys.argv[1] not in ("check", "repair"):
+        print("Использование: python stock_reconciliation.py check|repair")
+        sys.exit(2)
+    report = run_reconcile_job(repair=sys.argv[1] == "repair")
+    for item in report["discrepancies"]:
+        print(f"Товар {item['product_id']} '{item['name']}': остаток {item['stock_quantity']}, "
+              f"по журналу {item['ledger_balance']}, разница {item['difference']}")
+    for item in report["broken_chains"]:
+        print(f"Товар {item['product_id']}: разрывов stock_after {item['breaks']}, "
+              f"первый — движение {item['first_movement_id']}")
+    for item in report["negative_on_hand"]:
+        print(f"Работник {item['worker_id']}, товар {item['product_id']}: на руках {item['on_hand']}")
+    print(f"Движений: {report['movements']}, расхождений: {len(report['discrepancies'])}, "
+          f"корректировок: {report['adjustments']}")
@@ -2,31 +2,46 @@
 import pytest
 from fastapi.testclient import TestClient
 from sqlmodel import SQLModel, create_engine, Session
-from sqlalchemy.pool import StaticPool
-from main_api import app, get_session
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+from sqlmodel.ext.asyncio.session import AsyncSession
+from main_api import app, get_session, get_async_session
 from main_models import Product, Worker, Estimate, EstimateItem, Contract
 
-# Используем in-memory SQLite для тестов
-TEST_DATABASE_URL = "sqlite:///:memory:"
+# Используем файловую SQLite во временном каталоге: одну базу видят
+# и синхронный движок, и асинхронный (aiosqlite)
+@pytest.fixture(name="db_path")
+def db_path_fixture(tmp_path):
+    return tmp_path / "test.db"
 
 @pytest.fixture(name="session")
-def session_fixture():
+def session_fixture(db_path):
     engine = create_engine(
-        TEST_DATABASE_URL,
+        f"sqlite:///{db_path}",
         connect_args={"check_same_thread": False},
-        poolclass=StaticPool,
     )
     SQLModel.metadata.create_all(engine)
     with Session(engine) as session:
         yield session
     SQLModel.metadata.drop_all(engine)
+    engine.dispose()
+
+@pytest.fixture(name="async_engine")
+def async_engine_fixture(db_path):
+    # NullPool: соединения не переживают event loop тестового клиента
+    return create_async_engine(f"sqlite+aiosqlite:///{db_path}", poolclass=NullPool)
 
 @pytest.fixture(name="client")
-def client_fixture(session: Session):
+def client_fixture(session: Session, async_engine):
     def get_session_override():
         return session
 
+    async def get_async_session_override():
+        async with AsyncSession(async_engine, expire_on_commit=False) as async_session:
+            yield async_session
+
     app.dependency_overrides[get_session] = get_session_override
+    app.dependency_overrides[get_async_session] = get_async_session_override
     client = TestClient(app)
     yield client
     app.dependency_overrides.clear()
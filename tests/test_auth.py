@@ -0,0 +1,172 @@
+# tests/test_auth.py
+from datetime import datetime, timedelta, timezone
+
+import asyncio
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from fastapi import HTTPException
+from jose import JWTError, jwt
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import config
+from auth_sessions import AuthProviderError
+from main_api import (app, create_access_token, get_auth_provider, _get_active_auth_session,
+                      _open_auth_session)
+from token_cache import TokenVerifier, token_kind, KIND_LOCAL, KIND_SUPABASE
+
+
+def _supabase_token(**claims):
+    payload = {
+        "sub": "00000000-0000-0000-0000-000000000001", "aud": "authenticated",
+        "iss": "https://project.supabase.co/auth/v1", "role": "authenticated",
+        "exp": datetime.now(timezone.utc) + timedelta(hours=1),
+    }
+    payload.update(claims)
+    return jwt.encode(payload, config.SUPABASE_JWT_SECRET, algorithm="HS256")
+
+
+def test_token_kind_routing():
+    """Test that the secret is chosen from the token issuer"""
+    assert token_kind(create_access_token({"sub": "user"})) == KIND_LOCAL
+    assert token_kind(_supabase_token()) == KIND_SUPABASE
+    # Токены, выданные до появления iss, остаются нашими
+    legacy = jwt.encode({"sub": "user", "exp": datetime.now(timezone.utc) + timedelta(hours=1)},
+                        config.SECRET_KEY, algorithm=config.ALGORITHM)
+    assert token_kind(legacy) == KIND_LOCAL
+
+
+def test_verifier_caches_verified_tokens():
+    """Test that a repeated token is served from the cache"""
+    verifier = TokenVerifier(max_entries=10)
+    token = create_access_token({"sub": "user"})
+    assert verifier.verify(token)["sub"] == "user"
+    assert verifier.verify(token)["sub"] == "user"
+    verifier.verify(_supabase_token())
+    stats = verifier.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["verified"] == {"local": 1, "supabase": 1}
+
+
+def test_verifier_rejects_bad_tokens():
+    """Test that forged and garbage tokens are rejected and counted"""
+    verifier = TokenVerifier(max_entries=10)
+    forged = jwt.encode({"sub": "user", "iss": "sklad-api"}, "wrong-secret", algorithm="HS256")
+    with pytest.raises(JWTError):
+        verifier.verify(forged)
+    with pytest.raises(JWTError):
+        verifier.verify("not-a-token")
+    assert verifier.stats()["failures"] == 2
+    assert verifier.stats()["entries"] == 0
+
+
+def test_verifier_drops_expired_tokens():
+    """Test that a cached token stops being accepted after its exp"""
+    verifier = TokenVerifier(max_entries=10)
+    token = create_access_token({"sub": "user"})
+    verifier.verify(token)
+    digest = next(iter(verifier._cache))
+    claims, _ = verifier._cache[digest]
+    verifier._cache[digest] = (claims, 0.0)
+    # Запись истекла — токен проверяется заново (подпись ещё действительна)
+    verifier.verify(token)
+    assert verifier.stats()["misses"] == 2
+
+
+def test_verifier_is_bounded():
+    """Test LRU eviction when the cache is full"""
+    verifier = TokenVerifier(max_entries=2)
+    for i in range(3):
+        verifier.verify(create_access_token({"sub": f"user{i}"}))
+    assert verifier.stats()["entries"] == 2
+
+
+class LocalAuthProvider:
+    """Stand-in for Supabase: fixed users, no network"""
+
+    def __init__(self, users, delay=0.0):
+        self.users = users
+        self.delay = delay
+        self.calls = 0
+
+    def sign_in(self, username, password):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.users.get(username) != password:
+            raise AuthProviderError("Invalid login credentials")
+        return f"user-{username}"
+
+
+@pytest.fixture(name="auth_provider")
+def auth_provider_fixture(client: TestClient):
+    provider = LocalAuthProvider({"admin@example.com": "secret"})
+    app.dependency_overrides[get_auth_provider] = lambda: provider
+    return provider
+
+
+def _login(client, username="admin@example.com", password="secret"):
+    return client.post("/token", data={"username": username, "password": password})
+
+
+def test_login_issues_access_and_refresh_tokens(client: TestClient, auth_provider):
+    """Test logging in through the auth provider"""
+    response = _login(client)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["token_type"] == "bearer"
+    assert data["expires_in"] == config.ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    claims = jwt.decode(data["access_token"], config.SECRET_KEY, algorithms=[config.ALGORITHM])
+    assert claims["sub"] == "user-admin@example.com"
+    assert data["refresh_token"]
+
+
+def test_login_wrong_password(client: TestClient, auth_provider):
+    """Test that rejected credentials give 401"""
+    assert _login(client, password="wrong").status_code == 401
+
+
+def test_login_provider_timeout(client: TestClient, auth_provider, monkeypatch):
+    """Test that a slow auth provider is cut off by the timeout"""
+    monkeypatch.setattr(config, "AUTH_PROVIDER_TIMEOUT", 0.05)
+    auth_provider.delay = 0.5
+    assert _login(client).status_code == 504
+
+
+def test_refresh_is_served_locally_and_rotates(client: TestClient, auth_provider):
+    """Test that refresh does not call the provider and invalidates the old refresh token"""
+    refresh_token = _login(client).json()["refresh_token"]
+    response = client.post("/token/refresh", json={"refresh_token": refresh_token})
+    assert response.status_code == 200
+    assert response.json()["refresh_token"] != refresh_token
+    assert auth_provider.calls == 1
+    # Старый refresh-токен после ротации недействителен
+    assert client.post("/token/refresh", json={"refresh_token": refresh_token}).status_code == 401
+
+
+def test_revoked_session_cannot_refresh(client: TestClient, auth_provider):
+    """Test logout revokes the refresh token"""
+    refresh_token = _login(client).json()["refresh_token"]
+    assert client.post("/token/revoke", json={"refresh_token": refresh_token}).status_code == 200
+    assert client.post("/token/refresh", json={"refresh_token": refresh_token}).status_code == 401
+
+
+def test_concurrent_refresh_with_same_token(client: TestClient, async_engine, auth_provider):
+    """Test that only one of two refreshes racing with the same token gets a new session"""
+    refresh_token = _login(client).json()["refresh_token"]
+
+    async def race():
+        async with AsyncSession(async_engine, expire_on_commit=False) as first, \
+                AsyncSession(async_engine, expire_on_commit=False) as second:
+            # Оба запроса прочитали сессию до того, как кто-то из них её продлил
+            first_row = await _get_active_auth_session(refresh_token, first)
+            second_row = await _get_active_auth_session(refresh_token, second)
+            await first.commit()
+            await second.commit()
+            await _open_auth_session(first_row.user_id, first, first_row)
+            with pytest.raises(HTTPException) as error:
+                await _open_auth_session(second_row.user_id, second, second_row)
+            return error.value.status_code
+
+    assert asyncio.run(race()) == 401
@@ -0,0 +1,56 @@
+# tests/test_compression.py
+from fastapi.testclient import TestClient
+from sqlmodel import Session
+
+import http_encoding
+from main_models import Product
+
+
+def _add_products(session: Session, count: int):
+    for i in range(count):
+        session.add(Product(name=f"Труба ПНД 32 мм, бухта {i}", internal_sku=f"PIPE-{i:03d}",
+                            stock_quantity=10.0, retail_price=150.0))
+    session.commit()
+
+
+def test_large_response_is_gzipped(client: TestClient, session: Session, auth_headers):
+    """Test that large JSON responses are compressed when the client accepts gzip"""
+    _add_products(session, 50)
+    response = client.get("/products/", headers={**auth_headers, "Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert response.json()["total"] == 50
+
+    raw = client.get("/products/", headers={**auth_headers, "Accept-Encoding": "identity"})
+    assert "content-encoding" not in raw.headers
+    assert raw.json() == response.json()
+
+
+def test_small_response_is_not_compressed(client: TestClient, auth_headers):
+    """Test that responses below the size threshold are sent as is"""
+    response = client.get("/workers/", headers={**auth_headers, "Accept-Encoding": "gzip, br"})
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+
+
+def test_choose_encoding(monkeypatch):
+    """Test Accept-Encoding negotiation with quality values"""
+    monkeypatch.setattr(http_encoding, "brotli", object())
+    assert http_encoding.choose_encoding("gzip, deflate, br") == "br"
+    assert http_encoding.choose_encoding("br;q=0.5, gzip") == "gzip"
+    assert http_encoding.choose_encoding("br;q=0, gzip;q=0") is None
+    assert http_encoding.choose_encoding("*") == "br"
+    assert http_encoding.choose_encoding(None) is None
+
+    monkeypatch.setattr(http_encoding, "brotli", None)
+    assert http_encoding.choose_encoding("br") is None
+    assert http_encoding.choose_encoding("br, gzip") == "gzip"
+
+
+def test_orjson_response_for_untyped_endpoints(client: TestClient, auth_headers):
+    """Test that endpoints without response_model are serialized by orjson"""
+    response = client.get("/health/live")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    assert http_encoding.OrjsonResponse({"ключ": 1}).body == '{"ключ":1}'.encode("utf-8")
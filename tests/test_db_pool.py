@@ -0,0 +1,63 @@
+# tests/test_db_pool.py
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import exc as sa_exc, text
+from sqlmodel import create_engine
+
+from db_pool import TimedQueuePool, _instrument, async_database_url, pool_stats
+
+
+@pytest.fixture(name="pooled_engine")
+def pooled_engine_fixture(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'pool.db'}", poolclass=TimedQueuePool,
+        pool_size=1, max_overflow=0, pool_timeout=0.05
+    )
+    _instrument(engine)
+    yield engine
+    engine.dispose()
+
+
+def test_pool_stats_track_checkouts(pooled_engine):
+    """Test that checkouts, connects and waits are counted"""
+    for _ in range(3):
+        with pooled_engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    stats = pool_stats(pooled_engine)
+    assert stats["pool"] == "TimedQueuePool"
+    assert stats["size"] == 1
+    assert stats["checked_out"] == 0
+    assert stats["checkouts"] == 3
+    assert stats["connects"] == 1
+    assert stats["peak_checked_out"] == 1
+    assert sum(b["count"] for b in stats["wait_histogram"]) == 3
+
+
+def test_pool_timeout_is_counted(pooled_engine):
+    """Test that a checkout timing out on an exhausted pool is counted"""
+    with pooled_engine.connect():
+        with pytest.raises(sa_exc.TimeoutError):
+            pooled_engine.connect()
+        assert pool_stats(pooled_engine)["checked_out"] == 1
+    assert pool_stats(pooled_engine)["timeouts"] == 1
+
+
+def test_metrics_survive_dispose(pooled_engine):
+    """Test that engine.dispose() keeps accumulated pool metrics"""
+    with pooled_engine.connect():
+        pass
+    pooled_engine.dispose()
+    assert pool_stats(pooled_engine)["checkouts"] == 1
+
+
+def test_async_database_url():
+    """Test mapping sync database URLs to async drivers"""
+    assert async_database_url("postgresql://u:p@h/db") == "postgresql+asyncpg://u:p@h/db"
+    assert async_database_url("sqlite:///x.db") == "sqlite+aiosqlite:///x.db"
+
+
+def test_db_pool_endpoint(client: TestClient, auth_headers):
+    """Test the pool stats endpoint"""
+    response = client.get("/admin/db-pool", headers=auth_headers)
+    assert response.status_code == 200
+    assert set(response.json()) == {"sync", "async"}
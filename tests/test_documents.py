@@ -0,0 +1,206 @@
+# tests/test_documents.py
+import io
+import os
+import shutil
+import zipfile
+
+from docx import Document
+from fastapi.testclient import TestClient
+
+from docx_templates import TemplateRegistry
+from document_cache import DocumentCache, make_document_key
+
+TEMPLATES_SRC = os.path.join(os.path.dirname(os.path.dirname(__file__)), "templates")
+
+
+def _kp_context(client_name="Тестовый клиент"):
+    return {
+        'estimate_number': 'TEST-001', 'current_date_formatted': '01 мая 2025 г.',
+        'client_name': client_name, 'theme': 'Работы по смете', 'items': [
+            {'product_name': 'Тестовый товар', 'unit': 'шт.', 'quantity': 2,
+             'unit_price': '75.00', 'total': '150.00'}
+        ],
+        'total_sum_formatted': '150.00', 'total_items_count': 1,
+        'total_sum_in_words': 'Сто пятьдесят рублей 00 копеек', 'valid_until_date_formatted': '08.05.2025',
+    }
+
+
+def _docx_text(content: bytes) -> str:
+    return '\n'.join(p.text for p in Document(io.BytesIO(content)).paragraphs)
+
+
+def test_registry_renders_in_memory():
+    """Test that a template is rendered to .docx bytes without temp files"""
+    registry = TemplateRegistry(TEMPLATES_SRC)
+    content = registry.render("commercial_proposal_template.docx", _kp_context())
+    assert content[:2] == b"PK"
+    assert "Тестовый клиент" in _docx_text(content)
+
+
+def test_registry_loads_template_once():
+    """Test that repeated renders reuse the parsed template"""
+    registry = TemplateRegistry(TEMPLATES_SRC)
+    first = registry.get("commercial_proposal_template.docx")
+    registry.render("commercial_proposal_template.docx", _kp_context("Первый"))
+    second_content = registry.render("commercial_proposal_template.docx", _kp_context("Второй"))
+    assert registry.get("commercial_proposal_template.docx") is first
+    # Рендер не должен портить закэшированный шаблон
+    assert "Второй" in _docx_text(second_content)
+    assert "Первый" not in _docx_text(second_content)
+
+
+def test_registry_reloads_on_mtime_change(tmp_path):
+    """Test that a changed template file is reloaded"""
+    shutil.copy(os.path.join(TEMPLATES_SRC, "commercial_proposal_template.docx"),
+                tmp_path / "kp.docx")
+    registry = TemplateRegistry(str(tmp_path))
+    first = registry.get("kp.docx")
+
+    shutil.copy(os.path.join(TEMPLATES_SRC, "contract_template.docx"), tmp_path / "kp.docx")
+    stat = os.stat(tmp_path / "kp.docx")
+    os.utime(tmp_path / "kp.docx", (stat.st_atime, first.mtime + 10))
+
+    second = registry.get("kp.docx")
+    assert second is not first
+    assert second.version != first.version
+
+
+def test_registry_preload():
+    """Test that preload picks up every .docx template"""
+    registry = TemplateRegistry(TEMPLATES_SRC)
+    loaded = registry.preload()
+    assert "commercial_proposal_template.docx" in loaded
+    assert "contract_template.docx" in loaded
+
+
+def test_document_key_depends_on_template_and_context():
+    """Test that any change of template version or context changes the cache key"""
+    ctx = _kp_context()
+    key = make_document_key("v1", ctx)
+    assert key == make_document_key("v1", _kp_context())
+    assert key != make_document_key("v2", ctx)
+    changed = _kp_context()
+    changed['items'][0]['quantity'] = 3
+    assert key != make_document_key("v1", changed)
+
+
+def test_document_cache_hits_and_eviction(tmp_path):
+    """Test LRU eviction by total size and hit/miss accounting"""
+    cache = DocumentCache(str(tmp_path), max_bytes=250)
+    assert cache.get("a") is None
+    cache.put("a", b"a" * 100)
+    cache.put("b", b"b" * 100)
+    assert cache.get("a") == b"a" * 100  # "a" становится самым свежим
+    cache.put("c", b"c" * 100)           # вытесняет "b"
+
+    assert cache.get("b") is None
+    assert cache.get("c") == b"c" * 100
+    stats = cache.stats()
+    assert stats["entries"] == 2
+    assert stats["size_bytes"] == 200
+    assert stats["hits"] == 2
+    assert stats["misses"] == 2
+    assert stats["evictions"] == 1
+    assert stats["hit_rate"] == 0.5
+
+
+def test_document_cache_survives_restart(tmp_path):
+    """Test that cached documents are picked up from disk by a new instance"""
+    DocumentCache(str(tmp_path), max_bytes=1000).put("a", b"data")
+    cache = DocumentCache(str(tmp_path), max_bytes=1000)
+    assert cache.get("a") == b"data"
+
+
+def test_generate_commercial_proposal(client: TestClient, sample_product, auth_headers):
+    """Test downloading a commercial proposal for an estimate"""
+    create_response = client.post(
+        "/estimates/",
+        json={
+            "estimate_number": "TEST-KP",
+            "client_name": "Клиент КП",
+            "items": [{"product_id": sample_product.id, "quantity": 2.0, "unit_price": 75.0}]
+        },
+        headers=auth_headers
+    )
+    estimate_id = create_response.json()["id"]
+
+    response = client.get(
+        f"/estimates/{estimate_id}/generate-commercial-proposal", headers=auth_headers)
+    assert response.status_code == 200
+    assert "attachment" in response.headers["content-disposition"]
+    assert "Клиент КП" in _docx_text(response.content)
+
+
+def test_generate_commercial_proposal_batch(client: TestClient, sample_product, auth_headers):
+    """Test downloading a ZIP of commercial proposals for several estimates"""
+    ids = []
+    for number in ("BATCH-1", "BATCH/2"):
+        create_response = client.post(
+            "/estimates/",
+            json={
+                "estimate_number": number,
+                "client_name": f"Клиент {number}",
+                "items": [{"product_id": sample_product.id, "quantity": 1.0, "unit_price": 75.0}]
+            },
+            headers=auth_headers
+        )
+        ids.append(create_response.json()["id"])
+
+    response = client.post(
+        "/estimates/generate-commercial-proposal-batch",
+        json={"ids": ids},
+        headers=auth_headers
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
+        names = sorted(zf.namelist())
+        assert names == [f"KP_BATCH-1_{ids[0]}.docx", f"KP_BATCH_2_{ids[1]}.docx"]
+        assert "Клиент BATCH/2" in _docx_text(zf.read(names[1]))
+
+
+def test_batch_requires_ids_or_filter(client: TestClient, auth_headers):
+    """Test that a batch without ids or filters is rejected"""
+    response = client.post("/contracts/generate-docx-batch", json={}, headers=auth_headers)
+    assert response.status_code == 400
+
+
+def test_concurrent_batches_share_render_slots(monkeypatch):
+    """Test that two batches rendering at once never exceed the process-wide render limit"""
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from types import SimpleNamespace
+
+    import main_api
+
+    lock = threading.Lock()
+    running, peak = [0], [0]
+
+    def fake_render(template_name, context):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return context["n"].encode()
+
+    pool = ThreadPoolExecutor(max_workers=8)
+    monkeypatch.setattr(main_api, "_docx_render_slots", threading.BoundedSemaphore(2))
+    monkeypatch.setattr(main_api, "cpu_pool", lambda: pool)
+    monkeypatch.setattr(main_api, "render_template_job", fake_render)
+    monkeypatch.setattr(main_api, "template_registry", SimpleNamespace(get=lambda name: SimpleNamespace(version=1)))
+    monkeypatch.setattr(main_api, "make_document_key", lambda version, context: context["n"])
+    monkeypatch.setattr(main_api, "document_cache", SimpleNamespace(get=lambda key: None, put=lambda key, value: None))
+
+    def batch(prefix):
+        jobs = [(f"{prefix}{i}.docx", "kp.docx", {"n": f"{prefix}{i}"}) for i in range(6)]
+        return sorted(content for _, content, _ in main_api._render_documents(jobs))
+
+    with ThreadPoolExecutor(max_workers=2) as clients:
+        results = list(clients.map(batch, ["a", "b"]))
+    pool.shutdown(wait=True)
+
+    assert results == [sorted(f"{p}{i}".encode() for i in range(6)) for p in "ab"]
+    assert peak[0] <= 2
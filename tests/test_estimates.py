@@ -1,8 +1,10 @@
 # tests/test_estimates.py
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import text
 from sqlmodel import Session
-from main_models import Estimate, EstimateStatusEnum
+import estimate_totals
+from main_models import Estimate, EstimateItem, EstimateStatusEnum
 
 def test_create_estimate(client: TestClient, sample_product, auth_headers):
     """Test creating a new estimate"""
@@ -115,3 +117,154 @@ def test_complete_estimate(client: TestClient, sample_product, sample_worker, au
         headers=auth_headers
     )
     assert response.status_code == 200
+
+def test_read_estimate_detail(client: TestClient, sample_product, auth_headers):
+    """Test reading one estimate with items and total"""
+    create_response = client.post(
+        "/estimates/",
+        json={
+            "estimate_number": "TEST-DETAIL",
+            "client_name": "Клиент",
+            "items": [
+                {
+                    "product_id": sample_product.id,
+                    "quantity": 4.0,
+                    "unit_price": 75.0
+                }
+            ]
+        },
+        headers=auth_headers
+    )
+    estimate_id = create_response.json()["id"]
+
+    response = client.get(f"/estimates/{estimate_id}", headers=auth_headers)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["total_sum"] == 300.0
+    assert data["items"][0]["product_name"] == sample_product.name
+
+def test_read_estimates_summary_view(client: TestClient, sample_product, auth_headers):
+    """Test the summary view of the estimates list"""
+    client.post(
+        "/estimates/",
+        json={
+            "estimate_number": "TEST-003",
+            "client_name": "Клиент 3",
+            "items": [{"product_id": sample_product.id, "quantity": 1.0, "unit_price": 75.0}]
+        },
+        headers=auth_headers
+    )
+    response = client.get("/estimates/?view=summary", headers=auth_headers)
+    assert response.status_code == 200
+    item = response.json()["items"][0]
+    assert item["estimate_number"] == "TEST-003"
+    assert "user_id" not in item
+
+def test_estimate_totals_maintained(client: TestClient, session: Session, sample_product, auth_headers):
+    """Test that denormalised totals follow every item mutation"""
+    response = client.post(
+        "/estimates/",
+        json={
+            "estimate_number": "TOT-001",
+            "client_name": "Клиент",
+            "items": [{"product_id": sample_product.id, "quantity": 2.0, "unit_price": 100.0}]
+        },
+        headers=auth_headers
+    )
+    estimate_id = response.json()["id"]
+    assert response.json()["total_retail"] == 200.0
+    assert response.json()["total_purchase"] == 100.0
+    assert response.json()["item_count"] == 1
+
+    item_id = client.get(f"/estimates/{estimate_id}", headers=auth_headers).json()["items"][0]["id"]
+    client.patch(f"/estimates/{estimate_id}/items/{item_id}?quantity=3", headers=auth_headers)
+    detail = client.get(f"/estimates/{estimate_id}", headers=auth_headers).json()
+    assert detail["total_sum"] == 300.0
+
+    # Закупочная цена товара меняет закупочный итог смет с этим товаром
+    client.patch(f"/products/{sample_product.id}", json={"purchase_price": 60.0}, headers=auth_headers)
+    estimate = session.get(Estimate, estimate_id)
+    session.refresh(estimate)
+    assert estimate.total_purchase == 180.0
+
+    client.delete(f"/estimates/{estimate_id}/items/{item_id}", headers=auth_headers)
+    session.refresh(estimate)
+    assert (estimate.total_retail, estimate.total_purchase, estimate.item_count) == (0.0, 0.0, 0)
+
+
+def test_estimates_sorted_and_filtered_by_total(client: TestClient, sample_product, auth_headers):
+    """Test sorting and filtering the estimates list by amount"""
+    for number, quantity in (("S-1", 1.0), ("S-2", 5.0), ("S-3", 3.0)):
+        client.post(
+            "/estimates/",
+            json={"estimate_number": number, "client_name": "Клиент",
+                  "items": [{"product_id": sample_product.id, "quantity": quantity, "unit_price": 10.0}]},
+            headers=auth_headers
+        )
+    data = client.get("/estimates/?view=summary&sort_by=total&order=desc", headers=auth_headers).json()
+    assert [e["estimate_number"] for e in data["items"]] == ["S-2", "S-3", "S-1"]
+    assert data["items"][0]["total_retail"] == 50.0
+
+    data = client.get("/estimates/?min_total=20&max_total=40", headers=auth_headers).json()
+    assert data["total"] == 1
+    assert data["items"][0]["estimate_number"] == "S-3"
+
+
+def test_rebuild_estimate_totals(session: Session, sample_product):
+    """Test the full totals rebuild after out-of-band changes"""
+    estimate = Estimate(estimate_number="R-1", client_name="Клиент")
+    session.add(estimate)
+    session.flush()
+    session.add(EstimateItem(estimate_id=estimate.id, product_id=sample_product.id, quantity=4.0, unit_price=10.0))
+    session.commit()
+    session.exec(text("UPDATE estimate SET total_retail = 0, item_count = 0"))
+    session.commit()
+
+    with session.get_bind().begin() as conn:
+        assert estimate_totals.refresh_totals(conn) == 1
+    session.refresh(estimate)
+    assert (estimate.total_retail, estimate.item_count) == (40.0, 1)
+
+
+def _create_two_line_estimate(client: TestClient, product_id: int, number: str, auth_headers) -> int:
+    response = client.post(
+        "/estimates/",
+        json={"estimate_number": number, "client_name": "Клиент",
+              "items": [{"product_id": product_id, "quantity": 30.0, "unit_price": 10.0},
+                        {"product_id": product_id, "quantity": 20.0, "unit_price": 10.0}]},
+        headers=auth_headers
+    )
+    return response.json()["id"]
+
+
+def test_estimate_lifecycle_with_repeated_product(client: TestClient, session: Session, sample_product, sample_worker, auth_headers):
+    """Test ship, complete, cancel completion and reopen over an estimate listing one product twice"""
+    estimate_id = _create_two_line_estimate(client, sample_product.id, "L-1", auth_headers)
+
+    response = client.post(f"/estimates/{estimate_id}/ship?worker_id={sample_worker.id}", headers=auth_headers)
+    assert response.status_code == 200
+    session.refresh(sample_product)
+    assert sample_product.stock_quantity == 50.0
+
+    assert client.post(f"/estimates/{estimate_id}/complete", headers=auth_headers).status_code == 200
+    assert client.post(f"/estimates/{estimate_id}/cancel-completion", headers=auth_headers).status_code == 200
+    session.refresh(sample_product)
+    assert sample_product.stock_quantity == 100.0
+
+    history = client.get(f"/actions/history/?worker_id={sample_worker.id}", headers=auth_headers).json()
+    assert history["total"] == 6
+
+
+def test_ship_estimate_checks_total_per_product(client: TestClient, session: Session, sample_product, sample_worker, auth_headers):
+    """Test that shipping sums repeated lines before checking stock and changes nothing on failure"""
+    first = _create_two_line_estimate(client, sample_product.id, "L-2", auth_headers)
+    second = _create_two_line_estimate(client, sample_product.id, "L-3", auth_headers)
+    third = _create_two_line_estimate(client, sample_product.id, "L-4", auth_headers)
+    assert client.post(f"/estimates/{first}/ship?worker_id={sample_worker.id}", headers=auth_headers).status_code == 200
+    assert client.post(f"/estimates/{second}/ship?worker_id={sample_worker.id}", headers=auth_headers).status_code == 200
+
+    response = client.post(f"/estimates/{third}/ship?worker_id={sample_worker.id}", headers=auth_headers)
+    assert response.status_code == 400
+    assert "требуется: 50.0" in response.json()["detail"]
+    session.refresh(sample_product)
+    assert sample_product.stock_quantity == 0.0
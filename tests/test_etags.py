@@ -0,0 +1,89 @@
+# tests/test_etags.py
+from fastapi.testclient import TestClient
+from sqlmodel import Session
+
+from main_models import Estimate, EstimateItem, TableVersion
+
+
+def test_products_not_modified(client: TestClient, sample_product, auth_headers):
+    """Test that a repeated product list request with If-None-Match returns 304"""
+    response = client.get("/products/", headers=auth_headers)
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == "private, no-cache"
+
+    response = client.get("/products/", headers={**auth_headers, "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert response.content == b""
+
+    # Другие параметры запроса — другой ETag
+    response = client.get("/products/?search=Тестовый", headers={**auth_headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+
+def test_write_changes_etag(client: TestClient, session: Session, sample_product, auth_headers):
+    """Test that a write endpoint bumps the table version and invalidates the ETag"""
+    etag = client.get("/products/", headers=auth_headers).headers["etag"]
+    version = session.get(TableVersion, "product").version
+
+    response = client.post(
+        "/actions/receive-item/",
+        json={"product_id": sample_product.id, "quantity": 5.0},
+        headers=auth_headers
+    )
+    assert response.status_code == 200
+    session.expire_all()
+    assert session.get(TableVersion, "product").version > version
+
+    response = client.get("/products/", headers={**auth_headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert response.json()["items"][0]["stock_quantity"] == 105.0
+
+
+def test_workers_and_contracts_not_modified(client: TestClient, sample_worker, auth_headers):
+    """Test conditional GET on the worker and contract lists"""
+    for url in ("/workers/", "/contracts/"):
+        etag = client.get(url, headers=auth_headers).headers["etag"]
+        response = client.get(url, headers={**auth_headers, "If-None-Match": f'W/{etag}'})
+        assert response.status_code == 304
+
+    etag = client.get("/workers/", headers=auth_headers).headers["etag"]
+    client.post("/workers/", json={"name": "Второй работник"}, headers=auth_headers)
+    response = client.get("/workers/", headers={**auth_headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert len(response.json()) == 2
+
+
+def test_estimate_etag_depends_on_products(client: TestClient, session: Session, sample_product, auth_headers):
+    """Test that renaming a product invalidates the estimate card that shows it"""
+    estimate = Estimate(estimate_number="E-1", client_name="Клиент")
+    session.add(estimate)
+    session.commit()
+    session.add(EstimateItem(estimate_id=estimate.id, product_id=sample_product.id, quantity=2, unit_price=75.0))
+    session.commit()
+
+    url = f"/estimates/{estimate.id}"
+    etag = client.get(url, headers=auth_headers).headers["etag"]
+    assert client.get(url, headers={**auth_headers, "If-None-Match": etag}).status_code == 304
+
+    client.patch(f"/products/{sample_product.id}", json={"name": "Новое имя"}, headers=auth_headers)
+    response = client.get(url, headers={**auth_headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["items"][0]["product_name"] == "Новое имя"
+
+
+def test_version_bumped_after_commit(session: Session, sample_product):
+    """Test that a write transaction leaves the version row alone until it commits"""
+    version = session.get(TableVersion, "product").version
+    sample_product.stock_quantity = 42.0
+    session.add(sample_product)
+    session.flush()
+    with Session(session.get_bind()) as reader:
+        assert reader.get(TableVersion, "product").version == version
+
+    session.commit()
+    session.expire_all()
+    assert session.get(TableVersion, "product").version == version + 1
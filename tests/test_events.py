@@ -0,0 +1,155 @@
+# tests/test_events.py
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlmodel import Session, select
+
+import change_events
+import config
+from main_models import ChangeEvent
+
+
+def _events(session: Session):
+    return [(e.type, json.loads(e.payload)) for e in session.exec(select(ChangeEvent).order_by(ChangeEvent.id))]
+
+
+def _collect_stream(async_engine, last_event_id):
+    async def disconnect_after_first_poll():
+        calls.append(1)
+        return len(calls) > 1
+
+    async def collect():
+        return [chunk async for chunk in change_events.event_stream(
+            async_engine, last_event_id, disconnect_after_first_poll)]
+
+    calls = []
+    return asyncio.run(collect())
+
+
+def test_stock_changes_publish_events(client: TestClient, session: Session, sample_product, sample_worker, auth_headers):
+    """Test that issue and cancel record compact change events"""
+    session.exec(text("DELETE FROM changeevent"))
+    session.commit()
+    movement = client.post(
+        "/actions/issue-item/",
+        json={"product_id": sample_product.id, "worker_id": sample_worker.id, "quantity": 10.0},
+        headers=auth_headers
+    ).json()
+    client.post(f"/actions/history/cancel/{movement['id']}", headers=auth_headers)
+
+    events = _events(session)
+    assert events[:2] == [
+        ("movement.created", {"id": movement["id"], "product_id": sample_product.id, "worker_id": sample_worker.id,
+                              "type": "Выдача работнику", "quantity": -10.0, "stock_after": 90.0}),
+        ("product.stock", {"id": sample_product.id, "stock_quantity": 90.0}),
+    ]
+    assert ("movement.cancelled", {"id": movement["id"], "product_id": sample_product.id}) in events
+    assert ("product.stock", {"id": sample_product.id, "stock_quantity": 100.0}) in events
+
+
+def test_estimate_status_event(client: TestClient, session: Session, sample_product, sample_worker, auth_headers):
+    """Test that shipping an estimate publishes its new status"""
+    estimate_id = client.post(
+        "/estimates/",
+        json={"estimate_number": "EV-1", "client_name": "Клиент",
+              "items": [{"product_id": sample_product.id, "quantity": 1.0, "unit_price": 75.0}]},
+        headers=auth_headers
+    ).json()["id"]
+    client.post(f"/estimates/{estimate_id}/ship?worker_id={sample_worker.id}", headers=auth_headers)
+
+    statuses = [payload["status"] for kind, payload in _events(session) if kind == "estimate.status"]
+    assert statuses == ["Черновик", "В работе"]
+
+
+def test_stream_resumes_after_last_event_id(session: Session, async_engine, sample_product, monkeypatch):
+    """Test that the stream replays events after Last-Event-ID"""
+    monkeypatch.setattr(config, "EVENTS_POLL_SECONDS", 0.01)
+    sample_product.stock_quantity = 50.0
+    session.add(sample_product)
+    session.commit()
+    ids = [e.id for e in session.exec(select(ChangeEvent).order_by(ChangeEvent.id))]
+
+    chunks = _collect_stream(async_engine, ids[0])
+    messages = [c for c in chunks if c.startswith("id:")]
+    assert messages == [change_events.format_sse(
+        ids[1], "product.stock", json.dumps({"id": sample_product.id, "stock_quantity": 50.0}, separators=(",", ":")))]
+
+    # Без Last-Event-ID отдаются только новые события
+    assert not [c for c in _collect_stream(async_engine, None) if c.startswith("id:")]
+
+
+def test_stream_resets_when_events_purged(session: Session, async_engine, sample_product, monkeypatch):
+    """Test that a client behind the retention window gets a reset event"""
+    monkeypatch.setattr(config, "EVENTS_POLL_SECONDS", 0.01)
+    sample_product.stock_quantity = 50.0
+    session.add(sample_product)
+    session.commit()
+    sample_product.stock_quantity = 40.0
+    session.add(sample_product)
+    session.commit()
+    first_id = session.exec(select(ChangeEvent.id).order_by(ChangeEvent.id)).first()
+    session.exec(text(f"DELETE FROM changeevent WHERE id <= {first_id + 1}"))
+    session.commit()
+
+    chunks = _collect_stream(async_engine, first_id - 1)
+    assert chunks[0].startswith("id: ") and "event: reset" in chunks[0]
+    assert not [c for c in chunks[1:] if c.startswith("id:")]
+
+
+def test_stream_sends_event_that_commits_after_gap(session: Session, async_engine, monkeypatch):
+    """Test that an id skipped after the gap wait is re-read and sent once it commits"""
+    monkeypatch.setattr(config, "EVENTS_POLL_SECONDS", 0.01)
+    session.exec(text("DELETE FROM changeevent"))
+    old = datetime.utcnow() - timedelta(seconds=60)
+    session.add_all([ChangeEvent(id=1, type="contract.status", payload='{"id":1}', created_at=old),
+                     ChangeEvent(id=3, type="contract.status", payload='{"id":3}', created_at=old)])
+    session.commit()
+
+    async def commit_late_event_then_disconnect():
+        calls.append(1)
+        if len(calls) == 2:
+            # Транзакция с id=2 коммитится после того, как поток прошёл пропуск
+            session.add(ChangeEvent(id=2, type="contract.status", payload='{"id":2}', created_at=old))
+            session.commit()
+        return len(calls) > 2
+
+    async def collect():
+        return [chunk async for chunk in change_events.event_stream(
+            async_engine, 0, commit_late_event_then_disconnect)]
+
+    calls = []
+    messages = [c for c in asyncio.run(collect()) if c.startswith("id:")]
+    assert messages == [change_events.format_sse(1, "contract.status", '{"id":1}'),
+                        change_events.format_sse(1, "contract.status", '{"id":3}'),
+                        change_events.format_sse(3, "contract.status", '{"id":2}')]
+
+
+def test_stream_rereads_wide_gap_as_range(session: Session, async_engine, monkeypatch):
+    """Test that late events inside a wide id gap are found and the rest of the gap stays tracked"""
+    monkeypatch.setattr(config, "EVENTS_POLL_SECONDS", 0.01)
+    session.exec(text("DELETE FROM changeevent"))
+    old = datetime.utcnow() - timedelta(seconds=60)
+    session.add_all([ChangeEvent(id=1, type="contract.status", payload='{"id":1}', created_at=old),
+                     ChangeEvent(id=5000, type="contract.status", payload='{"id":5000}', created_at=old)])
+    session.commit()
+
+    async def commit_late_events_then_disconnect():
+        calls.append(1)
+        if len(calls) == 2:
+            session.add_all([ChangeEvent(id=event_id, type="contract.status", payload=f'{{"id":{event_id}}}',
+                                         created_at=old) for event_id in (10, 2500)])
+            session.commit()
+        return len(calls) > 2
+
+    async def collect():
+        return [chunk async for chunk in change_events.event_stream(
+            async_engine, 0, commit_late_events_then_disconnect)]
+
+    calls = []
+    messages = [c for c in asyncio.run(collect()) if c.startswith("id:")]
+    # Пропуски 2..9 и 11..2499, 2501..4999 ещё открыты — id возобновления перед самым ранним
+    assert messages[2:] == [change_events.format_sse(1, "contract.status", '{"id":10}'),
+                            change_events.format_sse(1, "contract.status", '{"id":2500}')]
@@ -0,0 +1,58 @@
+# tests/test_executors.py
+import asyncio
+import threading
+
+from executors import InstrumentedExecutor, _thread_pool, run_in_thread
+from excel_import import match_product_names, parse_number_robust
+
+
+def test_executor_tracks_queue_depth():
+    """Test that tasks beyond the worker count are counted as queued"""
+    executor = InstrumentedExecutor("test", _thread_pool, 1)
+    release = threading.Event()
+    futures = [executor.submit(release.wait) for _ in range(3)]
+    stats = executor.stats()
+    assert stats["in_flight"] == 3
+    assert stats["queue_depth"] == 2
+    release.set()
+    for f in futures:
+        f.result()
+    # Done-callback со статистикой выполняется после пробуждения f.result()
+    executor.shutdown(wait=True)
+    stats = executor.stats()
+    assert stats["in_flight"] == 0
+    assert stats["completed"] == 3
+    assert stats["max_queue_depth"] == 2
+
+
+def test_executor_counts_failures():
+    """Test that failed tasks are counted separately"""
+    executor = InstrumentedExecutor("test", _thread_pool, 1)
+    future = executor.submit(int, "not a number")
+    assert isinstance(future.exception(), ValueError)
+    executor.shutdown(wait=True)
+    assert executor.stats()["failed"] == 1
+
+
+def test_run_in_thread_leaves_event_loop():
+    """Test that blocking calls run outside the event loop thread"""
+    async def main():
+        loop_thread = threading.get_ident()
+        return loop_thread, await run_in_thread(threading.get_ident)
+
+    loop_thread, worker_thread = asyncio.run(main())
+    assert loop_thread != worker_thread
+
+
+def test_match_product_names():
+    """Test fuzzy matching of imported names against the catalog"""
+    choices = ["Труба ПНД 32 мм", "Насос скважинный"]
+    assert match_product_names(["Труба ПНД 32мм", "Кабель"], choices) == ["Труба ПНД 32 мм", None]
+    assert match_product_names(["Насос"], []) == [None]
+
+
+def test_parse_number_robust():
+    """Test parsing numbers with spaces and comma separators"""
+    assert parse_number_robust("1\u00A0200,50") == 1200.5
+    assert parse_number_robust(3) == 3.0
+    assert parse_number_robust("нет") is None
@@ -0,0 +1,109 @@
+# tests/test_forecasting.py
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+from fastapi.testclient import TestClient
+from sqlmodel import Session, select
+
+import forecasting
+from main_models import ConsumptionDaily, MovementTypeEnum, Product, StockMovement, TableVersion
+
+TODAY = date(2026, 3, 31)
+
+
+def _movement(session: Session, product: Product, quantity: float, days_ago: int,
+              movement_type=MovementTypeEnum.ISSUE_TO_WORKER):
+    session.add(StockMovement(
+        product_id=product.id, quantity=quantity, type=movement_type,
+        timestamp=datetime.combine(TODAY - timedelta(days=days_ago), datetime.min.time()) + timedelta(hours=12)))
+    session.commit()
+
+
+def test_compute_forecast_windows():
+    """Test the weighted window rate, days until stockout and reorder quantity"""
+    daily = pd.DataFrame({"product_id": [1, 1, 2], "day": [TODAY, TODAY - timedelta(days=40), TODAY],
+                          "quantity": [7.0, 90.0, 0.0]})
+    products = pd.DataFrame({"id": [1, 2], "stock_quantity": [20.0, 5.0], "min_stock_level": [5.0, 0.0]})
+
+    forecast = forecasting.compute_forecast(daily, products, TODAY, lead_time_days=7, cover_days=30)
+    first, second = forecast.to_dict("records")
+    # 7/7 * 0.5 + 7/30 * 0.3 + 97/90 * 0.2
+    assert first["consumption_rate"] == round(0.5 + 0.07 + 97 / 90 * 0.2, 4)
+    assert first["days_until_stockout"] == round(20 / first["consumption_rate"], 1)
+    assert first["suggested_reorder_qty"] == -(-(first["consumption_rate"] * 37 + 5 - 20) // 1)
+    assert pd.isna(second["days_until_stockout"]) and second["suggested_reorder_qty"] == 0
+
+
+def test_run_forecast_is_incremental(session: Session, sample_product):
+    """Test that each run reads only new movements and keeps the daily totals"""
+    engine = session.get_bind()
+    _movement(session, sample_product, -14.0, days_ago=1)
+    _movement(session, sample_product, 4.0, days_ago=1, movement_type=MovementTypeEnum.RETURN_FROM_WORKER)
+    _movement(session, sample_product, 50.0, days_ago=1, movement_type=MovementTypeEnum.INCOME)
+    first = forecasting.run_forecast(engine, today=TODAY)
+    assert first["movements"] == 3
+
+    _movement(session, sample_product, -4.0, days_ago=1)
+    second = forecasting.run_forecast(engine, today=TODAY)
+    assert second["movements"] == 1
+    daily = session.exec(select(ConsumptionDaily)).all()
+    assert [(d.day, d.quantity) for d in daily] == [(TODAY - timedelta(days=1), 14.0)]
+
+    session.refresh(sample_product)
+    rate = round(14 / 7 * 0.5 + 14 / 30 * 0.3 + 14 / 90 * 0.2, 4)
+    assert sample_product.consumption_rate == rate
+    assert sample_product.days_until_stockout == round(100 / rate, 1)
+    assert sample_product.forecast_at is not None
+
+
+def test_products_sorted_by_stockout(client: TestClient, session: Session, sample_product, auth_headers):
+    """Test sorting the product list by forecast days until stockout"""
+    idle = Product(name="Без расхода", internal_sku="IDLE-1", stock_quantity=5.0)
+    fast = Product(name="Быстрый расход", internal_sku="FAST-1", stock_quantity=5.0)
+    session.add_all([idle, fast])
+    session.commit()
+    _movement(session, sample_product, -7.0, days_ago=0)
+    _movement(session, fast, -7.0, days_ago=0)
+    forecasting.run_forecast(session.get_bind(), today=TODAY)
+
+    data = client.get("/products/?view=summary&sort_by=days_until_stockout", headers=auth_headers).json()
+    assert [p["internal_sku"] for p in data["items"]] == ["FAST-1", "TEST-001", "IDLE-1"]
+    assert data["items"][2]["days_until_stockout"] is None
+
+
+def test_run_forecast_waits_for_recent_id_gap(session: Session, sample_product):
+    """Test that a recent movement behind an id gap waits until the gap is filled"""
+    engine = session.get_bind()
+    _movement(session, sample_product, -3.0, days_ago=1)
+    _movement(session, sample_product, -2.0, days_ago=1)
+    assert forecasting.run_forecast(engine, today=TODAY, chunk_rows=1)["movements"] == 2
+    first_id = session.exec(select(StockMovement.id).order_by(StockMovement.id)).first()
+
+    # Id+3 уже закоммичен, а id+2 — ещё нет (транзакция, начатая раньше)
+    now = datetime.utcnow()
+    session.add(StockMovement(id=first_id + 3, product_id=sample_product.id, quantity=-5.0,
+                              type=MovementTypeEnum.ISSUE_TO_WORKER, timestamp=now))
+    session.commit()
+    waiting = forecasting.run_forecast(engine, today=TODAY)
+    assert (waiting["movements"], waiting["last_movement_id"]) == (0, first_id + 1)
+
+    session.add(StockMovement(id=first_id + 2, product_id=sample_product.id, quantity=-1.0,
+                              type=MovementTypeEnum.ISSUE_TO_WORKER, timestamp=now))
+    session.commit()
+    filled = forecasting.run_forecast(engine, today=TODAY, chunk_rows=1)
+    assert (filled["movements"], filled["last_movement_id"]) == (2, first_id + 3)
+    daily = session.exec(select(ConsumptionDaily).order_by(ConsumptionDaily.day)).all()
+    assert sum(d.quantity for d in daily) == 11.0
+
+
+def test_unchanged_forecast_is_not_rewritten(session: Session, sample_product):
+    """Test that a run with the same forecast leaves products and their ETag version alone"""
+    engine = session.get_bind()
+    _movement(session, sample_product, -7.0, days_ago=1)
+    assert forecasting.run_forecast(engine, today=TODAY)["updated"] == 1
+    version = session.exec(select(TableVersion.version).where(TableVersion.table_name == "product")).one()
+
+    again = forecasting.run_forecast(engine, today=TODAY)
+    assert (again["products"], again["updated"]) == (1, 0)
+    session.expire_all()
+    assert session.exec(select(TableVersion.version).where(TableVersion.table_name == "product")).one() == version
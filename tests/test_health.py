@@ -0,0 +1,69 @@
+# tests/test_health.py
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlmodel import SQLModel, create_engine
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+
+from warmup import WarmupState, warm_up, warmup_state
+
+
+@pytest.fixture(autouse=True)
+def _reset_warmup_state():
+    warmup_state.clear()
+    yield
+    warmup_state.clear()
+
+
+def test_health_live(client: TestClient):
+    """Test the liveness probe"""
+    assert client.get("/health/live").json() == {"status": "ok"}
+
+
+def test_health_ready_waits_for_schema_and_warmup(client: TestClient):
+    """Test that readiness is 503 until the schema check and warm-up are done"""
+    response = client.get("/health/ready")
+    assert response.status_code == 503
+    assert response.json()["components"]["schema"]["status"] == "pending"
+
+    warmup_state.set("schema", "ok", version=2)
+    warmup_state.set("cpu_pool", "pending")
+    assert client.get("/health/ready").status_code == 503
+
+    # Неудачный шаг прогрева не снимает экземпляр с трафика
+    warmup_state.set("cpu_pool", "error", error="boom")
+    response = client.get("/health/ready")
+    assert response.status_code == 200
+    components = response.json()["components"]
+    assert components["database"]["status"] == "ok"
+    assert "latency_ms" in components["database"]
+
+
+def test_warmup_state_records_errors():
+    """Test that a failing warm-up step is recorded without raising"""
+    state = WarmupState()
+    assert state.run("ok_step", lambda: {"items": 1})["items"] == 1
+    state.run("bad_step", lambda: 1 / 0)
+    snapshot = state.snapshot()
+    assert snapshot["ok_step"]["status"] == "ok"
+    assert snapshot["ok_step"]["items"] == 1
+    assert snapshot["bad_step"]["status"] == "error"
+
+
+def test_warm_up_runs_all_steps(tmp_path):
+    """Test a full warm-up against a file database"""
+    db_url = f"sqlite:///{tmp_path / 'warm.db'}"
+    engine = create_engine(db_url)
+    SQLModel.metadata.create_all(engine)
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'warm.db'}", poolclass=NullPool)
+
+    asyncio.run(warm_up(engine, async_engine, 2))
+    snapshot = warmup_state.snapshot()
+    engine.dispose()
+
+    for name in ("db_pool", "async_db_pool", "templates", "cpu_pool", "catalog", "lazy_imports"):
+        assert snapshot[name]["status"] == "ok", snapshot[name]
+    assert "commercial_proposal_template.docx" in snapshot["cpu_pool"]["templates"]
+    assert snapshot["catalog"]["products"] == 0
@@ -0,0 +1,131 @@
+# tests/test_idempotency.py
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy import update
+from sqlmodel import Session, select
+
+from idempotency import run_idempotent
+from main_models import IdempotencyKey, Product, StockMovement
+
+
+def _issue(client: TestClient, product_id: int, worker_id: int, quantity: float, key: str, auth_headers):
+    return client.post(
+        "/actions/issue-item/",
+        json={"product_id": product_id, "worker_id": worker_id, "quantity": quantity},
+        headers={**auth_headers, "Idempotency-Key": key}
+    )
+
+
+def test_retry_returns_stored_response(client: TestClient, session: Session, sample_product, sample_worker, auth_headers):
+    """Test that a retried issue with the same key is not executed twice"""
+    first = _issue(client, sample_product.id, sample_worker.id, 10.0, "retry-1", auth_headers)
+    second = _issue(client, sample_product.id, sample_worker.id, 10.0, "retry-1", auth_headers)
+    assert first.status_code == second.status_code == 200
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert second.json()["id"] == first.json()["id"]
+
+    session.refresh(sample_product)
+    assert sample_product.stock_quantity == 90.0
+    assert len(session.exec(select(StockMovement)).all()) == 1
+
+
+def test_key_reused_for_other_request_rejected(client: TestClient, sample_product, sample_worker, auth_headers):
+    """Test that a key cannot be reused with a different body"""
+    assert _issue(client, sample_product.id, sample_worker.id, 10.0, "reuse-1", auth_headers).status_code == 200
+    response = _issue(client, sample_product.id, sample_worker.id, 5.0, "reuse-1", auth_headers)
+    assert response.status_code == 422
+
+
+def test_failed_request_releases_key(client: TestClient, session: Session, sample_product, sample_worker, auth_headers):
+    """Test that an error response is not stored and the retry runs again"""
+    assert _issue(client, sample_product.id, sample_worker.id, 500.0, "fail-1", auth_headers).status_code == 400
+    assert session.exec(select(IdempotencyKey)).first() is None
+    assert _issue(client, sample_product.id, sample_worker.id, 500.0, "fail-1", auth_headers).status_code == 400
+
+
+def test_ship_retry_with_same_key(client: TestClient, session: Session, sample_product, sample_worker, auth_headers):
+    """Test that a retried shipment does not decrement stock twice"""
+    estimate_id = client.post(
+        "/estimates/",
+        json={"estimate_number": "IDEM-1", "client_name": "Клиент",
+              "items": [{"product_id": sample_product.id, "quantity": 10.0, "unit_price": 75.0}]},
+        headers=auth_headers
+    ).json()["id"]
+    headers = {**auth_headers, "Idempotency-Key": "ship-1"}
+    url = f"/estimates/{estimate_id}/ship?worker_id={sample_worker.id}"
+    first = client.post(url, headers=headers)
+    second = client.post(url, headers=headers)
+    assert first.status_code == second.status_code == 200
+    assert second.json() == first.json()
+    session.refresh(sample_product)
+    assert sample_product.stock_quantity == 90.0
+
+
+def test_concurrent_duplicate_waits_for_first_result(session: Session):
+    """Test that a duplicate arriving mid-request gets the first request's response"""
+    engine = session.get_bind()
+    user = {"sub": "user-1"}
+    claimed = threading.Event()
+    calls = []
+
+    def slow_handler():
+        calls.append("first")
+        claimed.set()
+        time.sleep(0.3)
+        return {"message": "готово"}
+
+    def first_request():
+        with Session(engine) as first_session:
+            run_idempotent(first_session, user, "concurrent-1", "scope", slow_handler)
+
+    thread = threading.Thread(target=first_request)
+    thread.start()
+    assert claimed.wait(5)
+    with Session(engine) as second_session:
+        response = run_idempotent(second_session, user, "concurrent-1", "scope", lambda: calls.append("second"))
+    thread.join()
+
+    assert calls == ["first"]
+    assert response.headers["Idempotent-Replayed"] == "true"
+    assert response.body == '{"message":"готово"}'.encode("utf-8")
+
+
+def test_abandoned_claim_is_taken_over(client: TestClient, session: Session, sample_product, sample_worker, auth_headers):
+    """Test that a claim left without a response by a crashed request is re-executed once"""
+    first = _issue(client, sample_product.id, sample_worker.id, 10.0, "crash-1", auth_headers)
+    # Экземпляр упал до commit: строка ключа без ответа, изменений в БД нет
+    session.exec(update(IdempotencyKey).values(
+        status_code=None, response_body=None, created_at=datetime.utcnow() - timedelta(hours=1)))
+    session.commit()
+
+    retry = _issue(client, sample_product.id, sample_worker.id, 10.0, "crash-1", auth_headers)
+    assert retry.status_code == 200 and "Idempotent-Replayed" not in retry.headers
+    replay = _issue(client, sample_product.id, sample_worker.id, 10.0, "crash-1", auth_headers)
+    assert replay.json()["id"] == retry.json()["id"] != first.json()["id"]
+
+
+def test_taken_over_request_rolls_back(session: Session, sample_product):
+    """Test that a request whose claim was taken over does not commit its changes"""
+    engine = session.get_bind()
+
+    def handler_outlived_by_retry():
+        # Пока запрос выполняется, повтор перехватывает ключ
+        with Session(engine) as retry_session:
+            retry_session.exec(update(IdempotencyKey).values(created_at=datetime.utcnow() + timedelta(seconds=1)))
+            retry_session.commit()
+        sample_product.stock_quantity = 1.0
+        session.add(sample_product)
+        session.flush()
+        return {"message": "готово"}
+
+    with pytest.raises(HTTPException) as error:
+        run_idempotent(session, {"sub": "user-1"}, "slow-1", "scope", handler_outlived_by_retry)
+    assert error.value.status_code == 409
+    with Session(engine) as check:
+        assert check.get(Product, sample_product.id).stock_quantity == 100.0
+        assert check.exec(select(IdempotencyKey)).one().status_code is None
@@ -0,0 +1,79 @@
+# tests/test_locations.py
+from fastapi.testclient import TestClient
+from sqlmodel import Session, func, select
+
+from main_models import LocationStock
+
+
+def _balances(client: TestClient, product_id: int, auth_headers):
+    rows = client.get(f"/products/{product_id}/locations", headers=auth_headers).json()
+    return {row["location_name"]: row["quantity"] for row in rows}
+
+
+def test_transfer_and_issue_from_location(client: TestClient, session: Session, sample_product, sample_worker, auth_headers):
+    """Test transfers between locations and issuing from a specific location"""
+    van = client.post("/locations/", json={"name": "Машина"}, headers=auth_headers).json()
+    default_id = next(l["id"] for l in client.get("/locations/", headers=auth_headers).json() if l["is_default"])
+
+    transfer = {"product_id": sample_product.id, "from_location_id": default_id,
+                "to_location_id": van["id"], "quantity": 30.0}
+    legs = client.post("/actions/transfer-item/", json=transfer, headers=auth_headers).json()
+    assert [(m["location_id"], m["quantity"]) for m in legs] == [(default_id, -30.0), (van["id"], 30.0)]
+    assert _balances(client, sample_product.id, auth_headers) == {"Основной склад": 70.0, "Машина": 30.0}
+
+    issue = {"product_id": sample_product.id, "worker_id": sample_worker.id, "location_id": van["id"]}
+    assert client.post("/actions/issue-item/", json={**issue, "quantity": 40.0}, headers=auth_headers).status_code == 400
+    issued = client.post("/actions/issue-item/", json={**issue, "quantity": 20.0}, headers=auth_headers).json()
+    session.refresh(sample_product)
+    assert sample_product.stock_quantity == 80.0
+    assert _balances(client, sample_product.id, auth_headers) == {"Основной склад": 70.0, "Машина": 10.0}
+
+    stock = client.get(f"/locations/{van['id']}/stock", headers=auth_headers).json()
+    assert [(s["product_id"], s["quantity"]) for s in stock] == [(sample_product.id, 10.0)]
+    products = client.get(f"/products/?location_id={van['id']}", headers=auth_headers).json()
+    assert [p["id"] for p in products["items"]] == [sample_product.id]
+    history = client.get(f"/actions/history/?location_id={van['id']}", headers=auth_headers).json()
+    assert history["total"] == 2
+
+    assert client.post(f"/actions/history/cancel/{legs[0]['id']}", headers=auth_headers).status_code == 400
+    client.post(f"/actions/history/cancel/{issued['id']}", headers=auth_headers)
+    assert _balances(client, sample_product.id, auth_headers) == {"Основной склад": 70.0, "Машина": 30.0}
+
+
+def test_location_balances_sum_to_total(client: TestClient, session: Session, sample_product, auth_headers):
+    """Test that stock written without a movement lands on the default location"""
+    van = client.post("/locations/", json={"name": "Машина"}, headers=auth_headers).json()
+    client.post("/actions/receive-item/", json={"product_id": sample_product.id, "quantity": 5.0,
+                                                "location_id": van["id"]}, headers=auth_headers)
+    session.refresh(sample_product)
+    sample_product.stock_quantity = 60.0
+    session.add(sample_product)
+    session.commit()
+
+    assert _balances(client, sample_product.id, auth_headers) == {"Основной склад": 55.0, "Машина": 5.0}
+    total = session.exec(select(func.sum(LocationStock.quantity)).where(
+        LocationStock.product_id == sample_product.id)).one()
+    assert total == sample_product.stock_quantity
+    assert client.post("/locations/", json={"name": "Машина"}, headers=auth_headers).status_code == 400
+
+
+def test_location_agnostic_paths_debit_default_location(client: TestClient, session: Session, sample_product, sample_worker, auth_headers):
+    """Test that shipping an estimate cannot take the default location below zero"""
+    van = client.post("/locations/", json={"name": "Машина"}, headers=auth_headers).json()
+    default_id = next(l["id"] for l in client.get("/locations/", headers=auth_headers).json() if l["is_default"])
+    client.post("/actions/transfer-item/", json={"product_id": sample_product.id, "from_location_id": default_id,
+                                                 "to_location_id": van["id"], "quantity": 100.0}, headers=auth_headers)
+    estimate_id = client.post("/estimates/", json={
+        "estimate_number": "LOC-1", "client_name": "Клиент",
+        "items": [{"product_id": sample_product.id, "quantity": 30.0, "unit_price": 75.0}]}, headers=auth_headers).json()["id"]
+
+    response = client.post(f"/estimates/{estimate_id}/ship?worker_id={sample_worker.id}", headers=auth_headers)
+    assert response.status_code == 400
+    session.refresh(sample_product)
+    assert sample_product.stock_quantity == 100.0
+    assert _balances(client, sample_product.id, auth_headers) == {"Машина": 100.0}
+
+    client.post("/actions/transfer-item/", json={"product_id": sample_product.id, "from_location_id": van["id"],
+                                                 "to_location_id": default_id, "quantity": 30.0}, headers=auth_headers)
+    assert client.post(f"/estimates/{estimate_id}/ship?worker_id={sample_worker.id}", headers=auth_headers).status_code == 200
+    assert _balances(client, sample_product.id, auth_headers) == {"Машина": 70.0}
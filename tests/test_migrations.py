@@ -0,0 +1,87 @@
+# tests/test_migrations.py
+import pytest
+from sqlalchemy import inspect, text
+from sqlmodel import SQLModel, create_engine
+
+import config
+import migrations
+
+
+@pytest.fixture(name="db_engine")
+def db_engine_fixture(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'migrations.db'}")
+    yield engine
+    engine.dispose()
+
+
+def _version(engine) -> int:
+    with engine.connect() as conn:
+        return migrations.current_version(conn)
+
+
+def test_fresh_database_is_created_at_head(db_engine):
+    """Test that an empty database gets the full schema and the latest version"""
+    assert _version(db_engine) == 0
+    migrations.upgrade(db_engine)
+    assert _version(db_engine) == migrations.HEAD_VERSION
+    assert inspect(db_engine).has_table("product")
+    # Повторный запуск ничего не делает
+    assert migrations.upgrade(db_engine) == []
+
+
+def test_legacy_database_is_migrated(db_engine):
+    """Test upgrading a database created before versioned migrations"""
+    SQLModel.metadata.create_all(db_engine)
+    with db_engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_stockmovement_product_id"))
+        conn.execute(text("ALTER TABLE estimate DROP COLUMN shipped_at"))
+        conn.execute(text("DROP TABLE authsession"))
+
+    applied = migrations.upgrade(db_engine)
+    assert applied == list(range(1, migrations.HEAD_VERSION + 1))
+    insp = inspect(db_engine)
+    assert "shipped_at" in {c["name"] for c in insp.get_columns("estimate")}
+    assert "ix_stockmovement_product_id" in {i["name"] for i in insp.get_indexes("stockmovement")}
+    assert insp.has_table("authsession")
+
+
+def test_check_schema_does_not_migrate_by_default(db_engine, monkeypatch):
+    """Test that the startup check only reports an outdated schema"""
+    monkeypatch.setattr(config, "MIGRATE_ON_STARTUP", False)
+    assert migrations.check_schema(db_engine) == 0
+    assert not inspect(db_engine).has_table("product")
+
+    monkeypatch.setattr(config, "MIGRATE_ON_STARTUP", True)
+    assert migrations.check_schema(db_engine) == migrations.HEAD_VERSION
+    assert migrations.check_schema(db_engine) == migrations.HEAD_VERSION
+
+
+def test_repair_numeric_columns(db_engine):
+    """Test the set-based repair of non-finite and negative values"""
+    migrations.upgrade(db_engine)
+    with db_engine.begin() as conn:
+        # Данные, записанные до появления CHECK
+        conn.execute(text("PRAGMA ignore_check_constraints = ON"))
+        conn.execute(text(
+            "INSERT INTO product (id, is_favorite, is_deleted, internal_sku, name, unit, "
+            "purchase_price, retail_price, stock_quantity, min_stock_level) "
+            "VALUES (1, 0, 0, 'BAD-001', 'Битый товар', 'szt', 10, 9e999, -5, -1)"))
+        conn.execute(text(
+            "INSERT INTO stockmovement (id, quantity, type, stock_after, product_id, timestamp) "
+            "VALUES (1, -9e999, 'INCOME', 9e999, 1, '2024-01-01')"))
+        conn.execute(text("PRAGMA ignore_check_constraints = OFF"))
+
+    with db_engine.begin() as conn:
+        fixed = migrations.repair_numeric_columns(conn)
+    assert fixed["product.retail_price"] == 1
+    assert fixed["product.min_stock_level"] == 1
+    # Отрицательный остаток допустим
+    assert fixed["product.stock_quantity"] == 0
+    assert fixed["stockmovement.quantity"] == 1
+
+    with db_engine.connect() as conn:
+        product = conn.execute(text(
+            "SELECT purchase_price, retail_price, stock_quantity, min_stock_level FROM product")).one()
+        movement = conn.execute(text("SELECT quantity, stock_after FROM stockmovement")).one()
+    assert tuple(product) == (10.0, 0.0, -5.0, 0.0)
+    assert tuple(movement) == (0.0, None)
@@ -1,7 +1,7 @@
 # tests/test_products.py
 import pytest
-import math
 from fastapi.testclient import TestClient
+from sqlalchemy.exc import IntegrityError
 from sqlmodel import Session
 from main_models import Product
 
@@ -68,16 +68,14 @@ def test_delete_product(client: TestClient, sample_product, auth_headers):
 
 def test_validate_quantity_nan(client: TestClient, auth_headers):
     """Test that NaN values are rejected"""
+    # httpx не сериализует NaN, поэтому тело передаётся как есть
     response = client.post(
         "/actions/receive-item/",
-        json={
-            "product_id": 1,
-            "quantity": float('nan')
-        },
-        headers=auth_headers
+        content='{"product_id": 1, "quantity": NaN}',
+        headers={**auth_headers, "Content-Type": "application/json"}
     )
-    # Should return 400 or similar error due to validation
-    assert response.status_code in [400, 422]
+    # Rejected by request validation (FiniteFloat)
+    assert response.status_code == 422
 
 def test_validate_quantity_negative(client: TestClient, sample_product, auth_headers):
     """Test that negative quantities are rejected"""
@@ -91,26 +89,107 @@ def test_validate_quantity_negative(client: TestClient, sample_product, auth_hea
     )
     assert response.status_code == 400
 
-def test_nan_values_cleaned_in_response(client: TestClient, session: Session, auth_headers):
-    """Test that products with NaN values return 0.0 instead"""
-    # Manually create a product with NaN (simulating corrupted data)
-    product = Product(
-        name="NaN Product",
-        internal_sku="NAN-001",
-        stock_quantity=float('nan'),
-        purchase_price=100.0,
-        retail_price=150.0
+def test_non_finite_values_rejected_by_database(session: Session):
+    """Test that CHECK constraints keep NaN/Infinity and negative prices out of the table"""
+    for values in ({"stock_quantity": float('inf')}, {"retail_price": -1.0}):
+        session.add(Product(name="Битый товар", internal_sku="BAD-001", **values))
+        with pytest.raises(IntegrityError):
+            session.commit()
+        session.rollback()
+
+
+def test_non_finite_values_rejected_on_update(client: TestClient, sample_product, auth_headers):
+    """Test that non-finite numbers in the request body are rejected with 422"""
+    response = client.patch(
+        f"/products/{sample_product.id}",
+        content='{"retail_price": Infinity}',
+        headers={**auth_headers, "Content-Type": "application/json"}
     )
-    session.add(product)
-    session.commit()
-    
+    assert response.status_code == 422
+
     response = client.get("/products/", headers=auth_headers)
     assert response.status_code == 200
+
+def test_universal_import_to_stock(client: TestClient, sample_product, auth_headers):
+    """Test importing stock from an Excel file"""
+    import io
+    from openpyxl import Workbook
+
+    wb = Workbook()
+    ws = wb.active
+    ws.append(["INTERNAL_SKU", "NAME", "STOCK_QUANTITY", "SUPPLIER_SKU"])
+    ws.append(["TEST-001", "Тестовый товар", 5, None])
+    ws.append(["NEW-IMPORT", "Импортированный товар", 7, None])
+    buf = io.BytesIO()
+    wb.save(buf)
+
+    response = client.post(
+        "/actions/universal-import/",
+        data={"mode": "to_stock"},
+        files={"file": ("stock.xlsx", buf.getvalue(),
+                        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")},
+        headers=auth_headers
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["updated"] == ["Тестовый товар"]
+    assert data["created"] == ["Импортированный товар"]
+
+
+def _xlsx(rows) -> bytes:
+    import io
+    from openpyxl import Workbook
+
+    wb = Workbook()
+    ws = wb.active
+    for row in rows:
+        ws.append(row)
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+def test_import_1c_estimate_fuzzy_match(client: TestClient, sample_product, auth_headers):
+    """Test importing a 1C estimate with fuzzy product name matching"""
+    content = _xlsx([
+        ["Коммерческое предложение № 42"],
+        ["Кому: Иванов Иван"],
+        ["Товары", "Кол-во", "Цена"],
+        ["Тестовый товар.", 3, "1 200,50"],
+        ["Итого:", None, None],
+    ])
+    response = client.post(
+        "/actions/import-1c-estimate/",
+        files={"file": ("kp.xlsx", content,
+                        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")},
+        headers=auth_headers
+    )
+    assert response.status_code == 200
     data = response.json()
-    
-    # Find our NaN product
-    nan_product = next((p for p in data["items"] if p["internal_sku"] == "NAN-001"), None)
-    assert nan_product is not None
-    # Should be cleaned to 0.0
-    assert nan_product["stock_quantity"] == 0.0
-    assert not math.isnan(nan_product["stock_quantity"])
+    assert data["estimate_number"] == "1C-42"
+    assert data["client_name"] == "Иванов Иван"
+
+
+def test_import_rejects_unreadable_file(client: TestClient, auth_headers):
+    """Test that a broken Excel file is reported as 400"""
+    response = client.post(
+        "/actions/universal-import/",
+        data={"mode": "to_stock"},
+        files={"file": ("broken.xlsx", b"not an excel file", "application/octet-stream")},
+        headers=auth_headers
+    )
+    assert response.status_code == 400
+    assert "Ошибка чтения Excel" in response.json()["detail"]
+
+def test_read_products_summary_view(client: TestClient, sample_product, auth_headers):
+    """Test that the summary view returns only the list columns"""
+    response = client.get("/products/?view=summary", headers=auth_headers)
+    assert response.status_code == 200
+    item = response.json()["items"][0]
+    assert item["internal_sku"] == "TEST-001"
+    assert item["stock_quantity"] == 100.0
+    assert "purchase_price" not in item
+    assert "min_stock_level" not in item
+
+    full = client.get("/products/", headers=auth_headers).json()["items"][0]
+    assert full["purchase_price"] == 50.0
@@ -0,0 +1,75 @@
+# tests/test_reorder_queue.py
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlmodel import Session, select
+
+import reorder_queue
+from main_models import ReorderQueue
+
+
+def _issue(client: TestClient, product_id: int, worker_id: int, quantity: float, auth_headers):
+    return client.post(
+        "/actions/issue-item/",
+        json={"product_id": product_id, "worker_id": worker_id, "quantity": quantity},
+        headers=auth_headers
+    )
+
+
+def test_queue_follows_stock_crossing_minimum(client: TestClient, session: Session, sample_product, sample_worker, auth_headers):
+    """Test that products enter the queue at the minimum and leave it when restocked"""
+    assert session.exec(select(ReorderQueue)).first() is None
+
+    _issue(client, sample_product.id, sample_worker.id, 92.0, auth_headers)
+    entry = session.get(ReorderQueue, sample_product.id)
+    assert entry.shortfall == 2.0
+    went_low_at = entry.went_low_at
+
+    # Остаётся в очереди: нехватка обновляется, время попадания — нет
+    _issue(client, sample_product.id, sample_worker.id, 3.0, auth_headers)
+    session.refresh(entry)
+    assert (entry.shortfall, entry.went_low_at) == (5.0, went_low_at)
+
+    client.post("/actions/receive-item/", json={"product_id": sample_product.id, "quantity": 20.0}, headers=auth_headers)
+    session.expire_all()
+    assert session.get(ReorderQueue, sample_product.id) is None
+
+
+def test_queue_consumers(client: TestClient, session: Session, sample_product, sample_worker, auth_headers):
+    """Test the products filter, the queue feed and the dashboard count"""
+    _issue(client, sample_product.id, sample_worker.id, 95.0, auth_headers)
+
+    low = client.get("/products/?stock_status=low_stock", headers=auth_headers).json()
+    assert [p["id"] for p in low["items"]] == [sample_product.id]
+
+    queue = client.get("/reorder-queue/", headers=auth_headers).json()
+    assert queue["total"] == 1
+    assert queue["items"][0]["shortfall"] == 5.0
+    went_low_at = queue["items"][0]["went_low_at"]
+    assert client.get(f"/reorder-queue/?since={went_low_at}", headers=auth_headers).json()["total"] == 0
+
+    summary = client.get("/dashboard/summary", headers=auth_headers).json()
+    assert summary["products_to_order_count"] == 1
+
+
+def test_minimum_change_and_delete_leave_queue(client: TestClient, session: Session, sample_product, sample_worker, auth_headers):
+    """Test that lowering the minimum or deleting the product removes it from the queue"""
+    _issue(client, sample_product.id, sample_worker.id, 95.0, auth_headers)
+    client.patch(f"/products/{sample_product.id}", json={"min_stock_level": 2.0}, headers=auth_headers)
+    session.expire_all()
+    assert session.get(ReorderQueue, sample_product.id) is None
+
+    client.patch(f"/products/{sample_product.id}", json={"min_stock_level": 10.0}, headers=auth_headers)
+    client.delete(f"/products/{sample_product.id}", headers=auth_headers)
+    session.expire_all()
+    assert session.get(ReorderQueue, sample_product.id) is None
+
+
+def test_rebuild_queue(session: Session, sample_product):
+    """Test the full rebuild after out-of-band stock changes"""
+    session.exec(text(f"UPDATE product SET stock_quantity = 4 WHERE id = {sample_product.id}"))
+    session.commit()
+    assert session.get(ReorderQueue, sample_product.id) is None
+
+    with session.get_bind().begin() as conn:
+        reorder_queue.refresh_queue(conn)
+    assert session.get(ReorderQueue, sample_product.id).shortfall == 6.0
@@ -0,0 +1,71 @@
+# tests/test_reports.py
+import pytest
+from datetime import datetime
+from fastapi.testclient import TestClient
+from sqlmodel import Session
+from main_models import Estimate, EstimateItem, EstimateStatusEnum
+
+
+@pytest.fixture
+def completed_estimate(session: Session, sample_product):
+    """Create a completed estimate: 10 × 75 retail against 50 purchase"""
+    estimate = Estimate(
+        estimate_number="REP-001",
+        client_name="Клиент отчета",
+        status=EstimateStatusEnum.COMPLETED,
+        created_at=datetime.utcnow()
+    )
+    session.add(estimate)
+    session.flush()
+    session.add(EstimateItem(estimate_id=estimate.id, product_id=sample_product.id,
+                             quantity=10.0, unit_price=75.0))
+    session.commit()
+    session.refresh(estimate)
+    return estimate
+
+
+def test_profit_report(client: TestClient, completed_estimate, auth_headers):
+    """Test profit report totals"""
+    response = client.get("/reports/profit", headers=auth_headers)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["grand_total_retail"] == 750.0
+    assert data["grand_total_purchase"] == 500.0
+    assert data["grand_total_profit"] == 250.0
+
+
+def test_profit_report_details(client: TestClient, completed_estimate, auth_headers):
+    """Test per-item profit details of an estimate"""
+    response = client.get(
+        f"/reports/profit/{completed_estimate.id}/details", headers=auth_headers)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["total_profit"] == 250.0
+    assert len(data["items"]) == 1
+
+
+def test_dashboard_summary(client: TestClient, completed_estimate, auth_headers):
+    """Test dashboard counters and 30-day profit"""
+    response = client.get("/dashboard/summary", headers=auth_headers)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["profit_last_30_days"] == 250.0
+    assert data["products_to_order_count"] == 0
+
+
+def test_history(client: TestClient, sample_product, sample_worker, auth_headers):
+    """Test movement history with search"""
+    client.post(
+        "/actions/issue-item/",
+        json={"product_id": sample_product.id, "worker_id": sample_worker.id, "quantity": 3.0},
+        headers=auth_headers
+    )
+    response = client.get("/actions/history/?search=Тестовый", headers=auth_headers)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["total"] == 1
+    assert data["items"][0]["worker"]["name"] == sample_worker.name
+
+    response = client.get("/actions/history/?search=нет-такого", headers=auth_headers)
+    assert response.status_code == 200
+    assert response.json() == {"total": 0, "items": []}
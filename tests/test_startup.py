@@ -0,0 +1,26 @@
+# tests/test_startup.py
+from import_benchmark import LAZY_MODULES, measure_import
+
+
+def test_heavy_modules_are_not_imported_at_startup():
+    """Test that importing the app does not load Excel/docx/AI/Supabase dependencies"""
+    total_ms, _, loaded = measure_import("main_api")
+    assert total_ms > 0
+    assert loaded == [], f"Loaded at import time: {loaded} (lazy: {LAZY_MODULES})"
+
+
+def test_docx_render_window_leaves_a_cpu_process_free():
+    """Test that the document batch window must be smaller than the CPU pool"""
+    import os
+    import subprocess
+    import sys
+
+    def load_config(**env):
+        return subprocess.run([sys.executable, "-c", "import config; print(config.DOCX_RENDER_PROCESSES)"],
+                              env={**os.environ, **env}, capture_output=True, text=True)
+
+    assert load_config(CPU_POOL_PROCESSES="4", DOCX_RENDER_PROCESSES="").stdout.strip() == "3"
+    assert load_config(CPU_POOL_PROCESSES="2", DOCX_RENDER_PROCESSES="2").returncode != 0
+    # Из одного процесса нельзя оставить свободный
+    assert load_config(CPU_POOL_PROCESSES="1", DOCX_RENDER_PROCESSES="").returncode != 0
+    assert load_config(CPU_POOL_PROCESSES="0", IO_POOL_THREADS="4", DOCX_RENDER_PROCESSES="").stdout.strip() == "3"
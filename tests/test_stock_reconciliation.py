@@ -0,0 +1,62 @@
+# tests/test_stock_reconciliation.py
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlmodel import Session, select
+
+import stock_reconciliation
+from main_models import Location, MovementTypeEnum, Product, StockMovement
+
+
+def test_consistent_ledger(client: TestClient, session: Session, sample_worker, auth_headers):
+    """Test that regular operations and cancellations leave no discrepancies"""
+    product = Product(name="Кабель", internal_sku="CAB-1", stock_quantity=0.0)
+    session.add(product)
+    session.commit()
+    client.post("/actions/receive-item/", json={"product_id": product.id, "quantity": 50.0}, headers=auth_headers)
+    issue = {"product_id": product.id, "worker_id": sample_worker.id, "quantity": 8.0}
+    issued = client.post("/actions/issue-item/", json=issue, headers=auth_headers).json()
+    client.post("/actions/issue-item/", json=issue, headers=auth_headers)
+    client.post("/actions/return-item/", json={**issue, "quantity": 3.0}, headers=auth_headers)
+    client.post("/actions/write-off-item/", json={**issue, "quantity": 2.0}, headers=auth_headers)
+    client.post(f"/actions/history/cancel/{issued['id']}", headers=auth_headers)
+
+    report = stock_reconciliation.reconcile(session.get_bind(), chunk_rows=2)
+    assert report["movements"] == 6
+    assert (report["discrepancies"], report["broken_chains"], report["negative_on_hand"]) == ([], [], [])
+
+
+def test_drift_detected_and_repaired(client: TestClient, session: Session, sample_product, sample_worker, auth_headers):
+    """Test reporting stock changed outside the ledger and repairing it with one adjustment"""
+    # У sample_product остаток 100 без прихода в журнале
+    client.post("/actions/issue-item/", json={"product_id": sample_product.id, "worker_id": sample_worker.id,
+                                              "quantity": 10.0}, headers=auth_headers)
+    session.exec(text(f"UPDATE product SET stock_quantity = 80 WHERE id = {sample_product.id}"))
+    session.commit()
+
+    report = stock_reconciliation.reconcile(session.get_bind(), chunk_rows=1)
+    assert report["discrepancies"] == [{"product_id": sample_product.id, "name": sample_product.name,
+                                        "stock_quantity": 80.0, "ledger_balance": -10.0, "difference": 90.0}]
+    assert report["broken_chains"][0]["expected_stock_after"] == -10.0
+    assert report["broken_chains"][0]["stock_after"] == 90.0
+
+    assert stock_reconciliation.reconcile(session.get_bind(), repair=True)["adjustments"] == 1
+    adjustment = session.exec(select(StockMovement).order_by(StockMovement.id.desc())).first()
+    assert (adjustment.type, adjustment.quantity, adjustment.stock_after) == (MovementTypeEnum.ADJUSTMENT, 90.0, 80.0)
+    assert adjustment.location_id == session.exec(select(Location.id).where(Location.is_default == True)).one()  # noqa: E712
+    assert stock_reconciliation.reconcile(session.get_bind())["discrepancies"] == []
+
+
+def test_chunking_does_not_change_report(client: TestClient, session: Session, sample_product, sample_worker, auth_headers):
+    """Test that the report is the same for any chunk size, including negative worker balances"""
+    for quantity in (5.0, 7.0):
+        client.post("/actions/issue-item/", json={"product_id": sample_product.id, "worker_id": sample_worker.id,
+                                                  "quantity": quantity}, headers=auth_headers)
+    session.add(StockMovement(product_id=sample_product.id, worker_id=sample_worker.id, quantity=20.0,
+                              type=MovementTypeEnum.WRITE_OFF_WORKER, stock_after=88.0))
+    session.commit()
+
+    reports = [stock_reconciliation.reconcile(session.get_bind(), chunk_rows=rows) for rows in (1, 2, 1000)]
+    assert reports[0] == reports[1] == reports[2]
+    assert reports[0]["negative_on_hand"] == [
+        {"worker_id": sample_worker.id, "product_id": sample_product.id, "on_hand": -8.0}]
+    assert reports[0]["broken_chains"][0]["breaks"] == 1
@@ -0,0 +1,89 @@
+# tests/test_stocktakes.py
+import io
+
+from fastapi.testclient import TestClient
+from sqlmodel import Session, select
+
+from main_models import MovementTypeEnum, Product, StockMovement
+
+XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def _issue(client: TestClient, product_id: int, worker_id: int, quantity: float, auth_headers):
+    return client.post("/actions/issue-item/", json={"product_id": product_id, "worker_id": worker_id,
+                                                     "quantity": quantity}, headers=auth_headers)
+
+
+def _xlsx(rows) -> bytes:
+    from openpyxl import Workbook
+
+    wb = Workbook()
+    ws = wb.active
+    for row in rows:
+        ws.append(row)
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+def test_stocktake_with_movements_during_count(client: TestClient, session: Session, sample_product, sample_worker, auth_headers):
+    """Test that movements before a count are expected and movements after it are kept"""
+    other = Product(name="Муфта", internal_sku="MUF-1", stock_quantity=20.0)
+    session.add(other)
+    session.commit()
+    stocktake = client.post("/stocktakes/", json={"note": "Квартал"}, headers=auth_headers).json()
+    assert (stocktake["line_count"], stocktake["counted_count"]) == (2, 0)
+
+    _issue(client, sample_product.id, sample_worker.id, 10.0, auth_headers)
+    counts = [{"product_id": sample_product.id, "counted_quantity": 88.0},
+              {"product_id": other.id, "counted_quantity": 20.0}]
+    response = client.put(f"/stocktakes/{stocktake['id']}/counts", json=counts, headers=auth_headers)
+    assert response.json()["counted_count"] == 2
+    _issue(client, sample_product.id, sample_worker.id, 5.0, auth_headers)
+
+    detail = client.get(f"/stocktakes/{stocktake['id']}", headers=auth_headers).json()
+    line = next(l for l in detail["lines"] if l["product_id"] == sample_product.id)
+    assert (line["expected_quantity"], line["movements_during_count"], line["variance"]) == (100.0, -10.0, -2.0)
+
+    result = client.post(f"/stocktakes/{stocktake['id']}/post", headers=auth_headers).json()
+    assert result == {"posted": 2, "adjustments": 1, "uncounted": 0}
+    session.refresh(sample_product)
+    assert sample_product.stock_quantity == 83.0
+    adjustment = session.exec(select(StockMovement).where(StockMovement.type == MovementTypeEnum.ADJUSTMENT)).one()
+    assert (adjustment.quantity, adjustment.stock_after) == (-2.0, 83.0)
+
+    assert client.post(f"/stocktakes/{stocktake['id']}/post", headers=auth_headers).status_code == 400
+    assert client.get(f"/stocktakes/{stocktake['id']}", headers=auth_headers).json()["status"] == "Проведена"
+
+
+def test_stocktake_sheet_upload(client: TestClient, session: Session, sample_product, auth_headers):
+    """Test counts from an uploaded sheet, unknown SKUs and overlapping stocktakes"""
+    stocktake = client.post("/stocktakes/", json={"product_ids": [sample_product.id]}, headers=auth_headers).json()
+    assert client.post("/stocktakes/", json={}, headers=auth_headers).status_code == 409
+
+    def upload(rows):
+        return client.post(f"/stocktakes/{stocktake['id']}/counts/upload",
+                           files={"file": ("count.xlsx", _xlsx(rows), XLSX)}, headers=auth_headers)
+
+    assert upload([["Артикул", "Факт"], ["NOPE-1", 1]]).status_code == 404
+    response = upload([["Инвентаризация склада"], ["Артикул", "Наименование", "Факт"],
+                       ["TEST-001", "Тестовый товар", "97,5"], [None, "Итого", None]])
+    assert response.status_code == 200
+    assert response.json()["counted_count"] == 1
+
+    assert client.post(f"/stocktakes/{stocktake['id']}/post", headers=auth_headers).json()["adjustments"] == 1
+    session.refresh(sample_product)
+    assert sample_product.stock_quantity == 97.5
+
+
+def test_cancel_stocktake(client: TestClient, session: Session, sample_product, auth_headers):
+    """Test that a cancelled stocktake changes nothing and frees its products"""
+    stocktake = client.post("/stocktakes/", json={}, headers=auth_headers).json()
+    client.put(f"/stocktakes/{stocktake['id']}/counts",
+               json=[{"product_id": sample_product.id, "counted_quantity": 1.0}], headers=auth_headers)
+    assert client.post(f"/stocktakes/{stocktake['id']}/cancel", headers=auth_headers).json()["status"] == "Отменена"
+    assert client.post(f"/stocktakes/{stocktake['id']}/post", headers=auth_headers).status_code == 400
+
+    session.refresh(sample_product)
+    assert sample_product.stock_quantity == 100.0
+    assert client.post("/stocktakes/", json={}, headers=auth_headers).status_code == 200
@@ -2,6 +2,7 @@
 import pytest
 from fastapi.testclient import TestClient
 from sqlmodel import Session
+from main_models import Product, Worker
 
 def test_create_worker(client: TestClient, auth_headers):
     """Test creating a new worker"""
@@ -86,3 +87,46 @@ def test_get_worker_stock(client: TestClient, sample_product, sample_worker, aut
     data = response.json()
     assert len(data) >= 1
     assert data[0]["quantity_on_hand"] == 15.0
+
+def test_history_views(client: TestClient, sample_product, sample_worker, auth_headers):
+    """Test the movement history in summary and full views"""
+    client.post(
+        "/actions/issue-item/",
+        json={"product_id": sample_product.id, "worker_id": sample_worker.id, "quantity": 3.0},
+        headers=auth_headers
+    )
+    summary = client.get("/actions/history/?view=summary", headers=auth_headers).json()
+    assert summary["total"] == 1
+    item = summary["items"][0]
+    assert item["product"]["name"] == "Тестовый товар"
+    assert item["worker"]["name"] == "Тестовый работник"
+    assert "product_id" not in item
+
+    full = client.get(f"/actions/history/?worker_id={sample_worker.id}", headers=auth_headers).json()
+    assert full["items"][0]["product_id"] == sample_product.id
+
+
+def test_worker_stock_matrix(client: TestClient, session: Session, sample_product, sample_worker, auth_headers):
+    """Test the all-workers on-hand matrix with totals and the product filter"""
+    other_worker = Worker(name="Второй работник")
+    other_product = Product(name="Второй товар", internal_sku="TEST-002", stock_quantity=50.0)
+    session.add_all([other_worker, other_product])
+    session.commit()
+    for worker_id, product_id, quantity in ((sample_worker.id, sample_product.id, 10.0),
+                                            (sample_worker.id, other_product.id, 2.0),
+                                            (other_worker.id, sample_product.id, 5.0)):
+        client.post("/actions/issue-item/", json={"product_id": product_id, "worker_id": worker_id, "quantity": quantity},
+                    headers=auth_headers)
+    # Полностью возвращённый товар в матрицу не попадает
+    client.post("/actions/return-item/", json={"product_id": other_product.id, "worker_id": sample_worker.id, "quantity": 2.0},
+                headers=auth_headers)
+
+    data = client.get("/actions/worker-stock-matrix", headers=auth_headers).json()
+    assert data["workers"] == {"id": [other_worker.id, sample_worker.id],
+                               "name": ["Второй работник", "Тестовый работник"], "total": [5.0, 10.0]}
+    assert data["products"]["id"] == [sample_product.id]
+    assert data["products"]["total"] == [15.0]
+    assert data["cells"] == {"worker": [0, 1], "product": [0, 0], "quantity": [5.0, 10.0]}
+
+    filtered = client.get(f"/actions/worker-stock-matrix?product_id={other_product.id}", headers=auth_headers).json()
+    assert filtered["cells"]["quantity"] == []
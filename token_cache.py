@@ -0,0 +1,121 @@
+# token_cache.py
+"""Проверка JWT с кэшем уже проверенных токенов.
+
+Токен проверяется подписью один раз: результат (claims) кладётся в ограниченный LRU
+по sha256 токена и живёт до его exp. Секрет для проверки выбирается по заголовку
+и issuer токена, а не перебором:
+- наши токены (выдаёт /token) подписаны SECRET_KEY и несут iss = TOKEN_ISSUER;
+- токены Supabase — issuer ".../auth/v1" и audience "authenticated", секрет SUPABASE_JWT_SECRET.
+Токены без iss выданы до его появления и считаются нашими.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from jose import JWTError, jwt
+
+from config import SECRET_KEY, ALGORITHM, SUPABASE_JWT_SECRET, TOKEN_CACHE_SIZE
+
+TOKEN_ISSUER = "sklad-api"
+KIND_LOCAL = "local"
+KIND_SUPABASE = "supabase"
+
+
+def token_kind(token: str) -> str:
+    """Определяет тип токена по непроверенным заголовку и claims."""
+    header = jwt.get_unverified_header(token)
+    claims = jwt.get_unverified_claims(token)
+    if header.get("alg") != ALGORITHM:
+        raise JWTError(f"Неподдерживаемый алгоритм подписи: {header.get('alg')}")
+    issuer = claims.get("iss") or ""
+    if issuer == TOKEN_ISSUER:
+        return KIND_LOCAL
+    audience = claims.get("aud")
+    if issuer.endswith("/auth/v1") or audience == "authenticated" or (
+            isinstance(audience, list) and "authenticated" in audience):
+        return KIND_SUPABASE
+    return KIND_LOCAL
+
+
+class TokenVerifier:
+    """Проверяет токены и кэширует результат до истечения срока токена."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[str, Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.verified = {KIND_LOCAL: 0, KIND_SUPABASE: 0}
+
+    def _lookup(self, digest: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._cache.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            claims, expires_at = entry
+            if expires_at <= time.time():
+                # Истёкший токен проверяем заново — jwt.decode вернёт понятную ошибку
+                del self._cache[digest]
+                self.misses += 1
+                return None
+            self._cache.move_to_end(digest)
+            self.hits += 1
+            return claims
+
+    def _store(self, digest: str, claims: Dict[str, Any]):
+        exp = claims.get("exp")
+        if not isinstance(exp, (int, float)) or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._cache[digest] = (claims, float(exp))
+            self._cache.move_to_end(digest)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def verify(self, token: str) -> Dict[str, Any]:
+        """Возвращает claims проверенного токена или выбрасывает JWTError."""
+        digest = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        claims = self._lookup(digest)
+        if claims is not None:
+            return dict(claims)
+        try:
+            kind = token_kind(token)
+            if kind == KIND_SUPABASE:
+                claims = jwt.decode(token, SUPABASE_JWT_SECRET,
+                                    algorithms=[ALGORITHM], audience="authenticated")
+            else:
+                claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            with self._lock:
+                self.failures += 1
+            raise
+        with self._lock:
+            self.verified[kind] += 1
+        self._store(digest, claims)
+        return dict(claims)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._cache),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "failures": self.failures,
+                "verified": dict(self.verified),
+            }
+
+
+# Глобальный кэш проверенных токенов
+token_verifier = TokenVerifier(TOKEN_CACHE_SIZE)
@@ -0,0 +1,166 @@
+# warmup.py
+"""Прогрев после деплоя или простоя и состояние готовности экземпляра.
+
+Прогрев выполняется в фоне после старта:
+- открывает DB_POOL_WARM_CONNECTIONS соединений в каждом пуле БД;
+- запускает процессы CPU-пула и загружает в них pandas, fuzzywuzzy, docxtpl
+  и скомпилированные шаблоны .docx;
+- выполняет запрос каталога товаров (прогрев кэша запросов SQLAlchemy и страниц БД);
+- загружает в основной процесс реестр шаблонов и лениво импортируемые модули.
+
+Состояние каждого шага хранится в warmup_state и отдаётся через /health/ready.
+"""
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+PENDING, OK, ERROR = "pending", "ok", "error"
+
+
+class WarmupState:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._components: Dict[str, Dict[str, Any]] = {}
+
+    def set(self, name: str, status: str, **details):
+        with self._lock:
+            self._components[name] = {"status": status, **details}
+
+    def run(self, name: str, fn: Callable, *args):
+        """Выполняет шаг прогрева, записывая статус и длительность. Ошибка шага не прерывает остальные."""
+        started = time.perf_counter()
+        try:
+            result = fn(*args)
+        except Exception as e:
+            logger.error(f"Прогрев '{name}' не удался: {e}")
+            self.set(name, ERROR, error=str(e), seconds=round(time.perf_counter() - started, 3))
+            return None
+        self.set(name, OK, seconds=round(time.perf_counter() - started, 3), **(result or {}))
+        return result
+
+    async def run_async(self, name: str, coro_fn: Callable, *args):
+        started = time.perf_counter()
+        try:
+            result = await coro_fn(*args)
+        except Exception as e:
+            logger.error(f"Прогрев '{name}' не удался: {e}")
+            self.set(name, ERROR, error=str(e), seconds=round(time.perf_counter() - started, 3))
+            return None
+        self.set(name, OK, seconds=round(time.perf_counter() - started, 3), **(result or {}))
+        return result
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {name: dict(info) for name, info in self._components.items()}
+
+    def clear(self):
+        with self._lock:
+            self._components.clear()
+
+
+def warm_worker_process() -> Dict[str, Any]:
+    """Выполняется в процессе CPU-пула: загружает тяжёлые модули и компилирует шаблоны."""
+    import pandas  # noqa: F401
+    from fuzzywuzzy import process  # noqa: F401
+    import docx_render  # noqa: F401
+    from docx_templates import template_registry
+
+    templates = template_registry.preload()
+    for name in templates:
+        template_registry.get(name).body_template
+    return {"templates": templates}
+
+
+def warm_cpu_pool() -> Dict[str, Any]:
+    from executors import cpu_pool
+
+    pool = cpu_pool()
+    futures = [pool.submit(warm_worker_process) for _ in range(pool.max_workers)]
+    templates: List[str] = []
+    for future in futures:
+        templates = future.result()["templates"]
+    return {"workers": pool.max_workers, "templates": templates}
+
+
+def warm_templates() -> Dict[str, Any]:
+    from docx_templates import template_registry
+
+    return {"templates": template_registry.preload()}
+
+
+def warm_lazy_imports() -> Dict[str, Any]:
+    """Модули, которые основной процесс импортирует лениво (вход через Supabase, КП, AI-чат)."""
+    import importlib
+    import config
+
+    modules = ["num2words", "supabase"]
+    if config.GEMINI_API_KEY:
+        modules.append("google.generativeai")
+    for module in modules:
+        importlib.import_module(module)
+    return {"modules": modules}
+
+
+def warm_sync_pool(engine, connections: int) -> Dict[str, Any]:
+    if engine.dialect.name == "sqlite":
+        connections = 1
+    opened = [engine.connect() for _ in range(max(1, connections))]
+    try:
+        for conn in opened:
+            conn.execute(text("SELECT 1"))
+    finally:
+        for conn in opened:
+            conn.close()
+    return {"connections": len(opened)}
+
+
+async def warm_async_pool(async_engine, connections: int) -> Dict[str, Any]:
+    if async_engine.dialect.name == "sqlite":
+        connections = 1
+    opened = []
+    try:
+        for _ in range(max(1, connections)):
+            conn = await async_engine.connect()
+            opened.append(conn)
+            await conn.execute(text("SELECT 1"))
+    finally:
+        for conn in opened:
+            await conn.close()
+    return {"connections": len(opened)}
+
+
+def warm_catalog(engine) -> Dict[str, Any]:
+    from sqlmodel import Session, select
+    from main_models import Product
+
+    with Session(engine) as session:
+        products = session.exec(select(Product).where(Product.is_deleted == False)).all()
+    return {"products": len(products)}
+
+
+async def warm_up(engine, async_engine, connections: int):
+    """Полный прогрев; шаги независимы и выполняются параллельно."""
+    from executors import run_in_thread
+
+    for name in ("db_pool", "async_db_pool", "templates", "cpu_pool", "catalog", "lazy_imports"):
+        warmup_state.set(name, PENDING)
+    started = time.perf_counter()
+    await asyncio.gather(
+        run_in_thread(warmup_state.run, "db_pool", warm_sync_pool, engine, connections),
+        warmup_state.run_async("async_db_pool", warm_async_pool, async_engine, connections),
+        run_in_thread(warmup_state.run, "templates", warm_templates),
+        run_in_thread(warmup_state.run, "cpu_pool", warm_cpu_pool),
+        run_in_thread(warmup_state.run, "catalog", warm_catalog, engine),
+        run_in_thread(warmup_state.run, "lazy_imports", warm_lazy_imports),
+    )
+    logger.info(f"Прогрев завершён за {time.perf_counter() - started:.2f} с")
+
+
+# Глобальное состояние прогрева экземпляра
+warmup_state = WarmupState()